@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Deposit Address Pool
+--------------------------------------------
+
+Keeps deposit addresses generated ahead of time by Circle
+(POST /v1/wallets/{id}/addresses) so creating a user's wallet never waits
+on that round trip.
+
+1. One queue of addresses per chain; take() pops one in O(1) without a lock
+2. Once a queue falls below its low watermark, a background thread refills
+   it up to the high watermark in batches of concurrent requests, which go
+   through the CircleClient's rate limiter like any other call
+3. When a queue is empty, take() waits up to `timeout` for the refill and
+   then either generates the address with a direct Circle call (fallback,
+   the default, counted as a miss) or raises PoolExhaustedError
+4. An address is handed out once; the ones still queued when the process
+   stops are simply never used
+
+Wallet addresses are stored as raw bytes of a 0x hex address (records.py),
+so only EVM chains (EVM_CHAINS) can have a queue.
+
+Usage:
+    address_pool = AddressPool(circle_client, PICPAY_WALLET_ID, low=200, high=1000).start()
+    service = PicPayUSDCService(circle_client, address_pool=address_pool)
+    ...
+    address_pool.stop()
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, Optional
+
+from records import address_bytes
+
+
+# Circle chains whose addresses are 0x-prefixed hex
+EVM_CHAINS = frozenset({"ETH", "AVAX", "MATIC", "ARB", "BASE", "OP", "CELO", "UNI"})
+
+
+class PoolExhaustedError(Exception):
+    """No pre-generated address was available in time and fallback is off"""
+
+
+class AddressPool:
+    """Background-filled queues of deposit addresses, one per chain"""
+
+    def __init__(self,
+                 circle_client,
+                 wallet_id: str,
+                 chains: Iterable[str] = ("ETH",),
+                 currency: str = "USD",
+                 low: int = 100,
+                 high: int = 1000,
+                 batch: int = 50,
+                 workers: int = 8,
+                 fallback: bool = True,
+                 timeout: float = 0.0,
+                 retry_delay: float = 1.0):
+        """
+        Args:
+            circle_client: CircleClient used to generate the addresses
+            wallet_id: Circle wallet the addresses are generated for
+            chains: Chains with a queue of their own (EVM chains only)
+            currency: Currency the addresses receive
+            low: Refill a queue once it holds fewer addresses than this
+            high: Refill it up to this many
+            batch: Addresses requested per refill step
+            workers: Requests of a step sent in parallel
+            fallback: Generate an address directly when a queue is empty
+                (else raise PoolExhaustedError)
+            timeout: Seconds take() waits for the refill before that
+            retry_delay: Pause after a refill step failed
+        """
+        if not 0 <= low <= high:
+            raise ValueError("Watermarks must satisfy 0 <= low <= high")
+        self.circle_client = circle_client
+        self.wallet_id = wallet_id
+        self.chains = tuple(chains)
+        unsupported = sorted(set(self.chains) - EVM_CHAINS)
+        if unsupported:
+            raise ValueError(f"Addresses of non-EVM chains cannot be stored: {', '.join(unsupported)}")
+        self.currency = currency
+        self.low = low
+        self.high = high
+        self.batch = batch
+        self.fallback = fallback
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        # Best-effort counters: updated without a lock to keep take() lock-free
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "fallbacks": 0, "exhausted": 0, "generated": 0,
+                      "refills": 0, "refill_errors": 0}
+
+        self._queues: Dict[str, Deque[bytes]] = {chain: deque() for chain in self.chains}
+        self._refilled = threading.Condition()  # Notified after every refill step
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="address-refill")
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Reads
+
+    def take(self, chain: str = "ETH", timeout: Optional[float] = None) -> bytes:
+        """Return an unused deposit address for a chain
+
+        A queued address is a hit. An empty queue wakes the refiller and
+        waits up to timeout (the pool's by default) for it, then falls back
+        to a direct Circle call or raises PoolExhaustedError.
+        """
+        queue = self._queues[chain]
+        try:
+            address = queue.popleft()
+        except IndexError:
+            return self._miss(chain, self.timeout if timeout is None else timeout)
+        self.stats["hits"] += 1
+        if len(queue) < self.low:
+            self._wakeup.set()
+        return address
+
+    def _miss(self, chain: str, timeout: float) -> bytes:
+        self.stats["misses"] += 1
+        self._wakeup.set()
+        queue = self._queues[chain]
+        if timeout > 0:
+            self.stats["waits"] += 1
+            deadline = time.monotonic() + timeout
+            with self._refilled:
+                while True:
+                    try:
+                        return queue.popleft()
+                    except IndexError:
+                        pass
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._stop.is_set():
+                        break
+                    self._refilled.wait(remaining)
+        if not self.fallback:
+            self.stats["exhausted"] += 1
+            raise PoolExhaustedError(f"No {chain} deposit address available")
+        self.stats["fallbacks"] += 1
+        return self._generate(chain)
+
+    def available(self, chain: str = "ETH") -> int:
+        """Addresses queued for a chain"""
+        return len(self._queues[chain])
+
+    # Refill
+
+    def _generate(self, chain: str) -> bytes:
+        response = self.circle_client.create_deposit_address(self.wallet_id, self.currency, chain)
+        self.stats["generated"] += 1
+        return address_bytes(response.get("data", response)["address"])
+
+    def refill(self, chain: str) -> int:
+        """Generate one batch of addresses for a chain (at most up to the high
+        watermark); returns how many were added"""
+        queue = self._queues[chain]
+        wanted = min(self.batch, self.high - len(queue))
+        if wanted <= 0:
+            return 0
+        added = 0
+        try:
+            for address in self._executor.map(lambda _: self._generate(chain), range(wanted)):
+                queue.append(address)
+                added += 1
+        except Exception:
+            self.stats["refill_errors"] += 1
+            raise
+        finally:
+            # Whatever arrived before a failure is kept
+            with self._refilled:
+                self._refilled.notify_all()
+        self.stats["refills"] += 1
+        return added
+
+    def fill(self):
+        """Fill every queue up to the high watermark from this thread"""
+        for chain in self.chains:
+            while len(self._queues[chain]) < self.high:
+                self.refill(chain)
+
+    def _run(self):
+        refilling = set()  # Chains that went below low and have not reached high yet
+        while not self._stop.is_set():
+            for chain in self.chains:
+                if len(self._queues[chain]) < self.low:
+                    refilling.add(chain)
+            if not refilling:
+                self._wakeup.clear()
+                # A take() may have emptied a queue between the check and the clear
+                if not any(len(self._queues[chain]) < self.low for chain in self.chains):
+                    self._wakeup.wait()
+                continue
+            for chain in list(refilling):
+                try:
+                    self.refill(chain)
+                except Exception:
+                    # Keep what is queued; retry after a short pause
+                    self._stop.wait(self.retry_delay)
+                if len(self._queues[chain]) >= self.high:
+                    refilling.discard(chain)
+
+    def start(self) -> "AddressPool":
+        """Start the background refiller thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="address-pool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background refiller"""
+        self._stop.set()
+        self._wakeup.set()
+        with self._refilled:
+            self._refilled.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Async Circle API Client
+-----------------------------------------------
+
+Asyncio counterpart of CircleClient in demo_code_example_en.py.
+
+Requests go through a single aiohttp connector that keeps HTTP/1.1
+connections alive and caps the number of requests in flight per host, so one
+process can keep hundreds of transfers outstanding without opening a new
+connection (and TLS handshake) for each of them.
+
+As in CircleClient, every request has a (connect, read) timeout, endpoints
+can have circuit breakers (resilience.py), and money-moving requests take
+an operation_id whose idempotency key (and, with an idempotency_store,
+cached response, returned as a ReplayedResponse) is shared with the sync
+client.
+
+Usage:
+    async with AsyncCircleClient(API_KEY, BASE_URL, limit_per_host=200) as client:
+        results = await asyncio.gather(*(client.mint_usdc(10.0, addr, operation_id=f"mint:{order}")
+                                         for addr, order in orders))
+"""
+
+import uuid
+import asyncio
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple, Union
+
+import aiohttp
+
+from demo_code_example_en import history_params, mint_payload, redeem_payload, transfer_payload
+from idempotency import IdempotencyStore, derive_idempotency_key
+
+if TYPE_CHECKING:
+    from resilience import CircuitBreakers
+
+
+class AsyncCircleClient:
+    """Asyncio client for interacting with Circle APIs"""
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str,
+                 limit_per_host: int = 100,
+                 keepalive_timeout: float = 30.0,
+                 timeout: Union[float, Tuple[float, float]] = (3.05, 10.0),
+                 breakers: Optional["CircuitBreakers"] = None,
+                 idempotency_store: Optional[IdempotencyStore] = None):
+        """
+        Args:
+            api_key: Circle API key
+            base_url: Circle API base URL
+            limit_per_host: Maximum concurrent requests (and open connections) per host
+            keepalive_timeout: Seconds an idle pooled connection is kept open
+            timeout: (connect, read) seconds for every request, as in
+                CircleClient; waiting for a free pooled connection is not counted
+            breakers: Per-endpoint circuit breakers, can be shared with sync clients
+            idempotency_store: Keys and results per operation_id
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.breakers = breakers
+        self.idempotency_store = idempotency_store
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncCircleClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled session, created lazily so it binds to the running event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+            self._session = aiohttp.ClientSession(
+                headers=self.headers, connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read))
+        return self._session
+
+    async def close(self):
+        """Close the session and every pooled connection"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _generate_idempotency_key(self, operation_id: Optional[str] = None) -> str:
+        """Generate an idempotency key for API requests (as CircleClient does)"""
+        if operation_id is not None:
+            return derive_idempotency_key(operation_id)
+        return str(uuid.uuid4())
+
+    async def _post_once(self, operation_id: Optional[str], endpoint: str, path: str,
+                         build_payload: Callable[[str], Dict]) -> Dict:
+        """POST a money-moving request under its operation's idempotency key
+        (see CircleClient._post_once); the store is used from a worker
+        thread so its SQLite commits never block the event loop"""
+        store = self.idempotency_store
+        if store is None or operation_id is None:
+            payload = build_payload(self._generate_idempotency_key(operation_id))
+            return await self._request("POST", endpoint, path, json=payload)
+
+        loop = asyncio.get_running_loop()
+        key, result = await loop.run_in_executor(None, store.begin, operation_id)
+        if result is not None:
+            return result
+        try:
+            result = await self._request("POST", endpoint, path, json=build_payload(key))
+        except aiohttp.ClientResponseError as e:
+            if 400 <= e.status < 500 and e.status != 429:
+                await loop.run_in_executor(None, store.forget, operation_id)
+            raise
+        await loop.run_in_executor(None, store.complete, operation_id, result)
+        return result
+
+    async def _request(self, method: str, endpoint: str, path: str, **kwargs) -> Dict:
+        """Send a request; endpoint (e.g. "POST /v1/transfers") names its
+        circuit breaker, which counts timeouts, connection errors and 5xx
+        answers as failures"""
+        breaker = self.breakers.get(endpoint) if self.breakers is not None else None
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                if breaker is not None:
+                    if response.status >= 500:
+                        breaker.on_failure()
+                    else:
+                        breaker.on_success()
+                    breaker = None
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # Errors after the headers arrived were already counted by status
+            if breaker is not None:
+                breaker.on_failure()
+            raise
+
+    async def get_wallet_balance(self, wallet_id: str) -> Dict:
+        """Get the balance of a specific wallet"""
+        return await self._request("GET", "GET /v1/businessAccount/wallets/{id}/balances",
+                                   f"/v1/businessAccount/wallets/{wallet_id}/balances")
+
+    async def mint_usdc(self, amount_usd: float, destination_address: str,
+                        operation_id: Optional[str] = None) -> Dict:
+        """Mint USDC from USD and send to destination address (operation_id
+        as in CircleClient.mint_usdc)"""
+        return await self._post_once(operation_id, "POST /v1/businessAccount/transfers",
+                                     "/v1/businessAccount/transfers",
+                                     lambda key: mint_payload(key, amount_usd, destination_address))
+
+    async def redeem_usdc(self, amount_usdc: float, blockchain_address: str,
+                          operation_id: Optional[str] = None) -> Dict:
+        """Redeem USDC to USD by transferring from blockchain to wallet"""
+        return await self._post_once(operation_id, "POST /v1/businessAccount/transfers",
+                                     "/v1/businessAccount/transfers",
+                                     lambda key: redeem_payload(key, amount_usdc, blockchain_address))
+
+    async def create_transfer(self,
+                              source_wallet_id: str,
+                              destination_wallet_id: str,
+                              amount: float,
+                              currency: str,
+                              operation_id: Optional[str] = None) -> Dict:
+        """Create a transfer between wallets"""
+        return await self._post_once(operation_id, "POST /v1/transfers", "/v1/transfers",
+                                     lambda key: transfer_payload(key, source_wallet_id, destination_wallet_id,
+                                                                  amount, currency))
+
+    async def get_transfer_status(self, transfer_id: str) -> Dict:
+        """Get the status of a transfer"""
+        return await self._request("GET", "GET /v1/transfers/{id}", f"/v1/transfers/{transfer_id}")
+
+    async def list_transfers(self,
+                             from_date: Optional[str] = None,
+                             to_date: Optional[str] = None,
+                             page_size: int = 50,
+                             page_before: Optional[str] = None,
+                             page_after: Optional[str] = None) -> Dict:
+        """List one page of the account's transfers (newest first)"""
+        return await self._request("GET", "GET /v1/transfers", "/v1/transfers",
+                                   params=history_params(from_date, to_date, page_size, page_before, page_after))
+
+    async def get_transaction_history(self, wallet_id: str,
+                                      from_date: Optional[str] = None,
+                                      to_date: Optional[str] = None,
+                                      page_size: int = 50,
+                                      page_before: Optional[str] = None,
+                                      page_after: Optional[str] = None) -> Dict:
+        """Get one page of transaction history for a wallet (newest first)"""
+        return await self._request("GET", "GET /v1/wallets/{id}/transactions",
+                                   f"/v1/wallets/{wallet_id}/transactions",
+                                   params=history_params(from_date, to_date, page_size, page_before, page_after))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Balance Read View
+-----------------------------------------
+
+Serves get_user_balance (the app's home screen) from memory: each user's
+answer is built when their balance changes, not when it is read.
+
+1. BalanceView wraps the WalletLedger the service writes to, so every
+   create_wallet / adjust_balance also rebuilds that user's entry; HoldBook
+   reports held amounts through set_held()
+2. An entry holds the finished response, including the BRL equivalent and
+   the time of the change, as a read-only mapping; a read is a dict lookup
+   that returns it as is, with no lock, no copy and no Circle call
+3. A rate change (refresh_rate() polls rate_source, set_rate() pushes one)
+   bumps a version; entries built at an older rate are converted again on
+   their next read, so a new rate costs nothing up front
+4. A background thread refreshes the rate every rate_interval seconds and,
+   every reconcile_interval seconds, compares each entry with the ledger
+   (repairing the ones that drifted, e.g. after a change made to the ledger
+   directly) and, with a circle_client, fetches the omnibus wallet's
+   balance at Circle next to the sum of the users' balances
+
+Entries are built on a user's first read or change and stay in memory.
+
+Usage:
+    balance_view = BalanceView(SQLiteLedger("wallets.db"), circle_client, PICPAY_WALLET_ID).start()
+    service = PicPayUSDCService(circle_client, balance_view=balance_view)
+    service.get_user_balances(["alice_123", "bob_456"])
+    ...
+    balance_view.stop()
+"""
+
+import threading
+from datetime import datetime
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple, Union
+
+from money import Money, Rate, converter
+from records import WalletRecord
+from wallet_ledger import InMemoryLedger, WalletLedger
+
+
+class BalanceView(WalletLedger):
+    """get_user_balance answers kept current by the ledger's writes"""
+
+    def __init__(self,
+                 ledger: Optional[WalletLedger] = None,
+                 circle_client=None,
+                 wallet_id: Optional[str] = None,
+                 rate_source: Optional[Callable[[], float]] = None,
+                 rate_interval: float = 1.0,
+                 reconcile_interval: float = 60.0):
+        """
+        Args:
+            ledger: The ledger written through the view (an InMemoryLedger by default)
+            circle_client: CircleClient used to fetch the omnibus balance when reconciling
+            wallet_id: Circle wallet holding the users' USDC
+            rate_source: Returns the current USD -> BRL rate; PicPayUSDCService
+                sets its own rates when this is None
+            rate_interval: Seconds between two rate refreshes
+            reconcile_interval: Seconds between two reconciliations
+        """
+        self.ledger = ledger if ledger is not None else InMemoryLedger()
+        self.circle_client = circle_client
+        self.wallet_id = wallet_id
+        self.rate_source = rate_source
+        self.rate_interval = rate_interval
+        self.reconcile_interval = reconcile_interval
+        # Best-effort counters: updated without a lock to keep reads lock-free
+        self.stats = {"reads": 0, "misses": 0, "updates": 0, "rate_changes": 0, "reconciliations": 0,
+                      "repaired": 0, "reconcile_errors": 0}
+        # Totals of the last reconciliation
+        self.reconciliation: Dict = {}
+
+        self._entries: Dict[str, Tuple[int, Mapping]] = {}  # user_id -> (rate version, response)
+        self._held: Dict[str, int] = {}  # user_id -> units on hold, as HoldBook reported them
+        self._rate = None
+        self._converter = None
+        self._version = 0
+        self._lock = threading.Lock()  # Serialises entry writes; reads never take it
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if rate_source is not None:
+            self.refresh_rate()
+
+    # Reads
+
+    def get(self, user_id: str) -> Optional[Mapping]:
+        """The user's balance response (read-only), or None if they have no wallet"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != self._version:
+            entry = self._load(user_id)
+            if entry is None:
+                return None
+        self.stats["reads"] += 1
+        return entry[1]
+
+    def get_many(self, user_ids: Iterable[str]) -> Dict[str, Mapping]:
+        """Balance responses keyed by user id; users without a wallet are left out"""
+        entries = self._entries
+        version = self._version
+        balances = {}
+        for user_id in user_ids:
+            entry = entries.get(user_id)
+            if entry is None or entry[0] != version:
+                entry = self._load(user_id)
+                if entry is None:
+                    continue
+            balances[user_id] = entry[1]
+        self.stats["reads"] += len(balances)
+        return balances
+
+    def _load(self, user_id: str) -> Optional[Tuple[int, Mapping]]:
+        """Build a missing entry from the ledger, or convert a stale one at the current rate"""
+        self.stats["misses"] += 1
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[0] != self._version:
+                    balance = entry[1]
+                    entry = self._entries[user_id] = (self._version, MappingProxyType({
+                        **balance, "balance_brl_equivalent": self._brl(balance["balance_usdc"])}))
+                return entry
+            wallet = self.ledger.get_wallet(user_id)
+            if wallet is None:
+                return None
+            return self._update(user_id, wallet)
+
+    def _brl(self, balance_usdc: Money) -> Money:
+        if self._converter is None:
+            raise ValueError("BalanceView has no rate yet; call set_rate() or refresh_rate()")
+        return self._converter(balance_usdc)
+
+    def _update(self, user_id: str, wallet: WalletRecord) -> Tuple[int, Mapping]:
+        """Rebuild a user's entry (caller holds self._lock)"""
+        balance_usdc = wallet.balance_usdc
+        entry = self._entries[user_id] = (self._version, MappingProxyType({
+            "user_id": user_id,
+            "balance_usdc": balance_usdc,
+            "held_usdc": Money(self._held.get(user_id, 0), "USDC"),
+            "balance_brl_equivalent": self._brl(balance_usdc),
+            "wallet_address": wallet.wallet_address,
+            "timestamp": datetime.now().isoformat()
+        }))
+        self.stats["updates"] += 1
+        return entry
+
+    # Writes (callers hold the user's lock, as with any WalletLedger). The
+    # ledger is written under self._lock too, so reconcile() never sees a
+    # ledger change whose entry update has not happened yet
+
+    def get_wallet(self, user_id: str) -> Optional[WalletRecord]:
+        return self.ledger.get_wallet(user_id)
+
+    def create_wallet(self, user_id: str, address: bytes, created_us: int) -> WalletRecord:
+        with self._lock:
+            wallet = self.ledger.create_wallet(user_id, address, created_us)
+            self._update(user_id, wallet)
+        return wallet
+
+    def adjust_balance(self, user_id: str, delta_units: int) -> int:
+        with self._lock:
+            balance_units = self.ledger.adjust_balance(user_id, delta_units)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._update(user_id, self.ledger.get_wallet(user_id))
+            else:
+                balance_usdc = Money(balance_units, "USDC")
+                self._entries[user_id] = (self._version, MappingProxyType({
+                    **entry[1], "balance_usdc": balance_usdc, "balance_brl_equivalent": self._brl(balance_usdc),
+                    "timestamp": datetime.now().isoformat()}))
+                self.stats["updates"] += 1
+        return balance_units
+
+    def set_held(self, user_id: str, held_units: int):
+        """Record the units now on hold for a user (HoldBook's on_change)"""
+        with self._lock:
+            if held_units:
+                self._held[user_id] = held_units
+            else:
+                self._held.pop(user_id, None)
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries[user_id] = (entry[0], MappingProxyType({**entry[1],
+                                                                      "held_usdc": Money(held_units, "USDC")}))
+
+    def find_user_by_address(self, wallet_address: Union[str, bytes]) -> Optional[str]:
+        return self.ledger.find_user_by_address(wallet_address)
+
+    def __len__(self) -> int:
+        return len(self.ledger)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries or user_id in self.ledger
+
+    def warm(self) -> int:
+        return self.ledger.warm()
+
+    def flush(self):
+        self.ledger.flush()
+
+    def close(self):
+        self.stop()
+        self.ledger.close()
+
+    # Rates
+
+    def set_rate(self, rate: Union[Rate, float, str]):
+        """Use a new USD -> BRL rate; entries are converted again as they are read"""
+        rate = Rate.parse(rate)
+        with self._lock:
+            if rate == self._rate:
+                return
+            self._rate = rate
+            self._converter = converter(rate, "USDC", "BRL")
+            self._version += 1
+        self.stats["rate_changes"] += 1
+
+    def refresh_rate(self):
+        """Take the rate from rate_source"""
+        self.set_rate(self.rate_source())
+
+    # Reconciliation
+
+    def reconcile(self) -> Dict:
+        """Check every entry against the ledger, repairing the ones that
+        differ, and compare the users' total with Circle's omnibus balance"""
+        checked = repaired = 0
+        view_units = 0
+        for user_id in list(self._entries):
+            with self._lock:
+                wallet = self.ledger.get_wallet(user_id)
+                entry = self._entries.get(user_id)
+                if wallet is None or entry is None:
+                    continue
+                balance = entry[1]
+                if (balance["balance_usdc"].units != wallet.balance_units
+                        or balance["wallet_address"] != wallet.wallet_address):
+                    self._update(user_id, wallet)
+                    repaired += 1
+            checked += 1
+            view_units += wallet.balance_units + self._held.get(user_id, 0)
+        report = {"at": datetime.now().isoformat(), "checked": checked, "repaired": repaired,
+                  "view_usdc": Money(view_units, "USDC")}
+        if self.circle_client is not None and self.wallet_id is not None:
+            response = self.circle_client.get_wallet_balance(self.wallet_id)
+            available = response.get("data", response).get("available", [])
+            circle_units = sum(Money.parse(item["amount"], "USDC").units for item in available
+                               if item["currency"] in ("USD", "USDC"))
+            report["circle_usdc"] = Money(circle_units, "USDC")
+            report["drift_usdc"] = Money(circle_units - view_units, "USDC")
+        self.reconciliation = report
+        self.stats["reconciliations"] += 1
+        self.stats["repaired"] += repaired
+        return report
+
+    def _run(self):
+        since_reconcile = 0.0
+        while not self._stop.wait(self.rate_interval):
+            since_reconcile += self.rate_interval
+            try:
+                if self.rate_source is not None:
+                    self.refresh_rate()
+                if since_reconcile >= self.reconcile_interval:
+                    since_reconcile = 0.0
+                    self.reconcile()
+            except Exception:
+                # Keep serving the entries we have; try again next round
+                self.stats["reconcile_errors"] += 1
+
+    def start(self) -> "BalanceView":
+        """Start the background rate refresher and reconciler"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="balance-view", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Benchmark: deposit address pool
+-------------------------------
+
+Onboards users (create_user_wallet) against a local CircleSimulator whose
+POST /v1/wallets/{id}/addresses takes --address-latency-ms, with --callers
+threads and addresses requested through a RateLimiter allowing --rate
+requests per second:
+
+1. Without a pool: every new wallet asks Circle for its address
+2. With an AddressPool filled up front (--high addresses), refilled in the
+   background from --low in batches of --batch
+
+and reports onboardings per second, p50/p99/max latency and the pool's
+misses. Then exhaustion: a burst larger than the pool with fallback off
+(PoolExhaustedError after --timeout), the same burst with fallback on
+(direct Circle calls), and the refill back to the high watermark. Last, a
+payment to a user without a wallet on an empty pool, checking that the
+direct Circle call is not made under either user's lock.
+
+Exits with status 1 if an address was handed out twice, the pool's p99 is
+not below the no-pool p50, the exhaustion cases behave otherwise than
+described, the pool does not get back to --high, or a Circle call is made
+under a user's lock.
+
+Usage:
+    python bench_address_pool.py --users 1000 --callers 16 --address-latency-ms 150
+"""
+
+import sys
+import time
+import argparse
+import threading
+
+from address_pool import AddressPool, PoolExhaustedError
+from circle_simulator import CircleSimulator
+from demo_code_example_en import PICPAY_WALLET_ID, CircleClient, PicPayUSDCService
+from rate_limiter import RateLimiter
+
+ENDPOINT = "POST /v1/wallets/{id}/addresses"
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def onboard(service: PicPayUSDCService, users: int, callers: int, prefix: str):
+    """Returns (elapsed seconds, sorted latencies, addresses handed out)"""
+    latencies = [[] for _ in range(callers)]
+    addresses = [[] for _ in range(callers)]
+
+    def caller(n: int):
+        for i in range(n, users, callers):
+            start = time.perf_counter()
+            wallet = service.create_user_wallet(f"{prefix}_{i}")
+            latencies[n].append(time.perf_counter() - start)
+            addresses[n].append(wallet.address)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start, sorted(latency for caller in latencies for latency in caller),
+            [address for caller in addresses for address in caller])
+
+
+def burst(pool: AddressPool, takers: int, timeout: float):
+    """takers threads each take one address; returns (addresses, exhausted count)"""
+    addresses, exhausted = [], []
+
+    def taker():
+        try:
+            addresses.append(pool.take(timeout=timeout))
+        except PoolExhaustedError:
+            exhausted.append(1)
+
+    threads = [threading.Thread(target=taker) for _ in range(takers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return addresses, len(exhausted)
+
+
+class LockProbe:
+    """Delegates to a CircleClient; records whether the watched users' locks
+    were free while a deposit address was requested"""
+
+    def __init__(self, client: CircleClient, locks, user_ids):
+        self.client = client
+        self.locks = locks
+        self.user_ids = user_ids
+        self.held = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def create_deposit_address(self, *args, **kwargs):
+        for user_id in self.user_ids:
+            def acquire():
+                with self.locks.hold(user_id):
+                    pass
+            thread = threading.Thread(target=acquire, daemon=True)
+            thread.start()
+            thread.join(1.0)
+            if thread.is_alive():
+                self.held.append(user_id)
+        return self.client.create_deposit_address(*args, **kwargs)
+
+
+def row(label: str, users: int, elapsed: float, latencies, misses: str) -> str:
+    return (f"  {label:<28} {users / elapsed:>10.1f} {percentile(latencies, 50) * 1000:>8.2f}ms "
+            f"{percentile(latencies, 99) * 1000:>8.2f}ms {latencies[-1] * 1000:>8.2f}ms {misses:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--address-latency-ms", type=float, default=150.0)
+    parser.add_argument("--rate", type=float, default=200.0, help="Address requests per second")
+    parser.add_argument("--low", type=int, default=300)
+    parser.add_argument("--high", type=int, default=1200)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--burst", type=int, default=300, help="Takers of the exhaustion runs")
+    parser.add_argument("--timeout", type=float, default=0.05, help="take() wait of the exhaustion runs")
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms, seed=1,
+                                endpoint_latency_ms={"POST /v1/wallets/{wallet_id}/addresses":
+                                                     args.address_latency_ms})
+    base_url = simulator.start_in_process()
+    errors = []
+    try:
+        client = CircleClient("BENCH_API_KEY", base_url,
+                              rate_limiter=RateLimiter(rate=1000.0, endpoint_rates={ENDPOINT: args.rate}))
+
+        # No pool: low = high = 0, so every take() is a direct Circle call
+        direct = AddressPool(client, PICPAY_WALLET_ID, low=0, high=0, workers=1)
+        service = PicPayUSDCService(client, address_pool=direct)
+        without = onboard(service, args.users, args.callers, "direct")
+        service.close()
+        direct.stop()
+
+        pool = AddressPool(client, PICPAY_WALLET_ID, low=args.low, high=args.high, batch=args.batch,
+                           workers=args.workers)
+        start = time.perf_counter()
+        pool.fill()
+        filled = time.perf_counter() - start
+        pool.start()
+        service = PicPayUSDCService(client, address_pool=pool)
+        pooled = onboard(service, args.users, args.callers, "pooled")
+        service.close()
+        pool.stop()
+
+        print(f"Onboarding: {args.users} users from {args.callers} threads, {args.address_latency_ms:g}ms per "
+              f"address request, at most {args.rate:g} requests/s")
+        print(f"  {'':<28} {'users/s':>10} {'p50':>10} {'p99':>10} {'max':>10} {'misses':>8}")
+        print(row("Circle call per wallet", args.users, *without[:2], "-"))
+        print(row(f"pool (low {args.low}, high {args.high})", args.users, *pooled[:2],
+                  str(pool.stats["misses"])))
+        print(f"  pool filled with {args.high} addresses in {filled:.2f}s; {pool.stats}")
+
+        handed_out = without[2] + pooled[2]
+        if len(set(handed_out)) != len(handed_out):
+            errors.append(f"{len(handed_out) - len(set(handed_out))} addresses handed out twice")
+        if percentile(pooled[1], 99) >= percentile(without[1], 50):
+            errors.append("the pool's p99 is not below the p50 without it")
+
+        # Exhaustion
+        size = args.burst // 3
+        strict = AddressPool(client, PICPAY_WALLET_ID, low=size, high=size, batch=args.batch,
+                             workers=args.workers, fallback=False)
+        strict.fill()
+        taken, exhausted = burst(strict, args.burst, args.timeout)
+        print(f"Exhaustion: {args.burst} takers, {size} queued, refill stopped")
+        print(f"  fallback off: {len(taken)} addresses, {exhausted} PoolExhaustedError after {args.timeout:g}s")
+        if len(taken) != size or exhausted != args.burst - size:
+            errors.append(f"fallback off: {len(taken)} taken and {exhausted} refused instead of "
+                          f"{size} and {args.burst - size}")
+        strict.stop()
+
+        lenient = AddressPool(client, PICPAY_WALLET_ID, low=size, high=size, batch=args.batch,
+                              workers=args.workers)
+        lenient.fill()
+        start = time.perf_counter()
+        taken, exhausted = burst(lenient, args.burst, 0.0)
+        print(f"  fallback on:  {len(taken)} addresses ({lenient.stats['fallbacks']} from direct calls) in "
+              f"{time.perf_counter() - start:.2f}s")
+        if len(taken) != args.burst or lenient.stats["fallbacks"] != args.burst - size:
+            errors.append(f"fallback on: {len(taken)} taken, {lenient.stats['fallbacks']} direct calls")
+        if len(set(taken)) != len(taken):
+            errors.append("the fallback burst handed out an address twice")
+
+        lenient.start()
+        start = time.perf_counter()
+        while lenient.available() < size and time.perf_counter() - start < 30:
+            time.sleep(0.01)
+        print(f"  refill from empty to {size}: {time.perf_counter() - start:.2f}s "
+              f"({lenient.stats['refills']} batches)")
+        if lenient.available() != size:
+            errors.append(f"the pool holds {lenient.available()} addresses after the refill instead of {size}")
+        lenient.stop()
+
+        # A pool miss during a payment: the address is fetched before the locks are taken
+        service = PicPayUSDCService(client)
+        probe = LockProbe(client, service.locks, ("payer", "payee"))
+        empty = AddressPool(probe, PICPAY_WALLET_ID, low=0, high=0, workers=1)
+        service.address_pool = empty
+        service.create_user_wallet("payer")
+        with service.locks.hold("payer"):
+            service.ledger.adjust_balance("payer", 10 ** 6)
+        service.send_international_payment("payer", "payee", "1")
+        print(f"Pool miss during a payment: {empty.stats['fallbacks']} direct calls, "
+              f"made under the lock of {probe.held or 'nobody'}")
+        if probe.held or empty.stats["fallbacks"] != 2:
+            errors.append(f"direct address calls made under the locks of {probe.held}")
+        service.close()
+        empty.stop()
+    finally:
+        simulator.stop_process()
+
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
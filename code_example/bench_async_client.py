@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark: CircleClient vs AsyncCircleClient
+--------------------------------------------
+
+Sends the same number of create_transfer calls through the blocking client
+and through the asyncio client against a local CircleSimulator and reports
+requests/sec for each.
+
+Then checks the async client's safeguards: a transfer retried under its
+operation_id with an idempotency store is answered from the store (a
+ReplayedResponse), and against a Circle slower than the read timeout the
+requests time out until the endpoint's circuit opens and fails fast.
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python bench_async_client.py --requests 2000 --latency-ms 20 --concurrency 200
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+from async_circle_client import AsyncCircleClient
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient
+from idempotency import IdempotencyStore, ReplayedResponse
+from resilience import CircuitBreakers, CircuitOpenError
+
+
+def bench_sync(base_url: str, total: int) -> float:
+    client = CircleClient("BENCH_API_KEY", base_url)
+    start = time.perf_counter()
+    for i in range(total):
+        client.create_transfer("wallet-a", "wallet-b", 1.0, "USD")
+    return total / (time.perf_counter() - start)
+
+
+async def bench_async(base_url: str, total: int, concurrency: int) -> float:
+    async with AsyncCircleClient("BENCH_API_KEY", base_url, limit_per_host=concurrency) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client.create_transfer("wallet-a", "wallet-b", 1.0, "USD")
+                               for _ in range(total)))
+        return total / (time.perf_counter() - start)
+
+
+async def check_replay(base_url: str, work: str) -> list:
+    store = IdempotencyStore(os.path.join(work, "idempotency.db"))
+    async with AsyncCircleClient("BENCH_API_KEY", base_url, idempotency_store=store) as client:
+        first = await client.create_transfer("wallet-a", "wallet-b", 1.0, "USD", operation_id="payout:1")
+        again = await client.create_transfer("wallet-a", "wallet-b", 1.0, "USD", operation_id="payout:1")
+    store.close()
+    if isinstance(first, ReplayedResponse) or not isinstance(again, ReplayedResponse) \
+            or again["data"]["id"] != first["data"]["id"]:
+        return ["a retried operation was not answered from the idempotency store"]
+    return []
+
+
+async def check_timeouts(base_url: str, threshold: int) -> list:
+    """base_url answers slower than the client's read timeout"""
+    breakers = CircuitBreakers(failure_threshold=threshold, reset_timeout=60.0)
+    outcomes = []
+    async with AsyncCircleClient("BENCH_API_KEY", base_url, timeout=(1.0, 0.05), breakers=breakers) as client:
+        for _ in range(threshold + 2):
+            try:
+                await client.get_transfer_status("transfer-1")
+                outcomes.append("ok")
+            except asyncio.TimeoutError:
+                outcomes.append("timeout")
+            except CircuitOpenError:
+                outcomes.append("open")
+    print(f"Slow Circle, 50ms read timeout: {outcomes}")
+    if outcomes != ["timeout"] * threshold + ["open"] * 2:
+        return [f"expected {threshold} timeouts then an open circuit, got {outcomes}"]
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--sync-requests", type=int, default=200,
+                        help="Requests for the sync client (it is much slower)")
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms)
+    base_url = simulator.start_in_thread()
+    slow = CircleSimulator(latency_ms=300.0)
+    slow_url = slow.start_in_thread()
+    try:
+        sync_rps = bench_sync(base_url, args.sync_requests)
+        async_rps = asyncio.run(bench_async(base_url, args.requests, args.concurrency))
+        with tempfile.TemporaryDirectory() as work:
+            errors = asyncio.run(check_replay(base_url, work))
+        errors += asyncio.run(check_timeouts(slow_url, 3))
+    finally:
+        simulator.stop_thread()
+        slow.stop_thread()
+
+    print(f"Simulated Circle latency: {args.latency_ms} ms")
+    print(f"CircleClient (sync):        {sync_rps:10.1f} req/s")
+    print(f"AsyncCircleClient (c={args.concurrency}): {async_rps:10.1f} req/s")
+    print(f"Speed-up: {async_rps / sync_rps:.1f}x")
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Benchmark: balance read view
+----------------------------
+
+--users wallets with random balances and open holds, then get_user_balance
+calls on random users:
+
+1. Without a view: ledger lookup, BRL conversion and timestamp per call
+2. With a BalanceView: through PicPayUSDCService.get_user_balance, straight
+   from BalanceView.get, and in batches of --batch through
+   get_user_balances
+
+reported as reads per second on one thread. Then, with a view, balance
+changes, hold commits and releases and a rate change are applied, and
+every answer is compared with what the service computes without it; a
+change made to the ledger behind the view's back must be repaired by
+reconcile(), which also reads the omnibus balance from a local
+CircleSimulator, and writes made through the view while reconcile() runs
+must not be counted as repairs.
+
+Exits with status 1 if BalanceView.get or the batch reads stay below
+--target reads per second, or an answer differs.
+
+Usage:
+    python bench_balance_view.py --users 100000 --reads 1000000 --batch 100
+"""
+
+import sys
+import time
+import random
+import threading
+import argparse
+
+import demo_code_example_en as demo
+from balance_view import BalanceView
+from circle_simulator import CircleSimulator
+from demo_code_example_en import PICPAY_WALLET_ID, CircleClient, PicPayUSDCService
+
+COMPARED = ("user_id", "balance_usdc", "held_usdc", "balance_brl_equivalent", "wallet_address")
+
+
+def populate(service: PicPayUSDCService, users: int, seed: int) -> list:
+    rng = random.Random(seed)
+    holds = []
+    for i in range(users):
+        user_id = f"user_{i}"
+        service.create_user_wallet(user_id)
+        with service.locks.hold(user_id):
+            service.ledger.adjust_balance(user_id, rng.randrange(0, 10 ** 10))
+        if i % 10 == 0:
+            holds.append(service.holds.place(user_id, rng.randrange(1, 10 ** 6)))
+    return holds
+
+
+def rate(label: str, reads: int, elapsed: float) -> float:
+    per_second = reads / elapsed
+    print(f"  {label:<40} {per_second:>12,.0f} reads/s {elapsed / reads * 1e9:>8.0f}ns each")
+    return per_second
+
+
+def differences(service: PicPayUSDCService, user_ids) -> list:
+    """Users whose view answer differs from the one computed without the view"""
+    wrong = []
+    for user_id, balance in service.get_user_balances(user_ids).items():
+        expected = service._balance(user_id, service.balance_view.ledger.get_wallet(user_id))
+        if any(balance[key] != expected[key] for key in COMPARED):
+            wrong.append(user_id)
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--reads", type=int, default=1_000_000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--target", type=float, default=1_000_000, help="Reads per second to reach")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(seed=args.seed)
+    base_url = simulator.start_in_process()
+    errors = []
+    try:
+        client = CircleClient("BENCH_API_KEY", base_url)
+        plain = PicPayUSDCService(client)
+        populate(plain, args.users, args.seed)
+        view = BalanceView(circle_client=client, wallet_id=PICPAY_WALLET_ID)
+        service = PicPayUSDCService(client, balance_view=view)
+        holds = populate(service, args.users, args.seed)
+
+        rng = random.Random(args.seed + 1)
+        sample = [f"user_{rng.randrange(args.users)}" for _ in range(args.reads)]
+        batches = [sample[i:i + args.batch] for i in range(0, len(sample), args.batch)]
+        service.get_user_balances(f"user_{i}" for i in range(args.users))  # Entries for every user
+
+        print(f"Balance reads: {args.users:,} users, {args.reads:,} reads of random users, one thread")
+        get = plain.get_user_balance
+        start = time.perf_counter()
+        for user_id in sample:
+            get(user_id)
+        baseline = rate("no view: get_user_balance", args.reads, time.perf_counter() - start)
+
+        get = service.get_user_balance
+        start = time.perf_counter()
+        for user_id in sample:
+            get(user_id)
+        through_service = rate("view: get_user_balance", args.reads, time.perf_counter() - start)
+
+        get = view.get
+        start = time.perf_counter()
+        for user_id in sample:
+            get(user_id)
+        direct = rate("view: BalanceView.get", args.reads, time.perf_counter() - start)
+
+        get_many = service.get_user_balances
+        start = time.perf_counter()
+        for batch in batches:
+            get_many(batch)
+        batched = rate(f"view: get_user_balances({args.batch} users)", args.reads, time.perf_counter() - start)
+        print(f"  speed-up over no view: {through_service / baseline:.1f}x through the service, "
+              f"{batched / baseline:.1f}x batched")
+
+        # Consistency
+        for hold in holds[::2]:
+            service.holds.commit(hold)
+        for hold in holds[1::4]:
+            service.holds.release(hold)
+        for _ in range(args.users // 10):
+            user_id = f"user_{rng.randrange(args.users)}"
+            with service.locks.hold(user_id):
+                service.ledger.adjust_balance(user_id, rng.randrange(-10 ** 6, 10 ** 6))
+        everyone = [f"user_{i}" for i in range(args.users)]
+        wrong = differences(service, everyone)
+        if wrong:
+            errors.append(f"{len(wrong)} answers differ after balance and hold changes, e.g. {wrong[0]}")
+
+        previous = demo.EXCHANGE_RATES["USD_BRL"]
+        demo.EXCHANGE_RATES["USD_BRL"] = 5.37
+        try:
+            start = time.perf_counter()
+            view.refresh_rate()
+            switched = time.perf_counter() - start
+            start = time.perf_counter()
+            wrong = differences(service, everyone)
+            reconverted = time.perf_counter() - start
+        finally:
+            demo.EXCHANGE_RATES["USD_BRL"] = previous
+        print(f"  rate change: {switched * 1e6:.0f}us to switch, entries converted again on their next read "
+              f"(first pass over every user {reconverted:.2f}s)")
+        if wrong:
+            errors.append(f"{len(wrong)} answers differ after a rate change, e.g. {wrong[0]}")
+
+        view.refresh_rate()
+        view.ledger.adjust_balance("user_0", 123)  # Behind the view's back
+        report = view.reconcile()
+        print(f"  reconcile: {report['checked']:,} entries checked, {report['repaired']} repaired in the view, "
+              f"users {report['view_usdc']!r} vs Circle {report.get('circle_usdc')!r}")
+        if report["repaired"] != 1 or differences(service, ["user_0"]):
+            errors.append(f"reconcile repaired {report['repaired']} entries instead of 1")
+        if "circle_usdc" not in report:
+            errors.append("reconcile did not read the omnibus balance")
+
+        # Writes through the view while reconciling: nothing has drifted
+        done = threading.Event()
+
+        def write():
+            while not done.is_set():
+                user_id = f"user_{rng.randrange(args.users)}"
+                with service.locks.hold(user_id):
+                    service.ledger.adjust_balance(user_id, 1)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            report = view.reconcile()
+        finally:
+            done.set()
+            writer.join()
+        if report["repaired"]:
+            errors.append(f"reconcile repaired {report['repaired']} entries during concurrent writes, expected 0")
+
+        try:
+            PicPayUSDCService(client, ledger=plain.ledger, balance_view=view)
+            errors.append("a ledger other than the one balance_view wraps was accepted")
+        except ValueError:
+            pass
+        service.close()
+        plain.close()
+    finally:
+        simulator.stop_process()
+
+    if direct < args.target:
+        errors.append(f"BalanceView.get: {direct:,.0f} reads/s below {args.target:,.0f}")
+    if batched < args.target:
+        errors.append(f"get_user_balances: {batched:,.0f} reads/s below {args.target:,.0f}")
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
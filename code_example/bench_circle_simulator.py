@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Circle simulator
+---------------------------
+
+Checks that CircleSimulator can stay out of the way of client benchmarks:
+
+1. Throughput: requests/sec for GET /v1/transfers/{id}, POST /v1/transfers
+   and a GET /v1/transfers page, over --connections keep-alive connections
+   from a raw asyncio client (the simulator runs in a child process)
+2. Latency model: measured mean/p50/p99 of each latency distribution
+   against its configured mean
+3. Fault injection: observed share of 429 and 5xx answers against
+   throttle_rate and error_rate
+4. Webhooks: time until every transfer's settlement notification reached a
+   WebhookReceiver, and whether each arrived
+
+Exits with status 1 if injected error rates are far off or notifications
+are missing.
+
+Usage:
+    python bench_circle_simulator.py --requests 50000 --connections 64
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from urllib.parse import urlsplit
+
+from circle_simulator import LATENCY_DISTRIBUTIONS, CircleSimulator
+from webhook_receiver import WebhookReceiver
+
+SECRET = b"bench-simulator-secret"
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def request_bytes(method: str, path: str, body=None) -> bytes:
+    payload = json.dumps(body).encode() if body is not None else b""
+    return (f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n").encode() + payload
+
+
+async def drive(base_url: str, make_request, count: int, connections: int, collect_ids: bool = False):
+    """Send count requests over keep-alive connections, one in flight per
+    connection; returns (elapsed seconds, sorted latencies, status counts,
+    ids of the created entities if collect_ids)"""
+    target = urlsplit(base_url)
+    latencies = []
+    statuses = {}
+    created = []
+    remaining = [count]
+
+    async def connection():
+        reader, writer = await asyncio.open_connection(target.hostname, target.port)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            writer.write(make_request(remaining[0]))
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.lower().split(b"content-length: ", 1)[1].split(b"\r\n", 1)[0])
+            body = await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            status = int(head.split(b" ", 2)[1])
+            statuses[status] = statuses.get(status, 0) + 1
+            if collect_ids and status == 201:
+                created.append(json.loads(body)["data"]["id"])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.perf_counter() - start, sorted(latencies), statuses, created
+
+
+def throughput(args) -> bool:
+    simulator = CircleSimulator()
+    base_url = simulator.start_in_process()
+    try:
+        def post_transfer(i):
+            return request_bytes("POST", "/v1/transfers", {
+                "idempotencyKey": f"bench-{i}-{time.monotonic_ns()}",
+                "source": {"type": "wallet", "id": "1000000001"},
+                "destination": {"type": "blockchain", "chain": "ETH", "address": "0x0"},
+                "amount": {"amount": "10.00", "currency": "USD"}})
+
+        elapsed, latencies, _, ids = asyncio.run(drive(base_url, post_transfer, args.requests, args.connections,
+                                                       collect_ids=True))
+        rows = [("POST /v1/transfers", args.requests / elapsed, latencies)]
+
+        def get_transfer(i):
+            return request_bytes("GET", f"/v1/transfers/{ids[i % len(ids)]}")
+
+        def list_page(i):
+            return request_bytes("GET", "/v1/transfers?pageSize=50")
+
+        for label, make_request in (("GET /v1/transfers/{id}", get_transfer),
+                                    ("GET /v1/transfers (50/page)", list_page)):
+            elapsed, latencies, _, _ = asyncio.run(drive(base_url, make_request, args.requests, args.connections))
+            rows.append((label, args.requests / elapsed, latencies))
+    finally:
+        simulator.stop_process()
+
+    print(f"Throughput: {args.requests} requests per endpoint over {args.connections} connections")
+    print(f"  {'':<28} {'requests/s':>11} {'p50':>9} {'p99':>9}")
+    for label, rate, latencies in rows:
+        print(f"  {label:<28} {rate:>11.0f} {percentile(latencies, 50) * 1000:>7.2f}ms "
+              f"{percentile(latencies, 99) * 1000:>7.2f}ms")
+    return True
+
+
+def latency_model(args) -> bool:
+    print(f"Latency model: mean {args.latency_ms:g}ms, {args.latency_requests} requests each")
+    print(f"  {'distribution':<14} {'mean':>9} {'p50':>9} {'p99':>9}")
+    for distribution in LATENCY_DISTRIBUTIONS:
+        simulator = CircleSimulator(latency_ms=args.latency_ms, latency_distribution=distribution, seed=1)
+        base_url = simulator.start_in_process()
+        try:
+            _, latencies, _, _ = asyncio.run(drive(base_url, lambda i: request_bytes("GET", "/v1/configuration"),
+                                                args.latency_requests, 32))
+        finally:
+            simulator.stop_process()
+        mean = sum(latencies) / len(latencies)
+        print(f"  {distribution:<14} {mean * 1000:>7.2f}ms {percentile(latencies, 50) * 1000:>7.2f}ms "
+              f"{percentile(latencies, 99) * 1000:>7.2f}ms")
+    return True
+
+
+def fault_injection(args) -> bool:
+    simulator = CircleSimulator(error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=1)
+    base_url = simulator.start_in_process()
+    try:
+        _, _, statuses, _ = asyncio.run(drive(base_url, lambda i: request_bytes("GET", "/v1/configuration"),
+                                           args.requests, args.connections))
+    finally:
+        simulator.stop_process()
+    throttled = statuses.get(429, 0) / args.requests
+    errors = (statuses.get(500, 0) + statuses.get(503, 0)) / args.requests
+    # Errors are only drawn for requests that were not throttled
+    expected_errors = args.error_rate * (1 - args.throttle_rate)
+    ok = abs(throttled - args.throttle_rate) < 0.01 + args.throttle_rate * 0.2 and \
+        abs(errors - expected_errors) < 0.01 + expected_errors * 0.2
+    print(f"Fault injection: 429 {throttled:.2%} (configured {args.throttle_rate:.2%}), "
+          f"5xx {errors:.2%} (expected {expected_errors:.2%})  {'PASS' if ok else 'FAIL'}")
+    return ok
+
+
+class _CountingService:
+    """Stands in for PicPayUSDCService: records the transfers notified as final"""
+
+    def __init__(self):
+        self.final = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.expected = 0
+
+    def apply_status_updates(self, updates):
+        with self.lock:
+            for update in updates:
+                self.final[update.transaction_id] = time.time()
+            if len(self.final) >= self.expected:
+                self.done.set()
+        return len(updates)
+
+
+def webhooks(args) -> bool:
+    service = _CountingService()
+    receiver = WebhookReceiver(service, SECRET, port=0)
+    webhook_url = receiver.start_in_thread()
+    simulator = CircleSimulator(settlement_delay=args.settlement_delay, failure_rate=0.05,
+                                webhook_url=webhook_url, webhook_secret=SECRET)
+    base_url = simulator.start_in_process()
+    try:
+        service.expected = args.webhook_transfers
+
+        def post_transfer(i):
+            return request_bytes("POST", "/v1/transfers", {
+                "idempotencyKey": f"webhook-{i}",
+                "source": {"type": "wallet", "id": "1000000001"},
+                "destination": {"type": "blockchain", "chain": "ETH", "address": "0x0"},
+                "amount": {"amount": "10.00", "currency": "USD"}})
+
+        created = time.time()
+        ids = set(asyncio.run(drive(base_url, post_transfer, args.webhook_transfers, 16, collect_ids=True))[3])
+        arrived = service.done.wait(timeout=args.settlement_delay * 1.5 + 10)
+    finally:
+        simulator.stop_process()
+        receiver.stop_thread()
+    missing = len(ids - set(service.final))
+    last = max(service.final.values(), default=created) - created
+    ok = arrived and not missing
+    print(f"Webhooks: {len(service.final)}/{len(ids)} transfers notified, last {last:.2f}s after creation "
+          f"(settlement delay {args.settlement_delay:g}s x0.5-1.5)  {'PASS' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50000)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, default=10.0)
+    parser.add_argument("--latency-requests", type=int, default=3000)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", type=float, default=0.05)
+    parser.add_argument("--settlement-delay", type=float, default=1.0)
+    parser.add_argument("--webhook-transfers", type=int, default=2000)
+    args = parser.parse_args()
+
+    results = [throughput(args), latency_model(args), fault_injection(args), webhooks(args)]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
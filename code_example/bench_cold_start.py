@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cold start
+---------------------
+
+Starts --runs fresh Python processes per mode against a local
+CircleSimulator whose connections cost --handshake-ms before their first
+response (the TCP and TLS handshakes of a real Circle connection), and in
+each one times:
+
+1. import of the client module, and the same import with the modules it
+   used to load eagerly (requests, asyncio, http.server, email.utils)
+   imported first
+2. building CircleClient and PicPayUSDCService (this is where requests is
+   actually imported now)
+3. warmup(), in the warm mode only
+4. the first mint_usdc, then a burst of --connections parallel ones (the
+   slowest of them is reported)
+
+and prints the medians. Time to first transfer runs from the start of the
+import to the first successful mint, warmup included. --output writes the
+medians as JSON.
+
+Exits with status 1 if importing the client module loads any of those
+modules, or if warming up does not take the handshakes off the first
+transfer and the burst.
+
+Usage:
+    python bench_cold_start.py --runs 5 --handshake-ms 100 --connections 8
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+HEAVY_MODULES = ("requests", "urllib3", "http.client", "ssl", "asyncio", "http.server", "email.utils")
+EAGER_IMPORTS = ("requests", "asyncio", "http.server", "email.utils")
+ADDRESS = "0x" + "0c" * 20
+
+
+def child(base_url: str, mode: str, connections: int):
+    """One cold process: print its timings as JSON"""
+    started = time.perf_counter()
+    if mode == "eager":
+        import importlib
+        for name in EAGER_IMPORTS:
+            importlib.import_module(name)
+    from demo_code_example_en import CircleClient, PicPayUSDCService
+    from cold_start import open_connections
+    from money import Money
+    imported = time.perf_counter()
+    # A lazily imported module is in sys.modules before it has run
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules and
+              type(sys.modules[name]).__name__ != "_LazyModule"]
+    if mode == "eager":
+        print(json.dumps({"import": imported - started}))
+        return
+
+    client = CircleClient("BENCH_API_KEY", base_url)
+    service = PicPayUSDCService(client)
+    built = time.perf_counter()
+    if mode == "warm":
+        service.warmup(connections)
+    ready = time.perf_counter()
+    amount = Money.parse(10, "USD")
+    client.mint_usdc(amount, ADDRESS)
+    first = time.perf_counter()
+
+    def timed_mint():
+        start = time.perf_counter()
+        client.mint_usdc(amount, ADDRESS)
+        return time.perf_counter() - start
+
+    burst = max(open_connections(timed_mint, connections))
+    service.close()
+    print(json.dumps({
+        "import": imported - started,
+        "loaded": loaded,
+        "construct": built - imported,
+        "warmup": ready - built,
+        "first_transfer": first - ready,
+        "time_to_first_transfer": first - started,
+        "burst_max": burst,
+    }))
+
+
+def run_child(base_url: str, mode: str, connections: int) -> dict:
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", base_url, "--mode", mode,
+                             "--connections", str(connections)],
+                            cwd=here, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--handshake-ms", type=float, default=100.0)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--output", help="Write the medians to this JSON file")
+    parser.add_argument("--child", metavar="BASE_URL", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=("cold", "warm", "eager"), default="cold", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.mode, args.connections)
+        return
+
+    # Not imported at the top: the child processes must start without asyncio
+    from circle_simulator import CircleSimulator
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms, handshake_ms=args.handshake_ms)
+    base_url = simulator.start_in_process()
+    runs = {"eager": [], "cold": [], "warm": []}
+    try:
+        for _ in range(args.runs):
+            for mode in runs:  # Interleaved, so drift on a noisy machine hits every mode alike
+                runs[mode].append(run_child(base_url, mode, args.connections))
+    finally:
+        simulator.stop_process()
+
+    medians = {mode: {key: statistics.median(run[key] for run in mode_runs)
+                      for key in mode_runs[0] if key != "loaded"}
+               for mode, mode_runs in runs.items()}
+    cold, warm = medians["cold"], medians["warm"]
+    print(f"Cold start: {args.runs} processes per mode, {args.handshake_ms:g}ms handshake, "
+          f"{args.latency_ms:g}ms Circle latency, bursts of {args.connections}")
+    print(f"  import client module        {cold['import'] * 1000:8.1f}ms  "
+          f"(with the former eager imports: {medians['eager']['import'] * 1000:.1f}ms)")
+    print(f"  {'':<26} {'cold':>10} {'warm':>10}")
+    for key, label in (("construct", "build client + service"), ("warmup", "warmup()"),
+                       ("first_transfer", "first transfer"), ("burst_max", "slowest of first burst"),
+                       ("time_to_first_transfer", "time to first transfer")):
+        print(f"  {label:<26} {cold[key] * 1000:>8.1f}ms {warm[key] * 1000:>8.1f}ms")
+
+    errors = []
+    loaded = sorted({name for run in runs["cold"] + runs["warm"] for name in run["loaded"]})
+    if loaded:
+        errors.append(f"importing the client module loaded {', '.join(loaded)}")
+    handshake = args.handshake_ms / 1000
+    if warm["first_transfer"] > cold["first_transfer"] - handshake / 2:
+        errors.append("warmup did not take the handshake off the first transfer")
+    if warm["burst_max"] > cold["burst_max"] - handshake / 2:
+        errors.append("warmup did not take the handshakes off the first burst")
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"handshake_ms": args.handshake_ms, "connections": args.connections, **medians},
+                      output, indent=2)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
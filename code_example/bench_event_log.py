@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Benchmark: event-sourced wallet ledger
+--------------------------------------
+
+1. Appends: adjust_balance events per second on an EventLogLedger with
+   sync=False (fsync every commit_interval), with sync=True from one thread
+   (one fsync per event) and with sync=True from --threads threads (group
+   commit), with the events each fsync carried
+2. Recovery: --wallets wallets and --events balance changes written with
+   snapshots every --snapshot-every events, then --tail-events more left in
+   the log after the last snapshot, a torn record appended to the
+   log as a crash in the middle of a write would leave, then the directory
+   opened again: time to open (map the snapshot, replay the tail) and to
+   serve the first lookups, next to what replaying the whole history would
+   take at the measured replay rate
+
+Exits with status 1 if the reopened ledger has a different wallet count, a
+sampled balance differs from the one expected, creating an existing wallet
+again replaced it, or the torn record was not cut off.
+
+Usage:
+    python bench_event_log.py --wallets 10000000 --events 100000000 --snapshot-every 5000000
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+
+import numpy as np
+
+from event_log import EventLogLedger
+
+
+def address_for(i: int) -> bytes:
+    return ((i * 0x9E3779B97F4A7C15) % (1 << 160)).to_bytes(20, "big")
+
+
+def fill(ledger: EventLogLedger, wallets: int):
+    for i in range(wallets):
+        ledger.create_wallet(f"user_{i}", address_for(i), 1_700_000_000_000_000 + i)
+
+
+def changes(count: int, wallets: int, seed: int):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, wallets, size=count).tolist(), rng.integers(-1000, 1000, size=count).tolist()
+
+
+def appends(directory: str, sync: bool, threads: int, events: int, wallets: int) -> dict:
+    ledger = EventLogLedger(directory, sync=False, snapshot_every=None)
+    fill(ledger, wallets)
+    ledger.close()
+    ledger = EventLogLedger(directory, sync=sync, snapshot_every=None)
+    commits = ledger.stats["commits"]
+    users, deltas = changes(events, wallets, 1)
+    per_thread = events // threads
+
+    def run(n: int):
+        for i in range(n * per_thread, (n + 1) * per_thread):
+            ledger.adjust_balance(f"user_{users[i]}", deltas[i])
+
+    workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    ledger.flush()
+    elapsed = time.perf_counter() - start
+    fsyncs = ledger.stats["commits"] - commits
+    ledger.close()
+    shutil.rmtree(directory)
+    return {"rate": per_thread * threads / elapsed, "per_fsync": per_thread * threads / max(fsyncs, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=1_000_000)
+    parser.add_argument("--events", type=int, default=5_000_000)
+    parser.add_argument("--snapshot-every", type=int, default=1_000_000)
+    parser.add_argument("--tail-events", type=int, default=500_000, help="Events after the last snapshot")
+    parser.add_argument("--append-events", type=int, default=200_000, help="Events of each append run")
+    parser.add_argument("--sync-events", type=int, default=2_000, help="Events of the one-thread sync run")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--samples", type=int, default=100_000)
+    parser.add_argument("--dir", help="Work directory (default a temporary one)")
+    args = parser.parse_args()
+
+    work = args.dir or tempfile.mkdtemp(prefix="bench-event-log-")
+    errors = []
+    try:
+        print(f"Appends ({args.append_events} adjust_balance events, 10000 wallets)")
+        for label, sync, threads, events in (("sync=False", False, 1, args.append_events),
+                                             ("sync=True, 1 thread", True, 1, args.sync_events),
+                                             (f"sync=True, {args.threads} threads", True, args.threads,
+                                              args.append_events)):
+            result = appends(os.path.join(work, "appends"), sync, threads, events, 10_000)
+            print(f"  {label:<24} {result['rate']:>12,.0f} events/s  {result['per_fsync']:>8,.1f} events per fsync")
+
+        directory = os.path.join(work, "ledger")
+        start = time.perf_counter()
+        ledger = EventLogLedger(directory, sync=False, snapshot_every=args.snapshot_every)
+        fill(ledger, args.wallets)
+        expected = np.zeros(args.wallets, dtype=np.int64)
+
+        def apply(first: int, count: int):
+            for offset in range(first, first + count, 1_000_000):
+                users, deltas = changes(min(1_000_000, first + count - offset), args.wallets, offset + 2)
+                for user, delta in zip(users, deltas):
+                    ledger.adjust_balance(f"user_{user}", delta)
+                np.add.at(expected, users, deltas)
+
+        apply(0, args.events)
+        ledger.close()
+        snapshots = ledger.stats["snapshots"]
+        # The rest stays in the log
+        ledger = EventLogLedger(directory, sync=False, snapshot_every=None)
+        apply(args.events, args.tail_events)
+        # Creating a wallet that exists returns it and logs nothing
+        again = ledger.create_wallet("user_0", address_for(args.wallets), 0)
+        if again.address != address_for(0) or again.balance_units != expected[0]:
+            errors.append(f"create_wallet of an existing user returned {again}")
+        ledger.close()
+        total = args.events + args.tail_events
+        written = time.perf_counter() - start
+        segment = max(name for name in os.listdir(directory) if name.endswith(".log"))
+        with open(os.path.join(directory, segment), "ab") as log:
+            log.write(b"\x30\x00\x00\x00\x00\x00\x00\x00torn")
+        disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        ledger = EventLogLedger(directory, snapshot_every=args.snapshot_every)
+        opened = time.perf_counter() - start
+        rng = np.random.default_rng(3)
+        sample = rng.integers(0, args.wallets, size=args.samples).tolist()
+        start = time.perf_counter()
+        first = ledger.get_wallet(f"user_{sample[0]}")
+        first_lookup = time.perf_counter() - start
+        start = time.perf_counter()
+        wrong = [i for i in sample if ledger.get_wallet(f"user_{i}").balance_units != expected[i]]
+        lookups = time.perf_counter() - start
+        if ledger.find_user_by_address(address_for(sample[0])) != f"user_{sample[0]}":
+            errors.append("address lookup failed after reopening")
+        if ledger.get_wallet("user_0").balance_units != expected[0]:
+            errors.append("user_0 lost its balance to a second create_wallet")
+        count = len(ledger)
+        stats = ledger.stats
+        ledger.close()
+
+        replay_rate = stats["replayed"] / max(stats["recovery_seconds"], 1e-9)
+        total_events = args.wallets + total
+        print(f"Recovery: {args.wallets:,} wallets, {total:,} balance changes, snapshot every "
+              f"{args.snapshot_every:,} events ({snapshots} taken, {written:.1f}s to write), {disk / 2 ** 20:,.0f}MiB "
+              f"on disk")
+        print(f"  open (map snapshot, replay {stats['replayed']:,} events)  {opened * 1000:10.1f}ms")
+        print(f"  first lookup                              {first_lookup * 1000:10.3f}ms")
+        print(f"  {args.samples:,} lookups                          {lookups / args.samples * 1e6:10.1f}us each")
+        print(f"  replay rate {replay_rate:,.0f} events/s: the whole history ({total_events:,} events) "
+              f"would take {total_events / max(replay_rate, 1):,.1f}s")
+        print(f"  peak RSS {max(rss_before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024:,.0f}MiB, "
+              f"torn bytes cut off: {stats['torn_bytes']}")
+
+        if count != args.wallets:
+            errors.append(f"{count} wallets after reopening instead of {args.wallets}")
+        if first is None or wrong:
+            errors.append(f"{len(wrong)} of {args.samples} sampled balances differ")
+        if not stats["torn_bytes"]:
+            errors.append("the torn record was not cut off")
+    finally:
+        if not args.dir:
+            shutil.rmtree(work, ignore_errors=True)
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Benchmark: pipelined exchange execution
+---------------------------------------
+
+Converts BRL -> USDC and USDC -> BRL through quote -> trade -> settlement
+against a local CircleSimulator whose quotes expire after --quote-ttl
+seconds and whose trades complete after about --trade-delay seconds:
+
+1. One step after another: --callers threads each quote, trade and poll
+   GET /v1/exchange/trades/{id} until complete, like the code did so far
+2. Batches: the quotes of --batch orders requested together, then their
+   trades, then the next batch, which shows what quoting too early costs
+   in expired quotes (nothing is requoted; only trade creation is timed)
+3. ExchangeEngine: the pipeline, each order done once its trade's
+   settlement is settled
+
+and reports conversions per second, the latency of an order (from the
+start of its batch in the batched run, from its submission to the engine
+otherwise) and the quote-expiry miss rate (quotes that could not be traded
+in time).
+
+Then --lost orders whose first trade response is lost after Circle
+executed the trade: each must succeed, executed once, and submit() after
+close() must return a failed order instead of raising.
+
+Exits with status 1 if an engine order failed, more than --max-miss-rate of
+its quotes expired, it was not faster than the step-by-step run, or the
+lost-response orders behave otherwise than described.
+
+Usage:
+    python bench_exchange.py --orders 2000 --quote-ttl 2 --trade-delay 0.3
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient
+from exchange import ExchangeEngine
+
+PAIRS = (("BRL", "USDC"), ("USDC", "BRL"))
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def random_orders(count: int, seed: int):
+    rng = random.Random(seed)
+    for _ in range(count):
+        from_currency, to_currency = rng.choice(PAIRS)
+        yield from_currency, rng.randint(10, 500), to_currency
+
+
+def step_by_step(client: CircleClient, orders, callers: int, poll_interval: float):
+    """Returns (elapsed seconds, sorted order latencies, failures, expired quotes)"""
+    orders = list(orders)
+    latencies = [[] for _ in range(callers)]
+    counts = {"failed": 0, "expired": 0}
+    lock = threading.Lock()
+
+    def caller(n: int):
+        for from_currency, amount, to_currency in orders[n::callers]:
+            start = time.perf_counter()
+            try:
+                quote = client.create_quote(from_currency, amount, to_currency)["data"]
+                trade = client.create_trade(quote["id"], operation_id=f"trade:{quote['id']}")["data"]
+                while trade["status"] != "complete":
+                    time.sleep(poll_interval)
+                    trade = client.get_trade(trade["id"])["data"]
+            except requests.HTTPError as e:
+                with lock:
+                    counts["failed"] += 1
+                    counts["expired"] += "expired" in e.response.text.lower()
+                continue
+            latencies[n].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start, sorted(latency for caller in latencies for latency in caller),
+            counts["failed"], counts["expired"])
+
+
+def batches(client: CircleClient, orders, batch: int, quote_workers: int, trade_workers: int):
+    """Quote a batch, then trade it; returns the same tuple as step_by_step"""
+    orders = list(orders)
+    expired = 0
+    failed = 0
+    latencies = []
+
+    def trade(quote):
+        try:
+            client.create_trade(quote["id"], operation_id=f"trade:{quote['id']}")
+        except requests.HTTPError as e:
+            return None, "expired" in e.response.text.lower()
+        return time.perf_counter() - batch_start, False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=quote_workers) as quote_pool, \
+            ThreadPoolExecutor(max_workers=trade_workers) as trade_pool:
+        for offset in range(0, len(orders), batch):
+            batch_start = time.perf_counter()
+            quotes = list(quote_pool.map(lambda order: client.create_quote(*order)["data"],
+                                         orders[offset:offset + batch]))
+            for latency, was_expired in trade_pool.map(trade, quotes):
+                if latency is None:
+                    failed += 1
+                    expired += was_expired
+                else:
+                    latencies.append(latency)
+    return time.perf_counter() - start, sorted(latencies), failed, expired
+
+
+def pipelined(engine: ExchangeEngine, orders):
+    latencies = []
+    failures = []
+    start = time.perf_counter()
+    for result in engine.execute(orders):
+        if result["success"]:
+            latencies.append(result["seconds"])
+        else:
+            failures.append(result["error"])
+    return time.perf_counter() - start, sorted(latencies), failures
+
+
+def row(label: str, count: int, elapsed: float, latencies, failed: int, misses: int, quotes: int) -> str:
+    # Only successful conversions count
+    return (f"  {label:<24} {count:>7} {len(latencies) / elapsed:>13.1f} {percentile(latencies, 50) * 1000:>8.1f}ms "
+            f"{percentile(latencies, 99) * 1000:>8.1f}ms {failed:>7} {misses / max(quotes, 1):>12.1%}")
+
+
+class LosingClient:
+    """Delegates to a CircleClient, but loses the response of the first
+    create_trade of every quote after Circle executed it"""
+
+    def __init__(self, client: CircleClient):
+        self.client = client
+        self.executed = {}  # Quote id -> ids of the trades Circle answered with
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def create_trade(self, quote_id: str, operation_id=None):
+        response = self.client.create_trade(quote_id, operation_id=operation_id)
+        with self._lock:
+            trades = self.executed.setdefault(quote_id, set())
+            first = not trades
+            trades.add(response.get("data", response)["id"])
+        if first:
+            raise requests.ConnectionError("Connection reset by peer")
+        return response
+
+
+class LateSettlementClient:
+    """Delegates to a CircleClient, but the first time a completed trade is
+    listed it comes without its settlementId"""
+
+    def __init__(self, client: CircleClient):
+        self.client = client
+        self.hidden = set()  # Ids of the trades listed once without settlementId
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def list_trades(self, **kwargs):
+        page = self.client.list_trades(**kwargs)
+        data = []
+        for trade in page.get("data", []):
+            if trade.get("settlementId"):
+                with self._lock:
+                    first = trade["id"] not in self.hidden
+                    self.hidden.add(trade["id"])
+                if first:
+                    trade = {key: value for key, value in trade.items() if key != "settlementId"}
+            data.append(trade)
+        return dict(page, data=data)
+
+
+def late_settlements(client: CircleClient, orders: int, poll_interval: float) -> list:
+    """Errors of the run where settlementIds show up one sweep late"""
+    late = LateSettlementClient(client)
+    engine = ExchangeEngine(late, wait_for="settled", poll_interval=poll_interval)
+    results = list(engine.execute(random_orders(orders, 5)))
+    engine.close()
+    errors = []
+    unsettled = [result for result in results if result.get("status") != "settled"]
+    if unsettled:
+        errors.append(f"{len(unsettled)} late-settlement orders finished unsettled, e.g. {unsettled[0]}")
+    print(f"Late settlementIds: {len(results)} orders, {len(late.hidden)} trades listed without one first")
+    return errors
+
+
+def lost_responses(client: CircleClient, orders: int) -> list:
+    """Errors of the lost-response run"""
+    losing = LosingClient(client)
+    engine = ExchangeEngine(losing, wait_for="created", retry_delay=0.01)
+    results = list(engine.execute(random_orders(orders, 4)))
+    engine.close()
+    errors = []
+    failed = [result for result in results if not result["success"]]
+    if failed:
+        errors.append(f"{len(failed)} lost-response orders failed, e.g. {failed[0]}")
+    twice = [quote_id for quote_id, trades in losing.executed.items() if len(trades) != 1]
+    if twice:
+        errors.append(f"{len(twice)} quotes traded more than once")
+    late = engine.submit("BRL", 100, "USDC").result()
+    if late["success"] or "closed" not in late["error"]:
+        errors.append(f"submit() after close() returned {late}")
+    print(f"Lost trade responses: {len(results)} orders, {engine.stats['trade_retries']} retries, "
+          f"{len(losing.executed)} quotes traded, {len(twice)} more than once")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--sequential-orders", type=int, default=400,
+                        help="Orders of the step-by-step run (it is slow)")
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=1000, help="Orders per batch of the batched run")
+    parser.add_argument("--quote-workers", type=int, default=8)
+    parser.add_argument("--trade-workers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=10.0)
+    parser.add_argument("--trade-latency-ms", type=float, default=50.0)
+    parser.add_argument("--quote-ttl", type=float, default=2.0)
+    parser.add_argument("--trade-delay", type=float, default=0.3)
+    parser.add_argument("--fx-settlement-delay", type=float, default=0.5)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--max-miss-rate", type=float, default=0.01)
+    parser.add_argument("--lost", type=int, default=50, help="Orders of the lost-response run")
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms, quote_ttl=args.quote_ttl,
+                                endpoint_latency_ms={"POST /v1/exchange/trades": args.trade_latency_ms},
+                                trade_delay=args.trade_delay, fx_settlement_delay=args.fx_settlement_delay,
+                                seed=1)
+    base_url = simulator.start_in_process()
+    try:
+        client = CircleClient("BENCH_API_KEY", base_url)
+        sequential = step_by_step(client, random_orders(args.sequential_orders, 1), args.callers,
+                                  args.poll_interval)
+        batched = batches(client, random_orders(args.orders, 2), args.batch, args.quote_workers,
+                          args.trade_workers)
+        engine = ExchangeEngine(client, quote_workers=args.quote_workers, trade_workers=args.trade_workers,
+                                wait_for="settled", poll_interval=args.poll_interval)
+        elapsed, latencies, failures = pipelined(engine, random_orders(args.orders, 3))
+        engine.close()
+        lost_errors = lost_responses(client, args.lost)
+        lost_errors += late_settlements(client, args.lost, args.poll_interval)
+    finally:
+        simulator.stop_process()
+
+    print(f"Exchange: {args.latency_ms:g}ms Circle latency, {args.trade_latency_ms:g}ms per trade request, "
+          f"quotes valid {args.quote_ttl:g}s, trades complete after ~{args.trade_delay:g}s")
+    print(f"  {'':<24} {'orders':>7} {'conversions/s':>13} {'p50':>10} {'p99':>10} {'failed':>7} "
+          f"{'quote misses':>12}")
+    print(row("one step after another", args.sequential_orders, *sequential, args.sequential_orders))
+    print(row(f"batches of {args.batch} (trades)", args.orders, *batched, args.orders))
+    print(row("engine (to settled)", args.orders, elapsed, latencies, len(failures), engine.expiry_misses,
+              engine.stats["quotes"]))
+    print(f"  engine: {engine.stats}")
+
+    errors = lost_errors
+    if failures:
+        errors.append(f"{len(failures)} engine orders failed, e.g. {failures[0]}")
+    miss_rate = engine.expiry_misses / max(engine.stats["quotes"], 1)
+    if miss_rate > args.max_miss_rate:
+        errors.append(f"quote miss rate {miss_rate:.1%} above {args.max_miss_rate:.1%}")
+    if args.orders / elapsed <= args.sequential_orders / sequential[0]:
+        errors.append("the engine was not faster than one step after another")
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Benchmark: balance holds
+------------------------
+
+Redeems USDC for --users users from --callers threads against a local
+CircleSimulator, first with the synchronous convert_usdc_to_brl (the caller
+waits for Circle) and then with convert_usdc_to_brl_async (the caller only
+waits for the hold), and reports conversions per second and the latency
+seen by the caller. --error-rate of the redemptions fail on the client side
+so that held funds also get released.
+
+After each run it checks that every hold was settled and that balances plus
+what was redeemed add up to the initial total; it also checks that an
+unsettled hold expires, that a late commit debits it again, and that one
+overdrawing the user is recorded in overdrafts. Exits with status 1 if a
+check fails.
+
+Usage:
+    python bench_holds.py --conversions 4000 --callers 16 --latency-ms 20
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+
+import requests
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from holds import HoldBook
+from money import Money
+from user_locks import UserLocks
+from wallet_ledger import InMemoryLedger
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class FlakyClient(CircleClient):
+    """CircleClient whose redemptions fail on the way out at a given rate"""
+
+    def __init__(self, *args, error_rate: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.error_rate = error_rate
+        self._random = random.Random(1)
+
+    def redeem_usdc(self, *args, **kwargs):
+        if self._random.random() < self.error_rate:
+            raise requests.ConnectionError("injected failure")
+        return super().redeem_usdc(*args, **kwargs)
+
+
+def run(client: CircleClient, users: int, conversions: int, callers: int, use_async: bool):
+    service = PicPayUSDCService(client)
+    user_ids = [f"user-{i}" for i in range(users)]
+    initial = Money.parse(1000, "USDC")
+    for user_id in user_ids:
+        service.create_user_wallet(user_id)
+        service.ledger.adjust_balance(user_id, initial.units)
+
+    latencies = [[] for _ in range(callers)]
+    outcomes = [[] for _ in range(callers)]  # (amount units, Future or None)
+
+    def caller(n: int):
+        rng = random.Random(n)
+        for _ in range(conversions // callers):
+            user_id = rng.choice(user_ids)
+            amount = Money.parse(rng.randint(1, 500) / 100, "USDC")
+            start = time.perf_counter()
+            try:
+                if use_async:
+                    outcomes[n].append((amount.units, service.convert_usdc_to_brl_async(user_id, amount)))
+                else:
+                    service.convert_usdc_to_brl(user_id, amount)
+                    outcomes[n].append((amount.units, None))
+            except (ValueError, requests.RequestException):
+                pass
+            latencies[n].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    service.close()  # Waits for the background redemptions
+    elapsed = time.perf_counter() - start
+
+    redeemed = 0
+    for outcome in outcomes:
+        for units, future in outcome:
+            if future is None or future.exception() is None:
+                redeemed += units
+    balances = sum(service.ledger.get_wallet(user_id).balance_units for user_id in user_ids)
+    errors = []
+    if len(service.holds):
+        errors.append(f"{len(service.holds)} holds left open")
+    if balances + redeemed != initial.units * users:
+        errors.append(f"total off by {balances + redeemed - initial.units * users} units")
+    all_latencies = sorted(latency for caller_latencies in latencies for latency in caller_latencies)
+    return (len(all_latencies) / elapsed, percentile(all_latencies, 50), percentile(all_latencies, 99),
+            service.holds.stats, errors)
+
+
+def check_expiry() -> list:
+    ledger = InMemoryLedger()
+    ledger.create_wallet("alice", b"\x01" * 20, 0)
+    ledger.adjust_balance("alice", 100)
+    holds = HoldBook(ledger, UserLocks(), ttl=0.05, sweep_interval=0.01).start()
+    errors = []
+    try:
+        hold = holds.place("alice", 60)
+        if ledger.get_wallet("alice").balance_units != 40 or holds.held_units("alice") != 60:
+            errors.append("hold did not reserve the amount")
+        time.sleep(0.2)
+        if hold.state != "expired" or ledger.get_wallet("alice").balance_units != 100:
+            errors.append("hold did not expire")
+        holds.commit(hold)
+        if ledger.get_wallet("alice").balance_units != 40 or holds.stats["late_commits"] != 1:
+            errors.append("late commit did not debit again")
+        if holds.release(hold) or ledger.get_wallet("alice").balance_units != 40:
+            errors.append("committed hold was released")
+        if holds.overdrafts:
+            errors.append("a covered late commit was reported as an overdraft")
+
+        # The released funds are spent before the late commit arrives
+        hold = holds.place("alice", 30)
+        time.sleep(0.2)
+        ledger.adjust_balance("alice", -30)
+        holds.commit(hold)
+        if ledger.get_wallet("alice").balance_units != -20 or holds.overdrafts != [hold]:
+            errors.append("overdrawing late commit was not recorded in overdrafts")
+    finally:
+        holds.stop()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--conversions", type=int, default=4000)
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms)
+    client = FlakyClient("BENCH_API_KEY", simulator.start_in_process(), error_rate=args.error_rate)
+    failed = False
+    try:
+        print(f"{args.conversions} redemptions from {args.callers} callers, "
+              f"{args.latency_ms:g}ms Circle latency, {args.error_rate:.0%} failing")
+        print(f"{'':<28} {'conversions/s':>14} {'caller p50':>11} {'caller p99':>11}  checks")
+        for label, use_async in (("Synchronous redeem", False), ("Hold + async redeem", True)):
+            rate, p50, p99, stats, errors = run(client, args.users, args.conversions, args.callers, use_async)
+            failed = failed or bool(errors)
+            print(f"{label:<28} {rate:>14.0f} {p50 * 1000:>9.3f}ms {p99 * 1000:>9.3f}ms  "
+                  f"{'; '.join(errors) or 'PASS'}")
+            print(f"{'':<28} holds: {stats}")
+    finally:
+        simulator.stop_process()
+
+    errors = check_expiry()
+    failed = failed or bool(errors)
+    print(f"Expiry and late commit: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Benchmark: durable idempotency store
+------------------------------------
+
+Throughput of IdempotencyStore, followed by crash-recovery checks against a
+local CircleSimulator (which, like Circle, answers a repeated idempotency
+key with the original transfer):
+
+1. begin() + complete() of new operations/sec from --threads threads, and
+   from --processes processes sharing one database file
+2. Repeated operations/sec served from the result cache
+3. Concurrent processes beginning the same operations all get the same keys
+4. A worker killed after sending a transfer but before recording the
+   result: the retry reuses the key and Circle creates no second transfer
+5. A completed operation retried later is answered from the cache without
+   calling Circle
+6. A conversion retried on a restarted service (same store and ledger, no
+   tracked transactions) is not credited twice
+7. A worker SIGKILLed in the middle of writing: the database passes
+   integrity_check and every key it handed out is still there
+
+The repo has no test suite; the checks live here and the script exits
+non-zero if one fails.
+
+Usage:
+    python bench_idempotency.py --operations 20000 --threads 8 --processes 4
+"""
+
+import os
+import sys
+import time
+import signal
+import sqlite3
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService, transfer_payload
+from idempotency import IdempotencyStore
+from wallet_ledger import InMemoryLedger
+
+RESULT = {"data": {"id": "transfer", "status": "pending"}}
+
+
+def run_threads(store: IdempotencyStore, operations: int, threads: int, prefix: str) -> float:
+    def work(worker: int):
+        for i in range(worker, operations, threads):
+            operation_id = f"{prefix}:{i}"
+            key, result = store.begin(operation_id)
+            if result is None:
+                store.complete(operation_id, RESULT)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(work, range(threads)))
+    return operations / (time.perf_counter() - start)
+
+
+def _process_worker(path: str, operations: int, worker: int, workers: int, prefix: str, conn):
+    store = IdempotencyStore(path)
+    keys = {}
+    for i in range(worker, operations, workers) if workers else range(operations):
+        operation_id = f"{prefix}:{i}"
+        keys[operation_id], result = store.begin(operation_id)
+        if result is None:
+            store.complete(operation_id, RESULT)
+    store.close()
+    conn.send(keys)
+
+
+def run_processes(path: str, operations: int, processes: int, prefix: str, same_operations: bool = False):
+    """Returns operations/sec and the keys each process was given"""
+    pipes, children = [], []
+    start = time.perf_counter()
+    for worker in range(processes):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=_process_worker, args=(
+            path, operations, worker, 0 if same_operations else processes, prefix, child_conn))
+        child.start()
+        pipes.append(parent_conn)
+        children.append(child)
+    keys = [conn.recv() for conn in pipes]
+    for child in children:
+        child.join()
+    total = operations * (processes if same_operations else 1)
+    return total / (time.perf_counter() - start), keys
+
+
+def _crash_after_send(path: str, base_url: str, operation_id: str):
+    """Record the key, send the transfer, then die before recording the result"""
+    store = IdempotencyStore(path)
+    client = CircleClient("BENCH_API_KEY", base_url)
+    key, _ = store.begin(operation_id)
+    client._request("POST", "POST /v1/transfers", "/v1/transfers",
+                    json=transfer_payload(key, "wallet-a", "wallet-b", 10.0, "USD"))
+    os._exit(1)
+
+
+def _write_until_killed(path: str, conn):
+    store = IdempotencyStore(path)
+    i = 0
+    while True:
+        operation_id = f"killed:{i}"
+        key, _ = store.begin(operation_id)
+        conn.send((operation_id, key))
+        i += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type=int, default=20_000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    failures = []
+
+    def check(name: str, ok: bool):
+        print(f"{'PASS' if ok else 'FAIL'}  {name}")
+        if not ok:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "idempotency.db")
+        store = IdempotencyStore(path)
+
+        new_rate = run_threads(store, args.operations, args.threads, "threads")
+        cached_rate = run_threads(store, args.operations, args.threads, "threads")
+        cold_store = IdempotencyStore(path, cache_size=0)
+        sqlite_rate = run_threads(cold_store, args.operations, args.threads, "threads")
+        process_rate, _ = run_processes(path, args.operations, args.processes, "processes")
+        shared_rate, keys = run_processes(path, args.operations // 4, args.processes, "shared",
+                                          same_operations=True)
+
+        print(f"New operations, {args.threads} threads:       {new_rate:12,.0f}/s")
+        print(f"New operations, {args.processes} processes:     {process_rate:12,.0f}/s")
+        print(f"Same operations, {args.processes} processes:    {shared_rate:12,.0f}/s")
+        print(f"Repeated operations (memory cache): {cached_rate:12,.0f}/s")
+        print(f"Repeated operations (SQLite):       {sqlite_rate:12,.0f}/s")
+        print()
+
+        check("concurrent processes get the same key per operation", all(k == keys[0] for k in keys))
+
+        simulator = CircleSimulator()
+        base_url = simulator.start_in_thread()
+        try:
+            client = CircleClient("BENCH_API_KEY", base_url, idempotency_store=store)
+
+            child = multiprocessing.Process(target=_crash_after_send, args=(path, base_url, "payout:crash:1"))
+            child.start()
+            child.join()
+            retried = client.create_transfer("wallet-a", "wallet-b", 10.0, "USD", operation_id="payout:crash:1")
+            check("retry after a crash reuses the key (no second transfer)",
+                  len(simulator.transfers) == 1 and simulator.replayed_count == 1)
+
+            requests_before = simulator.request_count
+            again = client.create_transfer("wallet-a", "wallet-b", 10.0, "USD", operation_id="payout:crash:1")
+            check("completed operation is answered from the cache",
+                  simulator.request_count == requests_before and again == retried)
+
+            ledger = InMemoryLedger()
+            first = PicPayUSDCService(client, ledger=ledger)
+            first.convert_brl_to_usdc("alice", "500", operation_id="mint:order-1")
+            first.close()
+            restarted = PicPayUSDCService(client, ledger=ledger)
+            restarted.convert_brl_to_usdc("alice", "500", operation_id="mint:order-1")
+            restarted.close()
+            check("retried conversion on a restarted service is credited once",
+                  ledger.get_wallet("alice").balance_units == 100_000_000)
+        finally:
+            simulator.stop_thread()
+
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        child = multiprocessing.Process(target=_write_until_killed, args=(path, child_conn))
+        child.start()
+        child_conn.close()
+        handed_out = []
+
+        def drain():
+            try:
+                while True:
+                    handed_out.append(parent_conn.recv())
+            except (EOFError, OSError):
+                pass
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        time.sleep(0.5)
+        os.kill(child.pid, signal.SIGKILL)
+        child.join()
+        reader.join()
+
+        conn = sqlite3.connect(path)
+        check("database intact after SIGKILL", conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok")
+        conn.close()
+        recovered = IdempotencyStore(path)
+        check(f"all {len(handed_out):,} keys handed out before SIGKILL survive",
+              bool(handed_out) and all(recovered.begin(op)[0] == key for op, key in handed_out))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Benchmark: hot-path instrumentation
+-----------------------------------
+
+Measures what opt-in Metrics cost:
+
+1. Per call: a @traced method with metrics off against the same method
+   undecorated, and a span with metrics on
+2. End to end: convert_brl_to_usdc followed by get_user_balance from
+   --callers threads against a local CircleSimulator (child process) with
+   --latency-ms per call, alternating rounds with and without Metrics; the
+   best instrumented round must be within --max-overhead of the best plain
+   one (best of, like timeit, as slower rounds are mostly scheduling noise).
+   With a short latency and many callers the run is CPU-bound, the worst
+   case for the overhead
+3. Scrape: time to render /metrics after the run, and that its counters
+   agree with what was sent (responses, retries under --throttle-rate)
+
+Exits with status 1 if the overhead is above --max-overhead or the counters
+are wrong.
+
+Usage:
+    python bench_instrumentation.py --operations 4000 --rounds 9 --latency-ms 2
+"""
+
+import sys
+import time
+import argparse
+import threading
+import urllib.request
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from instrumentation import Metrics, MetricsServer, traced
+
+
+class _Target:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def plain(self, value):
+        return value
+
+    @traced("bench_call")
+    def decorated(self, value):
+        return value
+
+
+def per_call(calls: int):
+    def cost(method) -> float:
+        start = time.perf_counter()
+        for i in range(calls):
+            method(i)
+        return (time.perf_counter() - start) / calls * 1e9
+
+    plain = cost(_Target(None).plain)
+    disabled = cost(_Target(None).decorated)
+    enabled = cost(_Target(Metrics()).decorated)
+    print(f"Per call: undecorated {plain:.0f}ns, @traced off {disabled:.0f}ns "
+          f"(+{disabled - plain:.0f}ns), on {enabled:.0f}ns (+{(enabled - plain) / 1000:.2f}us)")
+
+
+def run(base_url: str, args, metrics) -> float:
+    client = CircleClient("BENCH_API_KEY", base_url, metrics=metrics)
+    service = PicPayUSDCService(client, metrics=metrics)
+
+    def caller(n: int):
+        for i in range(args.operations // args.callers):
+            user_id = f"user-{n}-{i % 50}"
+            service.convert_brl_to_usdc(user_id, 100)
+            service.get_user_balance(user_id)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(args.callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    service.close()
+    return (args.operations // args.callers) * args.callers / elapsed
+
+
+def end_to_end(args) -> bool:
+    simulator = CircleSimulator(latency_ms=args.latency_ms, seed=1)
+    base_url = simulator.start_in_process()
+    try:
+        run(base_url, args, None)  # Warm up
+        plain, instrumented = [], []
+        for n in range(args.rounds):
+            # Alternate which goes first so drift in machine speed hits both alike
+            for metrics in ((None, Metrics()) if n % 2 else (Metrics(), None)):
+                (plain if metrics is None else instrumented).append(run(base_url, args, metrics))
+    finally:
+        simulator.stop_process()
+    overhead = 1 - max(instrumented) / max(plain)
+    ok = overhead <= args.max_overhead
+    print(f"End to end: {args.operations} conversions + balance reads, {args.callers} callers, "
+          f"{args.latency_ms:g}ms Circle latency, best of {args.rounds} rounds")
+    print(f"  without metrics {max(plain):>8.0f} ops/s  rounds: {' '.join(f'{rate:.0f}' for rate in plain)}")
+    print(f"  with metrics    {max(instrumented):>8.0f} ops/s  rounds: "
+          f"{' '.join(f'{rate:.0f}' for rate in instrumented)}")
+    print(f"  overhead {overhead:+.2%} (limit {args.max_overhead:.0%})  {'PASS' if ok else 'FAIL'}")
+    return ok
+
+
+def scrape(args) -> bool:
+    simulator = CircleSimulator(throttle_rate=args.throttle_rate, retry_after=0.001, seed=1)
+    base_url = simulator.start_in_process()
+    metrics = Metrics()
+    server = MetricsServer(metrics, port=0)
+    url = server.start_in_thread()
+    try:
+        run(base_url, args, metrics)
+        start = time.perf_counter()
+        body = urllib.request.urlopen(url).read().decode()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop_thread()
+        simulator.stop_process()
+
+    values = {}
+    for line in body.splitlines():
+        if not line.startswith("#"):
+            name = line.split("{", 1)[0]
+            values[(name, "status=\"429\"" in line)] = values.get((name, "status=\"429\"" in line), 0) + \
+                float(line.rsplit(" ", 1)[1])
+    operations = (args.operations // args.callers) * args.callers
+    accepted = values.get(("picpay_circle_responses_total", False), 0)
+    throttled = values.get(("picpay_circle_responses_total", True), 0)
+    retries = values.get(("picpay_circle_retries_total", False), 0)
+    ok = accepted == operations and throttled == retries and throttled > 0
+    print(f"Scrape: {len(body.splitlines())} lines in {elapsed * 1000:.1f}ms; {accepted:.0f} accepted responses "
+          f"for {operations} conversions, {throttled:.0f} throttled, {retries:.0f} retries  {'PASS' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1_000_000)
+    parser.add_argument("--operations", type=int, default=4000)
+    parser.add_argument("--callers", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=9)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.05)
+    parser.add_argument("--max-overhead", type=float, default=0.02)
+    args = parser.parse_args()
+
+    per_call(args.calls)
+    results = [end_to_end(args), scrape(args)]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark: float vs Decimal vs integer Money conversions
+--------------------------------------------------------
+
+Converts the same batch of BRL amounts to USDC three ways and reports
+conversions/sec and how many results differ from the exact answer:
+
+1. float: amount * rate (what convert_brl_to_usdc used to do)
+2. Decimal: quantized to 6 places with ROUND_HALF_EVEN
+3. Money: integer minor units through Converter.units / Converter.many
+
+It then runs randomized property checks: BRL -> USDC -> BRL must give
+back the original amount for every sampled amount and rate, every rounding
+mode must agree with Decimal.quantize, and Money.parse_positive must refuse
+zero and negative amounts.
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python bench_money.py --conversions 1000000 --round-trips 200000
+"""
+
+import sys
+import time
+import random
+import argparse
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from money import ROUNDING_MODES, Money, Rate, converter
+
+RATE = "0.1771"
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def check_round_trip(samples: int, seed: int = 1) -> int:
+    """BRL -> USDC -> BRL with random amounts and rates; returns the failures"""
+    rng = random.Random(seed)
+    failures = 0
+    for _ in range(samples):
+        brl = Money(rng.randrange(0, 10_000_000_000), "BRL")  # up to R$ 100 million
+        rate = Rate(rng.randrange(1, 10_000_000), 10 ** rng.randrange(5, 9))  # 0.00001 .. 100
+        usdc = brl.convert(rate, "USDC")
+        back = usdc.convert(rate.inverse(), "BRL")
+        # USDC keeps 4 more decimals than BRL, so the trip is exact as long as
+        # half a USDC micro-unit divided by the rate stays below half a centavo
+        if float(rate) >= 1e-3 and back != brl:
+            failures += 1
+    return failures
+
+
+def check_rounding(samples: int, seed: int = 2) -> int:
+    """USDC -> BRL in every rounding mode, against Decimal.quantize (negative
+    amounts included, where the modes differ most); returns the failures"""
+    rng = random.Random(seed)
+    failures = 0
+    for _ in range(samples):
+        usdc = Money(rng.randrange(-10 ** 12, 10 ** 12), "USDC")
+        rate = Rate(rng.randrange(1, 10_000_000), 10 ** rng.randrange(5, 9))
+        exact = usdc.to_decimal() * rate.numerator / rate.denominator
+        for rounding in ROUNDING_MODES:
+            expected = int(exact.quantize(Decimal("0.01"), rounding=rounding).scaleb(2))
+            failures += usdc.convert(rate, "BRL", rounding).units != expected
+    return failures
+
+
+def check_positive() -> int:
+    """Money.parse_positive on amounts that must be refused; returns how many were accepted"""
+    accepted = 0
+    for value in (0, "0.00", -1, "-0.01", 0.001, Money(0, "USDC"), Money(-1, "USDC")):
+        try:
+            Money.parse_positive(value, "BRL" if not isinstance(value, Money) else "USDC")
+            accepted += 1
+        except ValueError:
+            pass
+    return accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversions", type=int, default=1_000_000)
+    parser.add_argument("--round-trips", type=int, default=200_000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    centavos = [rng.randrange(1, 10_000_000) for _ in range(args.conversions)]
+
+    float_rate = float(RATE)
+    floats = [c / 100 for c in centavos]
+    float_results, float_time = timed(lambda: [f * float_rate for f in floats])
+
+    decimal_rate = Decimal(RATE)
+    places = Decimal("0.000001")
+    decimals = [Decimal(c).scaleb(-2) for c in centavos]
+    decimal_results, decimal_time = timed(
+        lambda: [(d * decimal_rate).quantize(places, rounding=ROUND_HALF_EVEN) for d in decimals])
+
+    to_usdc = converter(Rate.parse(RATE), "BRL", "USDC")
+    single_results, single_time = timed(lambda: [to_usdc.units(c) for c in centavos])
+    batch_results, batch_time = timed(lambda: to_usdc.many(centavos))
+
+    exact = [int(d.scaleb(6)) for d in decimal_results]
+    # Float results whose digits are not the exact product (e.g. 8.855000000000001)
+    float_inexact = sum(1 for f, e in zip(float_results, exact) if Decimal(repr(f)).scaleb(6) != e)
+    errors = []
+    if single_results != exact or batch_results != exact:
+        errors.append("Money conversions differ from Decimal")
+
+    n = args.conversions
+    print(f"{n:,} BRL -> USDC conversions at {RATE}")
+    print(f"float:            {n / float_time:14,.0f}/s   inexact results: {float_inexact:,}")
+    print(f"Decimal:          {n / decimal_time:14,.0f}/s")
+    print(f"Money (single):   {n / single_time:14,.0f}/s")
+    print(f"Money (batch):    {n / batch_time:14,.0f}/s")
+
+    failures = check_round_trip(args.round_trips)
+    print(f"Round trip BRL -> USDC -> BRL: {args.round_trips:,} samples, {failures} failures")
+    if failures:
+        errors.append(f"{failures} round trips did not give back the original amount")
+    samples = args.round_trips // 10
+    failures = check_rounding(samples)
+    print(f"Rounding modes vs Decimal: {samples:,} samples x {len(ROUNDING_MODES)} modes, {failures} failures")
+    if failures:
+        errors.append(f"{failures} conversions rounded differently from Decimal")
+    accepted = check_positive()
+    if accepted:
+        errors.append(f"parse_positive accepted {accepted} non-positive amounts")
+
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
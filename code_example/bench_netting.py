@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Benchmark: conversion netting
+-----------------------------
+
+Runs --conversions random BRL -> USDC and USDC -> BRL conversions for
+--users users from --callers threads against a local CircleSimulator, once
+with a Circle transfer per conversion and once through a NettingBook that
+settles every --window seconds, and reports Circle calls, USDC moved at
+Circle, conversions per second and the latency seen by the caller.
+
+In the netting run --error-rate of the net transfers fail after Circle
+accepted them (the response is lost), so batches are retried under the same
+operation id, and one settled transfer is reported failed by webhook, so
+its entries are settled again. Checks afterwards that:
+
+1. the reconciliation report balances and every entry was settled
+2. the omnibus position equals what the users' balances gained
+3. no batch reached Circle twice (retries reused their transfer)
+
+Finally a batch Circle refuses with a 400 must be parked as rejected while
+the next window still settles, and settle once retry_rejected() reopens it,
+and conversions retried under the same operation id must change the
+balance and be netted once, and batches whose transfer is final must be
+evicted after the retention period without unbalancing the report.
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python bench_netting.py --conversions 20000 --callers 16 --window 0.5
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+from types import SimpleNamespace
+
+import requests
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from money import Money
+from netting import SETTLED_STATUSES, NettingBook
+from webhook_receiver import StatusUpdate
+
+OMNIBUS_ADDRESS = "0x" + "0b" * 20
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class CountingClient(CircleClient):
+    """CircleClient counting mints and redeems; error_rate of them lose
+    Circle's response after it was accepted"""
+
+    def __init__(self, *args, error_rate: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.error_rate = error_rate
+        self.calls = 0
+        self.moved_units = 0
+        self.transfer_ids = {}  # operation_id -> transfer ids Circle returned for it
+        self._random = random.Random(1)
+        self._lock = threading.Lock()
+
+    def _counted(self, call, amount, address, operation_id):
+        response = call(amount, address, operation_id=operation_id)
+        with self._lock:
+            self.calls += 1
+            self.moved_units += Money.parse(amount, "USDC").units
+            if operation_id is not None:
+                self.transfer_ids.setdefault(operation_id, set()).add(response["data"]["id"])
+            lost = self._random.random() < self.error_rate
+        if lost:
+            raise requests.ConnectionError("response lost")
+        return response
+
+    def mint_usdc(self, amount, address, operation_id=None):
+        return self._counted(super().mint_usdc, amount, address, operation_id)
+
+    def redeem_usdc(self, amount, address, operation_id=None):
+        return self._counted(super().redeem_usdc, amount, address, operation_id)
+
+
+class RefusingClient(CircleClient):
+    """CircleClient refusing the first mint's operation with a 400, however
+    often it is sent"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refused = None
+
+    def mint_usdc(self, amount, address, operation_id=None):
+        self.refused = self.refused or operation_id
+        if operation_id == self.refused:
+            raise requests.HTTPError("400 Client Error: amount exceeds the account limit",
+                                     response=SimpleNamespace(status_code=400))
+        return super().mint_usdc(amount, address, operation_id=operation_id)
+
+
+def check_rejection(base_url: str) -> list:
+    """A refused batch is parked, later windows settle, and it settles once reopened"""
+    netting = NettingBook(RefusingClient("BENCH_API_KEY", base_url), OMNIBUS_ADDRESS)
+    errors = []
+    netting.add("user-a", "mint", 5_000_000)
+    try:
+        netting.settle(force=True)
+        errors.append("a refused batch did not raise")
+    except requests.HTTPError:
+        pass
+    report = netting.reconciliation_report()
+    if len(report["rejected"]) != 1 or not report["balanced"]:
+        errors.append("the refused batch is not reported as rejected")
+    netting.add("user-b", "mint", 7_000_000)
+    if netting.settle(force=True) is None:
+        errors.append("the window after a rejected batch did not settle")
+    netting.retry_rejected(report["rejected"][0]["batch_id"] if report["rejected"] else "")
+    netting.settle(force=True)
+    report = netting.reconciliation_report()
+    if report["rejected"] or len(netting) or not report["balanced"] or netting.position_units != 12_000_000:
+        errors.append("the reopened batch did not settle")
+    return errors
+
+
+def check_retries(base_url: str) -> list:
+    """Conversions retried under their operation id are credited, debited and netted once"""
+    netting = NettingBook(CircleClient("BENCH_API_KEY", base_url), OMNIBUS_ADDRESS)
+    service = PicPayUSDCService(netting.circle_client, netting=netting)
+    errors = []
+    for _ in range(2):
+        service.convert_brl_to_usdc("user-r", "500", operation_id="mint:order-1")
+    for _ in range(2):
+        service.convert_usdc_to_brl("user-r", "20", operation_id="redeem:order-2")
+    balance = service.ledger.get_wallet("user-r").balance_units
+    expected = Money.parse("500", "BRL").convert(service._exchange_rate("BRL_USD"), "USDC").units - 20_000_000
+    if balance != expected:
+        errors.append(f"balance {balance} after retried conversions instead of {expected}")
+    if len(netting) != 2 or netting.stats["entries"] != 2:
+        errors.append(f"{len(netting)} entries netted for 2 conversions retried once each")
+    service.close()
+    return errors
+
+
+def check_eviction(base_url: str) -> list:
+    """Final batches and old operation ids are dropped, and the report still balances"""
+    netting = NettingBook(CircleClient("BENCH_API_KEY", base_url), OMNIBUS_ADDRESS, retention=0.0, dedupe_size=2)
+    errors = []
+    for i in range(3):
+        netting.add("user-e", "mint", 1_000_000, operation_id=f"mint:evict-{i}")
+    if netting.entry_for("mint:evict-0") is not None:
+        errors.append("more than dedupe_size operation ids remembered")
+    settlement = netting.settle(force=True)
+    if settlement.status not in SETTLED_STATUSES:
+        netting.apply_status_update(StatusUpdate("transfer", settlement.transfer_id, "complete", 2 ** 62))
+    netting.add("user-e", "mint", 1_000_000)
+    netting.add("user-f", "redeem", 1_000_000)
+    netting.settle(force=True)  # Nets to zero, nothing sent: final right away
+    report = netting.reconciliation_report()
+    if netting.settlements or netting.entries(settlement.batch_id) or netting.stats["evicted_batches"] != 2:
+        errors.append(f"{len(netting.settlements)} final batches kept with retention=0")
+    if netting.entry_for("mint:evict-2") is not None:
+        errors.append("an operation id outlived retention")
+    if not report["balanced"] or netting.position_units != 3_000_000:
+        errors.append(f"report after eviction: {report}")
+    return errors
+
+
+def settle_all(netting: NettingBook):
+    """Settle until nothing is open, retrying batches whose response was lost"""
+    settlement = None
+    while len(netting):
+        try:
+            settlement = netting.settle(force=True) or settlement
+        except requests.RequestException:
+            pass
+    return settlement
+
+
+def run(client: CountingClient, args, netting: NettingBook = None):
+    service = PicPayUSDCService(client, netting=netting)
+    user_ids = [f"user-{i}" for i in range(args.users)]
+    initial = Money.parse(100, "USDC").units
+    for user_id in user_ids:
+        service.create_user_wallet(user_id)
+        service.ledger.adjust_balance(user_id, initial)
+
+    latencies = [[] for _ in range(args.callers)]
+
+    def caller(n: int):
+        rng = random.Random(n)
+        for _ in range(args.conversions // args.callers):
+            user_id = rng.choice(user_ids)
+            start = time.perf_counter()
+            try:
+                if rng.random() < 0.5:
+                    service.convert_brl_to_usdc(user_id, rng.randint(1, 100))
+                else:
+                    service.convert_usdc_to_brl(user_id, Money(rng.randint(1, 20) * 1_000_000, "USDC"))
+            except (ValueError, requests.RequestException):
+                pass
+            latencies[n].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(args.callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    errors = []
+    if netting is not None:
+        # A settled transfer Circle reports failed afterwards has to be settled again
+        settled = settle_all(netting)
+        if settled is not None and settled.transfer_id:
+            service.apply_status_updates([StatusUpdate("transfer", settled.transfer_id, "failed", 2 ** 62)])
+        netting.stop(settle=False)
+        settle_all(netting)
+        report = netting.reconciliation_report()
+        gained = sum(service.ledger.get_wallet(user_id).balance_units for user_id in user_ids) \
+            - initial * args.users
+        if not report["balanced"]:
+            errors.append("reconciliation report does not balance")
+        if len(netting):
+            errors.append(f"{len(netting)} entries left unsettled")
+        if netting.position_units != gained:
+            errors.append(f"omnibus position off by {netting.position_units - gained} units")
+        duplicated = sum(len(ids) - 1 for ids in client.transfer_ids.values())
+        if duplicated:
+            errors.append(f"{duplicated} batches reached Circle twice")
+    service.close()
+    all_latencies = sorted(latency for caller_latencies in latencies for latency in caller_latencies)
+    return len(all_latencies) / elapsed, percentile(all_latencies, 50), percentile(all_latencies, 99), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--conversions", type=int, default=20000)
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--window", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms)
+    base_url = simulator.start_in_process()
+    failed = False
+    try:
+        print(f"{args.conversions} conversions for {args.users} users from {args.callers} callers, "
+              f"{args.latency_ms:g}ms Circle latency")
+        print(f"{'':<24} {'Circle calls':>12} {'USDC moved':>14} {'conversions/s':>14} {'p50':>9} {'p99':>9}  checks")
+        for label, window in (("Transfer per conversion", None), (f"Netted every {args.window:g}s", args.window)):
+            client = CountingClient("BENCH_API_KEY", base_url, error_rate=0.0 if window is None else args.error_rate)
+            netting = NettingBook(client, OMNIBUS_ADDRESS, window=window).start() if window else None
+            rate, p50, p99, errors = run(client, args, netting)
+            failed = failed or bool(errors)
+            print(f"{label:<24} {client.calls:>12} {str(Money(client.moved_units, 'USDC')):>14} {rate:>14.0f} "
+                  f"{p50 * 1000:>7.2f}ms {p99 * 1000:>7.2f}ms  {'; '.join(errors) or 'PASS'}")
+            if netting is not None:
+                print(f"{'':<24} netting: {netting.stats}")
+        errors = check_rejection(base_url)
+        failed = failed or bool(errors)
+        print(f"Batch refused by Circle: {'; '.join(errors) or 'PASS'}")
+        errors = check_retries(base_url)
+        failed = failed or bool(errors)
+        print(f"Retried conversions: {'; '.join(errors) or 'PASS'}")
+        errors = check_eviction(base_url)
+        failed = failed or bool(errors)
+        print(f"Evicted batches: {'; '.join(errors) or 'PASS'}")
+    finally:
+        simulator.stop_process()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
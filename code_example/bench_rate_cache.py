@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark: exchange rate cache
+------------------------------
+
+Measures, against a local CircleSimulator:
+
+1. Rate lookups/sec when every conversion fetches /v1/exchange/rates
+2. Rate lookups/sec served by ExchangeRateCache.get()
+3. How many upstream requests N concurrent cold misses turn into
+4. How many fetches --outage-s seconds of get() calls start while every
+   fetch fails, with a --retry-delay backoff
+5. Whether get() on a stopped cache still serves the fallback rate
+
+Exits with status 1 if the outage starts more than one fetch per
+retry delay, or get() raises once the cache is stopped.
+
+Usage:
+    python bench_rate_cache.py --lookups 1000000 --latency-ms 20 --waiters 200
+"""
+
+import sys
+import time
+import argparse
+import threading
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import EXCHANGE_RATES, CircleClient
+from rate_cache import ExchangeRateCache
+
+
+class DownClient(CircleClient):
+    """CircleClient whose rate requests all fail, counted"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def get_exchange_rate(self, from_currency, to_currency):
+        self.calls += 1
+        raise ConnectionError("Circle unavailable")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=1_000_000)
+    parser.add_argument("--uncached-lookups", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--waiters", type=int, default=200)
+    parser.add_argument("--outage-s", type=float, default=1.0)
+    parser.add_argument("--retry-delay", type=float, default=0.25)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms)
+    base_url = simulator.start_in_thread()
+    client = CircleClient("BENCH_API_KEY", base_url)
+    try:
+        start = time.perf_counter()
+        for _ in range(args.uncached_lookups):
+            float(client.get_exchange_rate("BRL", "USDC")["data"]["rate"])
+        uncached = args.uncached_lookups / (time.perf_counter() - start)
+
+        # Cold misses from many threads at once
+        cache = ExchangeRateCache(client, fallback=EXCHANGE_RATES)
+        barrier = threading.Barrier(args.waiters)
+        before = simulator.request_count
+
+        def waiter():
+            barrier.wait()
+            cache.get_fresh("BRL_USD")
+
+        threads = [threading.Thread(target=waiter) for _ in range(args.waiters)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        upstream = simulator.request_count - before
+
+        cache.start()
+        cache.get_fresh("USD_BRL")
+        get = cache.get
+        start = time.perf_counter()
+        for _ in range(args.lookups):
+            get("BRL_USD")
+        cached = args.lookups / (time.perf_counter() - start)
+        cache.stop()
+
+        down = DownClient("BENCH_API_KEY", base_url)
+        outage = ExchangeRateCache(down, fallback=EXCHANGE_RATES, retry_delay=args.retry_delay)
+        reads = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.outage_s:
+            outage.get("BRL_USD")
+            reads += 1
+        outage.stop()
+
+        stopped = ExchangeRateCache(CircleClient("BENCH_API_KEY", base_url), fallback=EXCHANGE_RATES)
+        stopped.stop()
+        try:
+            after_stop = stopped.get("BRL_USD")
+        except Exception as e:
+            after_stop = e
+    finally:
+        simulator.stop_thread()
+
+    print(f"Uncached (HTTP per lookup): {uncached:12.1f} lookups/s")
+    print(f"ExchangeRateCache.get():    {cached:12.1f} lookups/s")
+    print(f"{args.waiters} concurrent cold misses -> {upstream} upstream request(s)")
+    print(f"Cache stats: {cache.stats}")
+    allowed = int(args.outage_s / args.retry_delay) + 1
+    print(f"Outage: {reads:,} get() calls in {args.outage_s:g}s -> {down.calls} fetch(es) "
+          f"(retry delay {args.retry_delay:g}s)")
+    print(f"get() after stop(): {after_stop!r}")
+    errors = []
+    if down.calls > allowed:
+        errors.append(f"{down.calls} fetches during the outage, more than {allowed}")
+    if after_stop != EXCHANGE_RATES["BRL_USD"]:
+        errors.append(f"get() after stop() returned {after_stop!r} instead of the fallback rate")
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark: shared rate limiter vs uncoordinated retries
+-------------------------------------------------------
+
+Many threads hammer create_transfer against a CircleSimulator that enforces
+an account-wide quota, answers excess requests with 429 + Retry-After and
+counts rejected requests against the quota as well.
+
+1. Blind retry: each thread retries a 429 on its own with a short exponential
+   backoff, ignoring Retry-After (the retryWithBackoff approach)
+2. Limited: all threads share one RateLimiter that adapts to the 429s
+
+For each mode the benchmark reports goodput (successful transfers/sec),
+the number of 429 responses and the calls that gave up after max_retries.
+
+Usage:
+    python bench_rate_limiter.py --threads 32 --quota 200 --seconds 10
+"""
+
+import time
+import random
+import argparse
+import threading
+from typing import Optional
+
+import requests
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient
+from rate_limiter import RateLimiter
+
+
+class BlindRetryClient(CircleClient):
+    """CircleClient retrying 429s with its own backoff and no shared limiter"""
+
+    def __init__(self, api_key: str, base_url: str, max_retries: int = 5):
+        super().__init__(api_key, base_url, max_retries=0)
+        self.blind_retries = max_retries
+
+    def create_transfer(self, *args, **kwargs):
+        for attempt in range(self.blind_retries + 1):
+            try:
+                return super().create_transfer(*args, **kwargs)
+            except requests.HTTPError as e:
+                if e.response.status_code != 429 or attempt == self.blind_retries:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def run(base_url: str, simulator: CircleSimulator, threads: int, seconds: float,
+        limiter: Optional[RateLimiter]) -> dict:
+    stop_at = time.monotonic() + seconds
+    successes = [0] * threads
+    failures = [0] * threads
+    throttled_before = simulator.throttled_count
+
+    def worker(n: int):
+        if limiter is None:
+            client = BlindRetryClient("BENCH_API_KEY", base_url, max_retries=5)
+        else:
+            client = CircleClient("BENCH_API_KEY", base_url, rate_limiter=limiter, max_retries=5)
+        while time.monotonic() < stop_at:
+            try:
+                client.create_transfer("wallet-a", "wallet-b", 1.0, "USD")
+                successes[n] += 1
+            except requests.HTTPError:
+                failures[n] += 1
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.monotonic()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    return {
+        "goodput": sum(successes) / elapsed,
+        "throttled": simulator.throttled_count - throttled_before,
+        "failed": sum(failures),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--quota", type=float, default=200.0, help="Simulated Circle quota (req/s)")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--state-dir", default=None,
+                        help="Share limiter state through this directory (cross-process mode)")
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms, rate_limit_rps=args.quota,
+                                retry_after=1.0, penalize_throttled=True)
+    base_url = simulator.start_in_thread()
+    try:
+        blind = run(base_url, simulator, args.threads, args.seconds, None)
+        time.sleep(1.0)  # let the simulator's quota refill between runs
+        limiter = RateLimiter(rate=args.quota * 2, state_dir=args.state_dir)
+        limited = run(base_url, simulator, args.threads, args.seconds, limiter)
+    finally:
+        simulator.stop_thread()
+
+    print(f"Quota {args.quota:g} req/s, {args.threads} threads, {args.seconds:g}s per mode")
+    for name, result in (("blind retry", blind), ("rate limited", limited)):
+        print(f"{name:>14}: goodput {result['goodput']:8.1f}/s  "
+              f"429s {result['throttled']:6d}  gave up {result['failed']:5d}")
+    print(f"Adapted rate for POST /v1/transfers: {limiter.bucket('POST /v1/transfers').rate:.1f} req/s")
+    limiter.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Benchmark: settlement reconciliation
+------------------------------------
+
+Generates --rows synthetic Circle records (UUID ids, USDC and BRL amounts)
+and the matching ledger rows --chunk-rows at a time, with one row in every
+--every of each kind broken on purpose:
+
+- an amount off by a few units, a currency that differs, a Circle record
+  with no ledger row, and a ledger row with no Circle record
+- a ledger entry split in two rows that add up (not a mismatch)
+
+1. Reconciler: ids decoded and rows spilled chunk by chunk, then the join;
+   reports rows per second for each phase and the process' peak RSS, which
+   should not grow with --rows
+2. A dict keyed by id string, one Python lookup per row, on the first
+   --baseline-rows rows (the join only; the strings are built beforehand)
+3. A LedgerJournal with a reversed entry and a torn last row, and ledger
+   rows of one id in two currencies
+4. circle_rows over lists that cap pageSize at 50, like Circle, with a
+   transfer in a currency Money does not know
+
+Exits with status 1 if the report does not find exactly the broken rows
+(counts, drift and the mismatch CSV), the baseline finds something else, or
+the journal, mixed-currency and paging checks fail.
+
+Usage:
+    python bench_reconciliation.py --rows 10000000 --chunk-rows 1000000 --partitions 64
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+
+from money import Money
+from reconciliation import (CATEGORIES, CURRENCIES, CURRENCY_CODES, ROW_DTYPE, LedgerJournal, Reconciler, circle_rows,
+                            id_keys, reconcile)
+
+HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+USDC, BRL = CURRENCY_CODES["USDC"], CURRENCY_CODES["BRL"]
+# Offsets of the broken rows within each --every rows
+DRIFT, CURRENCY, MISSING_IN_LEDGER, SPLIT = 1, 2, 3, 4
+
+
+def uuid_strings(key_bytes: np.ndarray) -> np.ndarray:
+    """"S36" UUID strings of (n, 16) uint8 values"""
+    digits = np.empty((len(key_bytes), 32), dtype=np.uint8)
+    digits[:, 0::2] = HEX[key_bytes >> 4]
+    digits[:, 1::2] = HEX[key_bytes & 15]
+    chars = np.full((len(key_bytes), 36), ord("-"), dtype=np.uint8)
+    chars[:, [i for i in range(36) if i not in (8, 13, 18, 23)]] = digits
+    return chars.view("S36").ravel()
+
+
+def synthetic(rows: int, chunk_rows: int, every: int, seed: int):
+    """((circle ids, units, currencies), (ledger ids, units, currencies),
+    {currency code: Circle minus ledger units}) per chunk"""
+    for offset in range(0, rows, chunk_rows):
+        count = min(chunk_rows, rows - offset)
+        rng = np.random.default_rng((seed, offset))
+        ids = uuid_strings(rng.integers(0, 256, size=(count, 16), dtype=np.uint8))
+        units = rng.integers(1, 10 ** 10, size=count, dtype=np.int64)
+        currencies = np.where(rng.random(count) < 0.1, BRL, USDC).astype(np.uint8)
+        position = (offset + np.arange(count)) % every
+
+        ledger_units = units.copy()
+        ledger_currencies = currencies.copy()
+        drifted = position == DRIFT
+        ledger_units[drifted] += rng.integers(1, 100, size=int(drifted.sum()))
+        drift = {code: int((units - ledger_units)[drifted & (currencies == code)].sum()) for code in (USDC, BRL)}
+        other = position == CURRENCY
+        ledger_currencies[other] = np.where(currencies[other] == USDC, BRL, USDC)
+        keep = position != MISSING_IN_LEDGER
+        split = position == SPLIT
+        half = units[split] // 2
+        ledger_units[split] -= half
+        extra = count // every  # Ledger rows Circle never saw
+        extra_ids = uuid_strings(rng.integers(0, 256, size=(extra, 16), dtype=np.uint8))
+        ledger = (np.concatenate([ids[keep], ids[split], extra_ids]),
+                  np.concatenate([ledger_units[keep], half, rng.integers(1, 10 ** 10, size=extra)]),
+                  np.concatenate([ledger_currencies[keep], currencies[split], np.full(extra, USDC, np.uint8)]))
+        order = rng.permutation(len(ledger[0]))  # The ledger comes in another order
+        yield (ids, units, currencies), tuple(column[order] for column in ledger), drift
+
+
+def columns(ids: np.ndarray, units: np.ndarray, currencies: np.ndarray) -> np.ndarray:
+    rows = np.empty(len(ids), dtype=ROW_DTYPE)
+    rows["hi"], rows["lo"] = id_keys(ids)
+    rows["units"] = units
+    rows["currency"] = currencies
+    return rows
+
+
+def expected(rows: int, chunk_rows: int, every: int) -> dict:
+    counts = {name: max(0, (rows - offset + every - 1) // every)
+              for name, offset in (("amount_mismatch", DRIFT), ("currency_mismatch", CURRENCY),
+                                   ("missing_in_ledger", MISSING_IN_LEDGER), ("duplicate_ledger_rows", SPLIT))}
+    counts["missing_at_circle"] = sum(min(chunk_rows, rows - offset) // every for offset in range(0, rows, chunk_rows))
+    counts["matched"] = rows - counts["missing_in_ledger"]
+    return counts
+
+
+def dict_join(circle, ledger) -> dict:
+    """The Python baseline: (mismatch counts, seconds)"""
+    start = time.perf_counter()
+    entries = {}
+    for transaction_id, units, currency in ledger:
+        entry = entries.get(transaction_id)
+        if entry is None:
+            entries[transaction_id] = [units, currency]
+        else:
+            entry[0] += units
+    counts = dict.fromkeys(CATEGORIES, 0)
+    for transaction_id, units, currency in circle:
+        entry = entries.pop(transaction_id, None)
+        if entry is None:
+            counts["missing_in_ledger"] += 1
+        elif entry[1] != currency:
+            counts["currency_mismatch"] += 1
+        elif entry[0] != units:
+            counts["amount_mismatch"] += 1
+    counts["missing_at_circle"] = len(entries)
+    return counts, time.perf_counter() - start
+
+
+def check_journal(work: str) -> list:
+    """A reversed entry is left out, a torn row is cut off, and ids whose
+    ledger rows come in two currencies are not summed"""
+    errors = []
+    path = os.path.join(work, "journal.bin")
+    journal = LedgerJournal(path)
+    journal.append("kept", 5_000_000)
+    journal.append("reversed", 7_000_000)
+    journal.append("reversed", -7_000_000)
+    journal.close()
+    with open(path, "ab") as torn:
+        torn.write(b"\1" * 10)
+    journal = LedgerJournal(path)
+    with Reconciler(partitions=4) as reconciler:
+        reconciler.add_circle([("kept", 5_000_000, "USDC")])
+        reconciler.add_journal(journal)
+        report = reconciler.run()
+    journal.close()
+    if not report["balanced"] or report["cancelled_ledger_ids"] != 1 or report["ledger_rows"] != 3:
+        errors.append(f"journal: {report['matched']} matched, {report['cancelled_ledger_ids']} cancelled, "
+                      f"{report['ledger_rows']} rows, balanced={report['balanced']}")
+
+    report = reconcile([("mixed", 10_000, "USDC")], [("mixed", 5_000, "USDC"), ("mixed", 5_000, "BRL")],
+                       partitions=4)
+    if report["currency_mismatch"] != 1 or report["mixed_currency_ledger_ids"] != 1:
+        errors.append(f"mixed currencies: {report['currency_mismatch']} currency mismatches, "
+                      f"{report['mixed_currency_ledger_ids']} mixed ids")
+    return errors
+
+
+class CappedLists:
+    """Newest-first transfer and FX settlement lists that, like Circle,
+    return at most 50 items whatever pageSize asks for"""
+
+    def __init__(self, transfers: int):
+        self.transfers = [{"id": f"transfer-{i}", "status": "complete", "amount": {"amount": "1.00", "currency": "USD"}}
+                          for i in range(transfers)]
+        # A currency Money does not know
+        self.transfers.append({"id": "transfer-eur", "status": "complete",
+                               "amount": {"amount": "3.50", "currency": "EUR"}})
+
+    @staticmethod
+    def _page(items, page_size, page_after):
+        start = 0 if page_after is None else next(i for i, item in enumerate(items) if item["id"] == page_after) + 1
+        return {"data": items[start:start + min(page_size, 50)]}
+
+    def list_transfers(self, from_date=None, page_size=50, page_after=None):
+        return self._page(self.transfers, page_size, page_after)
+
+    def list_fx_settlements(self, from_date=None, page_size=50, page_after=None):
+        return {"data": []}
+
+
+def check_circle_rows() -> list:
+    """circle_rows keeps paging when Circle returns fewer items than asked
+    for, and an unknown currency is reported rather than raised"""
+    try:
+        rows = list(circle_rows(CappedLists(120), page_size=100))
+    except ValueError as e:
+        return [f"circle_rows raised {e}"]
+    if len(rows) != 121:
+        return [f"circle_rows read {len(rows)} of 121 transfers with page_size=100"]
+    report = reconcile(rows, [(f"transfer-{i}", 1_000_000, "USDC") for i in range(120)], partitions=4)
+    if (report["matched"], report["missing_in_ledger"], report["unknown_currency_circle_rows"]) != (120, 1, 1):
+        return [f"EUR transfer: {report['matched']} matched, {report['missing_in_ledger']} missing in the ledger, "
+                f"{report['unknown_currency_circle_rows']} in an unknown currency"]
+    return []
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5_000_000, help="Circle records")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    parser.add_argument("--partitions", type=int, default=64)
+    parser.add_argument("--every", type=int, default=1000, help="One broken row of each kind per this many")
+    parser.add_argument("--baseline-rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    errors = []
+    with tempfile.TemporaryDirectory(prefix="bench-reconcile-") as work:
+        csv_path = os.path.join(work, "mismatches.csv")
+        with Reconciler(partitions=args.partitions, chunk_rows=args.chunk_rows, spill_dir=work) as reconciler:
+            start = time.perf_counter()
+            generating = 0.0
+            drift = {}
+            chunks = synthetic(args.rows, args.chunk_rows, args.every, args.seed)
+            while True:
+                generated = time.perf_counter()
+                chunk = next(chunks, None)
+                generating += time.perf_counter() - generated
+                if chunk is None:
+                    break
+                circle, ledger, chunk_drift = chunk
+                reconciler.add_columns("circle", columns(*circle))
+                reconciler.add_columns("ledger", columns(*ledger))
+                for code, units in chunk_drift.items():
+                    drift[code] = drift.get(code, 0) + units
+            loaded = time.perf_counter()
+            report = reconciler.run(mismatch_csv=csv_path)
+            joined = time.perf_counter()
+        with open(csv_path) as output:
+            csv_rows = sum(1 for _ in output) - 1
+        errors.extend(check_journal(work))
+    errors.extend(check_circle_rows())
+    load_seconds = loaded - start - generating
+    total_rows = report["circle_rows"] + report["ledger_rows"]
+    rss = peak_rss_mb()
+
+    print(f"Reconciliation: {report['circle_rows']} Circle records, {report['ledger_rows']} ledger rows, "
+          f"chunks of {args.chunk_rows}, {args.partitions} partitions")
+    print(f"  decode + spill   {load_seconds:8.2f}s {total_rows / load_seconds:>14,.0f} rows/s")
+    print(f"  join + report    {joined - loaded:8.2f}s {total_rows / (joined - loaded):>14,.0f} rows/s")
+    print(f"  total            {joined - loaded + load_seconds:8.2f}s "
+          f"{total_rows / (joined - loaded + load_seconds):>14,.0f} rows/s   peak RSS {rss:.0f}MB")
+    print(f"  found: {report['matched']} matched, " + ", ".join(f"{report[key]} {key}" for key in CATEGORIES)
+          + f", {report['duplicate_ledger_rows']} split ledger rows")
+    print("  drift (Circle - ledger): " + ", ".join(f"{money!r}" for money in report["amount_drift"].values()))
+
+    want = expected(args.rows, args.chunk_rows, args.every)
+    for key, count in want.items():
+        if report[key] != count:
+            errors.append(f"{key}: {report[key]} instead of {count}")
+    if report["duplicate_circle_rows"]:
+        errors.append(f"{report['duplicate_circle_rows']} duplicate Circle rows")
+    if csv_rows != sum(report[key] for key in CATEGORIES):
+        errors.append(f"{csv_rows} rows in the mismatch CSV")
+
+    for code, units in drift.items():
+        currency = CURRENCIES[code]
+        if units and report["amount_drift"].get(currency) != Money(units, currency):
+            errors.append(f"{currency} drift {report['amount_drift'].get(currency)!r} instead of "
+                          f"{Money(units, currency)!r}")
+
+    # Baseline on the first baseline_rows rows
+    circle, ledger = [], []
+    names = {USDC: "USDC", BRL: "BRL"}
+    for chunk in synthetic(args.baseline_rows, args.chunk_rows, args.every, args.seed):
+        for rows, (ids, units, currencies) in zip((circle, ledger), chunk[:2]):
+            rows.extend(zip([i.decode() for i in ids.tolist()], units.tolist(),
+                            [names[code] for code in currencies.tolist()]))
+    baseline, baseline_seconds = dict_join(circle, ledger)
+    small = Reconciler(partitions=args.partitions, chunk_rows=args.chunk_rows)
+    start = time.perf_counter()
+    small.add_circle(circle)
+    small.add_ledger(ledger)
+    small_report = small.run()
+    small_seconds = time.perf_counter() - start
+    small.close()
+    rows = len(circle) + len(ledger)
+    print(f"  {len(circle)} Circle records from Python rows: dict join {rows / baseline_seconds:,.0f} rows/s, "
+          f"Reconciler {rows / small_seconds:,.0f} rows/s (tuples to arrays included)")
+    for key in CATEGORIES:
+        if baseline[key] != small_report[key]:
+            errors.append(f"baseline found {baseline[key]} {key}, the Reconciler {small_report[key]}")
+
+    print(f"Checks: {'; '.join(errors) or 'PASS'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
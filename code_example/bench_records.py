@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark: dict records vs __slots__ records
+--------------------------------------------
+
+Compares the wallet and result representations used before and after
+records.py:
+
+1. Memory per million wallets (dict with hex address, ISO timestamp and
+   float balance vs WalletRecord with 20-byte address and epoch microseconds)
+2. Results built per second (dict with datetime.now().isoformat() vs
+   ConversionResult, which formats its timestamp only when read)
+
+Usage:
+    python bench_records.py --wallets 1000000 --results 1000000
+"""
+
+import os
+import time
+import uuid
+import argparse
+import tracemalloc
+from datetime import datetime
+
+from records import ConversionResult, WalletRecord, new_address, now_us
+
+
+def dict_wallet() -> dict:
+    return {
+        "wallet_address": f"0x{os.urandom(20).hex()}",
+        "created_at": datetime.now().isoformat(),
+        "balance_usdc": 0.0
+    }
+
+
+def record_wallet() -> WalletRecord:
+    return WalletRecord(new_address(), now_us(), 0)
+
+
+def wallet_memory(factory, count: int) -> int:
+    tracemalloc.start()
+    wallets = {f"user_{i}": factory() for i in range(count)}
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del wallets
+    return current
+
+
+def result_rate(factory, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        factory(i)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=1_000_000)
+    parser.add_argument("--results", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    # Both include the user_id keys and the dict holding the wallets
+    dict_bytes = wallet_memory(dict_wallet, args.wallets)
+    record_bytes = wallet_memory(record_wallet, args.wallets)
+    scale = 1_000_000 / args.wallets
+
+    transaction_id = str(uuid.uuid4())
+    dict_rate = result_rate(lambda i: {
+        "user_id": "user_1",
+        "amount_brl": 500.0,
+        "amount_usdc": 100.0,
+        "transaction_id": transaction_id,
+        "status": "pending",
+        "timestamp": datetime.now().isoformat()
+    }, args.results)
+    record_rate = result_rate(
+        lambda i: ConversionResult("user_1", 500.0, 100.0, transaction_id, "pending"), args.results)
+
+    print(f"Wallet memory per million: dict {dict_bytes * scale / 2**20:8.1f} MiB   "
+          f"record {record_bytes * scale / 2**20:8.1f} MiB   "
+          f"({1 - record_bytes / dict_bytes:.0%} less)")
+    print(f"Results built per second:  dict {dict_rate:12,.0f}   record {record_rate:12,.0f}   "
+          f"({record_rate / dict_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
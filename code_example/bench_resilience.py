@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmark: circuit breakers and hedged requests (chaos)
+-------------------------------------------------------
+
+Runs CircleClient against local CircleSimulators misbehaving on purpose:
+
+1. Long tail: get_transfer_status from --callers threads while Circle's
+   latency is lognormal with mean --latency-ms and sigma --sigma; compares
+   p50/p99/p99.9/max with and without a Hedger, and how many extra requests
+   the hedges cost
+2. Slowdown: every GET /v1/transfers/{id} takes --slow-ms. Compares no
+   timeout (what the client did before), a --read-timeout, and the timeout
+   plus CircuitBreakers: after a few timeouts the circuit opens and the
+   remaining calls fail in microseconds instead of holding a thread
+3. Breaker states: open after the threshold, fail fast, a single trial call
+   once reset_timeout has passed, closed again after it succeeds
+
+Exits with status 1 if hedging does not lower p99, if any call with the
+breaker waited well beyond the read timeout, or if the breaker misbehaves.
+
+Usage:
+    python bench_resilience.py --requests 4000 --callers 16 --latency-ms 10 --sigma 1.2
+"""
+
+import sys
+import time
+import argparse
+import threading
+
+import requests
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient
+from resilience import CircuitBreaker, CircuitBreakers, CircuitOpenError, Hedger
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def drive(client: CircleClient, transfer_id: str, requests_total: int, callers: int):
+    """Call get_transfer_status from callers threads; returns sorted
+    latencies and outcome counts"""
+    latencies = [[] for _ in range(callers)]
+    outcomes = {}
+    lock = threading.Lock()
+
+    def caller(n: int):
+        for _ in range(requests_total // callers):
+            start = time.perf_counter()
+            try:
+                client.get_transfer_status(transfer_id)
+                outcome = "ok"
+            except CircuitOpenError:
+                outcome = "fast-failed"
+            except requests.Timeout:
+                outcome = "timed out"
+            latencies[n].append(time.perf_counter() - start)
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latency for caller_latencies in latencies for latency in caller_latencies), outcomes
+
+
+def row(label: str, latencies, extra: str = "") -> str:
+    return (f"  {label:<26}" + "".join(f" {percentile(latencies, pct) * 1000:>8.1f}ms" for pct in (50, 99, 99.9))
+            + f" {latencies[-1] * 1000:>8.1f}ms  {extra}")
+
+
+def new_transfer(base_url: str) -> str:
+    return CircleClient("BENCH_API_KEY", base_url).create_transfer("1000000001", "1000000002", 1, "USD")["data"]["id"]
+
+
+def long_tail(args) -> bool:
+    simulator = CircleSimulator(latency_ms=args.latency_ms, latency_distribution="lognormal",
+                                latency_sigma=args.sigma, seed=1)
+    base_url = simulator.start_in_process()
+    try:
+        transfer_id = new_transfer(base_url)
+        plain, _ = drive(CircleClient("BENCH_API_KEY", base_url), transfer_id, args.requests, args.callers)
+        hedger = Hedger(percentile=args.hedge_percentile)
+        hedged, _ = drive(CircleClient("BENCH_API_KEY", base_url, hedger=hedger), transfer_id,
+                          args.requests, args.callers)
+        hedger.close()
+    finally:
+        simulator.stop_process()
+    ok = percentile(hedged, 99) < percentile(plain, 99)
+    print(f"Long tail: lognormal latency, mean {args.latency_ms:g}ms, sigma {args.sigma:g}, "
+          f"{args.requests} requests from {args.callers} callers")
+    print(f"  {'':<26} {'p50':>10} {'p99':>10} {'p99.9':>10} {'max':>10}")
+    print(row("no hedging", plain))
+    print(row(f"hedged after p{args.hedge_percentile:g}", hedged,
+              f"+{hedger.stats['hedged'] / hedger.stats['calls']:.1%} requests, "
+              f"{hedger.stats['hedge_won']} hedges won  {'PASS' if ok else 'FAIL'}"))
+    return ok
+
+
+def slowdown(args) -> bool:
+    simulator = CircleSimulator(endpoint_latency_ms={"GET /v1/transfers/{transfer_id}": args.slow_ms})
+    base_url = simulator.start_in_process()
+    ok = True
+    calls = args.callers * args.slow_calls
+    try:
+        transfer_id = new_transfer(base_url)
+        print(f"Slowdown: GET /v1/transfers/{{id}} takes {args.slow_ms:g}ms, {calls} calls from "
+              f"{args.callers} callers")
+        print(f"  {'':<26} {'p50':>10} {'p99':>10} {'p99.9':>10} {'max':>10}")
+        timeout = (1.0, args.read_timeout)
+        for label, client in (
+                ("no timeout", CircleClient("BENCH_API_KEY", base_url, timeout=None)),
+                (f"{args.read_timeout:g}s read timeout", CircleClient("BENCH_API_KEY", base_url, timeout=timeout)),
+                ("timeout + breaker", CircleClient("BENCH_API_KEY", base_url, timeout=timeout,
+                                                   breakers=CircuitBreakers(failure_threshold=5,
+                                                                            reset_timeout=60)))):
+            latencies, outcomes = drive(client, transfer_id, calls, args.callers)
+            extra = ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items()))
+            if client.breakers is not None:
+                # Bounded: nothing waits much past the read timeout, and most calls do not wait at all
+                bounded = latencies[-1] < args.read_timeout * 1.5 and outcomes.get("fast-failed", 0) > calls // 2
+                ok = ok and bounded
+                extra += f"  {'PASS' if bounded else 'FAIL'}"
+            print(row(label, latencies, extra))
+    finally:
+        simulator.stop_process()
+    return ok
+
+
+def check_breaker() -> list:
+    errors = []
+    breaker = CircuitBreaker("GET /v1/test", failure_threshold=3, reset_timeout=0.1)
+    for _ in range(3):
+        breaker.before_call()
+        breaker.on_failure()
+    if breaker.state != "open":
+        errors.append("did not open after the threshold")
+    try:
+        breaker.before_call()
+        errors.append("open circuit let a call through")
+    except CircuitOpenError:
+        pass
+    time.sleep(0.15)
+    breaker.before_call()  # The trial call
+    try:
+        breaker.before_call()
+        errors.append("half-open circuit let a second call through")
+    except CircuitOpenError:
+        pass
+    breaker.on_failure()
+    if breaker.state != "open":
+        errors.append("failed trial did not reopen the circuit")
+    time.sleep(0.15)
+    breaker.before_call()
+    breaker.on_success()
+    if breaker.state != "closed":
+        errors.append("successful trial did not close the circuit")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=10.0)
+    parser.add_argument("--sigma", type=float, default=1.2)
+    parser.add_argument("--hedge-percentile", type=float, default=95.0)
+    parser.add_argument("--slow-ms", type=float, default=2000.0)
+    parser.add_argument("--slow-calls", type=int, default=4, help="Calls per caller during the slowdown")
+    parser.add_argument("--read-timeout", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = [long_tail(args), slowdown(args)]
+    errors = check_breaker()
+    print(f"Breaker states: {'; '.join(errors) or 'PASS'}")
+    sys.exit(0 if all(results) and not errors else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark: sharded service
+--------------------------
+
+Starts ShardedService with 1, 2, 4, ... --max-shards worker processes,
+funds --users users through convert_brl_to_usdc on a local CircleSimulator,
+then sends --payments random payments between them (most cross shards) from
+--routers router processes in batches of --batch, and reports payments per
+second and the speedup over one shard.
+
+Checks after every run that the balances still add up to what was funded
+and that nothing went negative, and that recovery settles the holds of
+payments whose router died after the credit, or before it; exits with
+status 1 otherwise. Scaling needs at least shards + routers free cores.
+
+Usage:
+    python bench_sharded_service.py --max-shards 16 --routers 4 --payments 400000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import multiprocessing
+
+from circle_simulator import CircleSimulator
+from money import Money
+from sharded_service import ShardedService, ShardRouter
+from user_locks import shard_of
+
+
+def _route_payments(addresses, authkey, user_ids, payments: int, batch: int, seed: int, start, results):
+    router = ShardRouter(addresses, authkey)
+    rng = random.Random(seed)
+    batches = [[(rng.choice(user_ids), rng.choice(user_ids), Money(rng.randint(1, 100) * 10_000, "USDC"))
+                for _ in range(min(batch, payments - done))] for done in range(0, payments, batch)]
+    start.wait()
+    failed = 0
+    for payment_batch in batches:
+        failed += sum(1 for result in router.send_international_payments(payment_batch)
+                      if isinstance(result, Exception))
+    results.put(failed)
+    router.close()
+
+
+def run(base_url: str, shards: int, args) -> tuple:
+    user_ids = [f"user-{i}" for i in range(args.users)]
+    with ShardedService("BENCH_API_KEY", base_url, shards=shards) as cluster:
+        funded = cluster.router.map("convert_brl_to_usdc", [(user_id, 500) for user_id in user_ids])
+        errors = [result for result in funded if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        total = sum(result.amount_usdc.units for result in funded)
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        routers = [multiprocessing.Process(target=_route_payments, args=(
+            cluster.addresses, cluster.authkey, user_ids, args.payments // args.routers, args.batch,
+            args.seed + n, start, results)) for n in range(args.routers)]
+        for router in routers:
+            router.start()
+        time.sleep(0.5)  # Let the routers build their batches and connect
+        began = time.perf_counter()
+        start.set()
+        failed = sum(results.get() for _ in routers)
+        elapsed = time.perf_counter() - began
+        for router in routers:
+            router.join()
+
+        balances = [balance["balance_usdc"].units
+                    for balance in cluster.router.map("get_user_balance", [(user_id,) for user_id in user_ids])]
+    problems = []
+    if min(balances) < 0:
+        problems.append("negative balance")
+    if sum(balances) != total:
+        problems.append(f"total off by {sum(balances) - total} units")
+    return (args.payments // args.routers) * args.routers / elapsed, failed, problems
+
+
+def check_recovery(base_url: str) -> list:
+    """Leave one payment credited but not committed and one prepared but not
+    credited, as a dead router would, and check what recovery makes of them"""
+    problems = []
+    with ShardedService("BENCH_API_KEY", base_url, shards=2, service_options={"hold_ttl": 0.5}) as cluster:
+        router = cluster.router
+        sender = "user-0"
+        recipient = next(f"user-{i}" for i in range(1, 100) if shard_of(f"user-{i}", 2) != shard_of(sender, 2))
+        router.convert_brl_to_usdc(sender, 500)
+        router.create_user_wallet(recipient)
+        credited = router.call("prepare_payment", sender, 10_000_000, recipient)
+        router.call("credit_payment", recipient, 10_000_000, credited)
+        abandoned = router.call("prepare_payment", sender, 20_000_000, recipient)
+        time.sleep(3)
+        try:
+            router.call("credit_payment", recipient, 20_000_000, abandoned)
+            problems.append("a credit arriving after recovery was accepted")
+        except ValueError:
+            pass
+        if router.call("commit_payment", sender, credited) is not True:
+            problems.append("a late commit of a recovered payment was not reported as committed")
+        sender_units = router.get_user_balance(sender)["balance_usdc"].units
+        recipient_units = router.get_user_balance(recipient)["balance_usdc"].units
+        if (sender_units, recipient_units) != (90_000_000, 10_000_000):
+            problems.append(f"recovery left {sender_units} / {recipient_units} units, expected 90000000 / 10000000")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-shards", type=int, default=16)
+    parser.add_argument("--routers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--payments", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator()
+    base_url = simulator.start_in_process()
+    failed_checks = False
+    baseline = None
+    try:
+        print(f"{args.payments} payments between {args.users} users, {args.routers} routers, "
+              f"batches of {args.batch}, {os.cpu_count()} CPUs")
+        print(f"{'shards':>6} {'payments/s':>12} {'speedup':>8} {'rejected':>9}  checks")
+        shards = 1
+        while shards <= args.max_shards:
+            rate, rejected, problems = run(base_url, shards, args)
+            baseline = baseline or rate
+            failed_checks = failed_checks or bool(problems)
+            print(f"{shards:>6} {rate:>12.0f} {rate / baseline:>7.1f}x {rejected:>9}  {'; '.join(problems) or 'PASS'}")
+            shards *= 2
+        problems = check_recovery(base_url)
+        failed_checks = failed_checks or bool(problems)
+        print(f"Recovery of abandoned payments: {'; '.join(problems) or 'PASS'}")
+    finally:
+        simulator.stop_process()
+    sys.exit(1 if failed_checks else 0)
+
+
+if __name__ == "__main__":
+    main()
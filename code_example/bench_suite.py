@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Benchmark: end-to-end service suite
+-----------------------------------
+
+Drives PicPayUSDCService and CircleClient against a local CircleSimulator
+(in a child process) and measures every operation the demo only makes
+claims about:
+
+1. create_user_wallet for --users users
+2. convert_brl_to_usdc, send_international_payment, convert_usdc_to_brl
+   and get_user_balance for random users, --ops calls each
+3. get_transaction_history, following the page cursors of a wallet with
+   --history-size synthetic transactions, --ops pages
+
+Each operation runs from --concurrency threads and reports operations per
+second, errors, growth of the peak RSS and an HDR-style latency histogram
+(p50/p99/p99.9, see latency_histogram.py). --output writes everything,
+histograms included, as JSON; a file written that way can be passed back as
+--baseline, and the run exits with status 1 if an operation's throughput
+dropped or its p99 grew by more than --threshold (ignoring p99 changes
+below --noise-floor-us), or if any call failed.
+
+Usage:
+    python bench_suite.py --users 2000 --ops 5000 --concurrency 16 --output baseline.json
+    python bench_suite.py --users 2000 --ops 5000 --concurrency 16 --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import itertools
+import threading
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from latency_histogram import LatencyHistogram
+from money import Money
+
+HISTORY_WALLET = "bench-suite-wallet"
+
+
+def peak_rss_mib() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def measure(operation, count: int, concurrency: int, seed: int) -> dict:
+    """Call operation(rng) count times from concurrency threads, each with its
+    own histogram, and merge the results"""
+    histograms = [LatencyHistogram() for _ in range(concurrency)]
+    errors = [0] * concurrency
+    first_error = []
+    tickets = itertools.count()
+
+    def worker(n: int):
+        rng = random.Random(seed * 1000 + n)
+        histogram = histograms[n]
+        while next(tickets) < count:
+            start = time.perf_counter()
+            try:
+                operation(rng)
+            except Exception as error:
+                errors[n] += 1
+                first_error.append(error)
+            histogram.record_seconds(time.perf_counter() - start)
+
+    rss_before = peak_rss_mib()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    histogram = LatencyHistogram()
+    for worker_histogram in histograms:
+        histogram.merge(worker_histogram)
+    return {
+        "ops": count,
+        "errors": sum(errors),
+        "first_error": repr(first_error[0]) if first_error else None,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_ops_s": round(count / elapsed, 1),
+        "rss_growth_mib": round(peak_rss_mib() - rss_before, 2),
+        "latency": histogram.summary(),
+        "histogram": histogram.to_dict(),
+    }
+
+
+def run_suite(args) -> dict:
+    simulator = CircleSimulator(latency_ms=args.latency_ms, latency_distribution=args.latency_distribution,
+                                history_size=args.history_size, seed=args.seed)
+    client = CircleClient("BENCH_API_KEY", simulator.start_in_process())
+    service = PicPayUSDCService(client)
+    user_ids = [f"user-{i}" for i in range(args.users)]
+    results = {}
+    try:
+        def run(name, operation, count=args.ops):
+            results[name] = measure(operation, count, args.concurrency, args.seed)
+            print(format_row(name, results[name]), flush=True)
+
+        print(f"{'operation':<28} {'ops/s':>9} {'p50':>10} {'p99':>10} {'p99.9':>10} {'max':>10} "
+              f"{'RSS +MiB':>9} {'errors':>7}")
+
+        wallets = iter(user_ids)
+        run("create_user_wallet", lambda rng: service.create_user_wallet(next(wallets)), args.users)
+        run("convert_brl_to_usdc", lambda rng: service.convert_brl_to_usdc(rng.choice(user_ids), 100))
+
+        # Payments and redemptions must not fail for lack of funds
+        for user_id in user_ids:
+            service.ledger.adjust_balance(user_id, Money.parse(1000, "USDC").units)
+        run("send_international_payment",
+            lambda rng: service.send_international_payment(rng.choice(user_ids), rng.choice(user_ids), "1.00"))
+        run("convert_usdc_to_brl", lambda rng: service.convert_usdc_to_brl(rng.choice(user_ids), "1.00"))
+        run("get_user_balance", lambda rng: service.get_user_balance(rng.choice(user_ids)))
+
+        cursors = threading.local()
+
+        def history_page(rng):
+            page = client.get_transaction_history(HISTORY_WALLET, page_size=args.page_size,
+                                                  page_after=getattr(cursors, "after", None))["data"]
+            # Start over from the newest page once the history is exhausted
+            cursors.after = page[-1]["id"] if len(page) == args.page_size else None
+
+        run("get_transaction_history", history_page)
+    finally:
+        service.close()
+        simulator.stop_process()
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": {name: getattr(args, name) for name in (
+                "users", "ops", "concurrency", "latency_ms", "latency_distribution",
+                "history_size", "page_size", "seed")},
+        },
+        "peak_rss_mib": round(peak_rss_mib(), 2),
+        "operations": results,
+    }
+
+
+def format_row(name: str, result: dict) -> str:
+    latency = result["latency"]
+    return (f"{name:<28} {result['throughput_ops_s']:>9.0f} "
+            + " ".join(f"{latency[key] / 1000:>8.2f}ms" for key in ("p50_us", "p99_us", "p999_us", "max_us"))
+            + f" {result['rss_growth_mib']:>9.2f} {result['errors']:>7}")
+
+
+def compare(current: dict, baseline: dict, threshold: float, noise_floor_us: int) -> list:
+    """Regressions of current against baseline, as printable strings"""
+    if current["meta"]["config"] != baseline["meta"]["config"]:
+        print(f"warning: baseline was recorded with {baseline['meta']['config']}")
+    regressions = []
+    for name, before in baseline["operations"].items():
+        after = current["operations"].get(name)
+        if after is None:
+            regressions.append(f"{name}: missing from this run")
+            continue
+        drop = 1 - after["throughput_ops_s"] / before["throughput_ops_s"]
+        if drop > threshold:
+            regressions.append(f"{name}: throughput {before['throughput_ops_s']:.0f} -> "
+                               f"{after['throughput_ops_s']:.0f} ops/s (-{drop:.0%})")
+        p99_before, p99_after = before["latency"]["p99_us"], after["latency"]["p99_us"]
+        if p99_after - p99_before > max(noise_floor_us, p99_before * threshold):
+            regressions.append(f"{name}: p99 {p99_before / 1000:.2f} -> {p99_after / 1000:.2f}ms "
+                               f"(+{p99_after / max(p99_before, 1) - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--latency-distribution", default="fixed")
+    parser.add_argument("--history-size", type=int, default=100_000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Largest tolerated throughput drop or p99 growth (fraction)")
+    parser.add_argument("--noise-floor-us", type=int, default=200,
+                        help="p99 growth below this many microseconds is never a regression")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    print(f"Peak RSS: {results['peak_rss_mib']:.1f} MiB")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=1)
+        print(f"Results written to {args.output}")
+
+    failed = [f"{name}: {result['errors']} errors, first {result['first_error']}"
+              for name, result in results["operations"].items() if result["errors"]]
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold, args.noise_floor_us)
+        print(f"Against {args.baseline} (threshold {args.threshold:.0%}): "
+              f"{'PASS' if not regressions else 'REGRESSION'}")
+        failed += regressions
+    for problem in failed:
+        print(f"  {problem}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark: transfer status tracking
+-----------------------------------
+
+Creates --transfers transfers on a local CircleSimulator that settles them
+after about --settlement-delay seconds, puts --waiters callers on each one,
+and compares:
+
+1. Every caller polling get_transfer_status on its own every --poll-interval
+2. TransferTracker with per-transfer GETs only
+3. TransferTracker allowed to sweep GET /v1/transfers
+
+for requests per confirmed transfer and confirmation detection latency
+(from the transfer's updateDate to the moment a caller learned about it).
+
+Usage:
+    python bench_transfer_tracker.py --transfers 200 --waiters 4 --settlement-delay 3
+"""
+
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient
+from records import FINAL_STATUSES, parse_us
+from transfer_tracker import TransferTracker, _percentile
+
+
+def create_transfers(client: CircleClient, count: int):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return [result["data"] for result in executor.map(
+            lambda i: client.create_transfer(f"wallet-{i % 50}", f"wallet-{i % 50 + 50}", 10.0, "USD"),
+            range(count))]
+
+
+def naive(client: CircleClient, transfers, waiters: int, poll_interval: float):
+    latencies = []
+    lock = threading.Lock()
+
+    def waiter(transfer_id: str):
+        while True:
+            transfer = client.get_transfer_status(transfer_id)["data"]
+            if transfer["status"] in FINAL_STATUSES:
+                with lock:
+                    latencies.append(time.time() - parse_us(transfer["updateDate"]) / 1e6)
+                return
+            time.sleep(poll_interval)
+
+    threads = [threading.Thread(target=waiter, args=(transfer["id"],))
+               for transfer in transfers for _ in range(waiters)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def tracked(client: CircleClient, transfers, waiters: int, settlement_delay: float, sweep: bool):
+    tracker = TransferTracker(client, default_finality=settlement_delay, sweep=sweep).start()
+    try:
+        futures = [tracker.track_transfer(transfer) for transfer in transfers for _ in range(waiters)]
+        for future in futures:
+            future.result()
+        return tracker.metrics()
+    finally:
+        tracker.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transfers", type=int, default=200)
+    parser.add_argument("--waiters", type=int, default=4)
+    parser.add_argument("--settlement-delay", type=float, default=3.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms, settlement_delay=args.settlement_delay,
+                                failure_rate=0.02)
+    client = CircleClient("BENCH_API_KEY", simulator.start_in_thread())
+    rows = []
+    try:
+        transfers = create_transfers(client, args.transfers)
+        before = simulator.request_count
+        latencies = sorted(naive(client, transfers, args.waiters, args.poll_interval))
+        rows.append(("Callers poll on their own", (simulator.request_count - before) / args.transfers,
+                     _percentile(latencies, 50), _percentile(latencies, 99)))
+
+        for label, sweep in (("TransferTracker, GETs", False), ("TransferTracker, sweeps", True)):
+            transfers = create_transfers(client, args.transfers)
+            before = simulator.request_count
+            metrics = tracked(client, transfers, args.waiters, args.settlement_delay, sweep)
+            assert metrics["confirmed"] == args.transfers, metrics
+            rows.append((label, (simulator.request_count - before) / args.transfers,
+                         metrics["detection_p50"], metrics["detection_p99"]))
+    finally:
+        simulator.stop_thread()
+
+    print(f"{args.transfers} transfers x {args.waiters} waiters, ~{args.settlement_delay:g}s to settle")
+    print(f"{'':<28} {'requests/transfer':>18} {'detect p50':>11} {'detect p99':>11}")
+    for label, requests, p50, p99 in rows:
+        print(f"{label:<28} {requests:>18.2f} {p50 * 1000:>9.0f}ms {p99 * 1000:>9.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
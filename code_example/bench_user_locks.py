@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-user locking
+---------------------------
+
+Runs a mixed workload on one PicPayUSDCService from 1, 2, 4, ... --threads
+threads: local payments between random users (send_international_payment)
+and USDC redemptions that call a local CircleSimulator (convert_usdc_to_brl).
+Compares the service's sharded per-user locks with a single global lock
+(UserLocks with one shard) guarding the same critical sections, so Circle
+calls run outside it in both cases and only lock contention differs, and
+after every run checks that
+
+1. no balance went negative
+2. balances plus everything redeemed still add up to the initial total
+
+Exits with status 1 if a check fails.
+
+Usage:
+    python bench_user_locks.py --users 1000 --ops 4000 --threads 32 --latency-ms 5
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+
+from circle_simulator import CircleSimulator
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from money import Money
+from user_locks import UserLocks
+
+
+class GlobalLockService(PicPayUSDCService):
+    """Baseline: every user maps to the same lock"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, locks=UserLocks(shards=1), **kwargs)
+
+
+def run(service_class, client: CircleClient, users: int, ops: int, threads: int,
+        redeem_share: float, seed: int):
+    service = service_class(client)
+    user_ids = [f"user-{i}" for i in range(users)]
+    initial = Money.parse(100, "USDC")
+    for user_id in user_ids:
+        service.create_user_wallet(user_id)
+        service.ledger.adjust_balance(user_id, initial.units)
+
+    redeemed = [0] * threads
+    rejected = [0] * threads
+
+    def worker(n: int):
+        rng = random.Random(seed + n)
+        for _ in range(ops // threads):
+            sender = rng.choice(user_ids)
+            amount = Money.parse(rng.randint(1, 2000) / 100, "USDC")
+            try:
+                if rng.random() < redeem_share:
+                    service.convert_usdc_to_brl(sender, amount)
+                    redeemed[n] += amount.units
+                else:
+                    service.send_international_payment(sender, rng.choice(user_ids), amount)
+            except ValueError:
+                rejected[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    balances = [service.ledger.get_wallet(user_id).balance_units for user_id in user_ids]
+    errors = []
+    if min(balances) < 0:
+        errors.append(f"{sum(1 for units in balances if units < 0)} negative balances")
+    if sum(balances) + sum(redeemed) != initial.units * users:
+        errors.append(f"total off by {sum(balances) + sum(redeemed) - initial.units * users} units")
+    return (ops // threads) * threads / elapsed, sum(rejected), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--redeem-share", type=float, default=0.2)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    thread_counts = []
+    threads = 1
+    while threads <= args.threads:
+        thread_counts.append(threads)
+        threads *= 2
+
+    simulator = CircleSimulator(latency_ms=args.latency_ms)
+    client = CircleClient("BENCH_API_KEY", simulator.start_in_process())
+    failed = False
+    try:
+        print(f"{args.users} users, {args.ops} operations, {args.redeem_share:.0%} redemptions, "
+              f"{args.latency_ms:g}ms Circle latency")
+        print(f"{'threads':>7} {'global lock':>14} {'per-user locks':>15} {'speedup':>8}  checks")
+        for threads in thread_counts:
+            rates = []
+            problems = []
+            for service_class in (GlobalLockService, PicPayUSDCService):
+                rate, _, errors = run(service_class, client, args.users, args.ops, threads,
+                                      args.redeem_share, args.seed)
+                rates.append(rate)
+                problems.extend(f"{service_class.__name__}: {error}" for error in errors)
+            failed = failed or bool(problems)
+            print(f"{threads:>7} {rates[0]:>10.0f} op/s {rates[1]:>11.0f} op/s {rates[1] / rates[0]:>7.1f}x  "
+                  f"{'; '.join(problems) or 'PASS'}")
+    finally:
+        simulator.stop_process()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
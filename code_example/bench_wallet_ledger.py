@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark: wallet ledger backends
+---------------------------------
+
+Fills a ledger with N wallets through create_wallet (the path
+PicPayUSDCService uses) and reports insert rate, lookup latency by user_id
+and by wallet_address, balance update rate, peak RSS and, for SQLite, the
+database size on disk.
+
+Usage:
+    python bench_wallet_ledger.py --backend sqlite --wallets 10000000 --db /tmp/wallets.db
+    python bench_wallet_ledger.py --backend memory --wallets 10000000
+"""
+
+import os
+import time
+import random
+import argparse
+import resource
+
+from records import now_us
+from wallet_ledger import InMemoryLedger, SQLiteLedger
+
+
+def address_for(i: int) -> bytes:
+    return ((i * 0x9E3779B97F4A7C15) % (1 << 160)).to_bytes(20, "big")
+
+
+def percentile_us(samples, pct: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(pct / 100.0 * len(samples)))] / 1000.0
+
+
+def timed_lookups(fn, keys):
+    samples = []
+    for key in keys:
+        start = time.perf_counter_ns()
+        fn(key)
+        samples.append(time.perf_counter_ns() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--wallets", type=int, default=10_000_000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    parser.add_argument("--db", default="bench_wallets.db")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+        ledger = SQLiteLedger(args.db, batch_size=args.batch_size)
+    else:
+        ledger = InMemoryLedger()
+
+    created_us = now_us()
+    start = time.perf_counter()
+    for i in range(args.wallets):
+        ledger.create_wallet(f"user_{i}", address_for(i), created_us)
+    ledger.flush()
+    insert_rate = args.wallets / (time.perf_counter() - start)
+
+    rng = random.Random(7)
+    sample = [rng.randrange(args.wallets) for _ in range(args.lookups)]
+    by_user = timed_lookups(ledger.get_wallet, [f"user_{i}" for i in sample])
+    by_address = timed_lookups(ledger.find_user_by_address, [address_for(i) for i in sample])
+
+    start = time.perf_counter()
+    for i in sample:
+        ledger.adjust_balance(f"user_{i}", 1_000_000)
+    ledger.flush()
+    update_rate = len(sample) / (time.perf_counter() - start)
+
+    print(f"Backend: {args.backend}, wallets: {args.wallets:,}")
+    print(f"Insert rate:         {insert_rate:12,.0f} wallets/s")
+    print(f"Lookup by user_id:   p50 {percentile_us(by_user, 50):7.1f} us   p99 {percentile_us(by_user, 99):7.1f} us")
+    print(f"Lookup by address:   p50 {percentile_us(by_address, 50):7.1f} us   p99 {percentile_us(by_address, 99):7.1f} us")
+    print(f"Balance updates:     {update_rate:12,.0f} updates/s")
+    print(f"Peak RSS:            {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:12,.1f} MiB")
+    if args.backend == "sqlite":
+        ledger.close()
+        print(f"Database size:       {os.path.getsize(args.db) / 1024 / 1024:12,.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
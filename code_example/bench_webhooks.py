@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Benchmark: webhook ingestion
+----------------------------
+
+Load generator for WebhookReceiver. The receiver and its PicPayUSDCService
+run in a child process (one event loop, one core) that tracks --transfers
+transfers; the generator posts signed "transfers" notifications for them
+over --connections keep-alive connections, with --duplicate-ratio of them
+delivered twice and a --failed-ratio of transfers failing (which reverses
+their balance changes).
+
+Reports notifications/sec, p50/p99 time to acknowledgement, the receiver's
+CPU time per notification, and checks that every unique notification was
+applied exactly once and that malformed requests are answered 400.
+
+Usage:
+    python bench_webhooks.py --notifications 50000 --connections 64
+"""
+
+import time
+import json
+import random
+import asyncio
+import argparse
+
+from demo_code_example_en import CircleClient, PicPayUSDCService
+from money import Money
+from records import TransactionRecord
+from webhook_receiver import SIGNATURE_HEADER, WebhookReceiver, sign
+
+SECRET = b"bench-webhook-secret"
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_requests(args, host: str, path: str):
+    """Signed raw HTTP requests, with duplicates mixed in"""
+    rng = random.Random(7)
+    requests = []
+    for i in range(args.notifications):
+        status = "failed" if rng.random() < args.failed_ratio else "complete"
+        body = json.dumps({
+            "notificationType": "transfers",
+            "version": 1,
+            "transfer": {
+                "id": f"transfer-{i % args.transfers}",
+                "status": status,
+                "createDate": "2025-01-15T11:00:00.000Z",
+                "updateDate": f"2025-01-15T11:05:{i // args.transfers % 60:02d}.{i % 1000:03d}Z",
+                "amount": {"amount": "10.00", "currency": "USDC"},
+            },
+        }).encode()
+        request = (f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                   f"{SIGNATURE_HEADER}: {sign(SECRET, body)}\r\nContent-Length: {len(body)}\r\n\r\n"
+                   ).encode() + body
+        requests.append(request)
+        if rng.random() < args.duplicate_ratio:
+            requests.append(request)
+    rng.shuffle(requests)
+    return requests
+
+
+async def post_all(host: str, port: int, requests, connections: int):
+    latencies = []
+    statuses = {}
+    queue = iter(requests)
+
+    async def connection():
+        reader, writer = await asyncio.open_connection(host, port)
+        for request in queue:
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head[9:12])
+            length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.perf_counter() - start, latencies, statuses
+
+
+async def post_malformed(host: str, port: int):
+    """Statuses of requests whose request line or Content-Length cannot be parsed"""
+    statuses = []
+    for request in (b"GARBAGE\r\n\r\n", b"POST /webhooks/circle HTTP/1.1\r\nContent-Length: ten\r\n\r\n",
+                    b"POST /webhooks/circle HTTP/1.1\r\nContent-Length: -1\r\n\r\n"):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        statuses.append(int(head[9:12]))
+        writer.close()
+    return statuses
+
+
+async def post_oversized(host: str, port: int, path: str, max_body_bytes: int):
+    """Status of a request announcing a body over max_body_bytes (none is sent)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"POST {path} HTTP/1.1\r\nContent-Length: {max_body_bytes + 1}\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    writer.close()
+    return int(head[9:12])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notifications", type=int, default=50_000)
+    parser.add_argument("--transfers", type=int, default=10_000)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--failed-ratio", type=float, default=0.05)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    service = PicPayUSDCService(CircleClient("BENCH_API_KEY", "http://127.0.0.1:9"))
+    amount = Money.parse(10, "USDC")
+    for i in range(args.transfers):
+        sender, recipient = f"sender_{i % 100}", f"recipient_{i % 1000}"
+        for user_id in (sender, recipient):
+            if user_id not in service.ledger:
+                service.create_user_wallet(user_id)
+        service.transactions[f"transfer-{i}"] = TransactionRecord(
+            "transfer", sender, recipient, amount.units, "pending", 0)
+
+    receiver = WebhookReceiver(service, SECRET, batch_size=args.batch_size)
+    receiver.start_in_process()
+    requests = build_requests(args, receiver.host, receiver.path)
+    try:
+        malformed = asyncio.run(post_malformed(receiver.host, receiver.port))
+        oversized = asyncio.run(post_oversized(receiver.host, receiver.port, receiver.path,
+                                               receiver.max_body_bytes))
+        elapsed, latencies, statuses = asyncio.run(
+            post_all(receiver.host, receiver.port, requests, args.connections))
+    finally:
+        stats = receiver.stop_process()
+
+    unique = len(set(requests))
+    latencies.sort()
+    print(f"Notifications: {len(requests):,} ({len(requests) - unique:,} duplicates), statuses {statuses}")
+    print(f"Throughput:    {len(requests) / elapsed:,.0f} notifications/s")
+    print(f"Ack p50:       {percentile(latencies, 50) * 1000:.2f} ms")
+    print(f"Ack p99:       {percentile(latencies, 99) * 1000:.2f} ms")
+    print(f"Receiver CPU:  {stats['cpu_seconds'] / len(requests) * 1e6:.1f} us/notification "
+          f"({stats['cpu_seconds'] / elapsed:.0%} of one core, "
+          f"~{len(requests) / stats['cpu_seconds']:,.0f}/s when saturated)")
+    print(f"Batches:       {stats['batches']:,} (avg {stats['applied'] / max(1, stats['batches']):.0f} notifications)")
+    if malformed != [400] * len(malformed):
+        raise AssertionError(f"Malformed requests answered {malformed} instead of 400")
+    if oversized != 413:
+        raise AssertionError(f"Oversized request answered {oversized} instead of 413")
+    if stats["applied"] != unique or stats["duplicates"] != len(requests) - unique:
+        raise AssertionError(f"Expected {unique} applied, got {stats}")
+
+
+if __name__ == "__main__":
+    main()
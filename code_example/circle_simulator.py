@@ -0,0 +1,976 @@
+#!/usr/bin/env python3
+"""
+Circle API Simulator
+--------------------
+
+A local stand-in for the Circle sandbox so the clients in this folder can be
+exercised and benchmarked without network access or sandbox rate limits.
+
+The simulator speaks plain HTTP/1.1 with keep-alive on top of asyncio (an
+asyncio.Protocol, and uvloop when it is installed) and keeps all state in
+memory. It implements the endpoints used by the clients in this folder and
+by the Postman collection:
+
+1. GET /v1/configuration, /v1/businessAccount, /v1/businessAccount/balances
+   and /v1/businessAccount/banks/pix
+2. POST /v1/businessAccount/transfers (mint / redeem)
+3. POST /v1/transfers, POST /v1/transfers/quotes, GET /v1/transfers/{id}
+   and GET /v1/transfers (list)
+4. POST/GET /v1/wallets, GET /v1/wallets/{id}, POST/GET
+   /v1/wallets/{id}/addresses and GET /v1/wallets/{id}/transactions
+5. GET /v1/businessAccount/wallets/{id}/balances
+6. GET /v1/exchange/rates, POST /v1/exchange/quotes, POST/GET
+   /v1/exchange/trades, GET /v1/exchange/trades/{id}, GET
+   /v1/exchange/trades/settlements and .../settlements/instructions/{currency}
+
+Lists are newest first with pageBefore/pageAfter cursors and from/to.
+
+Load and failure modelling:
+- Latency per request drawn from a fixed, uniform, exponential or lognormal
+  distribution with mean latency_ms, overridable per endpoint
+- handshake_ms added to the first response of every new connection, like
+  the TCP and TLS handshakes a client pays before its first request
+- An account-wide quota answering excess requests with 429 and Retry-After,
+  plus random 429s (throttle_rate) and 500/503s (error_rate); half of the
+  injected errors are returned after the request took effect, like a
+  response lost on the way back
+- history_size synthetic past transactions per wallet, generated on demand
+- Transfers settle (complete or failed) after a jittered settlement_delay;
+  trades complete after trade_delay and open an FX settlement that settles
+  after fx_settlement_delay
+- With webhook_url set, every status change is POSTed there as a signed
+  Circle notification (transfers, trades, fxSettlement), with retries
+
+Usage:
+    python circle_simulator.py --port 8080 --latency-ms 5 --latency-distribution lognormal
+"""
+
+import re
+import json
+import bisect
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from urllib.parse import parse_qsl, urlsplit
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+from webhook_receiver import SIGNATURE_HEADER, sign
+
+try:
+    import uvloop
+except ImportError:  # Optional: a faster event loop
+    uvloop = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# High 64 bits of the ids of synthetic history records
+_SYNTHETIC_ID_TAG = 0x5157_4c00_0000_4000
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+# A named group of a route pattern, e.g. (?P<transfer_id>[^/]+)
+_GROUP = re.compile(r"[(][?]P<(\w+)>[^)]*[)]")
+
+# Entity kind -> (notificationType, key of the entity in the notification)
+NOTIFICATION_TYPES = {
+    "transfer": ("transfers", "transfer"),
+    "trade": ("trades", "trade"),
+    "settlement": ("fxSettlement", "fxSettlement"),
+}
+
+
+class SimulatorResponse:
+    """Status, JSON body and extra headers returned by a route handler"""
+
+    __slots__ = ("status", "body", "headers")
+
+    def __init__(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+def _epoch_ms(value: str) -> int:
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return (parsed - EPOCH) // timedelta(milliseconds=1)
+
+
+def _format_ms(epoch_ms: int) -> str:
+    return (EPOCH + timedelta(milliseconds=epoch_ms)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def _format_seconds(epoch_seconds: float) -> str:
+    return _format_ms(int(epoch_seconds * 1000))
+
+
+def _amount(value: Decimal) -> str:
+    return f"{value.quantize(Decimal('0.01'))}"
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """A uvloop loop when uvloop is installed, else asyncio's default"""
+    return uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+
+
+class WalletHistory:
+    """A wallet's (or, with no synthetic records, the account's) transactions,
+    oldest first: synthetic records generated on demand followed by the
+    transfers made through the simulator"""
+
+    def __init__(self, wallet_id: Optional[str], size: int, start_ms: int, step_ms: int,
+                 transfers: List[Dict], ids: Dict[str, Dict]):
+        self.wallet_id = wallet_id
+        self.size = size
+        self.start_ms = start_ms
+        self.step_ms = step_ms
+        self.transfers = transfers
+        self._ids = ids
+
+    def __len__(self) -> int:
+        return self.size + len(self.transfers)
+
+    def record(self, position: int) -> Dict:
+        if position >= self.size:
+            return self.transfers[position - self.size]
+        return {
+            "id": str(uuid.UUID(int=(_SYNTHETIC_ID_TAG << 64) | position)),
+            "source": {"type": "wallet", "id": self.wallet_id},
+            "destination": {"type": "blockchain", "chain": "ETH",
+                            "address": f"0x{position:040x}"},
+            "amount": {"amount": f"{position % 100_000 / 100 + 1:.2f}", "currency": "USD"},
+            "status": "complete",
+            "createDate": _format_ms(self.created_ms(position)),
+        }
+
+    def created_ms(self, position: int) -> int:
+        if position >= self.size:
+            return _epoch_ms(self.transfers[position - self.size]["createDate"])
+        return self.start_ms + position * self.step_ms
+
+    def position(self, item_id: str) -> Optional[int]:
+        """Position of an item id, or None if it is not in this history"""
+        try:
+            value = uuid.UUID(item_id).int
+        except ValueError:
+            return None
+        if value >> 64 == _SYNTHETIC_ID_TAG:
+            position = value & ((1 << 64) - 1)
+            return position if position < self.size else None
+        if item_id not in self._ids:
+            return None
+        # Transfers are appended in createDate order: search from the first
+        # one created in the same millisecond
+        created = _epoch_ms(self._ids[item_id]["createDate"])
+        start = bisect.bisect_left(self.transfers, created, key=lambda t: _epoch_ms(t["createDate"]))
+        for i in range(start, len(self.transfers)):
+            if self.transfers[i]["id"] == item_id:
+                return self.size + i
+        return None
+
+
+class CircleSimulator:
+    """In-memory Circle API served over HTTP/1.1 keep-alive"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0,
+                 rate_limit_rps: float = 0.0, retry_after: float = 1.0,
+                 penalize_throttled: bool = False, history_size: int = 0,
+                 history_step_ms: int = 1000, settlement_delay: float = 0.0,
+                 chain_delays: Optional[Dict[str, float]] = None, failure_rate: float = 0.0,
+                 latency_distribution: str = "fixed", latency_sigma: float = 0.5,
+                 endpoint_latency_ms: Optional[Dict[str, float]] = None,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 trade_delay: float = 0.0, fx_settlement_delay: float = 0.0, quote_ttl: float = 30.0,
+                 webhook_url: Optional[str] = None, webhook_secret: Union[str, bytes] = b"",
+                 webhook_concurrency: int = 4, webhook_retries: int = 3, handshake_ms: float = 0.0,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            host: Interface to listen on
+            port: Port to listen on (0 picks a free port)
+            latency_ms: Mean delay added before every response
+            rate_limit_rps: Account-wide quota; requests above it get a 429 (0 disables)
+            retry_after: Seconds advertised in the Retry-After header of a 429
+            penalize_throttled: Count rejected requests against the quota too,
+                so clients that keep hammering stay throttled
+            history_size: Synthetic past transactions of every wallet
+            history_step_ms: Milliseconds between consecutive synthetic transactions
+            settlement_delay: Mean seconds until a transfer leaves pending (0 keeps it pending)
+            chain_delays: settlement_delay overrides by destination chain, e.g. {"ETH": 60}
+            failure_rate: Fraction of transfers that end failed instead of complete
+            latency_distribution: One of LATENCY_DISTRIBUTIONS
+            latency_sigma: Shape of the lognormal distribution (higher means a longer tail)
+            endpoint_latency_ms: Mean latency overrides by route, e.g. {"POST /v1/transfers": 40}
+            error_rate: Fraction of requests answered with a 500 or 503
+            throttle_rate: Fraction of requests answered with a 429, on top of the quota
+            trade_delay: Mean seconds until a trade completes (0 completes it at once)
+            fx_settlement_delay: Mean seconds until a completed trade's settlement is settled
+            quote_ttl: Seconds a tradable quote can be traded
+            webhook_url: Where status change notifications are POSTed (None disables them)
+            webhook_secret: Key of the notifications' X-Circle-Signature
+            webhook_concurrency: Notifications delivered in parallel
+            webhook_retries: Extra attempts for a notification that was not acknowledged
+            handshake_ms: Delay added to the first response on each new connection
+            seed: Seed of the random choices (latencies, failures, injected errors)
+        """
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"latency_distribution must be one of {LATENCY_DISTRIBUTIONS}")
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.endpoint_latency_ms = endpoint_latency_ms or {}
+        self.handshake_ms = handshake_ms
+        self.connection_count = 0
+        self.rate_limit_rps = rate_limit_rps
+        self.retry_after = retry_after
+        self.penalize_throttled = penalize_throttled
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.transfers: Dict[str, Dict] = {}
+        self.transfer_log: List[Dict] = []
+        self.idempotency_keys: Dict[str, Dict] = {}
+        self.replayed_count = 0
+        self.wallet_transfers: Dict[str, List[Dict]] = {}
+        self.settlement_delay = settlement_delay
+        self.chain_delays = chain_delays or {}
+        self.failure_rate = failure_rate
+        self.trade_delay = trade_delay
+        self.fx_settlement_delay = fx_settlement_delay
+        # id -> (epoch seconds, final status, entity kind)
+        self._settlements: Dict[str, Tuple[float, str, str]] = {}
+        self._random = random.Random(seed)
+        self.history_size = history_size
+        self.history_step_ms = history_step_ms
+        # Synthetic history ends history_size steps after this, i.e. about now
+        self.history_start_ms = _epoch_ms(self._now()) - history_size * history_step_ms
+        self.max_page_size = 50
+        self.quotes: Dict[str, Dict] = {}
+        self._quote_expiry: Dict[str, float] = {}
+        self._used_quotes: Set[str] = set()
+        self.rates = {("BRL", "USDC"): 0.20, ("USDC", "BRL"): 5.0, ("USDC", "USD"): 1.0, ("USD", "USDC"): 1.0}
+        self.quote_ttl = quote_ttl
+        self.trades: Dict[str, Dict] = {}
+        self.trade_log: List[Dict] = []
+        self.fx_settlements: Dict[str, Dict] = {}
+        self.fx_settlement_log: List[Dict] = []
+        self.wallets: Dict[str, Dict] = {}
+        self.wallet_addresses: Dict[str, List[Dict]] = {}
+        self.entity_id = str(uuid.UUID(int=self._random.getrandbits(128)))
+        self.master_wallet_id = "1000000001"
+        self.account_balances = {"USD": Decimal("1000000.00"), "BRL": Decimal("5000000.00"),
+                                 "USDC": Decimal("1000000.00")}
+        self.request_count = 0
+        self.throttled_count = 0
+        self.injected_errors = 0
+        self._quota_tokens = rate_limit_rps
+        self._quota_updated = time.monotonic()
+        self._routes: List[Tuple[str, "re.Pattern", Callable, str]] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set["_HTTPConnection"] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_concurrency = webhook_concurrency
+        self.webhook_retries = webhook_retries
+        self.webhooks_sent = 0
+        self.webhooks_failed = 0
+        self._webhook_queue: Optional[asyncio.Queue] = None
+        self._webhook_tasks: List[asyncio.Task] = []
+        self._register_routes()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    # Routing
+
+    def route(self, method: str, pattern: str, handler: Callable):
+        """Register a handler for a method and a path regex
+
+        Routes are tried in registration order. The route's name for
+        endpoint_latency_ms is the method and the pattern with its groups
+        written as {name}, e.g. "GET /v1/transfers/{transfer_id}".
+        """
+        name = method + " " + _GROUP.sub(r"{\1}", pattern)
+        self._routes.append((method, re.compile(f"^{pattern}$"), handler, name))
+
+    def _register_routes(self):
+        self.route("GET", r"/v1/configuration", self._get_configuration)
+        self.route("GET", r"/v1/businessAccount", self._get_business_account)
+        self.route("GET", r"/v1/businessAccount/balances", self._get_account_balances)
+        self.route("GET", r"/v1/businessAccount/banks/pix", self._get_pix_accounts)
+        self.route("POST", r"/v1/businessAccount/transfers", self._create_business_transfer)
+        self.route("POST", r"/v1/transfers", self._create_transfer)
+        self.route("GET", r"/v1/transfers", self._list_transfers)
+        self.route("POST", r"/v1/transfers/quotes", self._create_transfer_quote)
+        self.route("GET", r"/v1/transfers/(?P<transfer_id>[^/]+)", self._get_transfer)
+        self.route("POST", r"/v1/wallets", self._create_wallet)
+        self.route("GET", r"/v1/wallets", self._list_wallets)
+        self.route("GET", r"/v1/wallets/(?P<wallet_id>[^/]+)", self._get_wallet)
+        self.route("POST", r"/v1/wallets/(?P<wallet_id>[^/]+)/addresses", self._create_address)
+        self.route("GET", r"/v1/wallets/(?P<wallet_id>[^/]+)/addresses", self._list_addresses)
+        self.route("GET", r"/v1/wallets/(?P<wallet_id>[^/]+)/transactions", self._list_transactions)
+        self.route("GET", r"/v1/businessAccount/wallets/(?P<wallet_id>[^/]+)/balances", self._get_balances)
+        self.route("GET", r"/v1/exchange/rates", self._get_rate)
+        self.route("POST", r"/v1/exchange/quotes", self._create_quote)
+        self.route("POST", r"/v1/exchange/trades", self._create_trade)
+        self.route("GET", r"/v1/exchange/trades", self._list_trades)
+        self.route("GET", r"/v1/exchange/trades/settlements", self._list_fx_settlements)
+        self.route("GET", r"/v1/exchange/trades/settlements/instructions/(?P<currency>[^/]+)",
+                   self._get_settlement_instructions)
+        self.route("GET", r"/v1/exchange/trades/(?P<trade_id>[^/]+)", self._get_trade)
+
+    def route_name(self, method: str, path: str) -> Optional[str]:
+        """Name of the route serving a request, None if there is none"""
+        for route_method, pattern, _, name in self._routes:
+            if route_method == method and pattern.match(path):
+                return name
+        return None
+
+    def dispatch(self, method: str, path: str, query: Dict[str, str], body: Optional[Dict]) -> SimulatorResponse:
+        """Find the handler for a request and run it"""
+        self.request_count += 1
+        if self.rate_limit_rps and not self._within_quota() or \
+                self.throttle_rate and self._random.random() < self.throttle_rate:
+            self.throttled_count += 1
+            return SimulatorResponse(429, {"code": 429, "message": "Too many requests"},
+                                     {"Retry-After": f"{self.retry_after:g}"})
+        inject = self.error_rate and self._random.random() < self.error_rate
+        if inject and self._random.random() < 0.5:
+            return self._injected_error()
+        path_matched = False
+        for route_method, pattern, handler, _ in self._routes:
+            match = pattern.match(path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method == method:
+                response = handler(query=query, body=body, **match.groupdict())
+                return self._injected_error() if inject else response
+        if path_matched:
+            return SimulatorResponse(405, {"code": 405, "message": "Method not allowed"})
+        return SimulatorResponse(404, {"code": 404, "message": "Not found"})
+
+    def _injected_error(self) -> SimulatorResponse:
+        self.injected_errors += 1
+        if self._random.random() < 0.5:
+            return SimulatorResponse(500, {"code": 500, "message": "Internal server error"})
+        return SimulatorResponse(503, {"code": 503, "message": "Service unavailable"},
+                                 {"Retry-After": f"{self.retry_after:g}"})
+
+    def _within_quota(self) -> bool:
+        now = time.monotonic()
+        self._quota_tokens = min(self.rate_limit_rps,
+                                 self._quota_tokens + (now - self._quota_updated) * self.rate_limit_rps)
+        self._quota_updated = now
+        if self._quota_tokens < 1.0:
+            if self.penalize_throttled:
+                self._quota_tokens = max(-self.rate_limit_rps, self._quota_tokens - 1.0)
+            return False
+        self._quota_tokens -= 1.0
+        return True
+
+    def latency(self, method: str, path: str) -> float:
+        """Seconds to wait before answering a request"""
+        mean = self.latency_ms
+        if self.endpoint_latency_ms:
+            mean = self.endpoint_latency_ms.get(self.route_name(method, path), mean)
+        if mean <= 0:
+            return 0.0
+        distribution = self.latency_distribution
+        if distribution == "fixed":
+            value = mean
+        elif distribution == "uniform":
+            value = self._random.uniform(0.0, 2.0 * mean)
+        elif distribution == "exponential":
+            value = self._random.expovariate(1.0 / mean)
+        else:
+            # Scaled so that the mean stays latency_ms whatever the sigma
+            sigma = self.latency_sigma
+            value = mean * self._random.lognormvariate(-sigma * sigma / 2.0, sigma)
+        return value / 1000.0
+
+    # State changes
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def _replay(self, body: Dict) -> Optional[SimulatorResponse]:
+        """The original response to a request whose idempotency key was already used"""
+        existing = self.idempotency_keys.get(body["idempotencyKey"])
+        if existing is None:
+            return None
+        self.replayed_count += 1
+        return SimulatorResponse(201, {"data": existing})
+
+    def _schedule(self, kind: str, entity: Dict, delay: float, status: str):
+        """Move an entity to a final status after about `delay` seconds
+        (at once when delay is 0)"""
+        if delay <= 0:
+            self._finish(kind, entity, status, time.time())
+            return
+        due = time.time() + delay * self._random.uniform(0.5, 1.5)
+        self._settlements[entity["id"]] = (due, status, kind)
+        if self.webhook_url and self._loop is not None:
+            # Settle on time so the notification goes out; reads settle lazily otherwise
+            self._loop.call_later(max(0.0, due - time.time()), self._settle, entity)
+
+    def _settle(self, entity: Dict) -> Dict:
+        """Move an entity to its final status once its settlement time has passed"""
+        settlement = self._settlements.get(entity["id"])
+        if settlement is not None and time.time() >= settlement[0]:
+            del self._settlements[entity["id"]]
+            due, status, kind = settlement
+            self._finish(kind, entity, status, due)
+        return entity
+
+    def _finish(self, kind: str, entity: Dict, status: str, when: float):
+        entity["status"] = status
+        entity["updateDate"] = _format_seconds(when)
+        if kind == "trade" and status == "complete":
+            self._open_fx_settlement(entity)
+        self._notify(kind, entity)
+
+    def _notify(self, kind: str, entity: Dict):
+        if self._webhook_queue is None:
+            return
+        notification_type, key = NOTIFICATION_TYPES[kind]
+        self._webhook_queue.put_nowait({"notificationType": notification_type, "version": 1, key: dict(entity)})
+
+    # Handlers: account
+
+    def _get_configuration(self, query, body):
+        return SimulatorResponse(200, {"data": {"payments": {"masterWalletId": self.master_wallet_id}}})
+
+    def _get_business_account(self, query, body):
+        return SimulatorResponse(200, {"data": {"entityId": self.entity_id,
+                                                "masterWalletId": self.master_wallet_id}})
+
+    def _get_account_balances(self, query, body):
+        return SimulatorResponse(200, {"data": {
+            "available": [{"amount": _amount(amount), "currency": currency}
+                          for currency, amount in self.account_balances.items()],
+            "unsettled": []}})
+
+    def _get_pix_accounts(self, query, body):
+        return SimulatorResponse(200, {"data": [{
+            "id": "b8627ae8-732b-4d25-b947-1df8f4007a29",
+            "status": "complete",
+            "description": "PICPAY INSTITUICAO DE PAGAMENTO ****0001",
+            "trackingRef": "CIR2PIXBR1",
+            "pixKey": "financeiro@picpay.com",
+            "currency": "BRL",
+        }]})
+
+    # Handlers: transfers
+
+    def _store_transfer(self, body: Optional[Dict]) -> SimulatorResponse:
+        if not body or "amount" not in body or "idempotencyKey" not in body:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid entity"})
+        replay = self._replay(body)
+        if replay is not None:
+            # A retry of a request already executed gets the original transfer back
+            return replay
+        transfer = {
+            "id": str(uuid.uuid4()),
+            "source": body.get("source"),
+            "destination": body.get("destination"),
+            "amount": body["amount"],
+            "status": "pending",
+            "createDate": self._now(),
+        }
+        self.transfers[transfer["id"]] = transfer
+        self.transfer_log.append(transfer)
+        self.idempotency_keys[body["idempotencyKey"]] = transfer
+        chain = (transfer["destination"] or {}).get("chain")
+        delay = self.chain_delays.get(chain, self.settlement_delay)
+        if delay > 0:
+            status = "failed" if self._random.random() < self.failure_rate else "complete"
+            self._schedule("transfer", transfer, delay, status)
+        for party in (transfer["source"], transfer["destination"]):
+            wallet_id = (party or {}).get("id")
+            if wallet_id:
+                self.wallet_transfers.setdefault(wallet_id, []).append(transfer)
+        return SimulatorResponse(201, {"data": transfer})
+
+    def _create_business_transfer(self, query, body):
+        return self._store_transfer(body)
+
+    def _create_transfer(self, query, body):
+        return self._store_transfer(body)
+
+    def _get_transfer(self, query, body, transfer_id):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return SimulatorResponse(404, {"code": 404, "message": "Transfer not found"})
+        return SimulatorResponse(200, {"data": self._settle(transfer)})
+
+    def _create_transfer_quote(self, query, body):
+        response = self._create_quote(query, body)
+        if response.status == 201:
+            quote = response.body["data"]
+            quote["fees"] = {"amount": _amount(Decimal(quote["from"]["amount"]) * Decimal("0.005")),
+                             "currency": quote["to"]["currency"]}
+        return response
+
+    def wallet_history(self, wallet_id: str) -> WalletHistory:
+        return WalletHistory(wallet_id, self.history_size, self.history_start_ms, self.history_step_ms,
+                             self.wallet_transfers.get(wallet_id, []), self.transfers)
+
+    def _list_transactions(self, query, body, wallet_id):
+        return self._page(self.wallet_history(wallet_id), query)
+
+    def _list_transfers(self, query, body):
+        return self._page(WalletHistory(None, 0, 0, 0, self.transfer_log, self.transfers), query)
+
+    def _page(self, history: WalletHistory, query: Dict[str, str]) -> SimulatorResponse:
+        """Newest first; pageAfter returns older items than the cursor, pageBefore newer ones"""
+        try:
+            page_size = min(int(query.get("pageSize", 50)), self.max_page_size)
+            positions = range(len(history))
+            low, high = 0, len(history)
+            if query.get("from"):
+                low = bisect.bisect_left(positions, _epoch_ms(query["from"]), key=history.created_ms)
+            if query.get("to"):
+                high = bisect.bisect_right(positions, _epoch_ms(query["to"]), key=history.created_ms)
+        except ValueError:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid query parameters"})
+        if page_size < 1:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid pageSize"})
+
+        cursor = query.get("pageAfter") or query.get("pageBefore")
+        if cursor:
+            position = history.position(cursor)
+            if position is None:
+                return SimulatorResponse(400, {"code": 2, "message": "Invalid page cursor"})
+            if query.get("pageAfter"):
+                high = min(high, position)
+            else:
+                low = max(low, position + 1)
+                high = min(high, low + page_size)
+        items = [self._settle(history.record(p)) for p in range(high - 1, max(low, high - page_size) - 1, -1)]
+        return SimulatorResponse(200, {"data": items})
+
+    # Handlers: wallets
+
+    def _create_wallet(self, query, body):
+        if not body or "idempotencyKey" not in body:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid entity"})
+        replay = self._replay(body)
+        if replay is not None:
+            return replay
+        wallet = {
+            "walletId": str(int(self.master_wallet_id) + len(self.wallets) + 1),
+            "entityId": self.entity_id,
+            "type": "end_user_wallet",
+            "description": body.get("description", ""),
+            "balances": [],
+        }
+        self.wallets[wallet["walletId"]] = wallet
+        self.idempotency_keys[body["idempotencyKey"]] = wallet
+        return SimulatorResponse(201, {"data": wallet})
+
+    def _list_wallets(self, query, body):
+        try:
+            page_size = min(int(query.get("pageSize", 50)), self.max_page_size)
+        except ValueError:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid query parameters"})
+        wallets = list(self.wallets.values())[::-1][:page_size]
+        return SimulatorResponse(200, {"data": wallets})
+
+    def _get_wallet(self, query, body, wallet_id):
+        if wallet_id == self.master_wallet_id:
+            return SimulatorResponse(200, {"data": {"walletId": wallet_id, "entityId": self.entity_id,
+                                                    "type": "merchant", "description": "Master Wallet",
+                                                    "balances": self._get_account_balances(query, body)
+                                                    .body["data"]["available"]}})
+        wallet = self.wallets.get(wallet_id)
+        if wallet is None:
+            return SimulatorResponse(404, {"code": 404, "message": "Wallet not found"})
+        return SimulatorResponse(200, {"data": wallet})
+
+    def _create_address(self, query, body, wallet_id):
+        if not body or "idempotencyKey" not in body or "currency" not in body or "chain" not in body:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid entity"})
+        replay = self._replay(body)
+        if replay is not None:
+            return replay
+        address = {"address": f"0x{self._random.getrandbits(160):040x}",
+                   "currency": body["currency"], "chain": body["chain"]}
+        self.wallet_addresses.setdefault(wallet_id, []).append(address)
+        self.idempotency_keys[body["idempotencyKey"]] = address
+        return SimulatorResponse(201, {"data": address})
+
+    def _list_addresses(self, query, body, wallet_id):
+        return SimulatorResponse(200, {"data": self.wallet_addresses.get(wallet_id, [])})
+
+    def _get_balances(self, query, body, wallet_id):
+        return SimulatorResponse(200, {"data": {"available": [{"amount": "1000000.00", "currency": "USD"}],
+                                                "unsettled": []}})
+
+    # Handlers: exchange
+
+    def _get_rate(self, query, body):
+        pair = (query.get("from"), query.get("to"))
+        if pair not in self.rates:
+            return SimulatorResponse(400, {"code": 2, "message": "Unsupported currency pair"})
+        return SimulatorResponse(200, {"data": {"from": pair[0], "to": pair[1], "rate": f"{self.rates[pair]:.6f}"}})
+
+    def _create_quote(self, query, body):
+        try:
+            source = body["from"]
+            pair = (source["currency"], body["to"]["currency"])
+            rate = self.rates[pair]
+            amount = float(source["amount"])
+        except (KeyError, TypeError, ValueError):
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid entity"})
+        expires = time.time() + self.quote_ttl
+        quote = {
+            "id": str(uuid.uuid4()),
+            "type": body.get("type", "tradable"),
+            "rate": rate,
+            "from": {"currency": pair[0], "amount": f"{amount:.2f}"},
+            "to": {"currency": pair[1], "amount": f"{amount * rate:.2f}"},
+            "expiresAt": _format_seconds(expires),
+        }
+        self.quotes[quote["id"]] = quote
+        self._quote_expiry[quote["id"]] = expires
+        return SimulatorResponse(201, {"data": quote})
+
+    def _create_trade(self, query, body):
+        if not body or "idempotencyKey" not in body or "quoteId" not in body:
+            return SimulatorResponse(400, {"code": 2, "message": "Invalid entity"})
+        replay = self._replay(body)
+        if replay is not None:
+            return replay
+        quote = self.quotes.get(body["quoteId"])
+        if quote is None or quote["type"] != "tradable":
+            return SimulatorResponse(400, {"code": 2, "message": "Quote not found"})
+        if time.time() > self._quote_expiry[quote["id"]]:
+            return SimulatorResponse(400, {"code": 2, "message": "Quote expired"})
+        if quote["id"] in self._used_quotes:
+            return SimulatorResponse(400, {"code": 2, "message": "Quote already used"})
+        self._used_quotes.add(quote["id"])
+        trade = {
+            "id": str(uuid.uuid4()),
+            "quoteId": quote["id"],
+            "from": dict(quote["from"]),
+            "to": dict(quote["to"]),
+            "status": "pending",
+            "createDate": self._now(),
+        }
+        self.trades[trade["id"]] = trade
+        self.trade_log.append(trade)
+        self.idempotency_keys[body["idempotencyKey"]] = trade
+        self._schedule("trade", trade, self.trade_delay, "complete")
+        return SimulatorResponse(201, {"data": trade})
+
+    def _open_fx_settlement(self, trade: Dict):
+        """Book a completed trade and open the settlement that pays for it"""
+        source, target = trade["from"], trade["to"]
+        self.account_balances[source["currency"]] = \
+            self.account_balances.get(source["currency"], Decimal(0)) - Decimal(source["amount"])
+        self.account_balances[target["currency"]] = \
+            self.account_balances.get(target["currency"], Decimal(0)) + Decimal(target["amount"])
+        settlement = {
+            "id": str(uuid.uuid4()),
+            "status": "pending",
+            # Booked now: trades complete lazily, and the list must stay in createDate order
+            "createDate": self._now(),
+            "currency": source["currency"],
+            "amount": source["amount"],
+            "type": "account_payable",
+            "reference": f"FXR{len(self.fx_settlement_log) + 1:07d}",
+        }
+        trade["settlementId"] = settlement["id"]
+        self.fx_settlements[settlement["id"]] = settlement
+        self.fx_settlement_log.append(settlement)
+        self._schedule("settlement", settlement, self.fx_settlement_delay, "settled")
+
+    def _get_trade(self, query, body, trade_id):
+        trade = self.trades.get(trade_id)
+        if trade is None:
+            return SimulatorResponse(404, {"code": 404, "message": "Trade not found"})
+        return SimulatorResponse(200, {"data": self._settle(trade)})
+
+    def _list_trades(self, query, body):
+        return self._page(WalletHistory(None, 0, 0, 0, self.trade_log, self.trades), query)
+
+    def _list_fx_settlements(self, query, body):
+        return self._page(WalletHistory(None, 0, 0, 0, self.fx_settlement_log, self.fx_settlements), query)
+
+    def _get_settlement_instructions(self, query, body, currency):
+        if currency != "BRL":
+            return SimulatorResponse(400, {"code": 2, "message": "Unsupported currency"})
+        return SimulatorResponse(200, {"data": {
+            "currency": "BRL",
+            "fiatAccountType": "pix",
+            "instruction": {"pixKey": "settlements@circle.com", "beneficiaryName": "CIRCLE BRASIL LTDA",
+                            "trackingRef": "CIR2FXBR1"},
+        }})
+
+    # Webhooks
+
+    async def _deliver_webhooks(self):
+        """Post queued notifications to webhook_url over one keep-alive connection"""
+        target = urlsplit(self.webhook_url)
+        host, port = target.hostname, target.port or 80
+        reader = writer = None
+        while True:
+            notification = await self._webhook_queue.get()
+            body = json.dumps(notification).encode()
+            request = (f"POST {target.path or '/'} HTTP/1.1\r\nHost: {target.netloc}\r\n"
+                       f"Content-Type: application/json\r\n{SIGNATURE_HEADER}: {sign(self.webhook_secret, body)}\r\n"
+                       f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+            for attempt in range(self.webhook_retries + 1):
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_connection(host, port)
+                    writer.write(request)
+                    head = await reader.readuntil(b"\r\n\r\n")
+                    status = int(head.split(b" ", 2)[1])
+                    length = re.search(rb"(?i)content-length:\s*(\d+)", head)
+                    await reader.readexactly(int(length.group(1)) if length else 0)
+                    if 200 <= status < 300:
+                        self.webhooks_sent += 1
+                        break
+                except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    if writer is not None:
+                        writer.close()
+                    reader = writer = None
+                await asyncio.sleep(min(2.0, 0.05 * 2 ** attempt))
+            else:
+                self.webhooks_failed += 1
+
+    # Lifecycle
+
+    async def start(self):
+        """Start listening on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        if self.webhook_url:
+            self._webhook_queue = asyncio.Queue()
+            self._webhook_tasks = [asyncio.create_task(self._deliver_webhooks())
+                                   for _ in range(self.webhook_concurrency)]
+        self._server = await self._loop.create_server(lambda: _HTTPConnection(self), self.host, self.port,
+                                                      backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop listening and close the server"""
+        if self._server is not None:
+            self._server.close()
+            for connection in list(self._connections):
+                connection.close()
+            for task in self._webhook_tasks:
+                task.cancel()
+            await asyncio.gather(*self._webhook_tasks, return_exceptions=True)
+            self._webhook_tasks = []
+            await self._server.wait_closed()
+
+    def start_in_thread(self) -> str:
+        """Run the simulator on its own event loop thread and return its base URL"""
+        ready = threading.Event()
+
+        def run():
+            loop = new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name="circle-simulator", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.base_url
+
+    def start_in_process(self) -> str:
+        """Run the simulator in a child process (so it does not compete for the
+        benchmark's GIL) and return its base URL"""
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_in_child, args=(self, child_conn),
+                                                name="circle-simulator", daemon=True)
+        self._process.start()
+        self.port = parent_conn.recv()
+        return self.base_url
+
+    def stop_process(self):
+        """Stop a simulator started with start_in_process"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def stop_thread(self):
+        """Stop a simulator started with start_in_thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+
+class _HTTPConnection(asyncio.Protocol):
+    """One client connection; requests are parsed straight from the socket
+    buffer and answered in the order they arrived"""
+
+    def __init__(self, simulator: CircleSimulator):
+        self.simulator = simulator
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.pending = deque()  # One [response bytes] slot per request, in arrival order
+        self.handshake = simulator.handshake_ms / 1000.0  # Paid by the first request only
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.simulator._connections.add(self)
+        self.simulator.connection_count += 1
+
+    def connection_lost(self, exc):
+        self.simulator._connections.discard(self)
+        self.transport = None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data: bytes):
+        self.buffer += data
+        while True:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            request_line, *header_lines = self.buffer[:end].decode("latin-1").split("\r\n")
+            length = 0
+            keep_alive = True
+            for line in header_lines:
+                name, _, value = line.partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection":
+                    keep_alive = value.strip().lower() != "close"
+            if len(self.buffer) < end + 4 + length:
+                return
+            raw_body = bytes(self.buffer[end + 4:end + 4 + length])
+            del self.buffer[:end + 4 + length]
+            try:
+                method, target, version = request_line.split(" ", 2)
+            except ValueError:
+                self.close()
+                return
+            self._accept(method, target, raw_body, keep_alive and version == "HTTP/1.1")
+
+    def _accept(self, method: str, target: str, raw_body: bytes, keep_alive: bool):
+        path, _, query_string = target.partition("?")
+        slot = [None, keep_alive]
+        self.pending.append(slot)
+        delay = self.simulator.latency(method, path) + self.handshake
+        self.handshake = 0.0
+        if delay > 0:
+            self.simulator._loop.call_later(delay, self._respond, slot, method, path, query_string, raw_body)
+        else:
+            self._respond(slot, method, path, query_string, raw_body)
+
+    def _respond(self, slot: List, method: str, path: str, query_string: str, raw_body: bytes):
+        try:
+            body = json.loads(raw_body) if raw_body else None
+        except ValueError:
+            response = SimulatorResponse(400, {"code": 2, "message": "Malformed JSON"})
+        else:
+            response = self.simulator.dispatch(method, path, dict(parse_qsl(query_string)), body)
+        payload = json.dumps(response.body).encode()
+        extra = "".join(f"{k}: {v}\r\n" for k, v in response.headers.items())
+        slot[0] = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if slot[1] else 'close'}\r\n"
+            f"{extra}\r\n".encode("latin-1") + payload
+        )
+        # Later requests may finish first when latencies vary; keep responses in order
+        while self.pending and self.pending[0][0] is not None:
+            response_bytes, keep_alive = self.pending.popleft()
+            if self.transport is None:
+                return
+            self.transport.write(response_bytes)
+            if not keep_alive:
+                self.transport.close()
+                return
+
+
+def _serve_in_child(simulator: CircleSimulator, conn):
+    async def serve():
+        await simulator.start()
+        conn.send(simulator.port)
+        await asyncio.Event().wait()
+
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Circle API simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--handshake-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rps", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--history-size", type=int, default=0)
+    parser.add_argument("--settlement-delay", type=float, default=0.0)
+    parser.add_argument("--trade-delay", type=float, default=0.0)
+    parser.add_argument("--fx-settlement-delay", type=float, default=0.0)
+    parser.add_argument("--webhook-url")
+    parser.add_argument("--webhook-secret", default="")
+    args = parser.parse_args()
+
+    simulator = CircleSimulator(args.host, args.port, args.latency_ms, args.rate_limit_rps,
+                                history_size=args.history_size, settlement_delay=args.settlement_delay,
+                                latency_distribution=args.latency_distribution, error_rate=args.error_rate,
+                                throttle_rate=args.throttle_rate, trade_delay=args.trade_delay,
+                                fx_settlement_delay=args.fx_settlement_delay, webhook_url=args.webhook_url,
+                                webhook_secret=args.webhook_secret, handshake_ms=args.handshake_ms)
+
+    async def serve():
+        await simulator.start()
+        print(f"Circle simulator listening on {simulator.base_url}")
+        await asyncio.Event().wait()
+
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Cold Start
+----------------------------------
+
+Moves the set-up costs of a freshly started process off its first user
+request.
+
+1. lazy_import() defers running a module until one of its attributes is
+   used, so importing the client module does not import requests (urllib3,
+   ssl, http.client, ...) until a CircleClient is built; modules only
+   needed by optional features are imported where those features start
+2. prime_dns() resolves the API host ahead of time: resolution errors show
+   up at start-up, and the system resolver's cache is warm for the pool
+3. open_connections() runs a cheap call from several threads released at
+   the same moment, so each opens its own connection (TCP and TLS
+   handshakes included) and leaves it idle in the session's pool for the
+   first real requests to reuse
+
+CircleClient.warmup() and PicPayUSDCService.warmup() combine these with
+preloading the exchange rates and the wallet ledger; run them before the
+pod reports ready.
+
+Usage:
+    service = PicPayUSDCService(CircleClient(API_KEY, BASE_URL), rate_cache=rate_cache)
+    timings = service.warmup(connections=8)
+"""
+
+import sys
+import socket
+import threading
+import importlib.util
+from types import ModuleType
+from typing import Callable, List
+from urllib.parse import urlsplit
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Return the module, executing it on first attribute access
+
+    A module already imported is returned as is. A missing module raises
+    ImportError here, like a plain import would.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def prime_dns(url: str) -> List[str]:
+    """Resolve the host of url; returns its addresses"""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    infos = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    return sorted({info[4][0] for info in infos})
+
+
+def open_connections(call: Callable, connections: int) -> List:
+    """Run call() from `connections` threads at once and return the results
+
+    All threads wait on a barrier first so the calls overlap and none can
+    reuse a connection another just returned. The first error is raised
+    after every call finished.
+    """
+    barrier = threading.Barrier(connections)
+    results: List = [None] * connections
+    errors: List[BaseException] = []
+
+    def run(n: int):
+        try:
+            barrier.wait()
+            results[n] = call()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,), name=f"warmup-{n}") for n in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
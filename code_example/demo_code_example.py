@@ -12,11 +12,20 @@ segurança, logging, e outras práticas de desenvolvimento robustas.
 
 import requests
 import json
+import time
 import uuid
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from decimal import Decimal
 
+from idempotency import derive_idempotency_key
+
+# (conexão, leitura) em segundos; sem isso uma Circle lenta trava a chamada indefinidamente
+TIMEOUT_CIRCLE = (3.05, 10.0)
+
 class CircleAPIDemo:
     """
     Classe de demonstração para integração com APIs da Circle
@@ -45,10 +54,16 @@ class CircleAPIDemo:
         print(f"🔧 Circle API Client inicializado - Ambiente: {environment}")
         print(f"🌐 Base URL: {self.base_url}")
     
-    def generate_idempotency_key(self) -> str:
+    def generate_idempotency_key(self, operacao: Optional[str] = None) -> str:
         """
         Gera chave de idempotência única para evitar transações duplicadas
+        
+        Com o identificador da operação (ex.: "mint:pedido-42") a chave é
+        derivada dele (como em idempotency.derive_idempotency_key), e toda
+        nova tentativa da mesma operação reutiliza a mesma chave
         """
+        if operacao is not None:
+            return derive_idempotency_key(operacao)
         return str(uuid.uuid4())
     
     def get_account_info(self) -> Dict[str, Any]:
@@ -60,7 +75,8 @@ class CircleAPIDemo:
         try:
             response = requests.get(
                 f"{self.base_url}/v1/businessAccount/balances",
-                headers=self.headers
+                headers=self.headers,
+                timeout=TIMEOUT_CIRCLE
             )
             
             if response.status_code == 200:
@@ -83,20 +99,22 @@ class CircleAPIDemo:
             print(f"❌ Exceção ao consultar conta: {str(e)}")
             return {"error": str(e)}
     
-    def mint_usdc(self, usd_amount: float, source_wallet_id: str) -> Dict[str, Any]:
+    def mint_usdc(self, usd_amount: float, source_wallet_id: str, 
+                  operacao: Optional[str] = None) -> Dict[str, Any]:
         """
         Demonstra mint de USDC a partir de USD
         
         Args:
             usd_amount: Valor em USD para converter em USDC
             source_wallet_id: ID da carteira de origem (USD)
+            operacao: Identificador da operação, de onde vem a chave de idempotência
         """
         print(f"\n🪙 Iniciando mint de USDC...")
         print(f"   💵 Valor: ${usd_amount}")
         print(f"   🏦 Carteira origem: {source_wallet_id}")
         
         payload = {
-            "idempotencyKey": self.generate_idempotency_key(),
+            "idempotencyKey": self.generate_idempotency_key(operacao),
             "source": {
                 "type": "wallet",
                 "id": source_wallet_id
@@ -140,20 +158,22 @@ class CircleAPIDemo:
             print(f"❌ Erro no mint: {str(e)}")
             return {"error": str(e)}
     
-    def redeem_usdc(self, usdc_amount: float, destination_wallet_id: str) -> Dict[str, Any]:
+    def redeem_usdc(self, usdc_amount: float, destination_wallet_id: str, 
+                    operacao: Optional[str] = None) -> Dict[str, Any]:
         """
         Demonstra redeem de USDC para USD
         
         Args:
             usdc_amount: Valor em USDC para converter em USD
             destination_wallet_id: ID da carteira de destino (USD)
+            operacao: Identificador da operação, de onde vem a chave de idempotência
         """
         print(f"\n💸 Iniciando redeem de USDC...")
         print(f"   🪙 Valor: {usdc_amount} USDC")
         print(f"   🏦 Carteira destino: {destination_wallet_id}")
         
         payload = {
-            "idempotencyKey": self.generate_idempotency_key(),
+            "idempotencyKey": self.generate_idempotency_key(operacao),
             "source": {
                 "type": "blockchain",
                 "chain": "ETH",
@@ -196,7 +216,8 @@ class CircleAPIDemo:
             print(f"❌ Erro no redeem: {str(e)}")
             return {"error": str(e)}
     
-    def transfer_usdc(self, from_address: str, to_address: str, amount: float) -> Dict[str, Any]:
+    def transfer_usdc(self, from_address: str, to_address: str, amount: float, 
+                      operacao: Optional[str] = None) -> Dict[str, Any]:
         """
         Demonstra transferência USDC entre endereços
         
@@ -204,6 +225,7 @@ class CircleAPIDemo:
             from_address: Endereço de origem
             to_address: Endereço de destino
             amount: Valor em USDC
+            operacao: Identificador da operação, de onde vem a chave de idempotência
         """
         print(f"\n🔄 Iniciando transferência USDC...")
         print(f"   📤 De: {from_address[:10]}...{from_address[-8:]}")
@@ -212,10 +234,12 @@ class CircleAPIDemo:
         
         # Em uma implementação real, isso seria feito através de smart contracts
         # ou APIs específicas da Circle para transferências
+        idempotency_key = self.generate_idempotency_key(operacao)
         
         mock_response = {
             "data": {
                 "id": f"transfer_{uuid.uuid4().hex[:8]}",
+                "idempotencyKey": idempotency_key,
                 "from": from_address,
                 "to": to_address,
                 "amount": amount,
@@ -248,38 +272,188 @@ class PicPayUSDCService:
             456: {"name": "João Santos", "brl_balance": 2000.0, "usdc_balance": 100.0}
         }
         
+        # Reservas (holds) abertas: o valor sai do saldo na reserva e só volta
+        # se a operação na Circle falhar ou se a reserva expirar
+        self.reservas: Dict[str, Dict[str, Any]] = {}
+        self.validade_reserva = 300  # segundos
+        # (expira_em, reserva_id) em heap, como em HoldBook: expirar olha só o topo
+        self._expiracoes: List[Tuple[float, str]] = []
+        # Reservas expiradas: uma confirmação atrasada ainda precisa debitar
+        self.reservas_expiradas: Dict[str, Dict[str, Any]] = {}
+        # Confirmações atrasadas que deixaram o saldo negativo
+        self.descobertos: List[Dict[str, Any]] = []
+        # Saldos e reservas são alterados também pelas liquidações em segundo plano
+        self._lock = threading.RLock()
+        # Chamadas à Circle das conversões, fora do caminho do usuário
+        self.liquidacao = ThreadPoolExecutor(max_workers=8, thread_name_prefix="liquidacao")
+        # Resultado de cada operação com pedido_id ("mint:<usuário>:<pedido>"):
+        # repetir o pedido devolve o resultado guardado sem mexer nos saldos
+        self.pedidos: Dict[str, Dict[str, Any]] = {}
+        # Transferências com pedido_id cuja chamada à Circle ainda não voltou
+        self._em_andamento: set = set()
+        
         print(f"🏦 PicPay USDC Service inicializado")
         print(f"💱 Taxa BRL/USD: {self.exchange_rate_brl_usd}")
     
-    def convert_brl_to_usdc(self, user_id: int, brl_amount: float) -> Dict[str, Any]:
+    def reservar(self, user_id: int, moeda: str, valor: float) -> Optional[str]:
+        """
+        Reserva um valor do saldo do usuário (fase 1); retorna o id da reserva
+        ou None se o saldo for insuficiente
+        """
+        with self._lock:
+            self.expirar_reservas()
+            saldo = f"{moeda}_balance"
+            user = self.users[user_id]
+            if user[saldo] < valor:
+                return None
+            user[saldo] -= valor
+            reserva_id = str(uuid.uuid4())
+            expira_em = time.time() + self.validade_reserva
+            self.reservas[reserva_id] = {"user_id": user_id, "saldo": saldo, "valor": valor, 
+                                         "expira_em": expira_em}
+            heapq.heappush(self._expiracoes, (expira_em, reserva_id))
+            return reserva_id
+    
+    def confirmar(self, reserva_id: str):
+        """
+        Confirma a reserva (fase 2): o débito passa a ser definitivo
+        
+        Se a reserva já expirou, o valor voltou para o saldo, mas a operação
+        aconteceu na Circle: ele é debitado de novo, como em HoldBook.commit,
+        e um saldo negativo fica registrado em self.descobertos
+        """
+        with self._lock:
+            if self.reservas.pop(reserva_id, None) is not None:
+                return
+            reserva = self.reservas_expiradas.pop(reserva_id, None)
+            if reserva is None:
+                return
+            user = self.users[reserva["user_id"]]
+            user[reserva["saldo"]] -= reserva["valor"]
+            if user[reserva["saldo"]] < 0:
+                print(f"⚠️  Confirmação atrasada deixou o saldo negativo: {user[reserva['saldo']]}")
+                self.descobertos.append(reserva)
+    
+    def liberar(self, reserva_id: str):
+        """
+        Libera a reserva (fase 2): o valor volta para o saldo do usuário
+        """
+        with self._lock:
+            reserva = self.reservas.pop(reserva_id, None)
+            if reserva is not None:
+                self.users[reserva["user_id"]][reserva["saldo"]] += reserva["valor"]
+            else:
+                # Já devolvida quando expirou
+                self.reservas_expiradas.pop(reserva_id, None)
+    
+    def expirar_reservas(self):
+        """
+        Libera as reservas que ninguém confirmou dentro do prazo, guardando-as
+        para o caso de uma confirmação atrasada
+        
+        Só percorre as reservas vencidas; as já confirmadas ou liberadas são
+        descartadas quando chegam ao topo do heap
+        """
+        agora = time.time()
+        with self._lock:
+            while self._expiracoes and self._expiracoes[0][0] <= agora:
+                _, reserva_id = heapq.heappop(self._expiracoes)
+                reserva = self.reservas.get(reserva_id)
+                if reserva is None:
+                    continue
+                self.liberar(reserva_id)
+                self.reservas_expiradas[reserva_id] = reserva
+    
+    def _repetido(self, operacao: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Resultado guardado de uma operação já aceita (chamar com self._lock)
+        
+        Uma conversão cujo mint falhou é esquecida, para que repetir o pedido
+        tente de novo
+        """
+        if operacao is None:
+            return None
+        resultado = self.pedidos.get(operacao)
+        if resultado is None:
+            return None
+        settlement = resultado.get("settlement")
+        if settlement is not None and settlement.done() and not settlement.result()["success"]:
+            del self.pedidos[operacao]
+            return None
+        print(f"   ↩️  Pedido repetido ({operacao}): saldos não alterados")
+        return {**resultado, "replayed": True}
+    
+    def convert_brl_to_usdc(self, user_id: int, brl_amount: float, 
+                            pedido_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Converte BRL para USDC para um usuário
+        
+        pedido_id identifica a conversão ("mint:<user_id>:<pedido_id>"): a
+        Circle recebe a mesma chave de idempotência e repetir a chamada com o
+        mesmo pedido devolve o resultado da primeira, sem nova reserva nem
+        novo crédito
+        
+        Retorna assim que o BRL está reservado; o mint na Circle roda em
+        segundo plano e "settlement" (um Future) traz o resultado final,
+        depois de a reserva ser confirmada e o USDC creditado, ou liberada
         """
         print(f"\n🔄 Conversão BRL → USDC")
         print(f"   👤 Usuário: {user_id} ({self.users[user_id]['name']})")
         print(f"   💰 Valor: R$ {brl_amount}")
+        operacao = f"mint:{user_id}:{pedido_id}" if pedido_id else None
         
-        # Verificar saldo BRL
-        user = self.users[user_id]
-        if user["brl_balance"] < brl_amount:
-            print("❌ Saldo BRL insuficiente!")
-            return {"success": False, "error": "Saldo insuficiente"}
-        
-        # Converter BRL para USD
-        usd_amount = brl_amount / self.exchange_rate_brl_usd
-        print(f"   💵 Equivalente em USD: ${usd_amount:.2f}")
-        
-        # Debitar BRL
-        user["brl_balance"] -= brl_amount
-        print(f"   ➖ BRL debitado. Novo saldo: R$ {user['brl_balance']}")
-        
-        # Simular mint USDC via Circle
-        mint_result = self.circle.mint_usdc(usd_amount, "picpay_usd_wallet")
+        with self._lock:
+            repetido = self._repetido(operacao)
+            if repetido is not None:
+                return repetido
+            
+            # Verificar e reservar saldo BRL
+            user = self.users[user_id]
+            reserva_id = self.reservar(user_id, "brl", brl_amount)
+            if reserva_id is None:
+                print("❌ Saldo BRL insuficiente!")
+                return {"success": False, "error": "Saldo insuficiente"}
+            print(f"   🔒 BRL reservado. Saldo disponível: R$ {user['brl_balance']}")
+            
+            # Converter BRL para USD
+            usd_amount = brl_amount / self.exchange_rate_brl_usd
+            print(f"   💵 Equivalente em USD: ${usd_amount:.2f}")
+            
+            # Mint USDC via Circle fora do caminho do usuário (como
+            # PicPayUSDCService.convert_usdc_to_brl_async em demo_code_example_en.py)
+            settlement = self.liquidacao.submit(self._liquidar_mint, reserva_id, user_id, brl_amount, 
+                                                usd_amount, operacao)
+            print("   ⏳ Conversão aceita; o mint será liquidado em segundo plano")
+            
+            resultado = {
+                "success": True,
+                "status": "pending",
+                "reserva_id": reserva_id,
+                "brl_reserved": brl_amount,
+                "usdc_to_credit": usd_amount,
+                "settlement": settlement
+            }
+            if operacao is not None:
+                self.pedidos[operacao] = resultado
+            return resultado
+    
+    def _liquidar_mint(self, reserva_id: str, user_id: int, brl_amount: float, usd_amount: float, 
+                       operacao: Optional[str]) -> Dict[str, Any]:
+        """
+        Faz o mint na Circle e liquida a reserva BRL (roda em self.liquidacao)
+        """
+        try:
+            mint_result = self.circle.mint_usdc(usd_amount, "picpay_usd_wallet", operacao=operacao)
+        except Exception as e:
+            mint_result = {"error": str(e)}
         
         if "error" not in mint_result:
-            # Creditar USDC
-            user["usdc_balance"] += usd_amount
-            print(f"   ➕ USDC creditado. Novo saldo: {user['usdc_balance']} USDC")
+            # Confirmar débito BRL e creditar USDC
+            with self._lock:
+                self.confirmar(reserva_id)
+                user = self.users[user_id]
+                user["usdc_balance"] += usd_amount
+                print(f"   ➕ USDC creditado. Novo saldo: {user['usdc_balance']} USDC")
             
             return {
                 "success": True,
@@ -288,55 +462,80 @@ class PicPayUSDCService:
                 "transaction_id": mint_result["data"]["id"]
             }
         else:
-            # Reverter débito BRL em caso de erro
-            user["brl_balance"] += brl_amount
-            print("❌ Erro no mint. Débito BRL revertido.")
+            # Liberar a reserva BRL em caso de erro
+            self.liberar(reserva_id)
+            print("❌ Erro no mint. Reserva BRL liberada.")
             return {"success": False, "error": "Erro no mint USDC"}
     
-    def send_international_transfer(self, from_user_id: int, to_email: str, usdc_amount: float) -> Dict[str, Any]:
+    def send_international_transfer(self, from_user_id: int, to_email: str, usdc_amount: float, 
+                                    pedido_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Envia transferência internacional em USDC
+        
+        pedido_id tem o mesmo papel que em convert_brl_to_usdc
+        ("transfer:<from_user_id>:<pedido_id>"); só transferências concluídas
+        são guardadas, então repetir uma que falhou tenta de novo
         """
         print(f"\n🌍 Transferência Internacional")
         print(f"   👤 De: {from_user_id} ({self.users[from_user_id]['name']})")
         print(f"   📧 Para: {to_email}")
         print(f"   💰 Valor: {usdc_amount} USDC")
+        operacao = f"transfer:{from_user_id}:{pedido_id}" if pedido_id else None
         
         user = self.users[from_user_id]
         
-        # Verificar saldo USDC
-        if user["usdc_balance"] < usdc_amount:
-            print("❌ Saldo USDC insuficiente!")
-            return {"success": False, "error": "Saldo USDC insuficiente"}
-        
-        # Debitar USDC
-        user["usdc_balance"] -= usdc_amount
-        print(f"   ➖ USDC debitado. Novo saldo: {user['usdc_balance']} USDC")
+        # Verificar e reservar saldo USDC; a checagem do pedido e a reserva
+        # acontecem juntas, então duas repetições simultâneas não reservam duas vezes
+        with self._lock:
+            repetido = self._repetido(operacao)
+            if repetido is not None:
+                return repetido
+            if operacao is not None and operacao in self._em_andamento:
+                return {"success": False, "error": "Pedido em andamento"}
+            reserva_id = self.reservar(from_user_id, "usdc", usdc_amount)
+            if reserva_id is None:
+                print("❌ Saldo USDC insuficiente!")
+                return {"success": False, "error": "Saldo USDC insuficiente"}
+            if operacao is not None:
+                self._em_andamento.add(operacao)
+        print(f"   🔒 USDC reservado. Saldo disponível: {user['usdc_balance']} USDC")
         
         # Simular transferência
-        transfer_result = self.circle.transfer_usdc(
-            "0xPicPayWallet123...",
-            "0xDestinationWallet456...",
-            usdc_amount
-        )
+        try:
+            transfer_result = self.circle.transfer_usdc(
+                "0xPicPayWallet123...",
+                "0xDestinationWallet456...",
+                usdc_amount,
+                operacao=operacao
+            )
+        except Exception as e:
+            transfer_result = {"error": str(e)}
         
         if "error" not in transfer_result:
+            resultado = {
+                "success": True,
+                "amount_sent": usdc_amount,
+                "recipient": to_email,
+                "transaction_hash": transfer_result["data"]["transactionHash"]
+            }
+            with self._lock:
+                self.confirmar(reserva_id)
+                if operacao is not None:
+                    self.pedidos[operacao] = resultado
+                    self._em_andamento.discard(operacao)
             print("✅ Transferência internacional concluída!")
             
             # Em produção, aqui enviaria notificação por email para o destinatário
             print(f"   📧 Notificação enviada para {to_email}")
             print(f"   ⏱️  Tempo total: ~2 minutos (vs 2 dias no processo atual)")
             
-            return {
-                "success": True,
-                "amount_sent": usdc_amount,
-                "recipient": to_email,
-                "transaction_hash": transfer_result["data"]["transactionHash"]
-            }
+            return resultado
         else:
-            # Reverter débito em caso de erro
-            user["usdc_balance"] += usdc_amount
-            print("❌ Erro na transferência. Débito revertido.")
+            # Liberar a reserva em caso de erro
+            with self._lock:
+                self.liberar(reserva_id)
+                self._em_andamento.discard(operacao)
+            print("❌ Erro na transferência. Reserva liberada.")
             return {"success": False, "error": "Erro na transferência"}
     
     def show_user_balances(self):
@@ -375,11 +574,23 @@ def main():
     print("📋 CENÁRIO 1: Maria converte R$ 500 para USDC")
     print("=" * 60)
     
-    result1 = picpay_service.convert_brl_to_usdc(123, 500.0)
+    result1 = picpay_service.convert_brl_to_usdc(123, 500.0, pedido_id="pedido-1001")
+    if result1["success"]:
+        # O app já respondeu; aqui esperamos a liquidação só para exibir o resultado
+        result1 = result1["settlement"].result()
     if result1["success"]:
         print(f"✅ Conversão realizada com sucesso!")
         print(f"   Transaction ID: {result1['transaction_id']}")
     
+    print("\n" + "=" * 60)
+    print("📋 CENÁRIO 1b: o app repete o pedido (ex.: timeout na rede do celular)")
+    print("=" * 60)
+    
+    retry1 = picpay_service.convert_brl_to_usdc(123, 500.0, pedido_id="pedido-1001")
+    if retry1.get("replayed"):
+        retry1 = retry1["settlement"].result()
+        print(f"✅ Mesmo resultado, sem novo débito: {retry1['transaction_id']}")
+    
     print("\n" + "=" * 60)
     print("📋 CENÁRIO 2: Maria envia USDC para filha nos EUA")
     print("=" * 60)
@@ -387,13 +598,20 @@ def main():
     result2 = picpay_service.send_international_transfer(
         123, 
         "filha@universidade.edu", 
-        50.0
+        50.0,
+        pedido_id="pedido-1002"
     )
     if result2["success"]:
         print(f"✅ Transferência internacional realizada!")
         print(f"   Hash: {result2['transaction_hash'][:20]}...")
     
+    retry2 = picpay_service.send_international_transfer(123, "filha@universidade.edu", 50.0, 
+                                                        pedido_id="pedido-1002")
+    if retry2.get("replayed"):
+        print(f"✅ Transferência repetida não debitou de novo: {retry2['transaction_hash'][:20]}...")
+    
     # Mostrar saldos finais
+    picpay_service.liquidacao.shutdown(wait=True)
     print("\n" + "=" * 60)
     print("📊 SALDOS FINAIS")
     print("=" * 60)
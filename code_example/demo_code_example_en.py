@@ -21,9 +21,36 @@ import os
 import uuid
 import json
 import time
-import requests
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import Dict, List, Optional, Union
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from cold_start import lazy_import, open_connections, prime_dns
+from holds import HoldBook
+from idempotency import IdempotencyStore, ReplayedResponse, derive_idempotency_key
+from instrumentation import Metrics, connection_pool_collector, traced
+from money import DECIMALS, Money
+from rate_limiter import RateLimiter, parse_retry_after
+from records import (FINAL_STATUSES, ConversionResult, HoldRecord, PaymentResult, TransactionRecord, WalletRecord, 
+                     new_address, now_us, parse_us)
+from transaction_history import iter_transaction_history
+from user_locks import UserLocks
+from wallet_ledger import InMemoryLedger, WalletLedger
+
+if TYPE_CHECKING:  # Optional features, imported by whoever uses them
+    from address_pool import AddressPool
+    from balance_view import BalanceView
+    from netting import NettingBook
+    from rate_cache import ExchangeRateCache
+    from reconciliation import LedgerJournal
+    from resilience import CircuitBreakers, Hedger
+    from webhook_receiver import StatusUpdate
+
+# Executed when the first CircleClient is built, not when this module is imported
+requests = lazy_import("requests")
 
 # Configuration
 # In production, these would be stored securely and not in code
@@ -37,250 +64,926 @@ EXCHANGE_RATES = {
     "USD_BRL": 5.0,    # 1 USD = 5.0 BRL
 }
 
+# Request payload builders shared by the sync and async clients
+
+def format_amount(amount: Union[Money, float, str], currency: str = "USDC") -> str:
+    """Exact decimal string for an API amount (floats are rounded to the currency's decimals)"""
+    if isinstance(amount, Money):
+        return str(amount)
+    return str(Money.parse(amount, currency if currency in DECIMALS else "USDC"))
+
+def mint_payload(idempotency_key: str, amount_usd: Union[Money, float], destination_address: str) -> Dict:
+    """Build the businessAccount transfer payload that mints USDC to an address"""
+    return {
+        "idempotencyKey": idempotency_key,
+        "source": {
+            "type": "wallet",
+            "id": PICPAY_WALLET_ID
+        },
+        "destination": {
+            "type": "blockchain",
+            "address": destination_address,
+            "chain": "ETH"
+        },
+        "amount": {
+            "amount": format_amount(amount_usd),
+            "currency": "USD"
+        }
+    }
+
+def redeem_payload(idempotency_key: str, amount_usdc: Union[Money, float], blockchain_address: str) -> Dict:
+    """Build the businessAccount transfer payload that redeems USDC to the wallet"""
+    return {
+        "idempotencyKey": idempotency_key,
+        "source": {
+            "type": "blockchain",
+            "address": blockchain_address,
+            "chain": "ETH"
+        },
+        "destination": {
+            "type": "wallet",
+            "id": PICPAY_WALLET_ID
+        },
+        "amount": {
+            "amount": format_amount(amount_usdc),
+            "currency": "USD"
+        }
+    }
+
+def transfer_payload(idempotency_key: str, 
+                     source_wallet_id: str, 
+                     destination_wallet_id: str, 
+                     amount: Union[Money, float], 
+                     currency: str) -> Dict:
+    """Build the payload for a wallet to wallet transfer"""
+    return {
+        "idempotencyKey": idempotency_key,
+        "source": {
+            "type": "wallet",
+            "id": source_wallet_id
+        },
+        "destination": {
+            "type": "wallet",
+            "id": destination_wallet_id
+        },
+        "amount": {
+            "amount": format_amount(amount, currency),
+            "currency": currency
+        }
+    }
+
+def history_params(from_date: Optional[str] = None, 
+                   to_date: Optional[str] = None, 
+                   page_size: int = 50, 
+                   page_before: Optional[str] = None, 
+                   page_after: Optional[str] = None) -> Dict:
+    """Build the query parameters for a transaction history request"""
+    params = {"pageSize": page_size}
+    if from_date:
+        params["from"] = from_date
+    if to_date:
+        params["to"] = to_date
+    if page_before:
+        params["pageBefore"] = page_before
+    if page_after:
+        params["pageAfter"] = page_after
+    return params
+
+
 class CircleClient:
     """Client for interacting with Circle APIs"""
     
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(self, api_key: str, base_url: str, 
+                 rate_limiter: Optional[RateLimiter] = None, 
+                 max_retries: int = 3, 
+                 idempotency_store: Optional[IdempotencyStore] = None, 
+                 metrics: Optional[Metrics] = None, 
+                 timeout: Union[float, Tuple[float, float]] = (3.05, 10.0), 
+                 breakers: Optional["CircuitBreakers"] = None, 
+                 hedger: Optional["Hedger"] = None):
         self.api_key = api_key
         self.base_url = base_url
+        self.rate_limiter = rate_limiter  # Can be shared by many clients
+        self.max_retries = max_retries  # Retries after a 429 response
+        self.idempotency_store = idempotency_store  # Keys and results per operation_id
+        self.timeout = timeout  # (connect, read) seconds for every request
+        self.breakers = breakers  # Per-endpoint circuit breakers, can be shared
+        self.hedger = hedger  # Hedges the idempotent reads (see resilience.py)
         self.session = requests.Session()
         self.session.headers.update({
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         })
+        self.metrics = metrics  # Opt-in timings and counters (see instrumentation.py)
+        self._metric_keys: Dict[str, Tuple] = {}  # Per endpoint, built on first use
+        if metrics is not None:
+            metrics.add_collector(connection_pool_collector(self.session))
     
-    def _generate_idempotency_key(self) -> str:
-        """Generate a unique idempotency key for API requests"""
+    def _generate_idempotency_key(self, operation_id: Optional[str] = None) -> str:
+        """Generate an idempotency key for API requests
+        
+        Requests without an operation_id get a unique key; with one the key
+        is derived from it, so every retry of the operation sends the same key.
+        """
+        if operation_id is not None:
+            return derive_idempotency_key(operation_id)
         return str(uuid.uuid4())
     
-    def get_wallet_balance(self, wallet_id: str) -> Dict:
-        """Get the balance of a specific wallet"""
-        url = f"{self.base_url}/v1/businessAccount/wallets/{wallet_id}/balances"
-        response = self.session.get(url)
+    def _post_once(self, operation_id: Optional[str], endpoint: str, path: str, 
+                   build_payload: Callable[[str], Dict]) -> Dict:
+        """POST a money-moving request under its operation's idempotency key
+        
+        With an idempotency_store the key is recorded before the request is
+        sent and Circle's response is cached afterwards, so retrying a
+        completed operation returns the cached response (a ReplayedResponse)
+        without calling Circle. A request Circle rejects (4xx other than 429) releases its
+        key so a corrected retry is not refused as a conflicting duplicate.
+        """
+        store = self.idempotency_store
+        if store is None or operation_id is None:
+            payload = build_payload(self._generate_idempotency_key(operation_id))
+            return self._request("POST", endpoint, path, json=payload)
+        
+        key, result = store.begin(operation_id)
+        if result is not None:
+            return result
+        try:
+            result = self._request("POST", endpoint, path, json=build_payload(key))
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and 400 <= status < 500 and status != 429:
+                store.forget(operation_id)
+            raise
+        store.complete(operation_id, result)
+        return result
+    
+    def _request(self, method: str, endpoint: str, path: str, hedge: bool = False, **kwargs) -> Dict:
+        """Send a request, waiting on the rate limiter and retrying 429 responses
+        
+        endpoint names the rate-limit bucket, e.g. "POST /v1/transfers". The
+        payload (and so its idempotency key) is the same on every attempt, which
+        keeps retried POSTs safe.
+        
+        With breakers set, an endpoint whose circuit is open raises
+        CircuitOpenError without calling Circle; timeouts, connection errors
+        and 5xx answers count as its failures. hedge=True (idempotent reads
+        only) lets the hedger send a second copy of a slow request.
+        """
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        metrics = self.metrics
+        breaker = self.breakers.get(endpoint) if self.breakers is not None else None
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                started = time.perf_counter()
+                self.rate_limiter.acquire(endpoint)
+                if metrics is not None:
+                    metrics.observe("circle_rate_limit_wait", time.perf_counter() - started, {"endpoint": endpoint})
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                if hedge and self.hedger is not None:
+                    response = self.hedger.call(endpoint, lambda: self._send(metrics, method, endpoint, url, **kwargs))
+                else:
+                    response = self._send(metrics, method, endpoint, url, **kwargs)
+            except requests.RequestException:
+                if breaker is not None:
+                    breaker.on_failure()
+                raise
+            if breaker is not None:
+                if response.status_code >= 500:
+                    breaker.on_failure()
+                else:
+                    breaker.on_success()
+            if response.status_code != 429:
+                break
+            
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if attempt == self.max_retries:
+                break
+            if metrics is not None:
+                metrics.increment("circle_retries_total", 1, {"endpoint": endpoint, "reason": "429"})
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_throttled(endpoint, retry_after)
+            else:
+                # Exponential backoff with full jitter
+                delay = retry_after if retry_after is not None else random.uniform(0, 0.5 * 2 ** attempt)
+                if metrics is not None:
+                    metrics.observe("circle_backoff", delay, {"endpoint": endpoint})
+                time.sleep(delay)
+        
         response.raise_for_status()
         return response.json()
     
-    def mint_usdc(self, amount_usd: float, destination_address: str) -> Dict:
-        """Mint USDC from USD and send to destination address"""
-        url = f"{self.base_url}/v1/businessAccount/transfers"
-        payload = {
-            "idempotencyKey": self._generate_idempotency_key(),
-            "source": {
-                "type": "wallet",
-                "id": PICPAY_WALLET_ID
-            },
-            "destination": {
-                "type": "blockchain",
-                "address": destination_address,
-                "chain": "ETH"
-            },
-            "amount": {
-                "amount": str(amount_usd),
-                "currency": "USD"
-            }
+    def _send(self, metrics: Optional[Metrics], method: str, endpoint: str, url: str, **kwargs):
+        if metrics is None:
+            return self.session.request(method, url, **kwargs)
+        return self._measured_request(metrics, method, endpoint, url, **kwargs)
+    
+    def _measured_request(self, metrics: Metrics, method: str, endpoint: str, url: str, **kwargs):
+        """session.request recording its timings, status and size
+        
+        circle_http_headers runs from sending the request (connecting first
+        if no pooled connection was free) to the response headers;
+        circle_http also covers reading the body.
+        """
+        keys = self._metric_keys.get(endpoint)
+        if keys is None:
+            labels = {"endpoint": endpoint}
+            keys = self._metric_keys[endpoint] = tuple(Metrics.key(name, labels) for name in (
+                "circle_http", "circle_http_headers", "circle_bytes_sent_total", "circle_bytes_received_total"))
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            metrics.increment("circle_transport_errors_total", 1, {"endpoint": endpoint, "error": type(e).__name__})
+            raise
+        metrics.observe_key(keys[0], time.perf_counter() - started)
+        metrics.observe_key(keys[1], response.elapsed.total_seconds())
+        metrics.increment_key(keys[2], len(response.request.body or b""))
+        metrics.increment_key(keys[3], len(response.content))
+        metrics.increment("circle_responses_total", 1, {"endpoint": endpoint, "status": str(response.status_code)})
+        return response
+    
+    def warmup(self, connections: int = 4) -> Dict:
+        """Resolve Circle's host and open connections before the first real request
+        
+        Each of the `connections` parallel GET /v1/configuration calls opens
+        its own pooled connection (keep it within the pool size, 10 per host
+        by default), and a wrong API key fails here instead of on a
+        customer's transfer. Returns the seconds each step took.
+        """
+        started = time.perf_counter()
+        addresses = prime_dns(self.base_url)
+        resolved = time.perf_counter()
+        open_connections(self.get_configuration, connections)
+        return {
+            "addresses": addresses,
+            "dns_seconds": resolved - started,
+            "connect_seconds": time.perf_counter() - resolved,
         }
-        response = self.session.post(url, json=payload)
-        response.raise_for_status()
-        return response.json()
     
-    def redeem_usdc(self, amount_usdc: float, blockchain_address: str) -> Dict:
+    def get_configuration(self) -> Dict:
+        """Get the account configuration (master wallet id); also a cheap authenticated ping"""
+        return self._request("GET", "GET /v1/configuration", "/v1/configuration")
+    
+    def get_wallet_balance(self, wallet_id: str) -> Dict:
+        """Get the balance of a specific wallet"""
+        return self._request("GET", "GET /v1/businessAccount/wallets/{id}/balances", 
+                             f"/v1/businessAccount/wallets/{wallet_id}/balances", hedge=True)
+    
+    def create_deposit_address(self, wallet_id: str, currency: str = "USD", chain: str = "ETH", 
+                               operation_id: Optional[str] = None) -> Dict:
+        """Generate a new blockchain deposit address for a wallet"""
+        return self._post_once(operation_id, "POST /v1/wallets/{id}/addresses", 
+                               f"/v1/wallets/{wallet_id}/addresses", 
+                               lambda key: {"idempotencyKey": key, "currency": currency, "chain": chain})
+    
+    def mint_usdc(self, amount_usd: Union[Money, float], destination_address: str, 
+                  operation_id: Optional[str] = None) -> Dict:
+        """Mint USDC from USD and send to destination address
+        
+        operation_id (e.g. "mint:<order id>") identifies the operation across
+        retries and processes; see _post_once.
+        """
+        return self._post_once(operation_id, "POST /v1/businessAccount/transfers", 
+                               "/v1/businessAccount/transfers", 
+                               lambda key: mint_payload(key, amount_usd, destination_address))
+    
+    def redeem_usdc(self, amount_usdc: Union[Money, float], blockchain_address: str, 
+                    operation_id: Optional[str] = None) -> Dict:
         """Redeem USDC to USD by transferring from blockchain to wallet"""
-        url = f"{self.base_url}/v1/businessAccount/transfers"
-        payload = {
-            "idempotencyKey": self._generate_idempotency_key(),
-            "source": {
-                "type": "blockchain",
-                "address": blockchain_address,
-                "chain": "ETH"
-            },
-            "destination": {
-                "type": "wallet",
-                "id": PICPAY_WALLET_ID
-            },
-            "amount": {
-                "amount": str(amount_usdc),
-                "currency": "USD"
-            }
-        }
-        response = self.session.post(url, json=payload)
-        response.raise_for_status()
-        return response.json()
+        return self._post_once(operation_id, "POST /v1/businessAccount/transfers", 
+                               "/v1/businessAccount/transfers", 
+                               lambda key: redeem_payload(key, amount_usdc, blockchain_address))
     
     def create_transfer(self, 
                        source_wallet_id: str, 
                        destination_wallet_id: str, 
-                       amount: float, 
-                       currency: str) -> Dict:
+                       amount: Union[Money, float], 
+                       currency: str, 
+                       operation_id: Optional[str] = None) -> Dict:
         """Create a transfer between wallets"""
-        url = f"{self.base_url}/v1/transfers"
-        payload = {
-            "idempotencyKey": self._generate_idempotency_key(),
-            "source": {
-                "type": "wallet",
-                "id": source_wallet_id
-            },
-            "destination": {
-                "type": "wallet",
-                "id": destination_wallet_id
-            },
-            "amount": {
-                "amount": str(amount),
-                "currency": currency
-            }
-        }
-        response = self.session.post(url, json=payload)
-        response.raise_for_status()
-        return response.json()
+        return self._post_once(operation_id, "POST /v1/transfers", "/v1/transfers", 
+                               lambda key: transfer_payload(key, source_wallet_id, destination_wallet_id, 
+                                                            amount, currency))
     
     def get_transfer_status(self, transfer_id: str) -> Dict:
         """Get the status of a transfer"""
-        url = f"{self.base_url}/v1/transfers/{transfer_id}"
-        response = self.session.get(url)
-        response.raise_for_status()
-        return response.json()
+        return self._request("GET", "GET /v1/transfers/{id}", f"/v1/transfers/{transfer_id}", hedge=True)
+    
+    def list_transfers(self, 
+                       from_date: Optional[str] = None, 
+                       to_date: Optional[str] = None, 
+                       page_size: int = 50, 
+                       page_before: Optional[str] = None, 
+                       page_after: Optional[str] = None) -> Dict:
+        """List one page of the account's transfers (newest first)"""
+        return self._request("GET", "GET /v1/transfers", "/v1/transfers", 
+                             params=history_params(from_date, to_date, page_size, page_before, page_after))
     
     def get_transaction_history(self, wallet_id: str, 
                                from_date: Optional[str] = None, 
                                to_date: Optional[str] = None, 
-                               page_size: int = 50) -> Dict:
-        """Get transaction history for a wallet"""
-        url = f"{self.base_url}/v1/wallets/{wallet_id}/transactions"
-        params = {"pageSize": page_size}
-        if from_date:
-            params["from"] = from_date
-        if to_date:
-            params["to"] = to_date
-            
-        response = self.session.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
+                               page_size: int = 50, 
+                               page_before: Optional[str] = None, 
+                               page_after: Optional[str] = None) -> Dict:
+        """Get one page of transaction history for a wallet (newest first)
+        
+        page_after / page_before take the id of an item from a previous page
+        and return the items older / newer than it.
+        """
+        return self._request("GET", "GET /v1/wallets/{id}/transactions", 
+                             f"/v1/wallets/{wallet_id}/transactions", 
+                             params=history_params(from_date, to_date, page_size, page_before, page_after))
+    
+    def iter_transaction_history(self, wallet_id: str, 
+                                 from_date: Optional[str] = None, 
+                                 to_date: Optional[str] = None, 
+                                 page_size: int = 50, 
+                                 prefetch: int = 4, 
+                                 windows: int = 1, 
+                                 ordered: bool = True) -> Iterator[Dict]:
+        """Iterate over a wallet's whole transaction history, following the
+        page cursors and prefetching pages (see transaction_history.py)"""
+        return iter_transaction_history(self, wallet_id, from_date, to_date, page_size,
+                                        prefetch, windows, ordered)
+    
+    def get_exchange_rate(self, from_currency: str, to_currency: str) -> Dict:
+        """Get the current indicative exchange rate between two currencies"""
+        return self._request("GET", "GET /v1/exchange/rates", "/v1/exchange/rates", hedge=True, 
+                             params={"from": from_currency, "to": to_currency})
+    
+    def create_quote(self, from_currency: str, from_amount: Union[Money, float], to_currency: str) -> Dict:
+        """Create a tradable exchange quote (valid until its expiresAt)"""
+        payload = {
+            "type": "tradable",
+            "idempotencyKey": self._generate_idempotency_key(),
+            "from": {
+                "currency": from_currency,
+                "amount": format_amount(from_amount, from_currency)
+            },
+            "to": {
+                "currency": to_currency
+            }
+        }
+        return self._request("POST", "POST /v1/exchange/quotes", "/v1/exchange/quotes", json=payload)
+    
+    def create_trade(self, quote_id: str, operation_id: Optional[str] = None) -> Dict:
+        """Execute a tradable quote (before its expiresAt)"""
+        return self._post_once(operation_id, "POST /v1/exchange/trades", "/v1/exchange/trades", 
+                               lambda key: {"idempotencyKey": key, "quoteId": quote_id})
+    
+    def get_trade(self, trade_id: str) -> Dict:
+        """Get a trade; once complete it carries the settlementId paying for it"""
+        return self._request("GET", "GET /v1/exchange/trades/{id}", f"/v1/exchange/trades/{trade_id}", 
+                             hedge=True)
+    
+    def list_trades(self, 
+                    from_date: Optional[str] = None, 
+                    to_date: Optional[str] = None, 
+                    page_size: int = 50, 
+                    page_before: Optional[str] = None, 
+                    page_after: Optional[str] = None) -> Dict:
+        """List one page of the account's trades (newest first)"""
+        return self._request("GET", "GET /v1/exchange/trades", "/v1/exchange/trades", 
+                             params=history_params(from_date, to_date, page_size, page_before, page_after))
+    
+    def list_fx_settlements(self, 
+                            from_date: Optional[str] = None, 
+                            to_date: Optional[str] = None, 
+                            page_size: int = 50, 
+                            page_before: Optional[str] = None, 
+                            page_after: Optional[str] = None) -> Dict:
+        """List one page of the settlements of completed trades (newest first)"""
+        return self._request("GET", "GET /v1/exchange/trades/settlements", "/v1/exchange/trades/settlements", 
+                             params=history_params(from_date, to_date, page_size, page_before, page_after))
+    
+    def get_settlement_instructions(self, currency: str) -> Dict:
+        """Get where to send the fiat that settles trades in a currency"""
+        return self._request("GET", "GET /v1/exchange/trades/settlements/instructions/{currency}", 
+                             f"/v1/exchange/trades/settlements/instructions/{currency}")
 
 
 class PicPayUSDCService:
     """Service for handling USDC operations within PicPay"""
     
-    def __init__(self, circle_client: CircleClient):
+    def __init__(self, circle_client: CircleClient, 
+                 rate_cache: Optional["ExchangeRateCache"] = None, 
+                 ledger: Optional[WalletLedger] = None, 
+                 locks: Optional[UserLocks] = None, 
+                 hold_ttl: float = 300.0, 
+                 settlement_workers: int = 32, 
+                 metrics: Optional[Metrics] = None, 
+                 netting: Optional["NettingBook"] = None, 
+                 address_pool: Optional["AddressPool"] = None, 
+                 balance_view: Optional["BalanceView"] = None, 
+                 settled_size: int = 100_000, 
+                 journal: Optional["LedgerJournal"] = None):
         self.circle_client = circle_client
-        self.user_wallets = {}  # In production, this would be in a database
+        self.rate_cache = rate_cache  # Live Circle rates; EXCHANGE_RATES when not set
+        # When set, get_user_balance is served from this view (see
+        # balance_view.py); it wraps the ledger, so writes go through it
+        self.balance_view = balance_view
+        if balance_view is not None:
+            if ledger is not None and ledger is not balance_view and ledger is not balance_view.ledger:
+                raise ValueError("ledger must be the one balance_view wraps; pass BalanceView(ledger) instead")
+            ledger = balance_view
+            if balance_view.rate_source is None:
+                balance_view.rate_source = lambda: self._exchange_rate("USD_BRL")
+                balance_view.refresh_rate()
+        # In production, use a persistent ledger such as SQLiteLedger
+        self.ledger = ledger if ledger is not None else InMemoryLedger()
+        # Serialises each user's balance changes; never held across Circle calls
+        self.locks = locks if locks is not None else UserLocks()
+        # Funds reserved for Circle calls in flight; unsettled holds expire after hold_ttl
+        self.holds = HoldBook(self.ledger, self.locks, ttl=hold_ttl, 
+                              on_change=balance_view.set_held if balance_view is not None else None).start()
+        # Runs the Circle calls of *_async operations (threads start on first use)
+        self.settlement = ThreadPoolExecutor(max_workers=settlement_workers, thread_name_prefix="settlement")
+        # Circle transactions started by this service, by id, updated by
+        # webhooks until they reach a final status; then they move to
+        # settled, which keeps the last settled_size of them so late or
+        # duplicate notifications are still recognised
+        self.transactions: Dict[str, TransactionRecord] = {}
+        self.settled: "OrderedDict[str, TransactionRecord]" = OrderedDict()
+        self.settled_size = settled_size
+        self._transactions_lock = threading.Lock()  # Guards both; taken after user locks, never before
+        # Opt-in timing of every public operation (see instrumentation.py)
+        self.metrics = metrics
+        # When set, conversions are netted into periodic omnibus transfers
+        # instead of one Circle call each (see netting.py); started and
+        # stopped by its owner
+        self.netting = netting
+        # Deposit addresses generated by Circle ahead of time (see
+        # address_pool.py); random local addresses when not set
+        self.address_pool = address_pool
+        # Durable record of every Circle transaction applied to balances,
+        # read by reconciliation (see reconciliation.py)
+        self.journal = journal
+    
+    def _exchange_rate(self, pair: str) -> float:
+        """Current rate for a pair such as "BRL_USD" (never waits on Circle)"""
+        if self.rate_cache is not None:
+            return self.rate_cache.get(pair)
+        return EXCHANGE_RATES[pair]
     
-    def create_user_wallet(self, user_id: str) -> Dict:
+    @traced("service_call")
+    def create_user_wallet(self, user_id: str) -> WalletRecord:
         """Create a new USDC wallet for a user"""
+        address = self._address_if_missing(user_id)
+        with self.locks.hold(user_id):
+            return self._get_or_create_wallet(user_id, address)
+    
+    def _address_if_missing(self, user_id: str) -> Optional[bytes]:
+        """A deposit address for the user's wallet if they have none yet
+        
+        A pool miss calls Circle, so this runs before the user's lock is
+        taken; the address goes unused if another call creates the wallet first.
+        """
+        if self.ledger.get_wallet(user_id) is not None:
+            return None
         # In production, this would involve creating a blockchain address
         # and storing it securely in a database
-        wallet_address = f"0x{uuid.uuid4().hex}"
-        self.user_wallets[user_id] = {
-            "wallet_address": wallet_address,
-            "created_at": datetime.now().isoformat(),
-            "balance_usdc": 0.0
-        }
-        return self.user_wallets[user_id]
+        return self.address_pool.take() if self.address_pool is not None else new_address()
+    
+    def _get_or_create_wallet(self, user_id: str, address: Optional[bytes]) -> WalletRecord:
+        """The user's wallet, created with the address from _address_if_missing
+        if missing (caller holds the user's lock)"""
+        wallet = self.ledger.get_wallet(user_id)
+        if wallet is None:
+            if address is None:
+                # Wallets are never removed, so the caller always has an address here
+                raise RuntimeError(f"No address taken for {user_id}'s new wallet")
+            wallet = self.ledger.create_wallet(user_id, address, now_us())
+        return wallet
     
-    def convert_brl_to_usdc(self, user_id: str, amount_brl: float) -> Dict:
-        """Convert BRL to USDC for a user"""
+    @traced("service_call")
+    def convert_brl_to_usdc(self, user_id: str, amount_brl: Union[Money, float, str], 
+                            operation_id: Optional[str] = None) -> ConversionResult:
+        """Convert BRL to USDC for a user
+        
+        operation_id (e.g. "mint:<order id>") is passed to Circle so a retried
+        conversion reuses the mint's idempotency key.
+        """
+        amount_brl = Money.parse_positive(amount_brl, "BRL")
+        
         # Check if user has a wallet
-        if user_id not in self.user_wallets:
-            self.create_user_wallet(user_id)
+        wallet = self.ledger.get_wallet(user_id)
+        if wallet is None:
+            wallet = self.create_user_wallet(user_id)
         
         # Convert BRL to USD
-        amount_usd = amount_brl * EXCHANGE_RATES["BRL_USD"]
+        amount_usd = amount_brl.convert(self._exchange_rate("BRL_USD"), "USDC")
+        
+        if self.netting is not None:
+            # Credit now; the omnibus wallet is topped up by the next net transfer
+            with self.locks.hold(user_id):
+                entry = self.netting.entry_for(operation_id) if operation_id is not None else None
+                if entry is None:
+                    self.ledger.adjust_balance(user_id, amount_usd.units)
+                    entry = self.netting.add(user_id, "mint", amount_usd.units, operation_id)
+            return ConversionResult(user_id, amount_brl, amount_usd, entry.entry_id, "netted")
         
         # Mint USDC and send to user's wallet
-        wallet_address = self.user_wallets[user_id]["wallet_address"]
-        mint_result = self.circle_client.mint_usdc(amount_usd, wallet_address)
+        response = self.circle_client.mint_usdc(amount_usd, wallet.wallet_address, operation_id=operation_id)
+        if self._replayed(response):
+            # A retried operation: the balance was credited the first time
+            mint = response.get("data", response)
+            return ConversionResult(user_id, amount_brl, amount_usd, mint["id"], self._status_of(mint))
         
         # Update user's balance (in production, this would be based on blockchain confirmation)
-        self.user_wallets[user_id]["balance_usdc"] += amount_usd
+        with self.locks.hold(user_id):
+            self.ledger.adjust_balance(user_id, amount_usd.units)
         
-        return {
-            "user_id": user_id,
-            "amount_brl": amount_brl,
-            "amount_usdc": amount_usd,
-            "transaction_id": mint_result.get("id"),
-            "status": mint_result.get("status", "pending"),
-            "timestamp": datetime.now().isoformat()
-        }
+        # After the credit, so a failure Circle already reported reverses it
+        mint = self._track("mint", response, user_id, None, amount_usd)
+        
+        return ConversionResult(user_id, amount_brl, amount_usd, 
+                                mint.get("id"), mint.get("status", "pending"))
     
-    def convert_usdc_to_brl(self, user_id: str, amount_usdc: float) -> Dict:
-        """Convert USDC to BRL for a user"""
-        # Check if user has a wallet and sufficient balance
-        if user_id not in self.user_wallets:
-            raise ValueError(f"User {user_id} does not have a wallet")
+    @traced("service_call")
+    def convert_usdc_to_brl(self, user_id: str, amount_usdc: Union[Money, float, str], 
+                            operation_id: Optional[str] = None) -> ConversionResult:
+        """Convert USDC to BRL for a user (operation_id as in convert_brl_to_usdc)"""
+        amount_usdc = Money.parse_positive(amount_usdc, "USDC")
         
-        if self.user_wallets[user_id]["balance_usdc"] < amount_usdc:
-            raise ValueError(f"Insufficient USDC balance")
+        # Check the balance and hold the amount before calling Circle, so
+        # concurrent redemptions cannot both spend it
+        hold = self.holds.place(user_id, amount_usdc.units)
+        return self._redeem_held(hold, amount_usdc, operation_id)
+    
+    @traced("service_call")
+    def convert_usdc_to_brl_async(self, user_id: str, amount_usdc: Union[Money, float, str], 
+                                  operation_id: Optional[str] = None) -> Future:
+        """Hold the amount and redeem it in the background
         
-        # Redeem USDC to USD
-        wallet_address = self.user_wallets[user_id]["wallet_address"]
-        redeem_result = self.circle_client.redeem_usdc(amount_usdc, wallet_address)
+        Returns as soon as the funds are held (a ValueError is raised right
+        away if they are not there); the Future resolves with the
+        ConversionResult once Circle has answered, or with its error after
+        the hold was released.
+        """
+        amount_usdc = Money.parse_positive(amount_usdc, "USDC")
+        hold = self.holds.place(user_id, amount_usdc.units)
+        return self.settlement.submit(self._redeem_held, hold, amount_usdc, operation_id)
+    
+    def _redeem_held(self, hold: HoldRecord, amount_usdc: Money, 
+                     operation_id: Optional[str] = None) -> ConversionResult:
+        """Redeem held funds at Circle and settle the hold"""
+        amount_brl = amount_usdc.convert(self._exchange_rate("USD_BRL"), "BRL")
+        if self.netting is not None:
+            with self.locks.hold(hold.user_id):
+                entry = self.netting.entry_for(operation_id) if operation_id is not None else None
+                if entry is None:
+                    self.holds.commit(hold)
+                    entry = self.netting.add(hold.user_id, "redeem", hold.amount_units, operation_id)
+                else:
+                    # A retried operation: the balance was debited the first time
+                    self.holds.release(hold)
+            return ConversionResult(hold.user_id, amount_brl, amount_usdc, entry.entry_id, "netted")
         
-        # Convert USD to BRL
-        amount_brl = amount_usdc * EXCHANGE_RATES["USD_BRL"]
+        wallet = self.ledger.get_wallet(hold.user_id)
         
-        # Update user's balance
-        self.user_wallets[user_id]["balance_usdc"] -= amount_usdc
+        # Redeem USDC to USD
+        try:
+            response = self.circle_client.redeem_usdc(amount_usdc, wallet.wallet_address, operation_id=operation_id)
+            if self._replayed(response):
+                # A retried operation: the balance was debited the first time
+                self.holds.release(hold)
+                redeem = response.get("data", response)
+                return ConversionResult(hold.user_id, amount_brl, amount_usdc, redeem["id"], self._status_of(redeem))
+            redeem = self._track("redeem", response, hold.user_id, None, amount_usdc)
+        except Exception:
+            self.holds.release(hold)
+            raise
+        self.holds.commit(hold)
         
-        return {
-            "user_id": user_id,
-            "amount_usdc": amount_usdc,
-            "amount_brl": amount_brl,
-            "transaction_id": redeem_result.get("id"),
-            "status": redeem_result.get("status", "pending"),
-            "timestamp": datetime.now().isoformat()
-        }
+        return ConversionResult(hold.user_id, amount_brl, amount_usdc, 
+                                redeem.get("id"), redeem.get("status", "pending"))
     
+    @traced("service_call")
     def send_international_payment(self, 
                                   sender_id: str, 
                                   recipient_id: str, 
-                                  amount_usdc: float) -> Dict:
+                                  amount_usdc: Union[Money, float, str]) -> PaymentResult:
         """Send an international payment using USDC"""
-        # Check if sender has a wallet and sufficient balance
-        if sender_id not in self.user_wallets:
-            raise ValueError(f"Sender {sender_id} does not have a wallet")
-        
-        if self.user_wallets[sender_id]["balance_usdc"] < amount_usdc:
-            raise ValueError(f"Insufficient USDC balance")
+        amount_usdc = Money.parse_positive(amount_usdc, "USDC")
+        recipient_address = self._address_if_missing(recipient_id)
         
-        # Create transfer between wallets
-        # In production, this would involve blockchain transactions
-        sender_wallet = self.user_wallets[sender_id]["wallet_address"]
+        with self.locks.hold(sender_id, recipient_id):
+            # Check if sender has a wallet and sufficient balance
+            sender_wallet = self.ledger.get_wallet(sender_id)
+            if sender_wallet is None:
+                raise ValueError(f"Sender {sender_id} does not have a wallet")
+            
+            if sender_wallet.balance_usdc < amount_usdc:
+                raise ValueError(f"Insufficient USDC balance")
+            
+            # Create transfer between wallets
+            # In production, this would involve blockchain transactions
+            
+            # Ensure recipient has a wallet
+            self._get_or_create_wallet(recipient_id, recipient_address)
+            
+            # Simulate transfer (in production, this would be a blockchain transaction)
+            transfer_id = str(uuid.uuid4())
+            
+            # Update balances
+            self.ledger.adjust_balance(sender_id, -amount_usdc.units)
+            self.ledger.adjust_balance(recipient_id, amount_usdc.units)
         
-        # Ensure recipient has a wallet
-        if recipient_id not in self.user_wallets:
-            self.create_user_wallet(recipient_id)
+        return PaymentResult(sender_id, recipient_id, amount_usdc, transfer_id, "completed")
+    
+    def send_international_payments_bulk(self, 
+                                         payments: Iterable[Tuple[str, str, Union[Money, float, str]]], 
+                                         max_workers: int = 32, 
+                                         max_in_flight: Optional[int] = None, 
+                                         operation_id: Optional[str] = None) -> Iterator[Dict]:
+        """Send a stream of (sender_id, recipient_id, amount_usdc) payments in parallel
         
-        recipient_wallet = self.user_wallets[recipient_id]["wallet_address"]
+        Payments are read lazily and at most max_in_flight of them are pending
+        at any time, so memory stays flat regardless of the batch size. Each
+        sender's balance is checked and debited as its payment is read, the
+        create_transfer calls run on a worker pool, and one result per payment
+        is yielded in completion order (with its input "index"). A failed
+        payment is refunded and reported with success=False; the batch goes on.
         
-        # Simulate transfer (in production, this would be a blockchain transaction)
-        transfer_id = str(uuid.uuid4())
+        With an operation_id (e.g. "payout:<batch id>"), payment i is sent as
+        operation "<operation_id>:<i>", so resubmitting the batch after a
+        crash does not pay anyone twice (the client needs an idempotency
+        store for that to hold across restarts).
+        """
+        max_in_flight = max_in_flight or max_workers * 4
+        pending = {}
         
-        # Update balances
-        self.user_wallets[sender_id]["balance_usdc"] -= amount_usdc
-        self.user_wallets[recipient_id]["balance_usdc"] += amount_usdc
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="payout") as executor:
+            for index, (sender_id, recipient_id, amount_usdc) in enumerate(payments):
+                if len(pending) >= max_in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._settle_bulk_payment(future, *pending.pop(future))
+                
+                try:
+                    amount_usdc = Money.parse_positive(amount_usdc, "USDC")
+                except (TypeError, ValueError) as e:
+                    yield self._bulk_failure((index, sender_id, recipient_id, amount_usdc), e)
+                    continue
+                
+                item = (index, sender_id, recipient_id, amount_usdc)
+                try:
+                    hold, sender_wallet, recipient_wallet = self._hold_for_payment(sender_id, recipient_id, 
+                                                                                   amount_usdc)
+                except ValueError as e:
+                    yield self._bulk_failure(item, e)
+                    continue
+                
+                future = executor.submit(self.circle_client.create_transfer, 
+                                         sender_wallet, recipient_wallet, amount_usdc, "USD", 
+                                         operation_id=f"{operation_id}:{index}" if operation_id else None)
+                pending[future] = (item, hold)
+            
+            for future in as_completed(list(pending)):
+                yield self._settle_bulk_payment(future, *pending.pop(future))
+    
+    def _hold_for_payment(self, sender_id: str, recipient_id: str, 
+                          amount_usdc: Money) -> Tuple[HoldRecord, str, str]:
+        """Hold a payment's amount on the sender, returning the hold and both wallet addresses"""
+        recipient_address = self._address_if_missing(recipient_id)
+        with self.locks.hold(sender_id, recipient_id):
+            if self.ledger.get_wallet(sender_id) is None:
+                raise ValueError(f"Sender {sender_id} does not have a wallet")
+            
+            hold = self.holds.place(sender_id, amount_usdc.units)
+            recipient_wallet = self._get_or_create_wallet(recipient_id, recipient_address)
+            return hold, self.ledger.get_wallet(sender_id).wallet_address, recipient_wallet.wallet_address
+    
+    def _settle_bulk_payment(self, future: Future, item: Tuple, hold: HoldRecord) -> Dict:
+        """Credit the recipient of a finished transfer, or release the sender's hold if it failed"""
+        index, sender_id, recipient_id, amount_usdc = item
+        try:
+            transfer_result = future.result()
+        except Exception as e:
+            self.holds.release(hold)
+            return self._bulk_failure(item, e)
         
+        if self._replayed(transfer_result):
+            # A resubmitted payment: both balances changed the first time
+            self.holds.release(hold)
+            transfer = transfer_result.get("data", transfer_result)
+        else:
+            self.holds.commit(hold)
+            with self.locks.hold(recipient_id):
+                self.ledger.adjust_balance(recipient_id, amount_usdc.units)
+            transfer = self._track("transfer", transfer_result, sender_id, recipient_id, amount_usdc)
+        return {
+            "index": index,
+            "success": True,
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "amount_usdc": amount_usdc,
+            "transaction_id": transfer.get("id"),
+            "status": self._status_of(transfer),
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    @staticmethod
+    def _bulk_failure(item: Tuple, error: Exception) -> Dict:
+        index, sender_id, recipient_id, amount_usdc = item
         return {
+            "index": index,
+            "success": False,
             "sender_id": sender_id,
             "recipient_id": recipient_id,
             "amount_usdc": amount_usdc,
-            "transaction_id": transfer_id,
-            "status": "completed",
+            "error": str(error),
             "timestamp": datetime.now().isoformat()
         }
     
-    def get_user_balance(self, user_id: str) -> Dict:
-        """Get a user's USDC balance"""
-        if user_id not in self.user_wallets:
+    def _track(self, kind: str, response: Dict, user_id: str, 
+               counterparty_id: Optional[str], amount_usdc: Money) -> Dict:
+        """Remember a transaction Circle accepted so webhooks can update it;
+        returns the transaction from the response
+        
+        Call it once the balance changes of the transaction are applied: a
+        notification may have arrived before the response, and if it
+        reported the transaction failed, the changes are reversed here.
+        """
+        transaction = response.get("data", response)
+        if not transaction.get("id"):
+            return transaction
+        created = transaction.get("createDate")
+        record = TransactionRecord(kind, user_id, counterparty_id, amount_usdc.units, 
+                                   transaction.get("status", "pending"), parse_us(created) if created else 0)
+        with self._transactions_lock:
+            # What notifications recorded so far (amount unknown to them)
+            known = self.settled.get(transaction["id"]) or self.transactions.get(transaction["id"])
+            if known is not None and (known.status in FINAL_STATUSES or known.updated_us > record.updated_us):
+                record.status = known.status
+                record.updated_us = known.updated_us
+            self._record(transaction["id"], record)
+        if self.journal is not None:
+            self.journal.append(transaction["id"], record.amount_units)
+        if record.status == "failed":
+            self._reverse(transaction["id"], record)
+        return transaction
+    
+    def _replayed(self, response: Dict) -> bool:
+        """Whether a response answers a retried operation_id whose balance
+        changes were applied the first time
+        
+        The client's idempotency store marks the responses it replays, which
+        covers transactions this service no longer tracks (evicted from
+        settled, or from before a restart) and retries that arrive before
+        the first call's _track. Without a store, only transactions still
+        tracked here are recognised.
+        """
+        if isinstance(response, ReplayedResponse):
+            return True
+        transaction_id = response.get("data", response).get("id")
+        if not transaction_id:
+            return False
+        with self._transactions_lock:
+            known = self.settled.get(transaction_id) or self.transactions.get(transaction_id)
+        # Records created by notifications alone have no amount
+        return known is not None and known.amount_units != 0
+    
+    def _status_of(self, transaction: Dict) -> str:
+        """The latest known status of a transaction from a Circle response"""
+        transaction_id = transaction.get("id")
+        with self._transactions_lock:
+            known = self.settled.get(transaction_id) or self.transactions.get(transaction_id)
+        return known.status if known is not None else transaction.get("status", "pending")
+    
+    def _record(self, transaction_id: str, record: TransactionRecord):
+        """Store a transaction's latest state (caller holds _transactions_lock)"""
+        if record.status not in FINAL_STATUSES:
+            self.transactions[transaction_id] = record
+            return
+        self.transactions.pop(transaction_id, None)
+        self.settled[transaction_id] = record
+        self.settled.move_to_end(transaction_id)
+        while len(self.settled) > self.settled_size:
+            self.settled.popitem(last=False)
+    
+    def apply_notifications(self, notifications: Iterable[Dict]) -> int:
+        """Apply Circle webhook notifications (already verified) to the service's state"""
+        from webhook_receiver import parse_notification
+        
+        updates = [parse_notification(notification) for notification in notifications]
+        return self.apply_status_updates([update for update in updates if update is not None])
+    
+    @traced("service_call")
+    def apply_status_updates(self, updates: Iterable["StatusUpdate"]) -> int:
+        """Apply a batch of transaction status changes; returns how many changed state
+        
+        Updates older than the known state (out-of-order deliveries) and
+        updates to transactions already in a final status are skipped. A
+        transaction of ours that fails has its balance changes reversed.
+        Transactions we did not start (e.g. trades) are recorded as they come.
+        Net transfers of the netting book are left to it.
+        """
+        applied = 0
+        for update in updates:
+            if self.netting is not None and self.netting.apply_status_update(update):
+                applied += 1
+                continue
+            with self._transactions_lock:
+                if update.transaction_id in self.settled:
+                    continue
+                record = self.transactions.get(update.transaction_id)
+                if record is None:
+                    # Not ours, or its response has not come back yet (_track merges it then)
+                    self._record(update.transaction_id, TransactionRecord(
+                        update.kind, update.client_id, None, 0, update.status, update.updated_us))
+                    applied += 1
+                    continue
+                if update.updated_us < record.updated_us:
+                    continue
+                record.status = update.status
+                record.updated_us = update.updated_us
+                self._record(update.transaction_id, record)
+            # Only the update that settled the record gets here with "failed"
+            if update.status == "failed" and record.amount_units:
+                self._reverse(update.transaction_id, record)
+            applied += 1
+        return applied
+    
+    def _reverse(self, transaction_id: str, record: TransactionRecord):
+        """Undo the balance changes made when a transaction was accepted"""
+        with self.locks.hold(record.user_id, record.counterparty_id):
+            if record.kind == "mint":
+                self.ledger.adjust_balance(record.user_id, -record.amount_units)
+            elif record.kind == "redeem":
+                self.ledger.adjust_balance(record.user_id, record.amount_units)
+            elif record.kind == "transfer":
+                self.ledger.adjust_balance(record.user_id, record.amount_units)
+                self.ledger.adjust_balance(record.counterparty_id, -record.amount_units)
+        if self.journal is not None:
+            self.journal.append(transaction_id, -record.amount_units)
+    
+    @traced("service_call")
+    def get_user_balance(self, user_id: str) -> Mapping:
+        """Get a user's USDC balance (read-only when served by the balance view)"""
+        if self.balance_view is not None:
+            balance = self.balance_view.get(user_id)
+            if balance is None:
+                raise ValueError(f"User {user_id} does not have a wallet")
+            return balance
+        
+        wallet = self.ledger.get_wallet(user_id)
+        if wallet is None:
             raise ValueError(f"User {user_id} does not have a wallet")
+        return self._balance(user_id, wallet)
+    
+    @traced("service_call")
+    def get_user_balances(self, user_ids: Iterable[str]) -> Dict[str, Mapping]:
+        """Get many users' balances, keyed by user id (users without a wallet are left out)"""
+        if self.balance_view is not None:
+            return self.balance_view.get_many(user_ids)
         
-        balance_usdc = self.user_wallets[user_id]["balance_usdc"]
-        balance_brl_equivalent = balance_usdc * EXCHANGE_RATES["USD_BRL"]
+        balances = {}
+        for user_id in user_ids:
+            wallet = self.ledger.get_wallet(user_id)
+            if wallet is not None:
+                balances[user_id] = self._balance(user_id, wallet)
+        return balances
+    
+    def _balance(self, user_id: str, wallet: WalletRecord) -> Dict:
+        """get_user_balance's answer for a wallet"""
+        balance_usdc = wallet.balance_usdc
+        balance_brl_equivalent = balance_usdc.convert(self._exchange_rate("USD_BRL"), "BRL")
         
         return {
             "user_id": user_id,
             "balance_usdc": balance_usdc,
+            "held_usdc": Money(self.holds.held_units(user_id), "USDC"),
             "balance_brl_equivalent": balance_brl_equivalent,
-            "wallet_address": self.user_wallets[user_id]["wallet_address"],
+            "wallet_address": wallet.wallet_address,
             "timestamp": datetime.now().isoformat()
         }
+    
+    def warmup(self, connections: int = 4, timeout: float = 10.0) -> Dict:
+        """Do the first request's set-up work ahead of time
+        
+        Opens Circle connections (see CircleClient.warmup), fetches every
+        pair of the rate cache and loads the ledger's wallets and indexes
+        into memory. Returns the seconds each step took.
+        """
+        timings = self.circle_client.warmup(connections)
+        started = time.perf_counter()
+        if self.rate_cache is not None:
+            for future in [self.rate_cache.refresh(pair) for pair in self.rate_cache.pairs]:
+                future.result(timeout)
+        timings["rates_seconds"] = time.perf_counter() - started
+        started = time.perf_counter()
+        timings["wallets"] = self.ledger.warm()
+        timings["ledger_seconds"] = time.perf_counter() - started
+        return timings
+    
+    def close(self):
+        """Wait for background settlements and stop the hold expiry sweeper"""
+        self.settlement.shutdown(wait=True)
+        self.holds.stop()
 
 
 def run_demo():
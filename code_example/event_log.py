@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Event-Sourced Wallet Ledger
+---------------------------------------------------
+
+EventLogLedger keeps balances in memory, and every change (create_wallet,
+adjust_balance) is also appended to a binary event log before it is
+acknowledged, so a restart rebuilds the exact balances.
+
+1. Each wallet gets a number when it is created, which is also its row in
+   snapshots. Events are fixed-size records (kind, wallet number, amount or
+   creation time); a new wallet's user id and address follow its block's
+   events
+2. A single committer thread writes whatever accumulated since its last
+   write as one block (event count, CRC32) and fsyncs it, so every caller
+   that arrived while the previous fsync ran shares the next one (group
+   commit). With sync=True a write returns once its block is fsynced; with
+   sync=False the committer runs every commit_interval seconds and flush()
+   forces it, like SQLiteLedger's batched commits
+3. Every snapshot_every events a background thread writes a snapshot: the
+   wallets as columns in wallet number order, an index sorted by user id
+   hash and one sorted by address hash, written to a temporary file and
+   renamed. The log rolls to a new segment at the same moment, so the
+   snapshot covers exactly the segments before it, which are then deleted
+4. Opening the directory maps the snapshot (only the balance column is
+   read), then replays the segments written after it a block at a time
+   with NumPy; a torn block at the end of the log, from a crash in the
+   middle of a write, is cut off
+
+Reads see writes not yet fsynced, as with SQLiteLedger.
+
+Usage:
+    ledger = EventLogLedger("/var/lib/picpay/wallets")
+    service = PicPayUSDCService(circle_client, ledger=ledger)
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from records import ADDRESS_BYTES, WalletRecord, address_bytes
+from wallet_ledger import WalletLedger
+
+CREATE, ADJUST = 1, 2
+_BLOCK = struct.Struct("<III")  # Events, bytes of new wallets after them, CRC32 of both
+_EVENT = struct.Struct("<B7xQq")  # Kind, wallet number, delta_units or created_us
+EVENT_DTYPE = np.dtype([("kind", "u1"), ("pad", "V7"), ("number", "<u8"), ("value", "<i8")])
+_NAME = struct.Struct("<H")
+
+_sync = getattr(os, "fdatasync", os.fsync)
+
+
+def _hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _sync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Snapshot:
+    """Wallets of a snapshot file, mapped read-only
+
+    Row n holds wallet number n. user_hash/user_row and
+    address_hash/address_row are the two lookup indexes, sorted by hash.
+    """
+
+    MAGIC = b"PPWSNAP1"
+    HEADER = struct.Struct("<8sQQQQ")  # Magic, wallets, first segment not covered, heap bytes, events
+    HEADER_BYTES = 64
+    COLUMNS = (("balance", "<i8"), ("created_us", "<i8"), ("name_start", "<u8"), ("user_hash", "<u8"),
+               ("user_row", "<u8"), ("address_hash", "<u8"), ("address_row", "<u8"), ("name_len", "<u4"),
+               ("address", f"V{ADDRESS_BYTES}"))
+
+    def __init__(self, count: int = 0, segment: int = 0, events: int = 0, columns: Optional[Dict] = None,
+                 heap=b"", mapped: Optional[mmap.mmap] = None):
+        self.count = count
+        self.segment = segment
+        self.events = events
+        self.heap = heap
+        self._mapped = mapped
+        columns = columns or {}
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, columns.get(name, np.empty(0, dtype=dtype)))
+
+    @classmethod
+    def layout(cls, count: int) -> Tuple[Dict[str, int], int]:
+        """Offsets of each column, and of the heap, in a file of count wallets"""
+        offsets = {}
+        offset = cls.HEADER_BYTES
+        for name, dtype in cls.COLUMNS:
+            offsets[name] = offset
+            offset += -(-count * np.dtype(dtype).itemsize // 8) * 8
+        return offsets, offset
+
+    @classmethod
+    def load(cls, path: str) -> "_Snapshot":
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "rb") as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, segment, heap_bytes, events = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path} is not a wallet snapshot")
+        offsets, heap_offset = cls.layout(count)
+        columns = {name: np.frombuffer(mapped, dtype=dtype, count=count, offset=offsets[name])
+                   for name, dtype in cls.COLUMNS}
+        heap = memoryview(mapped)[heap_offset:heap_offset + heap_bytes]
+        return cls(count, segment, events, columns, heap, mapped)
+
+    def name(self, row: int) -> str:
+        start = int(self.name_start[row])
+        return bytes(self.heap[start:start + int(self.name_len[row])]).decode()
+
+    def find(self, user_id: str) -> int:
+        """Row of a user id, or -1"""
+        key = user_id.encode()
+        digest = np.uint64(_hash(key))
+        index = int(np.searchsorted(self.user_hash, digest))
+        while index < self.count and self.user_hash[index] == digest:
+            row = int(self.user_row[index])
+            start = int(self.name_start[row])
+            if self.heap[start:start + int(self.name_len[row])] == key:
+                return row
+            index += 1
+        return -1
+
+    def find_address(self, address: bytes) -> int:
+        """Row of the wallet this address was given to, or -1"""
+        digest = np.uint64(_hash(address))
+        index = int(np.searchsorted(self.address_hash, digest))
+        while index < self.count and self.address_hash[index] == digest:
+            row = int(self.address_row[index])
+            if self.address[row].tobytes() == address:
+                return row
+            index += 1
+        return -1
+
+    def touch(self):
+        """Read one byte of every page of the mapping"""
+        if self._mapped is not None:
+            np.frombuffer(self._mapped, dtype=np.uint8)[::mmap.PAGESIZE].sum()
+
+    @staticmethod
+    def _insert(hashes: np.ndarray, rows: np.ndarray, new_hashes: List[int], new_rows: np.ndarray) -> Dict:
+        """A sorted (hash, row) index with entries added, in one merge"""
+        new_hashes = np.array(new_hashes, dtype="<u8")
+        order = np.argsort(new_hashes, kind="stable")
+        at = np.searchsorted(hashes, new_hashes[order], side="right")
+        return np.insert(hashes, at, new_hashes[order]), np.insert(rows, at, new_rows.astype("<u8")[order])
+
+    @classmethod
+    def write(cls, path: str, base: "_Snapshot", balance: np.ndarray, names: List[bytes],
+              addresses: List[bytes], created: List[int], segment: int, events: int):
+        """Write a snapshot atomically: base with the given balances and the
+        wallets created since (numbers base.count onwards)
+
+        Columns are built and written one (or one index) at a time.
+        """
+        count = len(balance)
+        rows = np.arange(base.count, count, dtype="<u8")
+        name_len = np.array([len(name) for name in names], dtype="<u4")
+
+        def created_us() -> Dict:
+            return {"created_us": np.concatenate([base.created_us, np.array(created, dtype="<i8")])}
+
+        def address() -> Dict:
+            return {"address": np.concatenate([base.address, np.array([np.void(a) for a in addresses],
+                                                                      dtype=base.address.dtype)])}
+
+        def user_index() -> Dict:
+            user_hash, user_row = cls._insert(base.user_hash, base.user_row, [_hash(n) for n in names], rows)
+            return {"user_hash": user_hash, "user_row": user_row}
+
+        def address_index() -> Dict:
+            address_hash, address_row = cls._insert(base.address_hash, base.address_row,
+                                                    [_hash(a) for a in addresses], rows)
+            return {"address_hash": address_hash, "address_row": address_row}
+
+        producers: Dict[str, Callable[[], Dict]] = {
+            "balance": lambda: {"balance": balance},
+            "created_us": created_us,
+            "name_start": lambda: {"name_start": np.concatenate([
+                base.name_start, np.cumsum(name_len, dtype="<u8") - name_len + len(base.heap)])},
+            "user_hash": user_index,
+            "address_hash": address_index,
+            "name_len": lambda: {"name_len": np.concatenate([base.name_len, name_len])},
+            "address": address,
+        }
+        heap_bytes = len(base.heap) + sum(len(name) for name in names)
+        offsets, heap_offset = cls.layout(count)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as output:
+            output.write(cls.HEADER.pack(cls.MAGIC, count, segment, heap_bytes, events)
+                         .ljust(cls.HEADER_BYTES, b"\0"))
+            ready: Dict[str, np.ndarray] = {}
+            for name, dtype in cls.COLUMNS:
+                if name not in ready:
+                    ready = producers[name]()
+                output.seek(offsets[name])
+                output.write(np.ascontiguousarray(ready.pop(name), dtype=dtype).tobytes())
+            output.seek(heap_offset)
+            output.write(base.heap)
+            output.write(b"".join(names))
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporary, path)
+        _sync_directory(os.path.dirname(path) or ".")
+
+
+class EventLogLedger(WalletLedger):
+    """Balances in memory, made durable by an append-only log and snapshots"""
+
+    SNAPSHOT = "snapshot.bin"
+
+    def __init__(self, directory: str, sync: bool = True, commit_interval: float = 0.005,
+                 snapshot_every: Optional[int] = 1_000_000):
+        """
+        Args:
+            directory: Where the log segments and the snapshot live
+            sync: Return from a write only once it is fsynced (group commit);
+                otherwise writes are fsynced within commit_interval
+            commit_interval: Seconds between commits when sync is False
+            snapshot_every: Events between two automatic snapshots (None for
+                none; snapshot() takes one on demand)
+        """
+        self.directory = directory
+        self.sync = sync
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+        self.stats = {"events": 0, "commits": 0, "committed_bytes": 0, "snapshots": 0, "replayed": 0,
+                      "torn_bytes": 0, "recovery_seconds": 0.0, "last_snapshot_seconds": 0.0}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._io_lock = threading.Lock()  # Held while the log file is written, fsynced or rolled
+        self._snapshot_lock = threading.Lock()
+        self._numbers: Dict[str, int] = {}  # User id -> wallet number, for the wallets looked up so far
+        # Wallets created since the snapshot, numbered from its count on
+        self._names: List[bytes] = []
+        self._addresses: List[bytes] = []
+        self._created: List[int] = []
+        self._new_addresses: Dict[bytes, int] = {}  # Addresses given out since the snapshot
+        self._events = bytearray()  # The block the committer writes next
+        self._trailer = bytearray()
+        self._block_events = 0
+        self._appended = 0  # Events appended / made durable since opening
+        self._durable = 0
+        self._since_snapshot = 0
+        self._snapshotting = False
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        started = time.perf_counter()
+        self._base = _Snapshot.load(self._path(self.SNAPSHOT))
+        self._balances = np.array(self._base.balance, dtype=np.int64)
+        self._count = self._base.count
+        self._segment = self._recover()
+        self.stats["recovery_seconds"] = time.perf_counter() - started
+        self._file = open(self._segment_path(self._segment), "ab", buffering=0)
+        _sync_directory(directory)
+        self._committer = threading.Thread(target=self._commit_loop, name="event-log-commit", daemon=True)
+        self._committer.start()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _segment_path(self, segment: int) -> str:
+        return self._path(f"{segment:012d}.log")
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    # Recovery
+
+    def _recover(self) -> int:
+        """Replay the segments the snapshot does not cover; returns the
+        number of the segment to append to"""
+        segments = []
+        for segment in self._segments():
+            if segment < self._base.segment:
+                # Covered by the snapshot; left behind by a crash after it was written
+                os.remove(self._segment_path(segment))
+            else:
+                segments.append(segment)
+        for segment in segments:
+            path = self._segment_path(segment)
+            with open(path, "rb") as log:
+                data = log.read()
+            valid = self._replay(data)
+            if valid < len(data):
+                self.stats["torn_bytes"] += len(data) - valid
+                with open(path, "r+b") as log:
+                    log.truncate(valid)
+        # A fresh segment, so a torn tail is never appended to
+        return max(segments[-1] + 1 if segments else 0, self._base.segment)
+
+    def _replay(self, data: bytes) -> int:
+        """Apply the blocks of one segment; returns the bytes that held whole blocks"""
+        offset = 0
+        view = memoryview(data)
+        while offset + _BLOCK.size <= len(data):
+            count, trailer_bytes, crc = _BLOCK.unpack_from(data, offset)
+            start = offset + _BLOCK.size
+            end = start + count * EVENT_DTYPE.itemsize + trailer_bytes
+            if end > len(data) or zlib.crc32(view[start:end]) != crc:
+                break
+            events = np.frombuffer(data, dtype=EVENT_DTYPE, count=count, offset=start)
+            self._replay_block(events, view[start + count * EVENT_DTYPE.itemsize:end])
+            offset = end
+            self.stats["replayed"] += count
+            self._since_snapshot += count
+        return offset
+
+    def _replay_block(self, events: np.ndarray, trailer: memoryview):
+        kinds = events["kind"]
+        creations = np.flatnonzero(kinds == CREATE)
+        offset = 0
+        # A new wallet has no older event in the block to come after, so
+        # creations go first and the adjustments are added in one pass
+        for index in creations.tolist():
+            (length,) = _NAME.unpack_from(trailer, offset)
+            name_end = offset + _NAME.size + length
+            self._apply_create(bytes(trailer[offset + _NAME.size:name_end]).decode(),
+                               bytes(trailer[name_end:name_end + ADDRESS_BYTES]), int(events["value"][index]))
+            offset = name_end + ADDRESS_BYTES
+        adjust = kinds == ADJUST
+        np.add.at(self._balances, events["number"][adjust].astype(np.intp), events["value"][adjust])
+
+    # State
+
+    def _number(self, user_id: str) -> int:
+        """Wallet number of a user id, or -1"""
+        number = self._numbers.get(user_id)
+        if number is None:
+            number = self._base.find(user_id)
+            if number < 0:
+                return -1
+            self._numbers[user_id] = number
+        return number
+
+    def _apply_create(self, user_id: str, address: bytes, created_us: int) -> int:
+        """Add a wallet the ledger does not have yet; returns its number"""
+        number = self._count
+        if number == len(self._balances):
+            self._balances = np.concatenate([self._balances, np.zeros(max(number, 1024), dtype=np.int64)])
+        self._count += 1
+        self._numbers[user_id] = number
+        self._names.append(user_id.encode())
+        self._addresses.append(address)
+        self._created.append(created_us)
+        self._new_addresses[address] = number
+        return number
+
+    def _wallet(self, number: int) -> WalletRecord:
+        if number >= self._base.count:
+            new = number - self._base.count
+            address, created_us = self._addresses[new], self._created[new]
+        else:
+            address, created_us = self._base.address[number].tobytes(), int(self._base.created_us[number])
+        return WalletRecord(address, created_us, int(self._balances[number]))
+
+    # Group commit
+
+    def _append(self, kind: int, number: int, value: int, trailer: bytes = b"") -> int:
+        """Queue an event (caller holds the lock); returns its ticket"""
+        if self._error is not None:
+            raise IOError("Event log is unavailable") from self._error
+        self._events += _EVENT.pack(kind, number, value)
+        self._trailer += trailer
+        self._block_events += 1
+        self._appended += 1
+        self._since_snapshot += 1
+        self.stats["events"] += 1
+        if self.sync:
+            self._cond.notify_all()
+        if (self.snapshot_every is not None and self._since_snapshot >= self.snapshot_every
+                and not self._snapshotting and not self._closed):
+            self._snapshotting = True
+            self._snapshot_thread = threading.Thread(target=self._snapshot_in_background,
+                                                     name="event-log-snapshot", daemon=True)
+            self._snapshot_thread.start()
+        return self._appended
+
+    def _take_block(self) -> Tuple[bytes, int]:
+        """The pending events as one block, and the ticket it covers (caller
+        holds the lock)"""
+        body = self._events + self._trailer
+        block = _BLOCK.pack(self._block_events, len(self._trailer), zlib.crc32(body)) + body
+        self._events, self._trailer, self._block_events = bytearray(), bytearray(), 0
+        return block, self._appended
+
+    def _write(self, block: bytes):
+        self._file.write(block)
+        _sync(self._file.fileno())
+        self.stats["commits"] += 1
+        self.stats["committed_bytes"] += len(block)
+
+    def _wait(self, ticket: int):
+        with self._cond:
+            while self._durable < ticket:
+                if self._error is not None:
+                    raise IOError("Event log is unavailable") from self._error
+                self._cond.wait()
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._block_events and not self._closed:
+                    self._cond.wait(None if self.sync else self.commit_interval)
+                if not self._block_events:
+                    return
+                # Taken before the state lock is released, so a roll cannot
+                # write later events ahead of these
+                self._io_lock.acquire()
+                block, ticket = self._take_block()
+            try:
+                self._write(block)
+            except BaseException as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            finally:
+                self._io_lock.release()
+            with self._cond:
+                self._durable = max(self._durable, ticket)
+                self._cond.notify_all()
+            if not self.sync and not self._closed:
+                time.sleep(self.commit_interval)
+
+    def _commit_now(self):
+        """Write and fsync the pending events from this thread (caller holds
+        the lock)"""
+        with self._io_lock:
+            if self._block_events:
+                block, ticket = self._take_block()
+                self._write(block)
+                self._durable = max(self._durable, ticket)
+                self._cond.notify_all()
+
+    # WalletLedger
+
+    def get_wallet(self, user_id: str) -> Optional[WalletRecord]:
+        with self._lock:
+            number = self._number(user_id)
+            return self._wallet(number) if number >= 0 else None
+
+    def create_wallet(self, user_id: str, address: bytes, created_us: int) -> WalletRecord:
+        with self._lock:
+            number = self._number(user_id)
+            if number >= 0:
+                # Someone created it since get_wallet: nothing to log
+                return self._wallet(number)
+            number = self._apply_create(user_id, address, created_us)
+            name = user_id.encode()
+            ticket = self._append(CREATE, number, created_us, _NAME.pack(len(name)) + name + address)
+        if self.sync:
+            self._wait(ticket)
+        return WalletRecord(address, created_us)
+
+    def adjust_balance(self, user_id: str, delta_units: int) -> int:
+        with self._lock:
+            number = self._number(user_id)
+            if number < 0:
+                raise KeyError(user_id)
+            self._balances[number] += delta_units
+            balance = int(self._balances[number])
+            ticket = self._append(ADJUST, number, delta_units)
+        if self.sync:
+            self._wait(ticket)
+        return balance
+
+    def find_user_by_address(self, wallet_address: Union[str, bytes]) -> Optional[str]:
+        address = address_bytes(wallet_address)
+        with self._lock:
+            number = self._new_addresses.get(address)
+            if number is None:
+                number = self._base.find_address(address)
+            if number < 0:
+                return None
+            if number >= self._base.count:
+                return self._names[number - self._base.count].decode()
+            return self._base.name(number)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count
+
+    def warm(self) -> int:
+        self._base.touch()
+        return len(self)
+
+    # Snapshots
+
+    def snapshot(self):
+        """Write a snapshot of every wallet and drop the log it covers"""
+        with self._snapshot_lock:
+            with self._cond:
+                # Everything appended before the roll goes to the old segment
+                self._commit_now()
+                with self._io_lock:
+                    self._file.close()
+                    self._segment += 1
+                    self._file = open(self._segment_path(self._segment), "ab", buffering=0)
+                _sync_directory(self.directory)
+                base, segment, count = self._base, self._segment, self._count
+                balance = self._balances[:count].copy()
+                names, addresses, created = list(self._names), list(self._addresses), list(self._created)
+                events = base.events + self._since_snapshot
+                self._since_snapshot = 0
+            started = time.perf_counter()
+            path = self._path(self.SNAPSHOT)
+            _Snapshot.write(path, base, balance, names, addresses, created, segment, events)
+            snapshot = _Snapshot.load(path)
+            with self._cond:
+                # Wallets created while the snapshot was written stay in front of it
+                done = count - base.count
+                del self._names[:done], self._addresses[:done], self._created[:done]
+                self._new_addresses = {address: number for address, number in self._new_addresses.items()
+                                       if number >= count}
+                self._base = snapshot
+                self.stats["snapshots"] += 1
+                self.stats["last_snapshot_seconds"] = time.perf_counter() - started
+            for old in self._segments():
+                if old < segment:
+                    os.remove(self._segment_path(old))
+
+    def _snapshot_in_background(self):
+        try:
+            self.snapshot()
+        finally:
+            with self._lock:
+                self._snapshotting = False
+
+    def flush(self):
+        with self._cond:
+            ticket = self._appended
+            if self.sync:
+                self._cond.notify_all()
+            else:
+                self._commit_now()
+        self._wait(ticket)
+
+    def close(self):
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._committer.join()
+        self._file.close()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Exchange Execution Engine
+-------------------------------------------------
+
+Runs currency conversions through Circle's exchange endpoints as a pipeline
+instead of one order after another:
+
+    quote (POST /v1/exchange/quotes) -> trade (POST /v1/exchange/trades)
+        -> confirm (GET /v1/exchange/trades, GET /v1/exchange/trades/settlements)
+
+1. Each stage has its own bounded worker pool and an order moves on as soon
+   as its previous stage is done, so quotes for the next orders are
+   requested while the trades of earlier ones execute
+2. Orders are quoted just in time: at most `lookahead` quoted orders wait
+   for a trade worker, so no quote queues long enough to expire. A quote
+   with less than expiry_margin seconds left when its trade is due, or that
+   Circle rejects as expired, is replaced by a new one (up to max_requotes
+   times); both count as expiry misses
+3. A trade's idempotency key is derived from its quote id, so retrying it
+   can never execute the quote twice. A trade request that times out or
+   loses its connection may still have executed, so it is retried with the
+   same quote (never requoted) up to trade_retries times; after that the
+   order is reported with status "unknown" rather than as not executed
+4. Confirmation sweeps the trade and settlement lists for every outstanding
+   order at once, one page per 50 orders, instead of one GET per order
+
+Usage:
+    engine = ExchangeEngine(circle_client, wait_for="settled")
+    for result in engine.execute([("BRL", 500, "USDC"), ("USDC", 20, "BRL")]):
+        print(result["index"], result["to_amount"], result["status"])
+    engine.close()
+"""
+
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+import requests
+
+from money import Money
+from records import parse_us
+
+WAIT_FOR = ("created", "complete", "settled")
+
+
+class QuoteExpiredError(Exception):
+    """An order's quotes kept expiring before its trade could be sent"""
+
+
+class TradeOutcomeUnknownError(Exception):
+    """A trade request kept failing in transport; Circle may have executed it"""
+
+
+class _Order:
+    """One conversion moving through the pipeline"""
+
+    __slots__ = ("index", "from_currency", "amount", "to_currency", "future", "quote", "expires_at",
+                 "trade", "requotes", "started")
+
+    def __init__(self, index: int, from_currency: str, amount: Money, to_currency: str):
+        self.index = index
+        self.from_currency = from_currency
+        self.amount = amount
+        self.to_currency = to_currency
+        self.future: Future = Future()
+        self.quote: Optional[Dict] = None
+        self.expires_at = 0.0  # Epoch seconds
+        self.trade: Optional[Dict] = None
+        self.requotes = 0
+        self.started = time.perf_counter()
+
+
+def _quote_expired(error: requests.HTTPError) -> bool:
+    response = error.response
+    return response is not None and response.status_code == 400 and "expired" in response.text.lower()
+
+
+class ExchangeEngine:
+    """Pipelined quote -> trade -> settlement execution"""
+
+    def __init__(self, circle_client, quote_workers: int = 8, trade_workers: int = 8,
+                 lookahead: Optional[int] = None, expiry_margin: float = 1.0, max_requotes: int = 2,
+                 wait_for: str = "complete", poll_interval: float = 0.2, page_size: int = 50,
+                 trade_retries: int = 3, retry_delay: float = 0.5):
+        """
+        Args:
+            circle_client: CircleClient used for every stage
+            quote_workers: Concurrent quote requests
+            trade_workers: Concurrent trade requests
+            lookahead: Quoted orders allowed to wait for a trade worker
+                (default trade_workers)
+            expiry_margin: Seconds of validity a quote needs left to be traded
+            max_requotes: New quotes an order may take before it fails
+            wait_for: When an order's result is returned: once its trade is
+                "created", once the trade is "complete", or once the trade's
+                settlement is "settled"
+            poll_interval: Seconds between two confirmation sweeps
+            page_size: pageSize of the sweep requests (Circle allows up to 50)
+            trade_retries: Retries of a trade request that failed in transport
+            retry_delay: Pause before the first such retry, doubled after each
+        """
+        if wait_for not in WAIT_FOR:
+            raise ValueError(f"wait_for must be one of {WAIT_FOR}")
+        self.circle_client = circle_client
+        self.quote_workers = quote_workers
+        self.trade_workers = trade_workers
+        self.lookahead = trade_workers if lookahead is None else lookahead
+        self.expiry_margin = expiry_margin
+        self.max_requotes = max_requotes
+        self.wait_for = wait_for
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self.trade_retries = trade_retries
+        self.retry_delay = retry_delay
+        self.stats = {"orders": 0, "quotes": 0, "trades": 0, "requotes": 0, "rejected_expired": 0,
+                      "trade_retries": 0, "unknown": 0, "completed": 0, "failed": 0, "sweep_requests": 0,
+                      "sweep_errors": 0}
+        self._lock = threading.Lock()  # Guards stats and the two dicts below
+        self._trades: Dict[str, _Order] = {}  # Trade id -> order waiting for it to complete
+        self._settlements: Dict[str, _Order] = {}  # Settlement id -> order waiting for it to settle
+        # Orders between their quote request and the end of their trade request
+        self._slots = threading.Semaphore(trade_workers + self.lookahead)
+        self._quote_pool = ThreadPoolExecutor(max_workers=quote_workers, thread_name_prefix="fx-quote")
+        self._trade_pool = ThreadPoolExecutor(max_workers=trade_workers, thread_name_prefix="fx-trade")
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self.stats[key] += amount
+
+    @property
+    def expiry_misses(self) -> int:
+        """Quotes that could not be traded before they expired"""
+        return self.stats["requotes"] + self.stats["rejected_expired"]
+
+    # Callers
+
+    def submit(self, from_currency: str, amount: Union[Money, float, str], to_currency: str,
+               index: int = 0) -> Future:
+        """Start one conversion; the Future resolves with its result dict
+        (success=False with an error when it failed, it never raises)"""
+        self._count("orders")
+        try:
+            order = _Order(index, from_currency, Money.parse_positive(amount, from_currency), to_currency)
+        except (TypeError, ValueError) as e:
+            order = _Order(index, from_currency, Money(0, "USDC"), to_currency)
+            self._fail(order, e)
+            return order.future
+        if self._closed:
+            self._fail(order, RuntimeError("ExchangeEngine is closed"))
+            return order.future
+        if self.wait_for != "created":
+            self.start()
+        try:
+            self._quote_pool.submit(self._quote_stage, order)
+        except RuntimeError as e:
+            # close() shut the pool down after the check above
+            self._fail(order, e)
+        return order.future
+
+    def execute(self, orders: Iterable[Tuple[str, Union[Money, float, str], str]],
+                max_in_flight: int = 4096) -> Iterator[Dict]:
+        """Convert a stream of (from_currency, amount, to_currency) orders
+
+        Orders are read lazily, at most max_in_flight of them are pending at
+        any time, and one result per order is yielded in completion order
+        (with its input "index"). Orders waiting for confirmation hold no
+        worker, so max_in_flight has to cover throughput times the time to
+        confirm, not just the worker pools.
+        """
+        pending = set()
+        for index, (from_currency, amount, to_currency) in enumerate(orders):
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(self.submit(from_currency, amount, to_currency, index))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    # Stages
+
+    def _quote(self, order: _Order):
+        response = self.circle_client.create_quote(order.from_currency, order.amount, order.to_currency)
+        order.quote = response.get("data", response)
+        order.expires_at = parse_us(order.quote["expiresAt"]) / 1_000_000
+        self._count("quotes")
+
+    def _quote_stage(self, order: _Order):
+        # Blocks this quote worker until the trade stage has room, which is
+        # what keeps quotes from being fetched too early
+        self._slots.acquire()
+        try:
+            self._quote(order)
+        except Exception as e:
+            self._slots.release()
+            self._fail(order, e)
+            return
+        self._trade_pool.submit(self._trade_stage, order)
+
+    def _trade(self, order: _Order) -> Dict:
+        """Trade the order's quote, requoting when it is about to expire or has"""
+        retries = 0  # Transport failures of the current quote's trade request
+        while True:
+            # Once a request for this quote may have executed, only the same
+            # quote can be retried: requoting could trade the order twice
+            if not retries and order.expires_at - time.time() < self.expiry_margin:
+                if order.requotes >= self.max_requotes:
+                    raise QuoteExpiredError(f"Quote {order.quote['id']} expired before it could be traded")
+                order.requotes += 1
+                self._count("requotes")
+                self._quote(order)
+                continue
+            quote_id = order.quote["id"]
+            try:
+                response = self.circle_client.create_trade(quote_id, operation_id=f"trade:{quote_id}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if retries >= self.trade_retries:
+                    raise TradeOutcomeUnknownError(
+                        f"Trade of quote {quote_id} may have executed: {e}") from e
+                time.sleep(self.retry_delay * 2 ** retries)
+                retries += 1
+                self._count("trade_retries")
+                continue
+            except requests.HTTPError as e:
+                if not _quote_expired(e) or order.requotes >= self.max_requotes:
+                    raise
+                order.requotes += 1
+                self._count("rejected_expired")
+                retries = 0
+                self._quote(order)
+                continue
+            self._count("trades")
+            return response.get("data", response)
+
+    def _trade_stage(self, order: _Order):
+        try:
+            order.trade = self._trade(order)
+        except Exception as e:
+            self._fail(order, e)
+            return
+        finally:
+            self._slots.release()
+        self._on_trade(order, order.trade)
+
+    def _on_trade(self, order: _Order, trade: Dict):
+        """Finish the order or move it to the next thing it waits for"""
+        status = trade.get("status")
+        with self._lock:
+            self._trades.pop(trade["id"], None)
+            if status == "failed":
+                pass
+            elif self.wait_for == "settled":
+                if trade.get("settlementId"):
+                    self._settlements[trade["settlementId"]] = order
+                else:
+                    # Not complete yet, or complete before Circle attached the
+                    # settlement: look again on the next sweep
+                    self._trades[trade["id"]] = order
+                return
+            elif self.wait_for != "created" and status != "complete":
+                self._trades[trade["id"]] = order
+                return
+        self._finish(order, status)
+
+    def _finish(self, order: _Order, status: str):
+        trade = order.trade
+        if status == "failed":
+            self._fail(order, RuntimeError(f"Trade {trade['id']} failed"))
+            return
+        self._count("completed")
+        order.future.set_result({
+            "index": order.index,
+            "success": True,
+            "from_amount": order.amount,
+            "to_amount": Money.parse(trade["to"]["amount"], order.to_currency),
+            "rate": order.quote["rate"],
+            "quote_id": order.quote["id"],
+            "trade_id": trade["id"],
+            "settlement_id": trade.get("settlementId"),
+            "status": status,
+            "requotes": order.requotes,
+            "seconds": time.perf_counter() - order.started,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    def _fail(self, order: _Order, error: Exception):
+        unknown = isinstance(error, TradeOutcomeUnknownError)
+        self._count("unknown" if unknown else "failed")
+        order.future.set_result({
+            "index": order.index,
+            "success": False,
+            # "unknown": the trade may have executed; retry create_trade with
+            # the same quote_id to find out
+            "status": "unknown" if unknown else "failed",
+            "from_amount": order.amount,
+            "quote_id": order.quote["id"] if order.quote else None,
+            "trade_id": order.trade["id"] if order.trade else None,
+            "requotes": order.requotes,
+            "error": str(error),
+            "seconds": time.perf_counter() - order.started,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    # Confirmation
+
+    def _list_since(self, list_page: Callable, since: str, wanted: Iterable[str]) -> Iterator[Dict]:
+        """Items with the wanted ids from a newest-first list, paging back to since"""
+        left = set(wanted)
+        cursor = None
+        while left:
+            page = list_page(from_date=since, page_size=self.page_size, page_after=cursor)
+            self._count("sweep_requests")
+            items = page.get("data", [])
+            for item in items:
+                if item["id"] in left:
+                    left.discard(item["id"])
+                    yield item
+            if not items:
+                return
+            # A short page does not mean the end: Circle caps pageSize at 50
+            cursor = items[-1]["id"]
+
+    def sweep(self):
+        """Check every outstanding trade and settlement once"""
+        with self._lock:
+            trades = dict(self._trades)
+            settlements = dict(self._settlements)
+        if trades:
+            since = min(order.trade["createDate"] for order in trades.values())
+            for trade in self._list_since(self.circle_client.list_trades, since, trades):
+                if trade["status"] in ("complete", "failed"):
+                    order = trades[trade["id"]]
+                    order.trade = trade
+                    self._on_trade(order, trade)
+        if settlements:
+            # Circle opens a trade's settlement when the trade completes
+            since = min(order.trade.get("updateDate") or order.trade["createDate"]
+                        for order in settlements.values())
+            for settlement in self._list_since(self.circle_client.list_fx_settlements, since, settlements):
+                if settlement["status"] == "settled":
+                    with self._lock:
+                        order = self._settlements.pop(settlement["id"], None)
+                    if order is not None:
+                        self._finish(order, "settled")
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.sweep()
+            except Exception:
+                self._count("sweep_errors")  # Retried on the next sweep
+
+    # Lifecycle
+
+    def start(self) -> "ExchangeEngine":
+        """Start the confirmation thread (submit() does it when needed)"""
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="fx-confirm", daemon=True)
+                self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the confirmation thread and the worker pools; later submit()
+        calls return failed orders"""
+        self._closed = True
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._quote_pool.shutdown(wait=True)
+        self._trade_pool.shutdown(wait=True)
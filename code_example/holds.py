@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Balance Holds
+-------------------------------------
+
+Two-phase reservations that keep Circle calls out of the balance critical
+section.
+
+1. place() checks the balance and debits the amount under the user's lock
+   (microseconds), so the caller can answer the user right away
+2. The Circle call runs afterwards, with no lock held, and settles the
+   hold: commit() when Circle accepted the operation, release() (which
+   credits the amount back) when it did not
+3. Holds nobody settles within their ttl are released by a background
+   sweeper, so a lost worker cannot freeze a user's funds; holds placed
+   with sweep=False are left to their owner, who must settle them
+
+A commit that arrives after its hold expired debits the amount again (the
+operation did happen at Circle) and is counted in stats["late_commits"];
+if the user spent the released funds meanwhile, the balance goes negative
+and the hold is kept in `overdrafts` for someone to recover. Keep ttl well
+above the client's timeout times its retries.
+
+Usage:
+    holds = HoldBook(ledger, locks, ttl=300).start()
+    hold = holds.place(user_id, amount.units)
+    try:
+        circle_client.redeem_usdc(amount, wallet_address)
+    except Exception:
+        holds.release(hold)
+        raise
+    holds.commit(hold)
+"""
+
+import heapq
+import uuid
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from records import HoldRecord, now_us
+from user_locks import UserLocks
+from wallet_ledger import WalletLedger
+
+
+class HoldBook:
+    """Open holds on ledger balances, with expiry"""
+
+    def __init__(self, ledger: WalletLedger, locks: UserLocks, ttl: float = 300.0,
+                 sweep_interval: float = 1.0, on_change: Optional[Callable[[str, int], None]] = None):
+        """
+        Args:
+            ledger: Ledger whose balances are held
+            locks: The UserLocks every other mutation of the ledger goes through
+            ttl: Default seconds before an unsettled hold is released
+            sweep_interval: Seconds between two expiry sweeps
+            on_change: Called with (user_id, units now held) under the user's
+                lock whenever that total changes (e.g. BalanceView.set_held)
+        """
+        self.ledger = ledger
+        self.locks = locks
+        self.ttl_us = int(ttl * 1_000_000)
+        self.sweep_interval = sweep_interval
+        self.on_change = on_change
+        self.stats = {"placed": 0, "committed": 0, "released": 0, "expired": 0, "late_commits": 0,
+                      "overdrafts": 0}
+        # Late commits that left their user's balance negative
+        self.overdrafts: List[HoldRecord] = []
+        self._mutex = threading.Lock()  # Guards the heap, the totals and stats; taken after user locks
+        self._heap: List[Tuple[int, int, HoldRecord]] = []  # (expires_us, sequence, hold)
+        self._sequence = 0
+        self._open = 0
+        self._held: Dict[str, int] = {}  # user_id -> units currently held
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def place(self, user_id: str, amount_units: int, ttl: Optional[float] = None,
+              sweep: bool = True) -> HoldRecord:
+        """Reserve amount_units of the user's balance; raises ValueError when
+        the amount is not positive or the user has no wallet or not enough funds
+
+        With sweep=False the hold never expires here; the caller settles it
+        (its expires_us is only a deadline for the caller to act on).
+        """
+        if amount_units <= 0:
+            raise ValueError(f"Hold amount must be positive, got {amount_units} units")
+        created = now_us()
+        expires = created + (self.ttl_us if ttl is None else int(ttl * 1_000_000))
+        with self.locks.hold(user_id):
+            wallet = self.ledger.get_wallet(user_id)
+            if wallet is None:
+                raise ValueError(f"User {user_id} does not have a wallet")
+            if wallet.balance_units < amount_units:
+                raise ValueError("Insufficient USDC balance")
+            self.ledger.adjust_balance(user_id, -amount_units)
+            hold = HoldRecord(uuid.uuid4().hex, user_id, amount_units, created, expires)
+            with self._mutex:
+                if sweep:
+                    self._sequence += 1
+                    heapq.heappush(self._heap, (expires, self._sequence, hold))
+                held = self._held[user_id] = self._held.get(user_id, 0) + amount_units
+                self._open += 1
+                self.stats["placed"] += 1
+            if self.on_change is not None:
+                self.on_change(user_id, held)
+        return hold
+
+    def commit(self, hold: HoldRecord) -> bool:
+        """Make a hold's debit final; False if it was already settled
+
+        A hold that expired is debited again; if that overdraws the user,
+        it is recorded in overdrafts (the commit still stands, the money
+        already left at Circle).
+        """
+        with self.locks.hold(hold.user_id):
+            if hold.state == "expired":
+                balance_units = self.ledger.adjust_balance(hold.user_id, -hold.amount_units)
+                hold.state = "committed"
+                with self._mutex:
+                    self.stats["committed"] += 1
+                    self.stats["late_commits"] += 1
+                    if balance_units < 0:
+                        self.overdrafts.append(hold)
+                        self.stats["overdrafts"] += 1
+                return True
+            if hold.state != "held":
+                return False
+            hold.state = "committed"
+            with self._mutex:
+                held = self._unhold(hold)
+                self.stats["committed"] += 1
+            if self.on_change is not None:
+                self.on_change(hold.user_id, held)
+        return True
+
+    def release(self, hold: HoldRecord) -> bool:
+        """Give a hold's amount back to the user; False if it was already settled"""
+        return self._release(hold, "released")
+
+    def _release(self, hold: HoldRecord, state: str) -> bool:
+        with self.locks.hold(hold.user_id):
+            if hold.state != "held":
+                return False
+            self.ledger.adjust_balance(hold.user_id, hold.amount_units)
+            hold.state = state
+            with self._mutex:
+                held = self._unhold(hold)
+                self.stats[state] += 1
+            if self.on_change is not None:
+                self.on_change(hold.user_id, held)
+        return True
+
+    def _unhold(self, hold: HoldRecord) -> int:
+        """Drop a settled hold from the user's total, returning what is still
+        held (caller holds self._mutex)"""
+        self._open -= 1
+        remaining = self._held[hold.user_id] - hold.amount_units
+        if remaining:
+            self._held[hold.user_id] = remaining
+        else:
+            del self._held[hold.user_id]
+        return remaining
+
+    def held_units(self, user_id: str) -> int:
+        """Units of the user's balance currently on hold"""
+        with self._mutex:
+            return self._held.get(user_id, 0)
+
+    def expire(self, now: Optional[int] = None) -> int:
+        """Release every hold past its expiry; returns how many were released"""
+        now = now_us() if now is None else now
+        due = []
+        with self._mutex:
+            while self._heap and self._heap[0][0] <= now:
+                hold = heapq.heappop(self._heap)[2]
+                if hold.state == "held":
+                    due.append(hold)
+            # Settled holds stay in the heap until they come due; drop them
+            # early when they make up most of it
+            if len(self._heap) > max(1024, 4 * self._open):
+                self._heap = [entry for entry in self._heap if entry[2].state == "held"]
+                heapq.heapify(self._heap)
+        return sum(self._release(hold, "expired") for hold in due)
+
+    def __len__(self) -> int:
+        """Number of holds not settled yet"""
+        with self._mutex:
+            return self._open
+
+    # Lifecycle
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            self.expire()
+
+    def start(self) -> "HoldBook":
+        """Start the expiry sweeper thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="hold-expiry", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the expiry sweeper; open holds stay open"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
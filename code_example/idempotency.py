@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Durable Idempotency Keys
+------------------------------------------------
+
+Makes retried Circle POSTs safe: every business operation ("mint:order-42",
+"payout:batch-7:311", ...) gets one idempotency key, recorded in an embedded
+SQLite database before the request is sent, so a retry after a timeout or a
+crash sends the same key and Circle does not execute the operation twice.
+
+1. begin(operation_id) returns the operation's key, creating it on first use
+2. complete(operation_id, result) caches Circle's response; later begin()
+   calls return it, as a ReplayedResponse, and the request is not sent at
+   all, so callers can tell a replay from a first execution
+3. Entries expire after ttl seconds (Circle keeps idempotency keys for a
+   limited time) and are purged as new ones are written
+4. Several threads and several processes can share one database file:
+   keys are created inside an IMMEDIATE transaction, so concurrent callers
+   of the same operation always get the same key
+
+Without a store, derive_idempotency_key() still gives a stable key per
+operation, just with no result cache and no expiry.
+
+Usage:
+    store = IdempotencyStore("idempotency.db")
+    client = CircleClient(API_KEY, BASE_URL, idempotency_store=store)
+    client.create_transfer(source, destination, 10.0, "USD", operation_id="payout:batch-7:311")
+"""
+
+import json
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from records import now_us
+
+# Namespace of keys derived from operation ids
+IDEMPOTENCY_NAMESPACE = uuid.UUID("5c1d9a3e-6f0b-4a57-9a8e-2f6b0c3d7e41")
+
+
+def derive_idempotency_key(operation_id: str) -> str:
+    """Deterministic idempotency key (UUID v5) for a business operation"""
+    return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, operation_id))
+
+
+class ReplayedResponse(dict):
+    """Circle's cached response to an operation that already completed
+
+    Returned by begin() instead of a plain dict, so the caller knows the
+    operation's side effects (e.g. ledger changes) were applied the first time.
+    """
+
+
+class IdempotencyStore:
+    """Idempotency keys and cached results per operation, in SQLite (WAL mode)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS idempotency (
+            operation_id    TEXT PRIMARY KEY,
+            idempotency_key TEXT NOT NULL,
+            created_us      INTEGER NOT NULL,
+            expires_us      INTEGER NOT NULL,
+            result          TEXT
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency (expires_us);
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 3600, cache_size: int = 10_000,
+                 purge_every: int = 10_000, busy_timeout: float = 30.0):
+        """
+        Args:
+            path: Database file, shared by every process using the store
+            ttl: Seconds an operation keeps its key and result
+            cache_size: Completed results kept in memory in front of SQLite
+            purge_every: Writes between two purges of expired entries
+            busy_timeout: Seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.ttl_us = int(ttl * 1_000_000)
+        self.cache_size = cache_size
+        self.purge_every = purge_every
+        self.stats = {"created": 0, "reused": 0, "cached": 0, "completed": 0, "purged": 0}
+        self._lock = threading.Lock()
+        self._writes = 0
+        # operation_id -> (expires_us, idempotency_key, result JSON)
+        self._results: "OrderedDict[str, Tuple[int, str, str]]" = OrderedDict()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Commits survive a crash of the process (not of the machine) without an fsync each
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def begin(self, operation_id: str) -> Tuple[str, Optional[ReplayedResponse]]:
+        """Return the operation's idempotency key and, if it already succeeded,
+        Circle's cached response
+
+        The key is committed before this returns, so it survives a crash of
+        the caller right after the request is sent.
+        """
+        now = now_us()
+        with self._lock:
+            cached = self._results.get(operation_id)
+            if cached is not None and cached[0] > now:
+                self.stats["cached"] += 1
+                return cached[1], ReplayedResponse(json.loads(cached[2]))
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT idempotency_key, expires_us, result FROM idempotency WHERE operation_id = ?",
+                    (operation_id,)).fetchone()
+                if row is not None and row[1] > now:
+                    self._conn.execute("COMMIT")
+                    key, expires_us, result = row
+                    if result is None:
+                        self.stats["reused"] += 1
+                        return key, None
+                    self.stats["cached"] += 1
+                    self._cache(operation_id, expires_us, key, result)
+                    return key, ReplayedResponse(json.loads(result))
+
+                key = str(uuid.uuid4())
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO idempotency (operation_id, idempotency_key, created_us, expires_us) "
+                    "VALUES (?, ?, ?, ?)", (operation_id, key, now, now + self.ttl_us))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.stats["created"] += 1
+            self._wrote()
+            return key, None
+
+    def complete(self, operation_id: str, result: Dict):
+        """Cache Circle's response to a successful operation"""
+        payload = json.dumps(result)
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE idempotency SET result = ? WHERE operation_id = ? RETURNING idempotency_key, expires_us",
+                (payload, operation_id)).fetchone()
+            if row is not None:
+                self.stats["completed"] += 1
+                self._cache(operation_id, row[1], row[0], payload)
+            self._wrote()
+
+    def forget(self, operation_id: str):
+        """Drop an operation that Circle rejected, so a corrected retry gets a new key"""
+        with self._lock:
+            self._results.pop(operation_id, None)
+            self._conn.execute("DELETE FROM idempotency WHERE operation_id = ?", (operation_id,))
+
+    def get_key(self, operation_id: str) -> Optional[str]:
+        """The operation's current key, if it has one"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT idempotency_key FROM idempotency WHERE operation_id = ? AND expires_us > ?",
+                (operation_id, now_us())).fetchone()
+        return row[0] if row else None
+
+    def purge(self) -> int:
+        """Delete expired entries; returns how many were removed"""
+        with self._lock:
+            return self._purge()
+
+    def _purge(self) -> int:
+        removed = self._conn.execute("DELETE FROM idempotency WHERE expires_us <= ?", (now_us(),)).rowcount
+        self.stats["purged"] += removed
+        return removed
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= self.purge_every:
+            self._writes = 0
+            self._purge()
+
+    def _cache(self, operation_id: str, expires_us: int, key: str, result: str):
+        self._results[operation_id] = (expires_us, key, result)
+        self._results.move_to_end(operation_id)
+        if len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM idempotency").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Latency Histogram
+-----------------------------------------
+
+HDR-style histogram of latencies in integer microseconds: fixed memory,
+constant-time recording, and percentiles accurate to under 1% at any
+magnitude (a 40 us call and a 40 s call are both measured to within 0.8%).
+
+1. Values below 256 us get a bucket each
+2. Above that, each power of two is split into 128 equal buckets, so a
+   bucket's width is always under 1/128 of its values
+3. Histograms recorded by different threads or processes are combined with
+   merge(), and round-trip through to_dict() / from_dict() for JSON
+
+Usage:
+    histogram = LatencyHistogram()
+    start = time.perf_counter()
+    ...
+    histogram.record_seconds(time.perf_counter() - start)
+    print(histogram.percentile(99.9))
+"""
+
+from typing import Dict, List
+
+SUB_BUCKET_BITS = 8
+_LINEAR = 1 << SUB_BUCKET_BITS       # Values below this are exact
+_HALF = _LINEAR >> 1                  # Buckets per power of two above it
+
+
+def bucket_index(value: int) -> int:
+    if value < _LINEAR:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return _LINEAR + (shift - 1) * _HALF + ((value >> shift) - _HALF)
+
+
+def bucket_bounds(index: int) -> (int, int):
+    """Lowest value of a bucket and the lowest value of the next one"""
+    if index < _LINEAR:
+        return index, index + 1
+    shift = (index - _LINEAR) // _HALF + 1
+    mantissa = (index - _LINEAR) % _HALF + _HALF
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class LatencyHistogram:
+    """Log-linear histogram of microsecond latencies"""
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts: List[int] = []
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, value_us: int, count: int = 1):
+        """Record a latency (or `count` identical ones) in microseconds"""
+        value_us = int(value_us)
+        if value_us < _LINEAR:
+            if value_us < 0:
+                value_us = 0
+            index = value_us
+        else:  # bucket_index(), inlined on the hot path
+            shift = value_us.bit_length() - SUB_BUCKET_BITS
+            index = _LINEAR + (shift - 1) * _HALF + (value_us >> shift) - _HALF
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += count
+        if value_us > self.max:
+            self.max = value_us
+        if value_us < self.min or not self.count:
+            self.min = value_us
+        self.count += count
+        self.total += value_us * count
+
+    def record_seconds(self, seconds: float):
+        self.record(int(seconds * 1_000_000))
+
+    def merge(self, other: "LatencyHistogram") -> "LatencyHistogram":
+        """Add another histogram's values to this one"""
+        if other.count == 0:
+            return self
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.min = other.min if not self.count else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def percentile(self, pct: float) -> int:
+        """Latency (us) at or below which pct percent of the values fall"""
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * pct // 100))  # ceil, at least the first value
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = bucket_bounds(index)
+                # Middle of the bucket, kept within what was actually recorded
+                return min(self.max, max(self.min, (low + high - 1) // 2))
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, float]:
+        """count, mean, min, max and the usual percentiles, in microseconds"""
+        return {
+            "count": self.count,
+            "mean_us": round(self.mean, 1),
+            "min_us": self.min,
+            "p50_us": self.percentile(50),
+            "p90_us": self.percentile(90),
+            "p99_us": self.percentile(99),
+            "p999_us": self.percentile(99.9),
+            "max_us": self.max,
+        }
+
+    def to_dict(self) -> Dict:
+        """JSON-friendly form keeping only the non-empty buckets"""
+        return {"buckets": {str(index): count for index, count in enumerate(self.counts) if count},
+                "count": self.count, "total": self.total, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "LatencyHistogram":
+        histogram = cls()
+        for index, count in data["buckets"].items():
+            index = int(index)
+            if index >= len(histogram.counts):
+                histogram.counts.extend([0] * (index + 1 - len(histogram.counts)))
+            histogram.counts[index] = count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Exact Money Arithmetic
+----------------------------------------------
+
+Amounts are stored as integer minor units of their currency (USDC has 6
+decimals, BRL and USD have 2), so sums are exact and values such as
+0.30000000000000004 can never reach the Circle API.
+
+1. Money: an amount in minor units plus its currency
+2. Rate: an exchange rate held as an exact integer fraction
+3. Converter: a precomputed rate/currency pair that converts single amounts
+   or whole batches with pure integer arithmetic and explicit rounding
+
+Rounding modes are the decimal module's names (ROUND_HALF_EVEN, ...).
+
+Usage:
+    amount = Money.parse("500.00", "BRL")
+    usdc = amount.convert(Rate.parse("0.1771"), "USDC")   # 88.550000 USDC
+    str(usdc)                                              # "88.55"
+"""
+
+from decimal import (ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_EVEN,
+                     ROUND_HALF_UP, ROUND_UP, Decimal, InvalidOperation)
+from fractions import Fraction
+from functools import lru_cache
+from math import gcd
+from typing import Iterable, List, Union
+
+DECIMALS = {
+    "USDC": 6,
+    "USD": 2,
+    "BRL": 2,
+}
+
+ROUNDING_MODES = (ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_DOWN, ROUND_UP, ROUND_FLOOR, ROUND_CEILING)
+
+Number = Union[int, float, str, Decimal]
+
+
+def round_div(numerator: int, denominator: int, rounding: str = ROUND_HALF_EVEN) -> int:
+    """Divide two integers (denominator > 0) and round the quotient"""
+    q, r = divmod(numerator, denominator)
+    if r == 0:
+        return q
+    if rounding == ROUND_HALF_EVEN:
+        twice = 2 * r
+        if twice > denominator or (twice == denominator and q & 1):
+            return q + 1
+        return q
+    if rounding == ROUND_HALF_UP:
+        twice = 2 * r
+        if twice > denominator or (twice == denominator and numerator > 0):
+            return q + 1
+        return q
+    if rounding == ROUND_FLOOR:
+        return q
+    if rounding == ROUND_CEILING:
+        return q + 1
+    if rounding == ROUND_DOWN:
+        return q if numerator > 0 else q + 1
+    if rounding == ROUND_UP:
+        return q + 1 if numerator > 0 else q
+    raise ValueError(f"Unsupported rounding mode {rounding}")
+
+
+def _parse_fraction(value: Number) -> Fraction:
+    """Exact value of a number; floats use their shortest repr (0.1 -> 1/10)"""
+    if isinstance(value, int):
+        return Fraction(value)
+    if isinstance(value, float):
+        value = repr(value)
+    if isinstance(value, str):
+        text = value.strip()
+        sign, digits = (-1, text[1:]) if text.startswith("-") else (1, text.lstrip("+"))
+        whole, _, frac = digits.partition(".")
+        if (whole or frac) and (whole + frac).isdigit():
+            return Fraction(sign * int(whole + frac or "0"), 10 ** len(frac))
+        try:
+            value = Decimal(text)  # Exponents, NaN checks, etc.
+        except InvalidOperation:
+            raise ValueError(f"Invalid amount {text!r}") from None
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            raise ValueError(f"Invalid amount {value}")
+        return Fraction(value)
+    raise TypeError(f"Cannot interpret {value!r} as a number")
+
+
+class Rate:
+    """An exchange rate as an exact fraction"""
+
+    __slots__ = ("numerator", "denominator")
+
+    def __init__(self, numerator: int, denominator: int = 1):
+        if denominator <= 0 or numerator <= 0:
+            raise ValueError("A rate must be positive")
+        divisor = gcd(numerator, denominator)
+        self.numerator = numerator // divisor
+        self.denominator = denominator // divisor
+
+    @classmethod
+    def parse(cls, value: Union[Number, "Rate"]) -> "Rate":
+        if isinstance(value, Rate):
+            return value
+        return _rate_from(value)
+
+    def inverse(self) -> "Rate":
+        return Rate(self.denominator, self.numerator)
+
+    def __float__(self) -> float:
+        return self.numerator / self.denominator
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, Rate) and self.numerator == other.numerator
+                and self.denominator == other.denominator)
+
+    def __hash__(self) -> int:
+        return hash((self.numerator, self.denominator))
+
+    def __repr__(self) -> str:
+        return f"Rate({self.numerator}/{self.denominator})"
+
+
+@lru_cache(maxsize=256)
+def _rate_from(value: Number) -> Rate:
+    fraction = _parse_fraction(value)
+    return Rate(fraction.numerator, fraction.denominator)
+
+
+class Converter:
+    """Converts minor units of one currency into another at a fixed rate"""
+
+    __slots__ = ("from_currency", "to_currency", "rounding", "_multiplier", "_divisor")
+
+    def __init__(self, rate: Rate, from_currency: str, to_currency: str,
+                 rounding: str = ROUND_HALF_EVEN):
+        if rounding not in ROUNDING_MODES:
+            raise ValueError(f"Unsupported rounding mode {rounding}")
+        self.from_currency = from_currency
+        self.to_currency = to_currency
+        self.rounding = rounding
+        # to_units = units * rate * 10**to_decimals / 10**from_decimals
+        multiplier = rate.numerator * 10 ** DECIMALS[to_currency]
+        divisor = rate.denominator * 10 ** DECIMALS[from_currency]
+        common = gcd(multiplier, divisor)
+        self._multiplier = multiplier // common
+        self._divisor = divisor // common
+
+    def units(self, units: int) -> int:
+        """Convert one amount in minor units"""
+        if self._divisor == 1:
+            return units * self._multiplier
+        return round_div(units * self._multiplier, self._divisor, self.rounding)
+
+    def __call__(self, amount: "Money") -> "Money":
+        if amount.currency != self.from_currency:
+            raise ValueError(f"Expected {self.from_currency}, got {amount.currency}")
+        return Money(self.units(amount.units), self.to_currency)
+
+    def many(self, units: Iterable[int]) -> List[int]:
+        """Convert a batch of amounts in minor units"""
+        multiplier, divisor = self._multiplier, self._divisor
+        if divisor == 1:
+            return [u * multiplier for u in units]
+        if self.rounding == ROUND_HALF_EVEN:
+            # Inlined round_div for the default mode: the hot path of batch conversions
+            result = []
+            append = result.append
+            for u in units:
+                q, r = divmod(u * multiplier, divisor)
+                twice = r + r
+                append(q + 1 if twice > divisor or (twice == divisor and q & 1) else q)
+            return result
+        rounding = self.rounding
+        return [round_div(u * multiplier, divisor, rounding) for u in units]
+
+
+@lru_cache(maxsize=256)
+def converter(rate: Rate, from_currency: str, to_currency: str,
+              rounding: str = ROUND_HALF_EVEN) -> Converter:
+    """Shared Converter for a rate and currency pair"""
+    return Converter(rate, from_currency, to_currency, rounding)
+
+
+class Money:
+    """An exact amount of a currency, held in integer minor units"""
+
+    __slots__ = ("units", "currency")
+
+    def __init__(self, units: int, currency: str):
+        if currency not in DECIMALS:
+            raise ValueError(f"Unsupported currency {currency}")
+        self.units = units
+        self.currency = currency
+
+    @classmethod
+    def parse(cls, value: Union[Number, "Money"], currency: str,
+              rounding: str = ROUND_HALF_EVEN) -> "Money":
+        """Build an amount from a number, rounding to the currency's decimals"""
+        if isinstance(value, Money):
+            if value.currency != currency:
+                raise ValueError(f"Expected {currency}, got {value.currency}")
+            return value
+        fraction = _parse_fraction(value) * 10 ** DECIMALS[currency]
+        return cls(round_div(fraction.numerator, fraction.denominator, rounding), currency)
+
+    @classmethod
+    def parse_positive(cls, value: Union[Number, "Money"], currency: str,
+                       rounding: str = ROUND_HALF_EVEN) -> "Money":
+        """parse() for an amount to move: raises ValueError unless it is
+        above zero once rounded"""
+        amount = cls.parse(value, currency, rounding)
+        if amount.units <= 0:
+            raise ValueError(f"Amount must be positive, got {amount!r}")
+        return amount
+
+    @classmethod
+    def zero(cls, currency: str) -> "Money":
+        return cls(0, currency)
+
+    def convert(self, rate: Union[Rate, Number], to_currency: str,
+                rounding: str = ROUND_HALF_EVEN) -> "Money":
+        """Convert to another currency at an exchange rate"""
+        return converter(Rate.parse(rate), self.currency, to_currency, rounding)(self)
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.units).scaleb(-DECIMALS[self.currency])
+
+    def _check(self, other: "Money"):
+        if not isinstance(other, Money):
+            raise TypeError(f"Cannot combine Money with {type(other).__name__}")
+        if other.currency != self.currency:
+            raise ValueError(f"Currency mismatch: {self.currency} vs {other.currency}")
+
+    def __add__(self, other: "Money") -> "Money":
+        self._check(other)
+        return Money(self.units + other.units, self.currency)
+
+    def __sub__(self, other: "Money") -> "Money":
+        self._check(other)
+        return Money(self.units - other.units, self.currency)
+
+    def __neg__(self) -> "Money":
+        return Money(-self.units, self.currency)
+
+    def __lt__(self, other: "Money") -> bool:
+        self._check(other)
+        return self.units < other.units
+
+    def __le__(self, other: "Money") -> bool:
+        self._check(other)
+        return self.units <= other.units
+
+    def __gt__(self, other: "Money") -> bool:
+        self._check(other)
+        return self.units > other.units
+
+    def __ge__(self, other: "Money") -> bool:
+        self._check(other)
+        return self.units >= other.units
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Money) and self.units == other.units and self.currency == other.currency
+
+    def __hash__(self) -> int:
+        return hash((self.units, self.currency))
+
+    def __bool__(self) -> bool:
+        return self.units != 0
+
+    def __float__(self) -> float:
+        return self.units / 10 ** DECIMALS[self.currency]
+
+    def __str__(self) -> str:
+        """Plain decimal string as sent to Circle, with at least 2 decimals ("20.00", "0.123456")"""
+        decimals = DECIMALS[self.currency]
+        sign = "-" if self.units < 0 else ""
+        whole, frac = divmod(abs(self.units), 10 ** decimals)
+        digits = f"{frac:0{decimals}d}".rstrip("0").ljust(min(2, decimals), "0")
+        return f"{sign}{whole}.{digits}" if digits else f"{sign}{whole}"
+
+    def __repr__(self) -> str:
+        return f"Money('{self}', '{self.currency}')"
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Conversion Netting
+------------------------------------------
+
+Nets many small user conversions into a few Circle transfers of the
+omnibus wallet instead of one mint_usdc / redeem_usdc per conversion.
+
+1. The service credits or debits the user on the internal ledger right away
+   and adds an entry (mint or redeem) to the open window; an entry added
+   under an operation id already seen is not added again, so a retried
+   conversion is netted once
+2. Every `window` seconds, or sooner once the window holds max_entries
+   entries or its net amount reaches max_net_units, mints are netted against
+   redeems and the difference goes to Circle as a single transfer; a window
+   that nets to zero needs no transfer at all, and a net below
+   min_transfer_units waits for the next window
+3. A net transfer that fails on the way is retried as the same batch, under
+   the same operation id, before anything newer is settled, so Circle sees
+   one idempotent request however often it is retried; a transfer Circle
+   later reports as failed puts its entries back into the open window
+4. A batch Circle refuses outright (a 4xx other than 429) would be refused
+   again on every retry, so it is parked among the rejected batches instead
+   of blocking the window; reconciliation_report() lists it and
+   retry_rejected() reopens its entries once the cause is fixed
+5. Every entry records the batch that settled it, and
+   reconciliation_report() / report_rows() tie each net transfer back to
+   the user-level entries it covers
+6. A batch is kept for `retention` seconds after its transfer reached a
+   final status, then evicted with its entries; operation ids are
+   remembered for the same time (and at most dedupe_size of them), so a
+   long-running book holds only recent history. Write the report before
+   batches age out if it has to cover all of them
+
+Usage:
+    netting = NettingBook(circle_client, OMNIBUS_ADDRESS, window=5.0).start()
+    service = PicPayUSDCService(circle_client, netting=netting)
+    ...
+    netting.stop()  # Settles what is still open
+"""
+
+import csv
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Deque, Dict, Iterator, List, Optional, Tuple
+
+from money import Money
+from records import FINAL_STATUSES, NetSettlement, NettingEntry, now_us
+
+if TYPE_CHECKING:
+    from reconciliation import LedgerJournal
+    from webhook_receiver import StatusUpdate
+
+KINDS = ("mint", "redeem")
+# Statuses after which a batch's settlement no longer changes ("netted":
+# nothing was sent to Circle)
+SETTLED_STATUSES = FINAL_STATUSES | {"netted"}
+
+
+def _rejected(error: Exception) -> bool:
+    """Whether Circle refused the request itself (4xx other than 429), so
+    sending it again cannot succeed"""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+class NettingBook:
+    """Open netting window, settled batches and the omnibus wallet position"""
+
+    def __init__(self, circle_client, omnibus_address: str, window: float = 1.0,
+                 max_entries: int = 10_000, max_net_units: Optional[int] = None,
+                 min_transfer_units: int = 0, journal: Optional["LedgerJournal"] = None,
+                 retention: float = 3600.0, dedupe_size: int = 1_000_000):
+        """
+        Args:
+            circle_client: CircleClient used for the net mint_usdc / redeem_usdc
+            omnibus_address: Blockchain address of the omnibus wallet holding users' USDC
+            window: Seconds between two settlements
+            max_entries: Settle early once the window holds this many entries
+            max_net_units: Settle early once the window's net amount reaches this
+                (limits the unsettled exposure); None disables
+            min_transfer_units: Carry nets smaller than this over to the next window
+            journal: Where net transfers are recorded for reconciliation
+                (usually the service's)
+            retention: Seconds a batch is kept once its transfer reached a final
+                status, and an operation id is remembered for deduplication
+            dedupe_size: Operation ids remembered for deduplication
+        """
+        self.circle_client = circle_client
+        self.omnibus_address = omnibus_address
+        self.window = window
+        self.max_entries = max_entries
+        self.max_net_units = max_net_units
+        self.min_transfer_units = min_transfer_units
+        self.journal = journal
+        self.retention = retention
+        self.dedupe_size = dedupe_size
+        # Net USDC Circle has accepted into (positive) or out of the omnibus wallet
+        self.position_units = 0
+        self.settlements: Dict[str, NetSettlement] = {}
+        self.stats = {"entries": 0, "duplicates": 0, "settlements": 0, "circle_calls": 0, "failed_calls": 0,
+                      "failed_transfers": 0, "rejected_batches": 0, "evicted_batches": 0, "gross_units": 0,
+                      "transferred_units": 0}
+        self._lock = threading.Lock()  # Guards everything below and the state above
+        self._settling = threading.Lock()  # One settlement at a time
+        self._open: List[NettingEntry] = []
+        self._open_net = 0
+        self._unsent: Optional[Tuple[str, List[NettingEntry]]] = None  # Batch whose transfer failed on the way
+        self._rejected: Dict[str, Tuple[List[NettingEntry], str]] = {}  # Batch id -> (entries, Circle's error)
+        self._batches: Dict[str, List[NettingEntry]] = {}
+        self._by_transfer: Dict[str, str] = {}  # Circle transfer id -> batch id
+        # Caller's operation id -> (time added, its entry), oldest first
+        self._by_operation: "OrderedDict[str, Tuple[float, NettingEntry]]" = OrderedDict()
+        self._finished: Deque[Tuple[float, str]] = deque()  # (time final, batch id), oldest first
+        self._added_net = 0  # Net of every entry ever added, evicted ones included
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, user_id: str, kind: str, amount_units: int,
+            operation_id: Optional[str] = None) -> NettingEntry:
+        """Record a conversion already applied to the user's balance
+
+        With an operation_id that was added before, the earlier entry is
+        returned and nothing is added (see entry_for).
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown netting entry kind {kind!r}")
+        entry = NettingEntry(uuid.uuid4().hex, user_id, kind, amount_units, now_us())
+        net = amount_units if kind == "mint" else -amount_units
+        with self._lock:
+            if operation_id is not None:
+                known = self._operation(operation_id)
+                if known is not None:
+                    self.stats["duplicates"] += 1
+                    return known
+                self._by_operation[operation_id] = (time.time(), entry)
+                if len(self._by_operation) > self.dedupe_size:
+                    self._by_operation.popitem(last=False)
+            self._open.append(entry)
+            self._open_net += net
+            self._added_net += net
+            self.stats["entries"] += 1
+            self.stats["gross_units"] += amount_units
+            full = len(self._open) >= self.max_entries or (
+                self.max_net_units is not None and abs(self._open_net) >= self.max_net_units)
+        if full:
+            self._wake.set()
+        return entry
+
+    def entry_for(self, operation_id: str) -> Optional[NettingEntry]:
+        """The entry added under an operation id, if any; callers check it
+        before changing the balance of a conversion that may be a retry"""
+        with self._lock:
+            return self._operation(operation_id)
+
+    def _operation(self, operation_id: str) -> Optional[NettingEntry]:
+        """entry_for, once operation ids older than retention are forgotten
+        (called with self._lock)"""
+        expired = time.time() - self.retention
+        while self._by_operation:
+            added, _ = next(iter(self._by_operation.values()))
+            if added > expired:
+                break
+            self._by_operation.popitem(last=False)
+        known = self._by_operation.get(operation_id)
+        return known[1] if known is not None else None
+
+    def _finish(self, batch_id: str):
+        """Note that a batch's settlement is final, and evict the batches
+        that have been final for longer than retention (called with self._lock)"""
+        now = time.time()
+        self._finished.append((now, batch_id))
+        while self._finished and self._finished[0][0] <= now - self.retention:
+            _, old = self._finished.popleft()
+            settlement = self.settlements.pop(old)
+            del self._batches[old]
+            if settlement.transfer_id:
+                self._by_transfer.pop(settlement.transfer_id, None)
+            self.stats["evicted_batches"] += 1
+
+    def settle(self, force: bool = False) -> Optional[NetSettlement]:
+        """Settle the open window with one net Circle transfer
+
+        A batch whose transfer failed earlier is retried first (and alone).
+        Returns the settlement, or None when there was nothing to settle or
+        the net is below min_transfer_units (unless force). Errors from
+        Circle are raised after the batch was kept for the next attempt, or
+        parked among the rejected batches if Circle refused it.
+        """
+        with self._settling:
+            with self._lock:
+                if self._unsent is not None:
+                    batch_id, entries = self._unsent
+                elif not self._open:
+                    return None
+                elif abs(self._open_net) < self.min_transfer_units and not force and \
+                        len(self._open) < self.max_entries:
+                    return None
+                else:
+                    batch_id, entries = uuid.uuid4().hex, self._open
+                    self._open, self._open_net = [], 0
+
+            minted = sum(entry.amount_units for entry in entries if entry.kind == "mint")
+            redeemed = sum(entry.amount_units for entry in entries if entry.kind == "redeem")
+            transfer_id, status = None, "netted"
+            if minted != redeemed:
+                try:
+                    transfer = self._transfer(batch_id, minted - redeemed)
+                except Exception as e:
+                    with self._lock:
+                        self.stats["failed_calls"] += 1
+                        if _rejected(e):
+                            self._rejected[batch_id] = (entries, str(e))
+                            self._unsent = None
+                            self.stats["rejected_batches"] += 1
+                        else:
+                            self._unsent = (batch_id, entries)
+                    raise
+                transfer_id, status = transfer.get("id"), transfer.get("status", "pending")
+
+            settlement = NetSettlement(batch_id, len(entries), minted, redeemed, transfer_id, status)
+            with self._lock:
+                self._unsent = None
+                for entry in entries:
+                    entry.batch_id = batch_id
+                self._batches[batch_id] = entries
+                self.settlements[batch_id] = settlement
+                if transfer_id:
+                    self._by_transfer[transfer_id] = batch_id
+                self.position_units += settlement.net_units
+                self.stats["settlements"] += 1
+                self.stats["transferred_units"] += abs(settlement.net_units)
+                if status in SETTLED_STATUSES:
+                    self._finish(batch_id)
+            if transfer_id and self.journal is not None:
+                self.journal.append(transfer_id, abs(settlement.net_units))
+            return settlement
+
+    def _transfer(self, batch_id: str, net_units: int) -> Dict:
+        """Mint (net_units > 0) or redeem the batch's net amount at Circle"""
+        self.stats["circle_calls"] += 1  # Only ever called under self._settling
+        operation_id = f"net:{batch_id}"
+        if net_units > 0:
+            response = self.circle_client.mint_usdc(Money(net_units, "USDC"), self.omnibus_address,
+                                                    operation_id=operation_id)
+        else:
+            response = self.circle_client.redeem_usdc(Money(-net_units, "USDC"), self.omnibus_address,
+                                                      operation_id=operation_id)
+        return response.get("data", response)
+
+    def apply_status_update(self, update: "StatusUpdate") -> bool:
+        """Apply a Circle status change if it concerns a net transfer
+
+        A failed net transfer reopens its entries so the next window settles
+        them again. Returns False for transactions that are not net transfers.
+        """
+        with self._lock:
+            batch_id = self._by_transfer.get(update.transaction_id)
+            if batch_id is None:
+                return False
+            settlement = self.settlements[batch_id]
+            if settlement.status in FINAL_STATUSES:
+                return True
+            settlement.status = update.status
+            if update.status == "failed":
+                self.position_units -= settlement.net_units
+                self.stats["failed_transfers"] += 1
+                if self.journal is not None:
+                    self.journal.append(update.transaction_id, -abs(settlement.net_units))
+                for entry in self._batches[batch_id]:
+                    self._open.append(entry)
+                    self._open_net += entry.amount_units if entry.kind == "mint" else -entry.amount_units
+            if update.status in SETTLED_STATUSES:
+                self._finish(batch_id)
+        if update.status == "failed":
+            self._wake.set()
+        return True
+
+    def retry_rejected(self, batch_id: str) -> int:
+        """Put a rejected batch's entries back into the open window (a new
+        batch, under a new operation id); returns how many were reopened"""
+        with self._lock:
+            entries, _ = self._rejected.pop(batch_id, ((), None))
+            for entry in entries:
+                self._open.append(entry)
+                self._open_net += entry.amount_units if entry.kind == "mint" else -entry.amount_units
+        if entries:
+            self._wake.set()
+        return len(entries)
+
+    def entries(self, batch_id: str) -> List[NettingEntry]:
+        """The user-level entries a batch settled (none once it was evicted)"""
+        with self._lock:
+            return list(self._batches.get(batch_id, ()))
+
+    def report_rows(self) -> Iterator[Dict]:
+        """One row per entry with the batch and Circle transfer that settled
+        it (empty for entries still open); entries of evicted batches are
+        left out"""
+        with self._lock:
+            batches = list(self._batches.items())
+            settlements = dict(self.settlements)
+            pending = list(self._open) + (list(self._unsent[1]) if self._unsent else [])
+            rejected = [(batch_id, list(entries)) for batch_id, (entries, _) in self._rejected.items()]
+        for batch_id, entries in batches:
+            settlement = settlements[batch_id]
+            for entry in entries:
+                # Entries of a failed batch are reported again under the batch that resettled them
+                if entry.batch_id == batch_id or settlement.status == "failed":
+                    yield self._row(entry, batch_id, settlement)
+        for entry in pending:
+            yield self._row(entry, None, None)
+        for batch_id, entries in rejected:
+            for entry in entries:
+                yield {**self._row(entry, batch_id, None), "transfer_status": "rejected"}
+
+    @staticmethod
+    def _row(entry: NettingEntry, batch_id: Optional[str], settlement: Optional[NetSettlement]) -> Dict:
+        return {
+            "entry_id": entry.entry_id,
+            "user_id": entry.user_id,
+            "kind": entry.kind,
+            "amount_usdc": str(entry.amount_usdc),
+            "created_at": entry.created_at,
+            "batch_id": batch_id or "",
+            "transfer_id": (settlement.transfer_id or "") if settlement else "",
+            "transfer_status": settlement.status if settlement else "open",
+        }
+
+    def write_report(self, path: str) -> int:
+        """Write report_rows() as CSV; returns the number of entries written"""
+        count = 0
+        with open(path, "w", newline="") as output:
+            writer = None
+            for row in self.report_rows():
+                if writer is None:
+                    writer = csv.DictWriter(output, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def reconciliation_report(self) -> Dict:
+        """Per-batch totals checked against their entries, and the omnibus
+        position checked against every entry ever added
+
+        "balanced" is True when each batch still kept adds up to its
+        transfer, no entry belongs to two live batches, and the position
+        plus what is still open, unsent or rejected equals the net of all
+        entries, evicted ones included.
+        """
+        with self._lock:
+            batches = list(self._batches.items())
+            settlements = dict(self.settlements)
+            open_entries = list(self._open)
+            unsent = list(self._unsent[1]) if self._unsent else []
+            rejected = [(batch_id, list(entries), error) for batch_id, (entries, error) in self._rejected.items()]
+            position = self.position_units
+            entries_net = self._added_net
+
+        rows = []
+        settled_entries = set()
+        duplicated = 0
+        rejected_entries = [entry for _, entries, _ in rejected for entry in entries]
+        batches_balanced = True
+        for batch_id, entries in batches:
+            settlement = settlements[batch_id]
+            minted = sum(entry.amount_units for entry in entries if entry.kind == "mint")
+            redeemed = sum(entry.amount_units for entry in entries if entry.kind == "redeem")
+            balanced = (minted, redeemed, len(entries)) == (
+                settlement.minted_units, settlement.redeemed_units, settlement.entry_count)
+            batches_balanced = batches_balanced and balanced
+            rows.append({**settlement.to_dict(), "balanced": balanced})
+            for entry in entries:
+                if settlement.status != "failed":
+                    duplicated += entry.entry_id in settled_entries
+                    settled_entries.add(entry.entry_id)
+
+        def net(entries) -> int:
+            return sum(entry.amount_units if entry.kind == "mint" else -entry.amount_units for entry in entries)
+
+        open_net, unsent_net = net(open_entries), net(unsent)
+        rejected_net = net(rejected_entries)
+        return {
+            "settlements": rows,
+            "open_entries": len(open_entries),
+            "open_net_usdc": Money(open_net, "USDC"),
+            "unsent_entries": len(unsent),
+            "unsent_net_usdc": Money(unsent_net, "USDC"),
+            "rejected": [{"batch_id": batch_id, "entries": len(entries), "net_usdc": Money(net(entries), "USDC"),
+                          "error": error} for batch_id, entries, error in rejected],
+            "rejected_net_usdc": Money(rejected_net, "USDC"),
+            "position_usdc": Money(position, "USDC"),
+            "entries_net_usdc": Money(entries_net, "USDC"),
+            "balanced": batches_balanced and not duplicated and
+                        position + open_net + unsent_net + rejected_net == entries_net,
+        }
+
+    def __len__(self) -> int:
+        """Entries waiting to be settled (rejected batches are not counted)"""
+        with self._lock:
+            return len(self._open) + (len(self._unsent[1]) if self._unsent else 0)
+
+    # Lifecycle
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.window)
+            self._wake.clear()
+            try:
+                self.settle()
+            except Exception:
+                pass  # Counted in stats["failed_calls"]; the batch is retried next window
+
+    def start(self) -> "NettingBook":
+        """Start the settlement thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="netting", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, settle: bool = True):
+        """Stop the settlement thread, then settle what is still open"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        while settle and len(self) and self.settle(force=True) is not None:
+            pass
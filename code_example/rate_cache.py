@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Exchange Rate Cache
+-------------------------------------------
+
+Keeps BRL/USDC rates from Circle (/v1/exchange/rates or tradable quotes from
+/v1/exchange/quotes) in memory so conversions never make an HTTP call.
+
+1. Reads are lock-free: refreshes build a new snapshot dict and swap it in
+2. A background thread refreshes each pair before its TTL (or the quote's
+   expiresAt) runs out
+3. Concurrent misses for the same pair share a single upstream request
+4. get() never waits on Circle; until the first fetch lands it serves the
+   fallback rates (e.g. EXCHANGE_RATES) and counts a miss
+5. After a failed fetch, get() starts no new one for that pair for
+   min(ttl, retry_delay) seconds, so a Circle outage is not met with a
+   request per read
+
+Usage:
+    rate_cache = ExchangeRateCache(circle_client, fallback=EXCHANGE_RATES)
+    rate_cache.start()
+    service = PicPayUSDCService(circle_client, rate_cache=rate_cache)
+"""
+
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+# Cache pair name -> (from currency, to currency) as Circle names them
+PAIR_CURRENCIES = {
+    "BRL_USD": ("BRL", "USDC"),
+    "USD_BRL": ("USDC", "BRL"),
+}
+
+
+class CachedRate(NamedTuple):
+    """An immutable rate snapshot for one pair"""
+    pair: str
+    rate: float
+    fetched_at: float  # time.monotonic()
+    expires_at: float  # time.monotonic()
+    quote_id: Optional[str] = None
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+
+class ExchangeRateCache:
+    """Background-refreshed, lock-free read cache of exchange rates"""
+
+    def __init__(self,
+                 circle_client,
+                 pairs: Iterable[str] = ("BRL_USD", "USD_BRL"),
+                 ttl: float = 30.0,
+                 refresh_ahead: float = 0.2,
+                 use_quotes: bool = False,
+                 quote_amount: float = 1000.0,
+                 fallback: Optional[Dict[str, float]] = None,
+                 retry_delay: float = 1.0):
+        """
+        Args:
+            circle_client: CircleClient used for upstream fetches
+            pairs: Pairs kept warm by the background refresher
+            ttl: Lifetime of a rate from /v1/exchange/rates (quotes use their expiresAt)
+            refresh_ahead: Fraction of the lifetime left when a refresh is started
+            use_quotes: Fetch tradable quotes instead of indicative rates
+            quote_amount: Notional in the source currency used for quotes
+            fallback: Rates served before the first successful fetch
+            retry_delay: Pause after a failed fetch before reads start another
+                (capped at ttl)
+        """
+        self.circle_client = circle_client
+        self.pairs = tuple(pairs)
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.use_quotes = use_quotes
+        self.quote_amount = quote_amount
+        self.fallback = dict(fallback or {})
+        self.retry_delay = min(ttl, retry_delay)
+        # Best-effort counters: updated without a lock to keep reads lock-free
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "refreshes": 0, "refresh_errors": 0,
+                      "backoffs": 0}
+
+        self._snapshot: Dict[str, CachedRate] = {}
+        self._retry_at: Dict[str, float] = {}  # pair -> time.monotonic() before which reads do not fetch it
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.pairs)),
+                                            thread_name_prefix="rate-refresh")
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Reads
+
+    def get(self, pair: str) -> float:
+        """Return the cached rate for a pair without ever blocking
+
+        A fresh entry is a hit. An expired entry is still served (and counted
+        as stale) while a refresh runs; a missing entry falls back to the
+        fallback rate and triggers a fetch. Within retry_delay of a failed
+        fetch, or once the cache is stopped, no new one is started.
+        """
+        entry = self._snapshot.get(pair)
+        now = time.monotonic()
+        if entry is not None:
+            if entry.is_fresh(now):
+                self.stats["hits"] += 1
+            else:
+                self.stats["stale"] += 1
+                self._refresh_unless_failed(pair, now)
+            return entry.rate
+
+        self.stats["misses"] += 1
+        self._refresh_unless_failed(pair, now)
+        if pair not in self.fallback:
+            raise KeyError(f"No rate available for {pair}")
+        return self.fallback[pair]
+
+    def get_entry(self, pair: str) -> Optional[CachedRate]:
+        """Return the cached snapshot for a pair (with its quote id), if any"""
+        return self._snapshot.get(pair)
+
+    def get_fresh(self, pair: str, timeout: Optional[float] = None) -> CachedRate:
+        """Return a non-expired entry, waiting on (a shared) upstream fetch if needed"""
+        entry = self._snapshot.get(pair)
+        if entry is not None and entry.is_fresh(time.monotonic()):
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        return self.refresh(pair).result(timeout)
+
+    # Refresh
+
+    def _refresh_unless_failed(self, pair: str, now: float):
+        if self._stop.is_set():
+            return  # Stopped: the executor is gone, serve what we have
+        if now < self._retry_at.get(pair, 0.0):
+            self.stats["backoffs"] += 1
+            return
+        try:
+            self.refresh(pair)
+        except RuntimeError:
+            # stop() shut the executor down after the check above
+            if not self._stop.is_set():
+                raise
+
+    def refresh(self, pair: str) -> Future:
+        """Start a fetch for a pair, or join the one already in flight"""
+        with self._inflight_lock:
+            future = self._inflight.get(pair)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._fetch, pair)
+            self._inflight[pair] = future
+        # Outside the lock: a fetch that already finished runs the callback inline
+        future.add_done_callback(lambda done, pair=pair: self._clear_inflight(pair, done))
+        return future
+
+    def _clear_inflight(self, pair: str, future: Future):
+        with self._inflight_lock:
+            if self._inflight.get(pair) is future:
+                del self._inflight[pair]
+
+    def _fetch(self, pair: str) -> CachedRate:
+        from_currency, to_currency = PAIR_CURRENCIES[pair]
+        try:
+            if self.use_quotes:
+                entry = self._parse_quote(pair, self.circle_client.create_quote(
+                    from_currency, self.quote_amount, to_currency))
+            else:
+                data = self.circle_client.get_exchange_rate(from_currency, to_currency)
+                data = data.get("data", data)
+                now = time.monotonic()
+                entry = CachedRate(pair, float(data["rate"]), now, now + self.ttl)
+        except Exception:
+            self.stats["refresh_errors"] += 1
+            self._retry_at[pair] = time.monotonic() + self.retry_delay
+            raise
+
+        with self._write_lock:
+            snapshot = dict(self._snapshot)
+            snapshot[pair] = entry
+            self._snapshot = snapshot  # Atomic reference swap; readers never lock
+            self._retry_at.pop(pair, None)
+        self.stats["refreshes"] += 1
+        self._wakeup.set()
+        return entry
+
+    def _parse_quote(self, pair: str, response: Dict) -> CachedRate:
+        data = response.get("data", response)
+        now = time.monotonic()
+        expires_at = now + self.ttl
+        if data.get("expiresAt"):
+            expires_epoch = datetime.fromisoformat(data["expiresAt"].replace("Z", "+00:00")).timestamp()
+            expires_at = now + (expires_epoch - time.time())
+        return CachedRate(pair, float(data["rate"]), now, expires_at, data.get("id"))
+
+    def _next_refresh(self) -> Tuple[float, Tuple[str, ...]]:
+        """Seconds until the next refresh is due and the pairs due by then"""
+        now = time.monotonic()
+        due_at = {}
+        for pair in self.pairs:
+            entry = self._snapshot.get(pair)
+            if entry is None:
+                due_at[pair] = now
+            else:
+                lifetime = entry.expires_at - entry.fetched_at
+                due_at[pair] = entry.expires_at - lifetime * self.refresh_ahead
+        next_due = min(due_at.values())
+        return max(0.0, next_due - now), tuple(p for p, t in due_at.items() if t <= next_due)
+
+    def _run(self):
+        while not self._stop.is_set():
+            delay, due = self._next_refresh()
+            if delay > 0:
+                self._wakeup.clear()
+                self._wakeup.wait(delay)
+                continue
+            for pair in due:
+                try:
+                    self.refresh(pair).result()
+                except Exception:
+                    # Keep serving the last known rate; retry after a short pause
+                    self._stop.wait(self.retry_delay)
+
+    def start(self) -> "ExchangeRateCache":
+        """Start the background refresher thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rate-cache", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background refresher; get() keeps serving the cached and
+        fallback rates without fetching"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Client-side Rate Limiter
+------------------------------------------------
+
+Token-bucket rate limiting for calls to Circle APIs, so bursts are smoothed
+out before they reach Circle instead of failing with 429 and being retried by
+every thread at once.
+
+1. One bucket per endpoint ("POST /v1/transfers", ...), with its own rate
+2. A 429 halves the bucket's rate (at most once per cooldown, so a burst of
+   429s from requests already in flight counts as one signal) and blocks it
+   until Retry-After has passed; the rate then climbs back linearly (AIMD)
+3. Buckets are shared by every thread using the same RateLimiter and, when a
+   state_dir is given, by every process on the node using the same directory.
+   Shared state is timed with the wall clock, which unlike the monotonic
+   clock survives a reboot; if the clock goes back, the stored times are
+   dropped rather than blocking the bucket until the clock catches up
+
+Usage:
+    limiter = RateLimiter(rate=20.0, endpoint_rates={"POST /v1/transfers": 5.0})
+    client = CircleClient(API_KEY, BASE_URL, rate_limiter=limiter)
+    ...
+    limiter.close()  # Unmaps shared state files
+"""
+
+import os
+import re
+import time
+import mmap
+import fcntl
+import struct
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+# tokens, last refill, current rate, blocked until, last decrease
+BucketState = Tuple[float, float, float, float, float]
+
+_STATE_FORMAT = struct.Struct("ddddd")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime  # Rarely needed and slow to import
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class _LocalSlot:
+    """Bucket state shared by the threads of one process"""
+
+    def __init__(self, initial: BucketState):
+        self._state = initial
+        self._lock = threading.Lock()
+
+    def transact(self, fn: Callable[[BucketState], Tuple[BucketState, float]]) -> float:
+        with self._lock:
+            self._state, result = fn(self._state)
+            return result
+
+    def close(self):
+        pass
+
+
+class _FileSlot:
+    """Bucket state stored in a small memory-mapped file shared by every
+    process on the node; updates are serialised with flock"""
+
+    def __init__(self, path: str, initial: BucketState):
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < _STATE_FORMAT.size:
+                os.ftruncate(self._fd, _STATE_FORMAT.size)
+                os.pwrite(self._fd, _STATE_FORMAT.pack(*initial), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, _STATE_FORMAT.size)
+
+    def transact(self, fn: Callable[[BucketState], Tuple[BucketState, float]]) -> float:
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state, result = fn(_STATE_FORMAT.unpack_from(self._map, 0))
+                _STATE_FORMAT.pack_into(self._map, 0, *state)
+                return result
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """Unmap the state and close the file (the state stays on disk)"""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+                self._map = None
+
+    def __enter__(self) -> "_FileSlot":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TokenBucket:
+    """Adaptive token bucket for a single endpoint"""
+
+    def __init__(self,
+                 rate: float,
+                 capacity: Optional[float] = None,
+                 min_rate: float = 0.5,
+                 decrease_factor: float = 0.5,
+                 decrease_cooldown: float = 1.0,
+                 recovery_seconds: float = 30.0,
+                 state_path: Optional[str] = None):
+        """
+        Args:
+            rate: Maximum requests per second
+            capacity: Burst size (defaults to one second worth of requests)
+            min_rate: Floor the adaptive rate never drops below
+            decrease_factor: Rate multiplier applied on a 429
+            decrease_cooldown: Seconds during which further 429s do not cut the rate again
+            recovery_seconds: Time to climb back from min_rate to rate
+            state_path: File holding the state when shared between processes
+        """
+        self.max_rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.min_rate = min(min_rate, rate)
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.recovery_per_second = (rate - self.min_rate) / recovery_seconds
+        # A state file outlives the boot whose monotonic clock it would use
+        self._clock = time.time if state_path else time.monotonic
+        initial = (self.capacity, self._clock(), rate, 0.0, 0.0)
+        self._slot = _FileSlot(state_path, initial) if state_path else _LocalSlot(initial)
+
+    def _refill(self, state: BucketState, now: float) -> BucketState:
+        tokens, updated, rate, blocked_until, last_decrease = state
+        if updated > now:
+            # Written on a clock that was ahead (set back since, or another
+            # clock altogether): its times mean nothing now
+            updated, blocked_until, last_decrease = now, 0.0, 0.0
+        elapsed = now - updated
+        tokens = min(self.capacity, tokens + elapsed * rate)
+        rate = min(self.max_rate, rate + elapsed * self.recovery_per_second)
+        return tokens, now, rate, blocked_until, last_decrease
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available; otherwise return the seconds to wait"""
+        def take(state):
+            now = self._clock()
+            state = self._refill(state, now)
+            tokens, _, rate, blocked_until, _ = state
+            if now < blocked_until:
+                return state, blocked_until - now
+            if tokens >= 1.0:
+                return (tokens - 1.0,) + state[1:], 0.0
+            return state, (1.0 - tokens) / rate
+        return self._slot.transact(take)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Block until a token is available; False if timeout expires first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        """Multiplicatively cut the rate and hold the bucket until Retry-After"""
+        def decrease(state):
+            now = self._clock()
+            tokens, updated, rate, blocked_until, last_decrease = self._refill(state, now)
+            if now - last_decrease >= self.decrease_cooldown:
+                rate = max(self.min_rate, rate * self.decrease_factor)
+                last_decrease = now
+            if retry_after:
+                blocked_until = max(blocked_until, now + retry_after)
+            return (0.0, updated, rate, blocked_until, last_decrease), 0.0
+        self._slot.transact(decrease)
+
+    @property
+    def rate(self) -> float:
+        """Currently allowed requests per second"""
+        return self._slot.transact(lambda state: (state, state[2]))
+
+    def close(self):
+        """Release the shared state file, if any"""
+        self._slot.close()
+
+
+class RateLimiter:
+    """Per-endpoint token buckets shared across CircleClient instances"""
+
+    def __init__(self,
+                 rate: float = 10.0,
+                 endpoint_rates: Optional[Dict[str, float]] = None,
+                 burst: Optional[float] = None,
+                 min_rate: float = 0.5,
+                 state_dir: Optional[str] = None):
+        """
+        Args:
+            rate: Default requests per second for an endpoint
+            endpoint_rates: Overrides keyed by endpoint, e.g. "POST /v1/transfers"
+            burst: Bucket capacity (defaults to one second worth of requests)
+            min_rate: Floor the adaptive rate never drops below
+            state_dir: Directory holding bucket state shared between processes
+        """
+        self.rate = rate
+        self.endpoint_rates = endpoint_rates or {}
+        self.burst = burst
+        self.min_rate = min_rate
+        self.state_dir = state_dir
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        """Get (or create) the bucket for an endpoint"""
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(endpoint)
+                if bucket is None:
+                    state_path = None
+                    if self.state_dir:
+                        slug = re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_")
+                        state_path = os.path.join(self.state_dir, f"{slug}.bucket")
+                    bucket = TokenBucket(self.endpoint_rates.get(endpoint, self.rate),
+                                         capacity=self.burst,
+                                         min_rate=self.min_rate,
+                                         state_path=state_path)
+                    self._buckets[endpoint] = bucket
+        return bucket
+
+    def acquire(self, endpoint: str, timeout: Optional[float] = None) -> bool:
+        """Block until the endpoint's bucket lets a request through"""
+        return self.bucket(endpoint).acquire(timeout)
+
+    def on_throttled(self, endpoint: str, retry_after: Optional[float] = None):
+        self.bucket(endpoint).on_throttled(retry_after)
+
+    def close(self):
+        """Release every bucket's shared state file; buckets asked for
+        afterwards are opened again"""
+        with self._lock:
+            buckets, self._buckets = list(self._buckets.values()), {}
+        for bucket in buckets:
+            bucket.close()
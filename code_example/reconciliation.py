@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Settlement Reconciliation
+-------------------------------------------------
+
+Matches Circle's records (GET /v1/transfers and
+GET /v1/exchange/trades/settlements) against the credits and debits
+PicPayUSDCService applied to user balances, in NumPy columns instead of
+one Python dict lookup per row.
+
+The ledger side comes from a LedgerJournal: the service (and its
+NettingBook) append a row for every Circle transaction whose balance
+changes they apply, and a negative one when a failure reverses them, so
+every transaction ever applied is there, not just those still in memory.
+
+1. Each side is read chunk_rows rows at a time into columns: the
+   transaction id as a 128-bit key (two uint64; UUIDs are decoded in bulk,
+   any other id is hashed), the amount in integer units of its currency and
+   a currency code
+2. Rows are hash-partitioned on the key into `partitions` spill files per
+   side, so memory holds one chunk while loading and one partition pair
+   while joining, whatever the number of rows
+3. Each partition pair is sorted on the key, rows of the same id on one
+   side are summed, and the two sides are merged in a single sort. Rows of
+   one id in different currencies are not summed: the id is reported as a
+   currency mismatch. Ledger ids whose rows cancel out (reversed) are
+   dropped
+4. The report counts matches, amount mismatches and their drift, ids
+   missing on either side and currency mismatches, with a few sample ids
+   per category; every mismatched row can also be written to a CSV
+
+Ids that are not UUIDs show up in samples and the CSV as the UUID form of
+their hash. Rows in a currency Money does not know get currency code 0
+("?"), can never match, and are counted under unknown_currency_*_rows.
+
+Usage:
+    journal = LedgerJournal("ledger-journal.bin")
+    service = PicPayUSDCService(circle_client, journal=journal)
+    ...
+    with Reconciler() as reconciler:
+        reconciler.add_circle(circle_rows(circle_client))
+        reconciler.add_journal(journal)
+        reconciler.add_ledger(exchange_rows(exchange_results))
+        report = reconciler.run(mismatch_csv="mismatches.csv")
+"""
+
+import os
+import csv
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from money import DECIMALS, Money
+
+# Code 0 is kept for currencies Circle may add later
+CURRENCIES = ("?",) + tuple(DECIMALS)
+CURRENCY_CODES = {currency: code for code, currency in enumerate(CURRENCIES)}
+# Code of an id whose rows on one side came in more than one currency
+MIXED_CURRENCY = 255
+
+ROW_DTYPE = np.dtype([("hi", "<u8"), ("lo", "<u8"), ("units", "<i8"), ("currency", "u1")])
+SIDES = ("circle", "ledger")
+CATEGORIES = ("amount_mismatch", "currency_mismatch", "missing_in_ledger", "missing_at_circle")
+
+Row = Tuple[str, int, str]  # (transaction id, amount units, currency)
+
+# Positions of the 32 hex digits in "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
+_HEX_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+_DASH_POSITIONS = np.array([8, 13, 18, 23])
+_NIBBLES = np.full(256, 255, dtype=np.uint8)
+for _digit in "0123456789abcdef":
+    _NIBBLES[ord(_digit)] = _NIBBLES[ord(_digit.upper())] = int(_digit, 16)
+
+
+def _uuid_keys(ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(hi, lo, ok) for an "S36" array; ok is False where a row is no UUID"""
+    chars = ids.view(np.uint8).reshape(-1, 36)
+    nibbles = _NIBBLES[chars[:, _HEX_POSITIONS]]
+    ok = (chars[:, _DASH_POSITIONS] == ord("-")).all(axis=1) & (nibbles != 255).all(axis=1)
+    packed = np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+    words = packed.view(">u8").astype("<u8")
+    return words[:, 0].copy(), words[:, 1].copy(), ok
+
+
+def _hash_key(transaction_id: Union[str, bytes]) -> Tuple[int, int]:
+    if isinstance(transaction_id, str):
+        transaction_id = transaction_id.encode()
+    digest = hashlib.blake2b(bytes(transaction_id), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+
+
+def id_keys(ids: Union[List[str], np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """128-bit keys of transaction ids (strings, or a bytes array), as
+    (hi, lo) uint64 arrays
+
+    A UUID's key is its value, so it can be turned back into the id; other
+    ids are hashed with BLAKE2b, one at a time.
+    """
+    count = len(ids)
+    hi = np.empty(count, dtype="<u8")
+    lo = np.empty(count, dtype="<u8")
+    if not count:
+        return hi, lo
+    raw = np.asarray(ids, dtype="S")
+    if raw.dtype.itemsize == 36:
+        candidates = np.arange(count)
+    else:
+        candidates = np.flatnonzero(np.char.str_len(raw) == 36)
+    ok = np.zeros(count, dtype=bool)
+    if len(candidates):
+        hi[candidates], lo[candidates], ok[candidates] = _uuid_keys(raw[candidates].astype("S36"))
+    for index in np.flatnonzero(~ok):
+        hi[index], lo[index] = _hash_key(ids[index])
+    return hi, lo
+
+
+def key_to_id(hi: int, lo: int) -> str:
+    return str(uuid.UUID(int=(int(hi) << 64) | int(lo)))
+
+
+def to_columns(ids: List[str], units: Iterable[int], currencies: Iterable[str]) -> np.ndarray:
+    """One ROW_DTYPE array from parallel lists"""
+    rows = np.empty(len(ids), dtype=ROW_DTYPE)
+    rows["hi"], rows["lo"] = id_keys(ids)
+    rows["units"] = np.fromiter(units, dtype=np.int64, count=len(ids))
+    rows["currency"] = np.fromiter((CURRENCY_CODES.get(currency, 0) for currency in currencies),
+                                   dtype=np.uint8, count=len(ids))
+    return rows
+
+
+def chunks(rows: Iterable[Row], chunk_rows: int) -> Iterator[np.ndarray]:
+    """ROW_DTYPE arrays of at most chunk_rows rows each"""
+    ids: List[str] = []
+    units: List[int] = []
+    currencies: List[str] = []
+    for transaction_id, amount_units, currency in rows:
+        ids.append(transaction_id)
+        units.append(amount_units)
+        currencies.append(currency)
+        if len(ids) >= chunk_rows:
+            yield to_columns(ids, units, currencies)
+            ids, units, currencies = [], [], []
+    if ids:
+        yield to_columns(ids, units, currencies)
+
+
+def _key_order(rows: np.ndarray) -> np.ndarray:
+    """Indices sorting rows on (hi, lo), keeping rows of equal keys in order
+
+    Sorts on hi alone, which is random and almost never repeats without the
+    whole key repeating; the slower two-column sort only runs when it does.
+    The stable sort is a merge, so two sorted runs cost one linear pass.
+    """
+    order = np.argsort(rows["hi"], kind="stable")
+    hi, lo = rows["hi"][order], rows["lo"][order]
+    if ((hi[1:] == hi[:-1]) & (lo[1:] != lo[:-1])).any():
+        order = np.lexsort((rows["lo"], rows["hi"]))
+    return order
+
+
+def currency_name(code: int) -> str:
+    return "mixed" if code == MIXED_CURRENCY else CURRENCIES[code]
+
+
+def _collapse(rows: np.ndarray) -> Tuple[np.ndarray, int, int]:
+    """Sort rows on the key and sum the amounts of rows sharing one; returns
+    (one row per key, rows merged away, keys with rows in several currencies)
+
+    A key whose rows differ in currency gets MIXED_CURRENCY (its sum means
+    nothing), so it can only come out as a mismatch.
+    """
+    if not len(rows):
+        return rows, 0, 0
+    rows = rows[_key_order(rows)]
+    first = np.empty(len(rows), dtype=bool)
+    first[0] = True
+    first[1:] = (rows["hi"][1:] != rows["hi"][:-1]) | (rows["lo"][1:] != rows["lo"][:-1])
+    starts = np.flatnonzero(first)
+    if len(starts) == len(rows):
+        return rows, 0, 0
+    unique = rows[starts]
+    unique["units"] = np.add.reduceat(rows["units"], starts)
+    mixed = np.maximum.reduceat(rows["currency"], starts) != np.minimum.reduceat(rows["currency"], starts)
+    unique["currency"][mixed] = MIXED_CURRENCY
+    return unique, len(rows) - len(starts), int(mixed.sum())
+
+
+class Reconciler:
+    """Partitioned sort/merge join of Circle records with ledger entries"""
+
+    def __init__(self, partitions: int = 64, chunk_rows: int = 1_000_000, spill_dir: Optional[str] = None,
+                 samples: int = 10):
+        """
+        Args:
+            partitions: Spill files per side; memory while joining is about
+                the rows of both sides divided by this
+            chunk_rows: Rows converted and partitioned at a time
+            spill_dir: Where the spill files go (default the system temp dir)
+            samples: Ids kept per category in the report
+        """
+        self.partitions = partitions
+        self.chunk_rows = chunk_rows
+        self.samples = samples
+        self.rows = {side: 0 for side in SIDES}
+        self.unknown_currency_rows = {side: 0 for side in SIDES}
+        self._dir = tempfile.mkdtemp(prefix="reconcile-", dir=spill_dir)
+
+    def _path(self, side: str, partition: int) -> str:
+        return os.path.join(self._dir, f"{side}-{partition:04d}.bin")
+
+    def add_columns(self, side: str, rows: np.ndarray):
+        """Spill a ROW_DTYPE array into its side's partitions"""
+        if side not in SIDES:
+            raise ValueError(f"side must be one of {SIDES}")
+        partition = (rows["hi"] % self.partitions).astype(np.intp)
+        order = np.argsort(partition, kind="stable")
+        rows = rows[order]
+        bounds = np.searchsorted(partition[order], np.arange(self.partitions + 1))
+        for number in range(self.partitions):
+            start, end = bounds[number], bounds[number + 1]
+            if end > start:
+                with open(self._path(side, number), "ab") as spill:
+                    spill.write(rows[start:end].tobytes())
+        self.rows[side] += len(rows)
+        self.unknown_currency_rows[side] += int((rows["currency"] == 0).sum())
+
+    def add(self, side: str, rows: Iterable[Row]):
+        """Spill (transaction id, amount units, currency) rows in chunks"""
+        for chunk in chunks(rows, self.chunk_rows):
+            self.add_columns(side, chunk)
+
+    def add_circle(self, rows: Iterable[Row]):
+        self.add("circle", rows)
+
+    def add_ledger(self, rows: Iterable[Row]):
+        self.add("ledger", rows)
+
+    def add_journal(self, journal: "LedgerJournal"):
+        """Spill every row of a LedgerJournal on the ledger side"""
+        for chunk in journal.chunks(self.chunk_rows):
+            self.add_columns("ledger", chunk)
+
+    def _load(self, side: str, partition: int) -> np.ndarray:
+        path = self._path(side, partition)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=ROW_DTYPE)
+        return np.fromfile(path, dtype=ROW_DTYPE)
+
+    def run(self, mismatch_csv: Optional[str] = None) -> Dict:
+        """Join every partition pair and return the report
+
+        Amounts in the report are Money per currency. With mismatch_csv,
+        every row of the four mismatch categories is written there as
+        category, transaction_id, currency, circle_amount, ledger_amount.
+        """
+        report = {
+            "circle_rows": self.rows["circle"],
+            "ledger_rows": self.rows["ledger"],
+            "unknown_currency_circle_rows": self.unknown_currency_rows["circle"],
+            "unknown_currency_ledger_rows": self.unknown_currency_rows["ledger"],
+            "matched": 0,
+            "duplicate_circle_rows": 0,
+            "duplicate_ledger_rows": 0,
+            "mixed_currency_circle_ids": 0,
+            "mixed_currency_ledger_ids": 0,
+            "cancelled_ledger_ids": 0,
+            **{category: 0 for category in CATEGORIES},
+        }
+        # Currency code -> units, for amount drift and the amounts of missing rows
+        drift: Dict[int, int] = {}
+        missing_units = {"missing_in_ledger": {}, "missing_at_circle": {}}
+        max_drift: Dict[int, int] = {}
+        samples: Dict[str, List[str]] = {category: [] for category in CATEGORIES}
+        output = open(mismatch_csv, "w", newline="") if mismatch_csv else None
+        writer = csv.writer(output) if output else None
+        if writer:
+            writer.writerow(("category", "transaction_id", "currency", "circle_amount", "ledger_amount"))
+        try:
+            for partition in range(self.partitions):
+                circle, circle_merged, circle_mixed = _collapse(self._load("circle", partition))
+                ledger, ledger_merged, ledger_mixed = _collapse(self._load("ledger", partition))
+                report["duplicate_circle_rows"] += circle_merged
+                report["duplicate_ledger_rows"] += ledger_merged
+                report["mixed_currency_circle_ids"] += circle_mixed
+                report["mixed_currency_ledger_ids"] += ledger_mixed
+                # Entries reversed in full moved nothing, like the failed transfers left out at Circle
+                cancelled = ledger["units"] == 0
+                if cancelled.any():
+                    report["cancelled_ledger_ids"] += int(cancelled.sum())
+                    ledger = ledger[~cancelled]
+                if not len(circle) and not len(ledger):
+                    continue
+                # Two sorted runs, the Circle one first: a stable sort merges
+                # them and puts a key's Circle row before its ledger row
+                rows = np.concatenate([circle, ledger])
+                side = np.concatenate([np.zeros(len(circle), np.uint8), np.ones(len(ledger), np.uint8)])
+                order = _key_order(rows)
+                rows, side = rows[order], side[order]
+                # Keys are unique per side, so a key found on both is a pair
+                # of neighbours with the Circle row first
+                same = (rows["hi"][1:] == rows["hi"][:-1]) & (rows["lo"][1:] == rows["lo"][:-1])
+                first = np.flatnonzero(same)
+                paired = np.zeros(len(rows), dtype=bool)
+                paired[first] = paired[first + 1] = True
+                report["matched"] += len(first)
+
+                circle_units = rows["units"][first]
+                ledger_units = rows["units"][first + 1]
+                circle_currency = rows["currency"][first]
+                # Neither a mixed sum nor an unknown currency's units can be compared
+                other_currency = (circle_currency != rows["currency"][first + 1]) | \
+                    (circle_currency == MIXED_CURRENCY) | (circle_currency == 0)
+                wrong_amount = ~other_currency & (circle_units != ledger_units)
+                found = {
+                    "amount_mismatch": (first[wrong_amount], first[wrong_amount] + 1),
+                    "currency_mismatch": (first[other_currency], first[other_currency] + 1),
+                    "missing_in_ledger": (np.flatnonzero(~paired & (side == 0)), None),
+                    "missing_at_circle": (None, np.flatnonzero(~paired & (side == 1))),
+                }
+                for code in np.unique(circle_currency[wrong_amount]):
+                    in_currency = wrong_amount & (circle_currency == code)
+                    differences = circle_units[in_currency] - ledger_units[in_currency]
+                    drift[code] = drift.get(code, 0) + int(differences.sum())
+                    max_drift[code] = max(max_drift.get(code, 0), int(np.abs(differences).max()))
+                for category, (at_circle, in_ledger) in found.items():
+                    any_side = at_circle if at_circle is not None else in_ledger
+                    report[category] += len(any_side)
+                    if category in missing_units:
+                        totals = missing_units[category]
+                        for code in np.unique(rows["currency"][any_side]):
+                            in_currency = any_side[rows["currency"][any_side] == code]
+                            totals[code] = totals.get(code, 0) + int(rows["units"][in_currency].sum())
+                    room = self.samples - len(samples[category])
+                    for index in any_side[:max(room, 0)]:
+                        samples[category].append(key_to_id(rows["hi"][index], rows["lo"][index]))
+                    if writer:
+                        self._write(writer, category, rows, at_circle, in_ledger)
+        finally:
+            if output:
+                output.close()
+
+        def money(totals: Dict[int, int]) -> Dict[str, Money]:
+            return {currency_name(code): Money(units, currency_name(code)) for code, units in sorted(totals.items())
+                    if currency_name(code) in DECIMALS}
+
+        report["amount_drift"] = money(drift)  # Circle minus ledger
+        report["max_amount_drift"] = money(max_drift)
+        report["missing_in_ledger_amount"] = money(missing_units["missing_in_ledger"])
+        report["missing_at_circle_amount"] = money(missing_units["missing_at_circle"])
+        report["samples"] = samples
+        report["balanced"] = not any(report[category] for category in CATEGORIES)
+        return report
+
+    @staticmethod
+    def _write(writer, category: str, rows: np.ndarray, at_circle: Optional[np.ndarray],
+               in_ledger: Optional[np.ndarray]):
+        def amount(index) -> str:
+            if index is None:
+                return ""
+            currency = currency_name(rows["currency"][index])
+            units = int(rows["units"][index])
+            return str(Money(units, currency)) if currency in DECIMALS else str(units)
+
+        count = len(at_circle if at_circle is not None else in_ledger)
+        for n in range(count):
+            circle_index = at_circle[n] if at_circle is not None else None
+            ledger_index = in_ledger[n] if in_ledger is not None else None
+            index = circle_index if circle_index is not None else ledger_index
+            writer.writerow((category, key_to_id(rows["hi"][index], rows["lo"][index]),
+                             currency_name(rows["currency"][index]), amount(circle_index), amount(ledger_index)))
+
+    def close(self):
+        """Delete the spill files"""
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self) -> "Reconciler":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LedgerJournal:
+    """Append-only file of the Circle transactions applied to user
+    balances, in ROW_DTYPE rows
+
+    Rows are written once batch_size of them are pending, and a background
+    thread writes whatever is pending every commit_interval seconds, like
+    SQLiteLedger's commits. A torn row at the end of the file, from a crash
+    in the middle of a write, is cut off on opening.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10_000, commit_interval: float = 0.05):
+        """
+        Args:
+            path: Journal file, created if missing and appended to otherwise
+            batch_size: Pending rows that trigger a write
+            commit_interval: Maximum seconds a row may wait for its write
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._ids: List[str] = []
+        self._units: List[int] = []
+        self._currencies: List[str] = []
+        with open(path, "ab") as journal:
+            size = journal.tell()
+            if size % ROW_DTYPE.itemsize:
+                journal.truncate(size - size % ROW_DTYPE.itemsize)
+        self._file = open(path, "ab")
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name="journal-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.commit_interval):
+            self.flush()
+
+    def append(self, transaction_id: str, amount_units: int, currency: str = "USDC"):
+        """Record a transaction's balance change (negative to reverse it)"""
+        with self._lock:
+            self._ids.append(transaction_id)
+            self._units.append(amount_units)
+            self._currencies.append(currency)
+            if len(self._ids) >= self.batch_size:
+                self._write()
+
+    def _write(self):
+        """Write the pending rows (caller holds self._lock)"""
+        if self._ids:
+            self._file.write(to_columns(self._ids, self._units, self._currencies).tobytes())
+            self._file.flush()
+            self._ids, self._units, self._currencies = [], [], []
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def chunks(self, chunk_rows: int) -> Iterator[np.ndarray]:
+        """Every row written so far (pending ones included), chunk_rows at a time"""
+        self.flush()
+        remaining = os.path.getsize(self.path) // ROW_DTYPE.itemsize
+        with open(self.path, "rb") as journal:
+            while remaining:
+                chunk = np.fromfile(journal, dtype=ROW_DTYPE, count=min(chunk_rows, remaining))
+                if not len(chunk):
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def __len__(self) -> int:
+        with self._lock:
+            return os.path.getsize(self.path) // ROW_DTYPE.itemsize + len(self._ids)
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self._write()
+            self._file.close()
+
+
+def reconcile(circle: Iterable[Row], ledger: Iterable[Row], mismatch_csv: Optional[str] = None,
+              **kwargs) -> Dict:
+    """Reconcile two row streams in one call; kwargs go to Reconciler"""
+    with Reconciler(**kwargs) as reconciler:
+        reconciler.add_circle(circle)
+        reconciler.add_ledger(ledger)
+        return reconciler.run(mismatch_csv)
+
+
+# Sources
+
+def _pages(list_page, from_date: Optional[str], page_size: int) -> Iterator[Dict]:
+    """Every item of a newest-first Circle list, back to from_date"""
+    cursor = None
+    while True:
+        items = list_page(from_date=from_date, page_size=page_size, page_after=cursor).get("data", [])
+        if not items:
+            return
+        yield from items
+        # A short page does not mean the end: Circle caps pageSize at 50
+        cursor = items[-1]["id"]
+
+
+def circle_rows(circle_client, from_date: Optional[str] = None, page_size: int = 50) -> Iterator[Row]:
+    """Circle's transfers and FX settlements as rows
+
+    Failed transfers moved nothing and are left out. USD amounts (mints and
+    redemptions go 1:1 between USD and USDC) are counted in USDC units, like
+    the ledger does. An amount in a currency Money does not know (EUR, say)
+    cannot be read: its row comes with 0 units and ends up a mismatch under
+    the "?" currency instead of stopping the reconciliation.
+    """
+    for transfer in _pages(circle_client.list_transfers, from_date, page_size):
+        if transfer.get("status") == "failed":
+            continue
+        amount = transfer["amount"]
+        currency = "USDC" if amount["currency"] == "USD" else amount["currency"]
+        yield transfer["id"], _units(amount["amount"], currency), currency
+    for settlement in _pages(circle_client.list_fx_settlements, from_date, page_size):
+        yield settlement["id"], _units(settlement["amount"], settlement["currency"]), settlement["currency"]
+
+
+def _units(amount: str, currency: str) -> int:
+    """Units of a Circle amount, or 0 for a currency Money does not know"""
+    if currency not in DECIMALS:
+        return 0
+    return Money.parse(amount, currency).units
+
+
+def exchange_rows(exchange_results: Iterable[Dict]) -> Iterator[Row]:
+    """ExchangeEngine results as ledger rows, matched on their settlement's id"""
+    for result in exchange_results:
+        if result.get("success") and result.get("settlement_id"):
+            amount = result["from_amount"]
+            yield result["settlement_id"], amount.units, amount.currency
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Compact Records
+---------------------------------------
+
+__slots__ record classes for wallets and operation results.
+
+Records keep raw values (20-byte addresses, integer epoch microseconds,
+integer USDC micro-units) and only format them when read, so millions of
+wallets cost a fraction of the equivalent dicts. Records can still be read
+like the dicts they replace (record["wallet_address"]) and turned into one
+with to_dict().
+"""
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Union
+
+from money import Money
+
+ADDRESS_BYTES = 20
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Transaction statuses after which Circle sends no further changes
+FINAL_STATUSES = frozenset({"complete", "failed", "settled"})
+
+
+def now_us() -> int:
+    """Current time as integer epoch microseconds"""
+    return time.time_ns() // 1000
+
+
+def format_us(epoch_us: int) -> str:
+    """Render epoch microseconds as a local ISO 8601 timestamp"""
+    seconds, micros = divmod(epoch_us, 1_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=micros).isoformat()
+
+
+def parse_us(value: str) -> int:
+    """Parse an ISO 8601 timestamp (Circle's "2025-01-15T10:35:00.000Z") into epoch microseconds"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return (parsed - EPOCH) // timedelta(microseconds=1)
+
+
+def new_address() -> bytes:
+    """Random 20-byte blockchain address"""
+    return os.urandom(ADDRESS_BYTES)
+
+
+def address_bytes(address: Union[str, bytes]) -> bytes:
+    """Raw bytes of an address given as bytes or a 0x-prefixed hex string"""
+    if isinstance(address, bytes):
+        return address
+    return bytes.fromhex(address[2:] if address.startswith("0x") else address)
+
+
+def format_address(address: bytes) -> str:
+    return f"0x{address.hex()}"
+
+
+class Record:
+    """Base for slotted records readable like a dict"""
+
+    __slots__ = ()
+    KEYS = ()
+
+    def __getitem__(self, key: str):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return self[key] if key in self.KEYS else default
+
+    def keys(self):
+        return self.KEYS
+
+    def to_dict(self) -> Dict:
+        return {key: getattr(self, key) for key in self.KEYS}
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class WalletRecord(Record):
+    """A user's wallet: raw address, creation time and USDC balance in micro-units"""
+
+    __slots__ = ("address", "created_us", "balance_units")
+    KEYS = ("wallet_address", "created_at", "balance_usdc")
+
+    def __init__(self, address: bytes, created_us: int, balance_units: int = 0):
+        self.address = address
+        self.created_us = created_us
+        self.balance_units = balance_units
+
+    @property
+    def balance_usdc(self) -> Money:
+        return Money(self.balance_units, "USDC")
+
+    @property
+    def wallet_address(self) -> str:
+        return format_address(self.address)
+
+    @property
+    def created_at(self) -> str:
+        return format_us(self.created_us)
+
+
+class ConversionResult(Record):
+    """Result of a BRL <-> USDC conversion"""
+
+    __slots__ = ("user_id", "amount_brl", "amount_usdc", "transaction_id", "status", "created_us")
+    KEYS = ("user_id", "amount_brl", "amount_usdc", "transaction_id", "status", "timestamp")
+
+    def __init__(self, user_id: str, amount_brl: Money, amount_usdc: Money,
+                 transaction_id: Optional[str], status: str, created_us: Optional[int] = None):
+        self.user_id = user_id
+        self.amount_brl = amount_brl
+        self.amount_usdc = amount_usdc
+        self.transaction_id = transaction_id
+        self.status = status
+        self.created_us = created_us if created_us is not None else now_us()
+
+    @property
+    def timestamp(self) -> str:
+        return format_us(self.created_us)
+
+
+class PaymentResult(Record):
+    """Result of a USDC payment between two users"""
+
+    __slots__ = ("sender_id", "recipient_id", "amount_usdc", "transaction_id", "status", "created_us")
+    KEYS = ("sender_id", "recipient_id", "amount_usdc", "transaction_id", "status", "timestamp")
+
+    def __init__(self, sender_id: str, recipient_id: str, amount_usdc: Money,
+                 transaction_id: Optional[str], status: str, created_us: Optional[int] = None):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.amount_usdc = amount_usdc
+        self.transaction_id = transaction_id
+        self.status = status
+        self.created_us = created_us if created_us is not None else now_us()
+
+    @property
+    def timestamp(self) -> str:
+        return format_us(self.created_us)
+
+
+class TransactionRecord(Record):
+    """Last known state of a Circle transaction (transfer, mint, redeem, trade
+    or settlement), kept up to date by webhook notifications"""
+
+    __slots__ = ("kind", "user_id", "counterparty_id", "amount_units", "status", "updated_us")
+    KEYS = ("kind", "user_id", "counterparty_id", "amount_usdc", "status", "updated_at")
+
+    def __init__(self, kind: str, user_id: Optional[str], counterparty_id: Optional[str],
+                 amount_units: int, status: str, updated_us: Optional[int] = None):
+        self.kind = kind
+        self.user_id = user_id
+        self.counterparty_id = counterparty_id
+        self.amount_units = amount_units
+        self.status = status
+        self.updated_us = updated_us if updated_us is not None else now_us()
+
+    @property
+    def amount_usdc(self) -> Money:
+        return Money(self.amount_units, "USDC")
+
+    @property
+    def updated_at(self) -> str:
+        return format_us(self.updated_us)
+
+
+class HoldRecord(Record):
+    """Funds reserved on a user's balance until the operation they pay for
+    is committed or released (see holds.py)"""
+
+    __slots__ = ("hold_id", "user_id", "amount_units", "state", "created_us", "expires_us")
+    KEYS = ("hold_id", "user_id", "amount_usdc", "state", "created_at", "expires_at")
+
+    def __init__(self, hold_id: str, user_id: str, amount_units: int, created_us: int, expires_us: int,
+                 state: str = "held"):
+        self.hold_id = hold_id
+        self.user_id = user_id
+        self.amount_units = amount_units
+        self.state = state
+        self.created_us = created_us
+        self.expires_us = expires_us
+
+    @property
+    def amount_usdc(self) -> Money:
+        return Money(self.amount_units, "USDC")
+
+    @property
+    def created_at(self) -> str:
+        return format_us(self.created_us)
+
+    @property
+    def expires_at(self) -> str:
+        return format_us(self.expires_us)
+
+
+class NettingEntry(Record):
+    """A user's mint or redeem credited on the internal ledger and awaiting a
+    net Circle transfer (see netting.py)"""
+
+    __slots__ = ("entry_id", "user_id", "kind", "amount_units", "created_us", "batch_id")
+    KEYS = ("entry_id", "user_id", "kind", "amount_usdc", "created_at", "batch_id")
+
+    def __init__(self, entry_id: str, user_id: str, kind: str, amount_units: int, created_us: int,
+                 batch_id: Optional[str] = None):
+        self.entry_id = entry_id
+        self.user_id = user_id
+        self.kind = kind
+        self.amount_units = amount_units
+        self.created_us = created_us
+        self.batch_id = batch_id
+
+    @property
+    def amount_usdc(self) -> Money:
+        return Money(self.amount_units, "USDC")
+
+    @property
+    def created_at(self) -> str:
+        return format_us(self.created_us)
+
+
+class NetSettlement(Record):
+    """One net Circle transfer covering a batch of netting entries"""
+
+    __slots__ = ("batch_id", "entry_count", "minted_units", "redeemed_units", "transfer_id", "status",
+                 "created_us")
+    KEYS = ("batch_id", "entries", "minted_usdc", "redeemed_usdc", "net_usdc", "transfer_id", "status",
+            "created_at")
+
+    def __init__(self, batch_id: str, entry_count: int, minted_units: int, redeemed_units: int,
+                 transfer_id: Optional[str], status: str, created_us: Optional[int] = None):
+        self.batch_id = batch_id
+        self.entry_count = entry_count
+        self.minted_units = minted_units
+        self.redeemed_units = redeemed_units
+        self.transfer_id = transfer_id
+        self.status = status
+        self.created_us = created_us if created_us is not None else now_us()
+
+    @property
+    def net_units(self) -> int:
+        """Positive: minted to the omnibus wallet; negative: redeemed from it"""
+        return self.minted_units - self.redeemed_units
+
+    @property
+    def entries(self) -> int:
+        return self.entry_count
+
+    @property
+    def minted_usdc(self) -> Money:
+        return Money(self.minted_units, "USDC")
+
+    @property
+    def redeemed_usdc(self) -> Money:
+        return Money(self.redeemed_units, "USDC")
+
+    @property
+    def net_usdc(self) -> Money:
+        return Money(self.net_units, "USDC")
+
+    @property
+    def created_at(self) -> str:
+        return format_us(self.created_us)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Circuit Breakers and Hedged Requests
+------------------------------------------------------------
+
+Keeps a slow or failing Circle from stalling every thread that calls it.
+
+1. CircuitBreakers keeps one breaker per endpoint. After failure_threshold
+   consecutive failures (timeouts, connection errors, 5xx) the endpoint's
+   circuit opens and calls fail at once with CircuitOpenError instead of
+   waiting on Circle; after reset_timeout one trial call is let through,
+   and its outcome closes the circuit or opens it again
+2. Hedger sends a second copy of an idempotent read when the first has not
+   answered within the endpoint's recent p95 latency, and returns whichever
+   answers first, so one slow connection does not set the tail latency
+
+Both are shared by every CircleClient given them, like the RateLimiter.
+
+Usage:
+    client = CircleClient(API_KEY, BASE_URL, timeout=(3.05, 10),
+                          breakers=CircuitBreakers(), hedger=Hedger())
+"""
+
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+
+from latency_histogram import LatencyHistogram
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an endpoint whose circuit is open
+
+    A RequestException, so callers that already treat Circle being
+    unreachable as a transient failure handle it the same way.
+    """
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Circuit open for {endpoint}; retry in {retry_in:.1f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Closed, open or half-open state of one endpoint"""
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0  # Consecutive
+        self.opened_at = 0.0
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now"""
+        with self._lock:
+            if self.state == "open":
+                retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.endpoint, retry_in)
+                self.state = "half-open"
+            if self.state == "half-open":
+                # A single trial call at a time; the others keep failing fast
+                if self._trial_running:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.endpoint, 0.0)
+                self._trial_running = True
+            self.stats["calls"] += 1
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self.state = "closed"
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.stats["failures"] += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class CircuitBreakers:
+    """One CircuitBreaker per endpoint, created on first use"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        """
+        Args:
+            failure_threshold: Consecutive failures that open an endpoint's circuit
+            reset_timeout: Seconds an open circuit fails fast before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint: str) -> CircuitBreaker:
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    endpoint, CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout))
+        return breaker
+
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return {endpoint: breaker.state for endpoint, breaker in self._breakers.items()}
+
+
+class _RecentLatency:
+    """Latencies of the last few thousand calls: two histograms, the older
+    one dropped each time the newer one fills up"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.current = LatencyHistogram()
+        self.previous = LatencyHistogram()
+
+    def record(self, seconds: float):
+        if self.current.count >= self.size:
+            self.previous, self.current = self.current, LatencyHistogram()
+        self.current.record(seconds * 1_000_000)
+
+    def percentile(self, pct: float) -> Tuple[int, float]:
+        """(samples, latency in seconds)"""
+        merged = LatencyHistogram().merge(self.previous).merge(self.current)
+        return merged.count, merged.percentile(pct) / 1_000_000
+
+
+class Hedger:
+    """Sends a second copy of slow idempotent requests"""
+
+    def __init__(self, percentile: float = 95.0, min_delay: float = 0.005, initial_delay: float = 0.1,
+                 min_samples: int = 50, window: int = 2000, max_workers: int = 64):
+        """
+        Args:
+            percentile: Recent latency percentile after which the copy is sent
+            min_delay: Lower bound on that delay, so fast endpoints are not doubled
+            initial_delay: Delay until an endpoint has min_samples latencies
+            window: Latencies per endpoint the percentile is taken over (about)
+            max_workers: Threads running hedged requests
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.stats = {"calls": 0, "hedged": 0, "hedge_won": 0}
+        self._latency: Dict[str, _RecentLatency] = {}
+        self._delays: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+    def delay(self, endpoint: str) -> float:
+        """Seconds to wait for the first copy before sending the second"""
+        return self._delays.get(endpoint, self.initial_delay)
+
+    def _timed(self, endpoint: str, call: Callable):
+        start = time.perf_counter()
+        result = call()
+        with self._lock:
+            latency = self._latency.get(endpoint)
+            if latency is None:
+                latency = self._latency[endpoint] = _RecentLatency(self.window // 2)
+            latency.record(time.perf_counter() - start)
+            # Recomputing the percentile every call would cost more than it saves
+            if latency.current.count % 64 == 0:
+                samples, value = latency.percentile(self.percentile)
+                if samples >= self.min_samples:
+                    self._delays[endpoint] = max(self.min_delay, value)
+        return result
+
+    def call(self, endpoint: str, call: Callable):
+        """Run call(), and a second call() if the first is slower than the
+        endpoint's delay; returns the first result and raises only if both fail"""
+        with self._lock:
+            self.stats["calls"] += 1
+        first = self._executor.submit(self._timed, endpoint, call)
+        done, _ = wait([first], timeout=self.delay(endpoint))
+        if done:
+            return first.result()
+
+        with self._lock:
+            self.stats["hedged"] += 1
+        second = self._executor.submit(self._timed, endpoint, call)
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self.stats["hedge_won"] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def close(self):
+        self._executor.shutdown(wait=False)
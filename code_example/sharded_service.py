@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Sharded Service
+---------------------------------------
+
+Runs PicPayUSDCService in N worker processes so throughput is not capped by
+one interpreter's GIL.
+
+1. Each user belongs to shard crc32(user_id) % N (user_locks.shard_of), and
+   only that shard's process holds the user's wallet
+2. ShardRouter sends each call to the owning shard over a Unix socket;
+   calls are grouped into one message per shard, and any number of routers
+   (threads or processes) can connect to the same shards
+3. A payment between two shards takes two steps:
+     prepare: the sender's shard places a hold on the amount (holds.py)
+     credit:  the recipient's shard credits it, once per transfer id
+   followed by a commit (or a release if the credit failed) on the sender's
+   shard. A payment whose commit or release fails is reported as a
+   SettlementError.
+4. Prepared holds do not expire on their own. If the router dies before
+   settling one, the sender's shard resolves it once the hold's ttl is
+   over: it asks the recipient's shard whether the transfer was credited
+   and commits the hold if it was. Otherwise the recipient's shard marks
+   the transfer aborted, refusing a credit that arrives later, and the hold
+   is released. Outcomes are remembered for `retention` seconds, which
+   must stay well above the hold ttl
+
+Usage:
+    with ShardedService(API_KEY, BASE_URL, shards=8) as cluster:
+        cluster.router.convert_brl_to_usdc("user-1", 500)
+        cluster.router.send_international_payment("user-1", "user-2", 10)
+        # In other processes:
+        router = ShardRouter(cluster.addresses, cluster.authkey)
+"""
+
+import os
+import time
+import pickle
+import shutil
+import tempfile
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from money import Money
+from records import HoldRecord, PaymentResult, now_us
+from user_locks import shard_of
+
+# Calls that wait on Circle; the calls of a batch of these run concurrently
+CIRCLE_OPERATIONS = frozenset({"convert_brl_to_usdc", "convert_usdc_to_brl"})
+
+
+class SettlementError(Exception):
+    """The last step of a cross-shard payment (commit or release of the
+    sender's hold) failed; the message says what state it was left in"""
+
+
+def _picklable(error: BaseException) -> BaseException:
+    """The error itself if it can be sent to another process, else a RuntimeError describing it"""
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+class _Shard:
+    """The operations a worker process runs on its slice of users"""
+
+    def __init__(self, index: int, shards: int, service, retention: float = 3600.0):
+        self.index = index
+        self.shards = shards
+        self.service = service
+        self.retention_us = int(retention * 1_000_000)  # How long transfer outcomes are remembered
+        # hold_id -> (HoldRecord, recipient_id) of prepared cross-shard payments,
+        # in expiry order (all use the service's ttl)
+        self._pending: "OrderedDict[str, Tuple[HoldRecord, str]]" = OrderedDict()
+        # Recipient side: transfer id -> (when, credited); False means aborted by recovery
+        self._credits: "OrderedDict[str, Tuple[int, bool]]" = OrderedDict()
+        # Sender side: hold id -> (when, committed) of the holds recovery settled
+        self._resolved: "OrderedDict[str, Tuple[int, bool]]" = OrderedDict()
+        self._mutex = threading.Lock()
+        self._operations = {
+            "create_user_wallet": lambda user_id: service.create_user_wallet(user_id).wallet_address,
+            "convert_brl_to_usdc": service.convert_brl_to_usdc,
+            "convert_usdc_to_brl": service.convert_usdc_to_brl,
+            "get_user_balance": service.get_user_balance,
+            "send_international_payment": service.send_international_payment,
+            "prepare_payment": self.prepare_payment,
+            "credit_payment": self.credit_payment,
+            "commit_payment": self.commit_payment,
+            "release_payment": self.release_payment,
+            "resolve_payment": self.resolve_payment,
+        }
+
+    def execute(self, method: str, args: Tuple) -> Tuple[bool, object]:
+        try:
+            if shard_of(args[0], self.shards) != self.index:
+                raise ValueError(f"User {args[0]} does not belong to shard {self.index}")
+            return True, self._operations[method](*args)
+        except Exception as error:
+            return False, _picklable(error)
+
+    def prepare_payment(self, sender_id: str, amount_units: int, recipient_id: str) -> str:
+        """Step 1: hold the amount on the sender; returns the hold id"""
+        hold = self.service.holds.place(sender_id, amount_units, sweep=False)
+        with self._mutex:
+            self._pending[hold.hold_id] = (hold, recipient_id)
+        return hold.hold_id
+
+    def credit_payment(self, recipient_id: str, amount_units: int, transfer_id: str):
+        """Step 2: credit the recipient, at most once per transfer id; raises
+        ValueError if recovery already aborted the transfer"""
+        service = self.service
+        address = service._address_if_missing(recipient_id)
+        with service.locks.hold(recipient_id):
+            with self._mutex:
+                known = self._credits.get(transfer_id)
+            if known is not None:
+                if known[1]:
+                    return
+                raise ValueError(f"Payment {transfer_id} was aborted by the sender's shard")
+            service._get_or_create_wallet(recipient_id, address)
+            service.ledger.adjust_balance(recipient_id, amount_units)
+            with self._mutex:
+                self._remember(self._credits, transfer_id, True)
+
+    def commit_payment(self, sender_id: str, hold_id: str) -> bool:
+        with self._mutex:
+            pending = self._pending.pop(hold_id, None)
+            if pending is None:
+                resolved = self._resolved.get(hold_id)
+                return resolved is not None and resolved[1]
+        return self.service.holds.commit(pending[0])
+
+    def release_payment(self, sender_id: str, hold_id: str) -> bool:
+        with self._mutex:
+            pending = self._pending.pop(hold_id, None)
+        return pending is not None and self.service.holds.release(pending[0])
+
+    def resolve_payment(self, recipient_id: str, transfer_id: str) -> bool:
+        """Recovery, on the recipient's shard: whether the transfer was
+        credited; one that was not is aborted, so its credit cannot land later"""
+        # The recipient's lock orders this against a credit_payment in progress
+        with self.service.locks.hold(recipient_id):
+            with self._mutex:
+                known = self._credits.get(transfer_id)
+                if known is None:
+                    self._remember(self._credits, transfer_id, False)
+                    return False
+                return known[1]
+
+    def _remember(self, outcomes: "OrderedDict[str, Tuple[int, bool]]", key: str, outcome: bool):
+        """Record an outcome and drop the ones older than retention (caller holds self._mutex)"""
+        now = now_us()
+        outcomes[key] = (now, outcome)
+        cutoff = now - self.retention_us
+        while next(iter(outcomes.values()))[0] < cutoff:
+            outcomes.popitem(last=False)
+
+    def resolve_expired(self, peers: "ShardRouter") -> int:
+        """Settle the prepared holds whose router did not within their ttl,
+        asking the recipients' shards through peers; returns how many were
+        settled
+
+        Recipients that cannot be reached are asked again on the next call.
+        """
+        now = now_us()
+        with self._mutex:
+            due = []
+            for hold_id, (hold, recipient_id) in self._pending.items():
+                if hold.expires_us > now:
+                    break
+                due.append((hold_id, hold, recipient_id))
+        if not due:
+            return 0
+        credited = peers.map("resolve_payment", [(recipient_id, hold_id) for hold_id, _, recipient_id in due])
+        settled = 0
+        for (hold_id, hold, _), outcome in zip(due, credited):
+            if isinstance(outcome, Exception):
+                continue
+            with self._mutex:
+                if self._pending.pop(hold_id, None) is None:
+                    continue  # The router settled it meanwhile
+                self._remember(self._resolved, hold_id, outcome)
+            if outcome:
+                self.service.holds.commit(hold)
+            else:
+                self.service.holds.release(hold)
+            settled += 1
+        return settled
+
+    def start_recovery(self, addresses: Sequence[str], authkey: bytes, interval: float):
+        """Run resolve_expired every interval seconds in a background thread"""
+        def run():
+            peers = None
+            while True:
+                time.sleep(interval)
+                try:
+                    if peers is None:
+                        peers = ShardRouter(addresses, authkey)
+                    self.resolve_expired(peers)
+                except OSError:
+                    peers = None  # A shard went away; reconnect next round
+                except Exception:
+                    pass  # The holds stay pending; try again next round
+
+        threading.Thread(target=run, name=f"shard-{self.index}-recovery", daemon=True).start()
+
+    def serve(self, conn, executor: ThreadPoolExecutor):
+        """Answer one router's batches until it disconnects"""
+        send_lock = threading.Lock()
+
+        def reply(batch_id: int, results):
+            with send_lock:
+                conn.send((batch_id, results))
+
+        def run(batch_id: int, calls):
+            reply(batch_id, [self.execute(method, args) for method, args in calls])
+
+        def run_concurrently(batch_id: int, calls):
+            results = [None] * len(calls)
+            remaining = [len(calls)]
+            lock = threading.Lock()
+
+            def run_one(position: int, method: str, args: Tuple):
+                results[position] = self.execute(method, args)
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]:
+                        return
+                reply(batch_id, results)
+
+            for position, (method, args) in enumerate(calls):
+                executor.submit(run_one, position, method, args)
+
+        while True:
+            try:
+                batch_id, calls = conn.recv()
+            except (EOFError, OSError):
+                return
+            if len(calls) > 1 and any(method in CIRCLE_OPERATIONS for method, _ in calls):
+                run_concurrently(batch_id, calls)
+            else:
+                executor.submit(run, batch_id, calls)
+
+
+def _serve_shard(index: int, shards: int, addresses: Sequence[str], authkey: bytes, api_key: str,
+                 base_url: str, service_options: Dict, threads: int, ready):
+    # Imported here so that only the workers load the HTTP client
+    from demo_code_example_en import CircleClient, PicPayUSDCService
+
+    service = PicPayUSDCService(CircleClient(api_key, base_url), **service_options)
+    shard = _Shard(index, shards, service)
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"shard-{index}")
+    listener = Listener(addresses[index], family="AF_UNIX", authkey=authkey)
+    shard.start_recovery(addresses, authkey, service.holds.sweep_interval)
+    ready.send(index)
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=shard.serve, args=(conn, executor), daemon=True).start()
+
+
+class ShardRouter:
+    """Front end that routes PicPayUSDCService calls to the owning shard"""
+
+    def __init__(self, addresses: Sequence[str], authkey: bytes):
+        self.shards = len(addresses)
+        self._conns = [Client(address, family="AF_UNIX", authkey=authkey) for address in addresses]
+        self._send_locks = [threading.Lock() for _ in addresses]
+        self._futures: Dict[int, Future] = {}
+        self._batch_ids = itertools.count()
+        self._mutex = threading.Lock()
+        self._readers = [threading.Thread(target=self._read, args=(conn,), daemon=True) for conn in self._conns]
+        for reader in self._readers:
+            reader.start()
+
+    def _read(self, conn):
+        while True:
+            try:
+                batch_id, results = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._mutex:
+                future = self._futures.pop(batch_id)
+            future.set_result(results)
+        with self._mutex:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(ConnectionError("shard connection closed"))
+
+    def _send(self, shard: int, calls: List[Tuple[str, Tuple]]) -> Future:
+        future = Future()
+        with self._mutex:
+            batch_id = next(self._batch_ids)
+            self._futures[batch_id] = future
+        with self._send_locks[shard]:
+            self._conns[shard].send((batch_id, calls))
+        return future
+
+    def map(self, method: str, calls: Sequence[Tuple]) -> List:
+        """Run method once per argument tuple (whose first item is the user_id
+        that picks the shard), with one message per shard; returns results in
+        order, with an exception in place of every call that raised"""
+        by_shard: Dict[int, List[int]] = {}
+        for position, args in enumerate(calls):
+            by_shard.setdefault(shard_of(args[0], self.shards), []).append(position)
+        futures = [(positions, self._send(shard, [(method, calls[position]) for position in positions]))
+                   for shard, positions in by_shard.items()]
+        results = [None] * len(calls)
+        for positions, future in futures:
+            for position, (ok, value) in zip(positions, future.result()):
+                results[position] = value
+        return results
+
+    def call(self, method: str, user_id: str, *args):
+        """Run one method on the user's shard and return its result"""
+        ok, value = self._send(shard_of(user_id, self.shards), [(method, (user_id,) + args)]).result()[0]
+        if not ok:
+            raise value
+        return value
+
+    def create_user_wallet(self, user_id: str) -> str:
+        """Create the user's wallet on its shard; returns the wallet address"""
+        return self.call("create_user_wallet", user_id)
+
+    def convert_brl_to_usdc(self, user_id: str, amount_brl: Union[Money, float, str],
+                            operation_id: Optional[str] = None):
+        return self.call("convert_brl_to_usdc", user_id, amount_brl, operation_id)
+
+    def convert_usdc_to_brl(self, user_id: str, amount_usdc: Union[Money, float, str],
+                            operation_id: Optional[str] = None):
+        return self.call("convert_usdc_to_brl", user_id, amount_usdc, operation_id)
+
+    def get_user_balance(self, user_id: str) -> Dict:
+        return self.call("get_user_balance", user_id)
+
+    def send_international_payment(self, sender_id: str, recipient_id: str,
+                                   amount_usdc: Union[Money, float, str]) -> PaymentResult:
+        result = self.send_international_payments([(sender_id, recipient_id, amount_usdc)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def send_international_payments(self, payments: Iterable[Tuple[str, str, Union[Money, float, str]]]) -> List:
+        """Send a batch of payments; returns a PaymentResult or an exception per payment, in order
+
+        Payments within one shard are sent to it as they are; the others go
+        through prepare / credit / commit, each step batched per shard.
+        """
+        payments = [(sender_id, recipient_id, Money.parse_positive(amount, "USDC"))
+                    for sender_id, recipient_id, amount in payments]
+        results: List = [None] * len(payments)
+        local, remote = [], []
+        for position, (sender_id, recipient_id, _) in enumerate(payments):
+            same = shard_of(sender_id, self.shards) == shard_of(recipient_id, self.shards)
+            (local if same else remote).append(position)
+
+        for position, result in zip(local, self.map("send_international_payment",
+                                                    [payments[position] for position in local])):
+            results[position] = result
+
+        holds = self.map("prepare_payment", [(payments[position][0], payments[position][2].units,
+                                              payments[position][1]) for position in remote])
+        prepared = []
+        for position, hold_id in zip(remote, holds):
+            if isinstance(hold_id, Exception):
+                results[position] = hold_id
+            else:
+                prepared.append((position, hold_id))
+
+        credits = self.map("credit_payment", [(payments[position][1], payments[position][2].units, hold_id)
+                                              for position, hold_id in prepared])
+        commits, releases = [], []
+        for (position, hold_id), credit in zip(prepared, credits):
+            sender_id, recipient_id, amount_usdc = payments[position]
+            if isinstance(credit, ConnectionError):
+                # The credit may have landed; the sender's shard settles the hold once it expires
+                results[position] = SettlementError(
+                    f"Payment {hold_id} to {recipient_id} has an unknown outcome ({credit}); the hold on "
+                    f"{sender_id} is committed or released when it expires")
+            elif isinstance(credit, Exception):
+                results[position] = credit
+                releases.append((position, hold_id))
+            else:
+                results[position] = PaymentResult(sender_id, recipient_id, amount_usdc, hold_id, "completed")
+                commits.append((position, hold_id))
+
+        committed = self.map("commit_payment", [(payments[position][0], hold_id) for position, hold_id in commits])
+        for (position, hold_id), done in zip(commits, committed):
+            if done is not True:
+                sender_id, recipient_id, _ = payments[position]
+                reason = done if isinstance(done, Exception) else "the hold was no longer pending"
+                results[position] = SettlementError(
+                    f"Payment {hold_id} credited {recipient_id} but the hold on {sender_id} was not "
+                    f"committed: {reason}")
+        released = self.map("release_payment", [(payments[position][0], hold_id) for position, hold_id in releases])
+        for (position, hold_id), done in zip(releases, released):
+            # False means recovery already settled the hold (a credit it aborted gave the amount back)
+            if isinstance(done, Exception):
+                results[position] = SettlementError(
+                    f"Payment {hold_id} failed ({results[position]}) and the hold on {payments[position][0]} "
+                    f"was not released: {done}; recovery releases it once it expires")
+        return results
+
+    def close(self):
+        """Disconnect from the shards (their state is kept)"""
+        for conn in self._conns:
+            conn.close()
+
+
+class ShardedService:
+    """N worker processes, each running PicPayUSDCService for its users"""
+
+    def __init__(self, api_key: str, base_url: str, shards: int = 4, threads: int = 32,
+                 service_options: Optional[Dict] = None):
+        """
+        Args:
+            api_key: Circle API key used by every shard
+            base_url: Circle API base URL
+            shards: Worker processes (one per core is a good start)
+            threads: Threads per worker running calls (most of them wait on Circle)
+            service_options: Extra PicPayUSDCService arguments, e.g. {"hold_ttl": 60}
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.shards = shards
+        self.threads = threads
+        self.service_options = service_options or {}
+        self.authkey = os.urandom(16)
+        self.addresses: List[str] = []
+        self.router: Optional[ShardRouter] = None
+        self._directory: Optional[str] = None
+        self._processes: List[multiprocessing.Process] = []
+
+    def start(self) -> "ShardedService":
+        """Start the worker processes and connect self.router"""
+        self._directory = tempfile.mkdtemp(prefix="picpay-shards-")
+        self.addresses = [os.path.join(self._directory, f"shard-{index}.sock") for index in range(self.shards)]
+        ready_recv, ready_send = multiprocessing.Pipe(duplex=False)
+        for index, address in enumerate(self.addresses):
+            process = multiprocessing.Process(
+                target=_serve_shard, name=f"picpay-shard-{index}", daemon=True,
+                args=(index, self.shards, self.addresses, self.authkey, self.api_key, self.base_url,
+                      self.service_options, self.threads, ready_send))
+            process.start()
+            self._processes.append(process)
+        for _ in self._processes:
+            ready_recv.recv()
+        self.router = ShardRouter(self.addresses, self.authkey)
+        return self
+
+    def stop(self):
+        """Disconnect the router and stop the workers (their state is lost)"""
+        if self.router is not None:
+            self.router.close()
+            self.router = None
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        self._processes = []
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def __enter__(self) -> "ShardedService":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
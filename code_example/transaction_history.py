@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Streaming Transaction History
+-----------------------------------------------------
+
+Walks a wallet's full transaction history without the caller handling
+pagination, for exports that cover millions of records.
+
+1. Pages are followed through Circle's pageAfter cursor (the id of the last,
+   oldest, item of the previous page)
+2. A background worker fetches up to `prefetch` pages ahead while the caller
+   consumes the current one
+3. A from/to range can be split into time windows that are walked in
+   parallel, each with its own cursor chain
+4. At most windows * prefetch pages are buffered, so memory stays constant
+   however long the history is
+
+Records are yielded newest first. Since a window's pages come from a chain
+of cursors, an ordered walk can only run `prefetch` pages ahead of the
+consumer in each window; with ordered=False records from different windows
+are yielded as soon as they arrive instead, which keeps every window busy
+all the time.
+
+Usage:
+    for transfer in iter_transaction_history(circle_client, wallet_id,
+                                             from_date="2025-07-01T00:00:00Z",
+                                             to_date="2025-07-31T23:59:59Z",
+                                             windows=8):
+        writer.writerow(transfer)
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Marks the end of a window's pages in its queue
+_DONE = object()
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp as used by Circle ("2025-07-01T00:00:00.000Z")"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def split_windows(from_date: str, to_date: str, windows: int) -> List[Tuple[str, str]]:
+    """Split an inclusive from/to range into non-overlapping windows, newest first
+
+    Circle treats both bounds as inclusive, so each window ends one
+    millisecond before the next one starts.
+    """
+    start, end = parse_timestamp(from_date), parse_timestamp(to_date)
+    if end < start:
+        raise ValueError("to_date is before from_date")
+    total_ms = (end - start) // timedelta(milliseconds=1) + 1
+    windows = max(1, min(windows, total_ms))
+    bounds = [start + timedelta(milliseconds=total_ms * i // windows) for i in range(windows + 1)]
+    return [(format_timestamp(bounds[i]), format_timestamp(bounds[i + 1] - timedelta(milliseconds=1)))
+            for i in reversed(range(windows))]
+
+
+def iter_pages(circle_client, wallet_id: str,
+               from_date: Optional[str] = None,
+               to_date: Optional[str] = None,
+               page_size: int = 50) -> Iterator[List[Dict]]:
+    """Yield the pages of a wallet's history one request at a time"""
+    page_after = None
+    while True:
+        response = circle_client.get_transaction_history(wallet_id, from_date, to_date, page_size,
+                                                         page_after=page_after)
+        page = response.get("data", [])
+        if not page:
+            return
+        yield page
+        # A short page does not mean the end: Circle caps pageSize at 50
+        page_after = page[-1]["id"]
+
+
+def iter_transaction_history(circle_client, wallet_id: str,
+                             from_date: Optional[str] = None,
+                             to_date: Optional[str] = None,
+                             page_size: int = 50,
+                             prefetch: int = 4,
+                             windows: int = 1,
+                             ordered: bool = True) -> Iterator[Dict]:
+    """Yield every transaction of a wallet, fetching pages in the background
+
+    Args:
+        circle_client: CircleClient (or anything with get_transaction_history)
+        wallet_id: Wallet whose history is walked
+        from_date: Oldest createDate included (ISO 8601)
+        to_date: Newest createDate included (ISO 8601, defaults to now when windows > 1)
+        page_size: Records per request
+        prefetch: Pages fetched ahead of the consumer, per window
+        windows: Time windows walked in parallel (needs from_date)
+        ordered: Yield newest first across windows; False yields as pages arrive
+    """
+    if windows > 1:
+        if from_date is None:
+            raise ValueError("from_date is required to split the history into windows")
+        ranges = split_windows(from_date, to_date or format_timestamp(datetime.now(timezone.utc)), windows)
+    else:
+        ranges = [(from_date, to_date)]
+
+    stop = threading.Event()
+    # Ordered output needs a queue per window; unordered output shares one
+    queues = [queue.Queue(maxsize=max(1, prefetch)) for _ in ranges] if ordered else \
+        [queue.Queue(maxsize=max(1, prefetch) * len(ranges))]
+
+    def put(q: queue.Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(q: queue.Queue, window_from: Optional[str], window_to: Optional[str]):
+        try:
+            for page in iter_pages(circle_client, wallet_id, window_from, window_to, page_size):
+                if not put(q, page):
+                    return
+        except Exception as error:
+            put(q, error)
+            return
+        put(q, _DONE)
+
+    executor = ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="history")
+    try:
+        for i, (window_from, window_to) in enumerate(ranges):
+            executor.submit(produce, queues[i if ordered else 0], window_from, window_to)
+
+        remaining = len(ranges)
+        current = 0
+        while remaining:
+            item = queues[current].get()
+            if item is _DONE:
+                remaining -= 1
+                if ordered:
+                    current += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+    finally:
+        # Also runs when the caller stops iterating early
+        stop.set()
+        executor.shutdown(wait=True)
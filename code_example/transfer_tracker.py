@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Transfer Status Tracker
+-----------------------------------------------
+
+Polls Circle for the final status of pending transfers where webhooks
+(webhook_receiver.py) are not available, with one poll schedule per
+transfer instead of one per caller.
+
+1. Pending transfers sit in a priority queue ordered by their next poll
+2. Poll intervals adapt to each transfer: they close in on the usual
+   finality time of its chain, then back off in proportion to its age
+3. Every caller waiting on the same transfer_id shares one Future
+4. When many transfers are due together and paging through
+   GET /v1/transfers?from= costs fewer requests than one GET per transfer,
+   the tracker sweeps the list instead
+5. Final statuses can be forwarded (in batches) to a listener such as
+   PicPayUSDCService.apply_status_updates
+
+metrics() reports requests per confirmed transfer and detection latency
+(from the transfer's updateDate to the moment the tracker saw it).
+
+Usage:
+    tracker = TransferTracker(circle_client, listener=service.apply_status_updates).start()
+    transfer = tracker.wait(transfer_id, chain="ETH", timeout=300)
+"""
+
+import math
+import time
+import heapq
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from records import FINAL_STATUSES, parse_us
+from webhook_receiver import StatusUpdate
+
+# Typical seconds until a transfer on each chain is final
+CHAIN_FINALITY = {
+    "ETH": 60.0,
+    "MATIC": 10.0,
+    "AVAX": 3.0,
+    "SOL": 2.0,
+    "ALGO": 5.0,
+    "XLM": 6.0,
+}
+
+
+def _percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class _Tracked:
+    """A pending transfer and everything needed to schedule its next poll"""
+
+    __slots__ = ("transfer_id", "chain", "created_at", "future", "polls")
+
+    def __init__(self, transfer_id: str, chain: Optional[str], created_at: float):
+        self.transfer_id = transfer_id
+        self.chain = chain
+        self.created_at = created_at  # Epoch seconds
+        self.future: Future = Future()
+        self.polls = 0
+
+
+class TransferTracker:
+    """Shared, adaptive poller of transfer statuses"""
+
+    def __init__(self,
+                 circle_client,
+                 min_interval: float = 0.25,
+                 max_interval: float = 30.0,
+                 age_factor: float = 0.1,
+                 default_finality: float = 5.0,
+                 chain_finality: Optional[Dict[str, float]] = None,
+                 sweep: bool = True,
+                 sweep_page_size: int = 50,
+                 coalesce_window: float = 0.05,
+                 max_workers: int = 16,
+                 listener: Optional[Callable[[List[StatusUpdate]], object]] = None):
+        """
+        Args:
+            circle_client: CircleClient used for get_transfer_status / list_transfers
+            min_interval: Shortest pause between two polls of a transfer
+            max_interval: Longest pause between two polls of a transfer
+            age_factor: Once past finality, poll every age * age_factor seconds
+            default_finality: Expected seconds to finality for unknown chains
+            chain_finality: Overrides of CHAIN_FINALITY
+            sweep: Allow GET /v1/transfers sweeps when they are cheaper
+            sweep_page_size: pageSize of sweep requests (Circle allows up to 50)
+            coalesce_window: Polls due within this many seconds are handled together
+            max_workers: Concurrent requests to Circle
+            listener: Called with the StatusUpdates of newly final transfers
+        """
+        self.circle_client = circle_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.age_factor = age_factor
+        self.default_finality = default_finality
+        self.chain_finality = dict(CHAIN_FINALITY, **(chain_finality or {}))
+        self.sweep = sweep
+        self.sweep_page_size = sweep_page_size
+        self.coalesce_window = coalesce_window
+        self.listener = listener
+        self.stats = {"tracked": 0, "confirmed": 0, "get_requests": 0, "sweep_requests": 0,
+                      "sweeps": 0, "errors": 0}
+
+        self._tracked: Dict[str, _Tracked] = {}
+        self._heap: List[Tuple[float, int, str]] = []  # (monotonic due time, sequence, transfer_id)
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._latencies = deque(maxlen=100_000)
+        self._sweep_density: Optional[float] = None  # Account transfers per second, learned from sweeps
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transfer-poll")
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+
+    # Callers
+
+    def track(self, transfer_id: str, chain: Optional[str] = None,
+              created_date: Optional[str] = None) -> Future:
+        """Start tracking a transfer (or join its existing schedule); the Future
+        resolves with the transfer once its status is final"""
+        with self._cond:
+            tracked = self._tracked.get(transfer_id)
+            if tracked is None:
+                created_at = parse_us(created_date) / 1e6 if created_date else time.time()
+                tracked = _Tracked(transfer_id, chain, created_at)
+                self._tracked[transfer_id] = tracked
+                self.stats["tracked"] += 1
+                self._schedule(tracked)
+            return tracked.future
+
+    def track_transfer(self, transfer: Dict) -> Future:
+        """track() a transfer as returned by create_transfer"""
+        transfer = transfer.get("data", transfer)
+        chain = (transfer.get("destination") or {}).get("chain")
+        return self.track(transfer["id"], chain, transfer.get("createDate"))
+
+    def wait(self, transfer_id: str, chain: Optional[str] = None, timeout: Optional[float] = None) -> Dict:
+        """Block until a transfer is final and return it"""
+        return self.track(transfer_id, chain).result(timeout)
+
+    def metrics(self) -> Dict:
+        with self._cond:
+            stats = dict(self.stats)
+            latencies = sorted(self._latencies)
+            stats["pending"] = len(self._tracked)
+        requests = stats["get_requests"] + stats["sweep_requests"]
+        stats["requests_per_confirmed"] = requests / stats["confirmed"] if stats["confirmed"] else 0.0
+        stats["detection_p50"] = _percentile(latencies, 50)
+        stats["detection_p99"] = _percentile(latencies, 99)
+        return stats
+
+    # Scheduling
+
+    def _interval(self, tracked: _Tracked) -> float:
+        age = max(0.0, time.time() - tracked.created_at)
+        remaining = self.chain_finality.get(tracked.chain, self.default_finality) - age
+        interval = max(remaining / 2, age * self.age_factor)
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _schedule(self, tracked: _Tracked):
+        """Queue the next poll of a transfer (caller holds self._cond)"""
+        self._sequence += 1
+        heapq.heappush(self._heap, (time.monotonic() + self._interval(tracked), self._sequence,
+                                    tracked.transfer_id))
+        self._cond.notify()
+
+    def _take_due(self) -> List[_Tracked]:
+        due = []
+        horizon = time.monotonic() + self.coalesce_window
+        while self._heap and self._heap[0][0] <= horizon:
+            tracked = self._tracked.get(heapq.heappop(self._heap)[2])
+            if tracked is not None:  # Resolved early by a sweep otherwise
+                due.append(tracked)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._take_due()
+                while not due and not self._stop:
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                    due = self._take_due()
+                if self._stop:
+                    return
+                use_sweep = self.sweep and len(due) > 1 and self._sweep_pages(due) < len(due)
+            if use_sweep:
+                self._executor.submit(self._sweep, due)
+            else:
+                for tracked in due:
+                    self._executor.submit(self._poll, tracked)
+
+    def _sweep_pages(self, due: List[_Tracked]) -> int:
+        """Estimated list requests needed to cover every due transfer"""
+        oldest = min(tracked.created_at for tracked in due)
+        window = max(1.0, time.time() - oldest)
+        known = sum(1 for tracked in self._tracked.values() if tracked.created_at >= oldest)
+        estimate = max(known, (self._sweep_density or 0.0) * window)
+        return max(1, math.ceil(estimate / self.sweep_page_size))
+
+    # Polling
+
+    def _poll(self, tracked: _Tracked):
+        try:
+            transfer = self.circle_client.get_transfer_status(tracked.transfer_id)
+        except Exception as error:
+            with self._cond:
+                self.stats["get_requests"] += 1
+                self.stats["errors"] += 1
+                if getattr(getattr(error, "response", None), "status_code", None) == 404:
+                    del self._tracked[tracked.transfer_id]
+                    tracked.future.set_exception(error)
+                else:
+                    self._schedule(tracked)
+            return
+        with self._cond:
+            self.stats["get_requests"] += 1
+        self._observe([transfer.get("data", transfer)], {tracked.transfer_id})
+
+    def _sweep(self, due: List[_Tracked]):
+        oldest = min(tracked.created_at for tracked in due) - 1.0  # Allow for clock skew
+        from_date = datetime.fromtimestamp(oldest, timezone.utc).isoformat(
+            timespec="milliseconds").replace("+00:00", "Z")
+        seen = 0
+        page_after = None
+        try:
+            while True:
+                response = self.circle_client.list_transfers(from_date, None, self.sweep_page_size,
+                                                             page_after=page_after)
+                with self._cond:
+                    self.stats["sweep_requests"] += 1
+                page = response.get("data", [])
+                seen += len(page)
+                self._observe(page, set())
+                if not page:
+                    break
+                # A short page does not mean the end: Circle caps pageSize at 50
+                page_after = page[-1]["id"]
+        except Exception:
+            with self._cond:
+                self.stats["errors"] += 1
+        with self._cond:
+            self.stats["sweeps"] += 1
+            density = seen / max(1.0, time.time() - oldest)
+            self._sweep_density = density if self._sweep_density is None else \
+                0.5 * self._sweep_density + 0.5 * density
+            # Due transfers the sweep did not finish get polled again later
+            for tracked in due:
+                if self._tracked.get(tracked.transfer_id) is tracked:
+                    tracked.polls += 1
+                    self._schedule(tracked)
+
+    def _observe(self, transfers: Iterable[Dict], reschedule: Set[str]):
+        """Resolve tracked transfers that reached a final status; reschedule
+        the ones in `reschedule` that did not"""
+        resolved = []
+        updates = []
+        now = time.time()
+        with self._cond:
+            for transfer in transfers:
+                tracked = self._tracked.get(transfer.get("id"))
+                if tracked is None:
+                    continue
+                if transfer.get("status") not in FINAL_STATUSES:
+                    if tracked.transfer_id in reschedule:
+                        tracked.polls += 1
+                        self._schedule(tracked)
+                    continue
+                del self._tracked[tracked.transfer_id]
+                self.stats["confirmed"] += 1
+                updated = transfer.get("updateDate")
+                updated_us = parse_us(updated) if updated else 0
+                if updated_us:
+                    self._latencies.append(max(0.0, now - updated_us / 1e6))
+                resolved.append((tracked, transfer))
+                updates.append(StatusUpdate("transfer", tracked.transfer_id, transfer["status"], updated_us))
+        for tracked, transfer in resolved:
+            tracked.future.set_result(transfer)
+        if updates and self.listener is not None:
+            self.listener(updates)
+
+    # Lifecycle
+
+    def start(self) -> "TransferTracker":
+        """Start the scheduler thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="transfer-tracker", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop polling; pending Futures stay unresolved"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=True)
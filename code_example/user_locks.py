@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Per-user Locks
+--------------------------------------
+
+Serialises balance mutations per user without a global lock.
+
+1. user_ids are hashed (crc32, stable across processes) onto a fixed
+   number of lock shards, so memory does not grow with the user base
+2. hold(*user_ids) takes every shard involved in ascending shard order;
+   since every caller orders them the same way, a transfer from A to B and
+   one from B to A can never deadlock
+3. Locks are only held around reads and writes of the ledger, never around
+   calls to Circle (see PicPayUSDCService)
+
+Take all the users an operation needs in one hold() call: nesting hold()
+calls for different users would defeat the ordering.
+
+Usage:
+    locks = UserLocks(shards=1024)
+    with locks.hold(sender_id, recipient_id):
+        ...
+"""
+
+import zlib
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Stable shard index of a user_id"""
+    return zlib.crc32(user_id.encode()) % shards
+
+
+class UserLocks:
+    """Fixed pool of re-entrant locks addressed by user_id"""
+
+    def __init__(self, shards: int = 1024):
+        self.shards = shards
+        self._locks = [threading.RLock() for _ in range(shards)]
+
+    def _ordered(self, user_ids) -> List[threading.RLock]:
+        indexes = sorted({shard_of(user_id, self.shards) for user_id in user_ids if user_id is not None})
+        return [self._locks[index] for index in indexes]
+
+    @contextmanager
+    def hold(self, *user_ids: Optional[str]) -> Iterator[None]:
+        """Lock the given users (None entries are skipped) for the block"""
+        locks = self._ordered(user_ids)
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
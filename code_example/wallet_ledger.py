@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Wallet Ledger Backends
+----------------------------------------------
+
+Storage for user wallets and USDC balances used by PicPayUSDCService.
+
+1. InMemoryLedger: the original dict of dicts, for demos and tests
+2. SQLiteLedger: embedded SQLite in WAL mode, indexed by user_id (primary
+   key) and wallet_address, with writes committed in batches
+3. EventLogLedger (event_log.py): balances in memory, made durable by an
+   append-only event log with group commit and periodic snapshots
+
+Wallets are returned as WalletRecord objects (see records.py). Any object
+implementing WalletLedger's methods can be passed to
+PicPayUSDCService(ledger=...).
+
+Usage:
+    ledger = SQLiteLedger("wallets.db")
+    service = PicPayUSDCService(circle_client, ledger=ledger)
+"""
+
+import sqlite3
+import threading
+from typing import Dict, Optional, Union
+
+from records import WalletRecord, address_bytes
+
+
+class WalletLedger:
+    """Interface of a wallet/balance store"""
+
+    def get_wallet(self, user_id: str) -> Optional[WalletRecord]:
+        """Return the user's wallet, or None"""
+        raise NotImplementedError
+
+    def create_wallet(self, user_id: str, address: bytes, created_us: int) -> WalletRecord:
+        """Store a new wallet with a zero balance and return it; if the user
+        already has one (created by someone else since get_wallet), return
+        that one unchanged"""
+        raise NotImplementedError
+
+    def adjust_balance(self, user_id: str, delta_units: int) -> int:
+        """Add delta_units USDC micro-units (negative to debit) to a balance and
+        return the new balance in micro-units"""
+        raise NotImplementedError
+
+    def find_user_by_address(self, wallet_address: Union[str, bytes]) -> Optional[str]:
+        """Return the user owning a wallet address (raw or 0x hex), if any"""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get_wallet(user_id) is not None
+
+    def warm(self) -> int:
+        """Load what lookups read into memory ahead of the first request;
+        returns the number of wallets"""
+        return len(self)
+
+    def flush(self):
+        """Make every accepted write durable"""
+
+    def close(self):
+        """Flush and release resources"""
+        self.flush()
+
+
+class InMemoryLedger(WalletLedger):
+    """Wallets kept in a plain dict (lost on restart)"""
+
+    def __init__(self):
+        self.wallets: Dict[str, WalletRecord] = {}
+        self._by_address: Dict[bytes, str] = {}
+
+    def get_wallet(self, user_id: str) -> Optional[WalletRecord]:
+        return self.wallets.get(user_id)
+
+    def create_wallet(self, user_id: str, address: bytes, created_us: int) -> WalletRecord:
+        wallet = self.wallets.get(user_id)
+        if wallet is not None:
+            return wallet
+        wallet = WalletRecord(address, created_us)
+        self.wallets[user_id] = wallet
+        self._by_address[address] = user_id
+        return wallet
+
+    def adjust_balance(self, user_id: str, delta_units: int) -> int:
+        wallet = self.wallets[user_id]
+        wallet.balance_units += delta_units
+        return wallet.balance_units
+
+    def find_user_by_address(self, wallet_address: Union[str, bytes]) -> Optional[str]:
+        return self._by_address.get(address_bytes(wallet_address))
+
+    def __len__(self) -> int:
+        return len(self.wallets)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.wallets
+
+
+class SQLiteLedger(WalletLedger):
+    """Wallets in an embedded SQLite database (WAL mode, batched commits)
+
+    Writes are committed once batch_size of them are pending, and a
+    background thread commits whatever is pending every commit_interval
+    seconds; call flush() to force a commit. Reads on this ledger see
+    uncommitted writes; other processes see them after the commit.
+
+    Several processes can share the file. A process with pending writes
+    holds the write lock until its next commit, so the others wait up to
+    busy_timeout for it. create_wallet keeps a wallet another process
+    created first.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS wallets (
+            user_id        TEXT PRIMARY KEY,
+            wallet_address BLOB NOT NULL,
+            created_us     INTEGER NOT NULL,
+            balance_units  INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_address ON wallets (wallet_address);
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000, commit_interval: float = 0.05,
+                 busy_timeout: float = 30.0):
+        """
+        Args:
+            path: Database file (":memory:" for a throwaway database)
+            batch_size: Pending writes that trigger a commit
+            commit_interval: Maximum seconds a write may wait for its commit
+            busy_timeout: Seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._closed = threading.Event()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+        self._conn.executescript(self.SCHEMA)
+        self._flusher = threading.Thread(target=self._flush_periodically, name="ledger-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.commit_interval):
+            self.flush()
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def get_wallet(self, user_id: str) -> Optional[WalletRecord]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT wallet_address, created_us, balance_units FROM wallets WHERE user_id = ?",
+                (user_id,)).fetchone()
+        return WalletRecord(*row) if row is not None else None
+
+    def create_wallet(self, user_id: str, address: bytes, created_us: int) -> WalletRecord:
+        """Store a new wallet, or return the user's existing one unchanged
+        (another process may have created it since get_wallet)"""
+        with self._lock:
+            inserted = self._conn.execute(
+                "INSERT INTO wallets (user_id, wallet_address, created_us, balance_units) "
+                "VALUES (?, ?, ?, 0) ON CONFLICT (user_id) DO NOTHING", (user_id, address, created_us)).rowcount
+            if inserted:
+                self._wrote()
+                return WalletRecord(address, created_us)
+            row = self._conn.execute(
+                "SELECT wallet_address, created_us, balance_units FROM wallets WHERE user_id = ?",
+                (user_id,)).fetchone()
+        return WalletRecord(*row)
+
+    def adjust_balance(self, user_id: str, delta_units: int) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE wallets SET balance_units = balance_units + ? WHERE user_id = ? RETURNING balance_units",
+                (delta_units, user_id)).fetchone()
+            if row is None:
+                raise KeyError(user_id)
+            self._wrote()
+        return row[0]
+
+    def find_user_by_address(self, wallet_address: Union[str, bytes]) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT user_id FROM wallets WHERE wallet_address = ?",
+                                     (address_bytes(wallet_address),)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM wallets").fetchone()[0]
+
+    def warm(self) -> int:
+        # Reads both b-trees end to end so their pages sit in the page cache
+        with self._lock:
+            self._conn.execute("SELECT COUNT(*) FROM wallets INDEXED BY idx_wallets_address").fetchone()
+            return self._conn.execute("SELECT COUNT(*), SUM(balance_units) FROM wallets").fetchone()[0]
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._commit()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self.flush()
+            self._conn.close()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+PicPay Digital Assets - Circle Webhook Receiver
+-----------------------------------------------
+
+Receives Circle's trade, settlement and transfer notifications so the
+service learns about status changes without polling get_transfer_status.
+
+1. Every notification must carry a valid X-Circle-Signature (hex
+   HMAC-SHA256 of the raw body with the shared webhook secret). This is a
+   stand-in: Circle signs notifications with public keys (AWS SNS message
+   signatures, or ECDSA under X-Circle-Key-Id on its newer APIs), so in
+   production verify_signature must check that scheme, or an authenticating
+   proxy in front of the receiver must add the HMAC
+2. Circle may deliver a notification more than once; duplicates are
+   recognised by notification id and acknowledged without being reapplied
+3. Accepted notifications are applied to PicPayUSDCService in batches (at
+   most batch_size, or whatever arrived within batch_interval). Each request
+   is answered once its batch has been applied, so a 200 means the change is
+   in the service's state, and a failed batch answers 500 so Circle retries
+
+The server is plain asyncio HTTP/1.1 with keep-alive; batches are applied on
+a single worker thread so the event loop keeps accepting requests meanwhile.
+
+Usage:
+    receiver = WebhookReceiver(service, WEBHOOK_SECRET, port=8443)
+    receiver.start_in_thread()
+"""
+
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from records import parse_us
+
+SIGNATURE_HEADER = "X-Circle-Signature"
+
+# notificationType -> (key of the entity in the payload, transaction kind)
+NOTIFICATION_ENTITIES = {
+    "transfers": ("transfer", "transfer"),
+    "trades": ("trade", "trade"),
+    "fxSettlement": ("fxSettlement", "settlement"),
+}
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class StatusUpdate(NamedTuple):
+    """A status change carried by a notification"""
+    kind: str
+    transaction_id: str
+    status: str
+    updated_us: int  # updateDate as epoch microseconds (0 if missing)
+    client_id: Optional[str] = None  # customAttributes.clientId, if set
+
+
+def sign(secret: Union[str, bytes], body: bytes) -> str:
+    """Signature Circle sends in X-Circle-Signature for a raw body"""
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: Union[str, bytes], body: bytes, signature: Optional[str]) -> bool:
+    return bool(signature) and hmac.compare_digest(sign(secret, body), signature)
+
+
+def parse_notification(notification: Dict) -> Optional[StatusUpdate]:
+    """Extract the status change from a notification; None if it carries none"""
+    entity_key, kind = NOTIFICATION_ENTITIES.get(notification.get("notificationType"), (None, None))
+    entity = notification.get(entity_key) if entity_key else None
+    if not isinstance(entity, dict) or not entity.get("id") or not entity.get("status"):
+        return None
+    updated = entity.get("updateDate") or entity.get("createDate")
+    client_id = (notification.get("customAttributes") or {}).get("clientId")
+    return StatusUpdate(kind, entity["id"], entity["status"], parse_us(updated) if updated else 0, client_id)
+
+
+def notification_id(notification: Dict, update: StatusUpdate) -> str:
+    """Dedupe key: the notification's own id, or else entity, status and
+    updateDate (a redelivered notification repeats all three)"""
+    explicit = notification.get("notificationId")
+    if explicit:
+        return str(explicit)
+    return f"{update.kind}:{update.transaction_id}:{update.status}:{update.updated_us}"
+
+
+class WebhookReceiver:
+    """Signature-checking, deduplicating, batching webhook endpoint"""
+
+    def __init__(self, service, secret: Union[str, bytes],
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 path: str = "/webhooks/circle",
+                 batch_size: int = 1000,
+                 batch_interval: float = 0.005,
+                 dedupe_size: int = 1_000_000,
+                 max_body_bytes: int = 1 << 20):
+        """
+        Args:
+            service: PicPayUSDCService (or anything with apply_status_updates)
+            secret: Shared webhook secret used for X-Circle-Signature
+            host: Interface to listen on
+            port: Port to listen on (0 picks a free port)
+            path: URL path Circle posts notifications to
+            batch_size: Notifications that trigger an immediate batch
+            batch_interval: Maximum seconds a notification waits for its batch
+            dedupe_size: Notification ids remembered for deduplication
+            max_body_bytes: Largest request body accepted; bigger ones get 413
+        """
+        self.service = service
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.host = host
+        self.port = port
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.dedupe_size = dedupe_size
+        self.max_body_bytes = max_body_bytes
+        self.stats = {"received": 0, "applied": 0, "duplicates": 0, "rejected": 0,
+                      "ignored": 0, "batches": 0, "errors": 0}
+
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._batch: List[Tuple[str, StatusUpdate]] = []
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-apply")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._process: Optional[multiprocessing.Process] = None
+        self._control = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}{self.path}"
+
+    # Notifications
+
+    async def receive(self, body: bytes, signature: Optional[str]) -> Tuple[int, Dict]:
+        """Handle one notification; returns the HTTP status and JSON body"""
+        self.stats["received"] += 1
+        if not verify_signature(self.secret, body, signature):
+            self.stats["rejected"] += 1
+            return 401, {"message": "Invalid signature"}
+        try:
+            notification = json.loads(body)
+            update = parse_notification(notification)
+        except (ValueError, TypeError, AttributeError):
+            self.stats["rejected"] += 1
+            return 400, {"message": "Invalid notification"}
+        if update is None:
+            # Acknowledge types we do not track so Circle stops resending them
+            self.stats["ignored"] += 1
+            return 200, {"status": "ignored"}
+
+        key = notification_id(notification, update)
+        if key in self._seen:
+            self.stats["duplicates"] += 1
+            return 200, {"status": "duplicate"}
+        future = self._pending.get(key)
+        if future is None:
+            future = self._enqueue(key, update)
+        else:
+            self.stats["duplicates"] += 1
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            return 500, {"message": "Notification could not be applied"}
+        return 200, {"status": "applied"}
+
+    def _enqueue(self, key: str, update: StatusUpdate) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        self._batch.append((key, update))
+        if len(self._batch) >= self.batch_size:
+            self._batch_ready.set()
+        elif len(self._batch) == 1:
+            self._batch_timer = asyncio.get_running_loop().call_later(self.batch_interval, self._batch_ready.set)
+        return future
+
+    async def _flush_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._batch_ready.wait()
+            self._batch_ready.clear()
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            batch, self._batch = self._batch, []
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(self._executor, self.service.apply_status_updates,
+                                           [update for _, update in batch])
+            except Exception as error:
+                # Not remembered as seen, so Circle's retry is applied later
+                self.stats["errors"] += len(batch)
+                for key, _ in batch:
+                    self._pending.pop(key).set_exception(error)
+                continue
+            self.stats["batches"] += 1
+            self.stats["applied"] += len(batch)
+            for key, _ in batch:
+                self._remember(key)
+                self._pending.pop(key).set_result(None)
+
+    def _remember(self, key: str):
+        self._seen[key] = None
+        if len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+
+    # HTTP/1.1 transport
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    # The body cannot be framed, so the connection cannot be reused
+                    self._respond(writer, 400, {"message": "Malformed request"}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if length > self.max_body_bytes:
+                    self._respond(writer, 413, {"message": "Payload too large"}, keep_alive=False)
+                    await writer.drain()
+                    break
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                if target.partition("?")[0] != self.path:
+                    status, response = 404, {"message": "Not found"}
+                elif method != "POST":
+                    status, response = 405, {"message": "Method not allowed"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, response = await self.receive(body, headers.get(SIGNATURE_HEADER.lower()))
+                if status in (404, 405) and length:
+                    # The unread body is still on the socket; close rather than drain it
+                    keep_alive = False
+
+                self._respond(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: int, response: Dict, keep_alive: bool):
+        payload = json.dumps(response).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+        )
+
+    async def start(self):
+        """Start listening on the running event loop"""
+        self._batch_ready = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_batches())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting notifications, apply the pending batch and close the server"""
+        if self._server is not None:
+            self._server.close()
+            # Includes a batch the flusher has already taken and is applying
+            if self._pending:
+                self._batch_ready.set()
+                await asyncio.gather(*self._pending.values(), return_exceptions=True)
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    def start_in_thread(self) -> str:
+        """Run the receiver on its own event loop thread and return its URL"""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="webhook-receiver", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.url
+
+    def stop_thread(self):
+        """Stop a receiver started with start_in_thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def start_in_process(self) -> str:
+        """Run the receiver (and its service) in a child process and return its URL"""
+        self._control, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_in_child, args=(self, child_conn),
+                                                name="webhook-receiver", daemon=True)
+        self._process.start()
+        self.port = self._control.recv()
+        return self.url
+
+    def stop_process(self) -> Dict:
+        """Stop a receiver started with start_in_process and return its final
+        stats, plus the child's CPU seconds under "cpu_seconds" """
+        stats = {}
+        if self._process is not None:
+            self._control.send("stop")
+            stats = self._control.recv()
+            self._process.join()
+            self._process = None
+        return stats
+
+
+def _serve_in_child(receiver: WebhookReceiver, conn):
+    async def serve():
+        await receiver.start()
+        conn.send(receiver.port)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        await receiver.stop()
+        times = os.times()
+        conn.send(dict(receiver.stats, cpu_seconds=times.user + times.system))
+
+    asyncio.run(serve())